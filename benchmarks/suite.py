@@ -0,0 +1,513 @@
+"""
+End-to-end benchmark suite.
+
+Every benchmark runs in-process against FakeRedis, the fake AMQP broker and
+the fake SMSC used by the tests, so the results only depend on the vumi code
+and the machine the suite is run on.
+
+Run the whole suite and write the results to a file::
+
+    python benchmarks/suite.py --output results.json
+
+Compare a run against stored results (the exit status is non-zero if any
+benchmark is slower than the baseline by more than the tolerance)::
+
+    python benchmarks/suite.py --baseline results.json --tolerance 0.2
+
+Baselines are only meaningful on the machine they were recorded on.
+"""
+
+import json
+import platform
+import sys
+import time
+from datetime import datetime
+
+from twisted.internet import task
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, gatherResults)
+from twisted.python import usage
+
+from vumi.dispatchers.base import BaseDispatchWorker
+from vumi.dispatchers.tests.helpers import DispatcherHelper
+from vumi.message import TransportUserMessage
+from vumi.middleware.base import MiddlewareStack, setup_middlewares_from_config
+from vumi.tests.helpers import MessageHelper, PersistenceHelper
+from vumi.transports.httprpc import HttpRpcTransport
+from vumi.transports.smpp.smpp_transport import SmppTransceiverTransport
+from vumi.transports.smpp.tests.fake_smsc import FakeSMSC
+from vumi.transports.tests.helpers import TransportHelper
+from vumi.utils import http_request_full
+
+
+class Benchmark(object):
+    """
+    Base class for benchmarks.
+
+    :meth:`run` performs :attr:`operations` operations and may return a
+    deferred. If it returns a list of per-operation latencies (in seconds),
+    these are summarised in the results too.
+    """
+
+    name = None
+    description = None
+    requires_riak = False
+
+    def __init__(self, operations):
+        self.operations = operations
+        self.msg_helper = MessageHelper()
+
+    def setup(self):
+        pass
+
+    def run(self):
+        raise NotImplementedError("Sub-classes of Benchmark should implement"
+                                  " .run()")
+
+    def cleanup(self):
+        pass
+
+
+class MessageEncodeBenchmark(Benchmark):
+    name = "message_encode"
+    description = "Encode messages to JSON."
+
+    def setup(self):
+        self.msgs = [self.msg_helper.make_inbound("hello %d" % (i,))
+                     for i in range(self.operations)]
+
+    def run(self):
+        for msg in self.msgs:
+            msg.to_json()
+
+
+class MessageDecodeBenchmark(Benchmark):
+    name = "message_decode"
+    description = "Decode messages from JSON."
+
+    def setup(self):
+        self.msgs = [self.msg_helper.make_inbound("hello %d" % (i,)).to_json()
+                     for i in range(self.operations)]
+
+    def run(self):
+        for msg in self.msgs:
+            TransportUserMessage.from_json(msg)
+
+
+class MiddlewareStackBenchmark(Benchmark):
+    name = "middleware_stack"
+    description = "Pass inbound and outbound messages through a stack of" \
+                  " three transport middlewares."
+
+    MIDDLEWARE_CONFIG = {
+        "middleware": [
+            {"address_translator": "vumi.middleware.address_translator"
+                                   ".AddressTranslationMiddleware"},
+            {"provider_setter": "vumi.middleware.provider_setter"
+                                ".StaticProviderSettingMiddleware"},
+            {"tagger": "vumi.middleware.tagger.TaggingMiddleware"},
+        ],
+        "address_translator": {
+            "outbound_map": {"+27831234567": "+27837654321"},
+        },
+        "provider_setter": {
+            "provider": "bench",
+        },
+        "tagger": {
+            "incoming": {
+                "addr_pattern": r"^\d+(\d{3})$",
+                "tagpool_template": r"pool",
+                "tagname_template": r"tag-\1",
+            },
+            "outgoing": {
+                "tagname_pattern": r"tag-(\d{3})$",
+                "msg_template": {"from_addr": r"1234\1"},
+            },
+        },
+    }
+
+    @inlineCallbacks
+    def setup(self):
+        middlewares = yield setup_middlewares_from_config(
+            None, self.MIDDLEWARE_CONFIG)
+        self.stack = MiddlewareStack(middlewares)
+        self.inbound = [
+            self.msg_helper.make_inbound("in %d" % (i,), to_addr="12345")
+            for i in range(self.operations // 2)]
+        self.outbound = [
+            self.msg_helper.make_outbound("out %d" % (i,))
+            for i in range(self.operations - len(self.inbound))]
+
+    @inlineCallbacks
+    def run(self):
+        for msg in self.inbound:
+            yield self.stack.apply_consume("inbound", msg, "bench")
+        for msg in self.outbound:
+            yield self.stack.apply_publish("outbound", msg, "bench")
+
+    def cleanup(self):
+        return self.stack.teardown()
+
+
+class DispatcherRoutingBenchmark(Benchmark):
+    name = "dispatcher_routing"
+    description = "Route inbound messages through a dispatcher with a" \
+                  " ToAddrRouter over the fake AMQP broker."
+
+    @inlineCallbacks
+    def setup(self):
+        self.disp_helper = DispatcherHelper(BaseDispatchWorker)
+        self.disp_helper.setup()
+        yield self.disp_helper.get_dispatcher({
+            "transport_names": ["transport"],
+            "exposed_names": ["app1", "app2"],
+            "router_class": "vumi.dispatchers.base.ToAddrRouter",
+            "toaddr_mappings": {
+                "app1": r"^1\d+$",
+                "app2": r"^2\d+$",
+            },
+        })
+        self.transport = self.disp_helper.get_connector_helper("transport")
+        self.apps = [self.disp_helper.get_connector_helper(name)
+                     for name in ("app1", "app2")]
+        self.msgs = [
+            self.msg_helper.make_inbound(
+                "hello", to_addr="%d%04d" % (i % 2 + 1, i),
+                transport_name="transport")
+            for i in range(self.operations)]
+
+    @inlineCallbacks
+    def run(self):
+        for msg in self.msgs:
+            self.transport.dispatch_inbound(msg)
+        # Messages alternate between the two apps, starting with app1.
+        app1, app2 = self.apps
+        yield app1.wait_for_dispatched_inbound((self.operations + 1) // 2)
+        yield app2.wait_for_dispatched_inbound(self.operations // 2)
+
+    def cleanup(self):
+        return self.disp_helper.cleanup()
+
+
+class SmppBenchmark(Benchmark):
+    """
+    Base class for SMPP benchmarks. This sets up a transceiver bound to a
+    fake SMSC.
+    """
+
+    @inlineCallbacks
+    def setup(self):
+        self.fake_smsc = FakeSMSC()
+        self.tx_helper = TransportHelper(SmppTransceiverTransport)
+        self.tx_helper.setup()
+        self.transport = yield self.tx_helper.get_transport({
+            'twisted_endpoint': self.fake_smsc.endpoint,
+            'system_id': 'foo',
+            'password': 'bar',
+            'delivery_report_processor': (
+                'vumi.transports.smpp.processors.DeliveryReportProcessor'),
+            'deliver_short_message_processor': (
+                'vumi.transports.smpp.processors.'
+                'DeliverShortMessageProcessor'),
+        })
+        yield self.fake_smsc.bind()
+        self.msgs = [self.tx_helper.make_outbound("hello %d" % (i,))
+                     for i in range(self.operations)]
+
+    @inlineCallbacks
+    def submit(self):
+        for msg in self.msgs:
+            self.tx_helper.dispatch_outbound(msg)
+        for i in range(self.operations):
+            yield self.fake_smsc.submit_sm_resp(message_id="remote%d" % (i,))
+        yield self.tx_helper.wait_for_dispatched_events(self.operations)
+
+    def cleanup(self):
+        return self.tx_helper.cleanup()
+
+
+class SmppSubmitBenchmark(SmppBenchmark):
+    name = "smpp_submit"
+    description = "Submit messages over a single SMPP bind and process the" \
+                  " submit_sm_resp PDUs."
+
+    def run(self):
+        return self.submit()
+
+
+class SmppDeliveryReportBenchmark(SmppBenchmark):
+    name = "smpp_dlr"
+    description = "Process delivery reports over a single SMPP bind."
+
+    DR_TEMPLATE = ("id:%s sub:... dlvrd:... submit date:200101010030"
+                   " done date:200101020030 stat:DELIVRD err:... text:Meep")
+
+    @inlineCallbacks
+    def setup(self):
+        yield super(SmppDeliveryReportBenchmark, self).setup()
+        yield self.submit()
+        self.tx_helper.clear_dispatched_events()
+
+    @inlineCallbacks
+    def run(self):
+        for i in range(self.operations):
+            self.fake_smsc.send_mo(
+                sequence_number=i + 1,
+                short_message=self.DR_TEMPLATE % ("remote%d" % (i,),),
+                source_addr='123', destination_addr='456', esm_class=4)
+        yield self.tx_helper.wait_for_dispatched_events(self.operations)
+
+
+class ReplyingHttpRpcTransport(HttpRpcTransport):
+
+    def handle_raw_inbound_message(self, msgid, request):
+        self.publish_message(
+            message_id=msgid,
+            content=request.content.read(),
+            to_addr='to_addr',
+            from_addr='from_addr',
+            provider='',
+            session_event=TransportUserMessage.SESSION_NEW,
+            transport_name=self.transport_name,
+            transport_type='http_api',
+            transport_metadata={},
+        )
+
+
+class HttpRpcLatencyBenchmark(Benchmark):
+    name = "httprpc_latency"
+    description = "Make HTTP requests to an HttpRpcTransport and reply to" \
+                  " them over the fake AMQP broker, one at a time."
+
+    @inlineCallbacks
+    def setup(self):
+        self.tx_helper = TransportHelper(ReplyingHttpRpcTransport)
+        self.tx_helper.setup()
+        transport = yield self.tx_helper.get_transport({
+            'web_path': "bench",
+            'web_port': 0,
+        })
+        self.url = transport.get_transport_url("bench")
+
+    @inlineCallbacks
+    def run(self):
+        latencies = []
+        for i in range(self.operations):
+            start = time.time()
+            d = http_request_full(self.url, "ping", method='POST')
+            [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+            self.tx_helper.clear_dispatched_inbound()
+            yield self.tx_helper.make_dispatch_reply(msg, "pong")
+            yield d
+            latencies.append(time.time() - start)
+        self.tx_helper.clear_dispatched_events()
+        returnValue(latencies)
+
+    def cleanup(self):
+        return self.tx_helper.cleanup()
+
+
+class MessageStoreWriteBenchmark(Benchmark):
+    name = "message_store_write"
+    description = "Add outbound messages to a batch in the MessageStore."
+    requires_riak = True
+
+    @inlineCallbacks
+    def setup(self):
+        from vumi.components.message_store import MessageStore
+        self.persistence_helper = PersistenceHelper(use_riak=True)
+        self.persistence_helper.setup()
+        riak = yield self.persistence_helper.get_riak_manager()
+        redis = yield self.persistence_helper.get_redis_manager()
+        self.store = MessageStore(riak, redis)
+        self.batch_id = yield self.store.batch_start([])
+        self.msgs = [self.msg_helper.make_outbound("hello %d" % (i,))
+                     for i in range(self.operations)]
+
+    def run(self):
+        return gatherResults([
+            self.store.add_outbound_message(msg, batch_id=self.batch_id)
+            for msg in self.msgs])
+
+    def cleanup(self):
+        return self.persistence_helper.cleanup()
+
+
+BENCHMARKS = [
+    (MessageEncodeBenchmark, 10000),
+    (MessageDecodeBenchmark, 10000),
+    (MiddlewareStackBenchmark, 5000),
+    (DispatcherRoutingBenchmark, 2000),
+    (SmppSubmitBenchmark, 1000),
+    (SmppDeliveryReportBenchmark, 1000),
+    (HttpRpcLatencyBenchmark, 200),
+    (MessageStoreWriteBenchmark, 200),
+]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+@inlineCallbacks
+def run_benchmark(benchmark_class, operations, repeat):
+    """
+    Run a benchmark ``repeat`` times and return a dict of results for the
+    fastest run.
+    """
+    runs = []
+    for _ in range(repeat):
+        benchmark = benchmark_class(operations)
+        yield maybeDeferred(benchmark.setup)
+        try:
+            start = time.time()
+            latencies = yield maybeDeferred(benchmark.run)
+            runs.append((time.time() - start, latencies))
+        finally:
+            yield maybeDeferred(benchmark.cleanup)
+
+    seconds, latencies = min(runs)
+    result = {
+        "operations": operations,
+        "seconds": seconds,
+        "ops_per_sec": operations / seconds,
+    }
+    if latencies:
+        result.update({
+            "latency_mean": sum(latencies) / len(latencies),
+            "latency_p95": percentile(latencies, 0.95),
+            "latency_max": max(latencies),
+        })
+    returnValue(result)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results with a baseline and return a list of
+    ``(name, ratio, regressed)`` tuples, where ``ratio`` is the ratio of the
+    current throughput to the baseline throughput.
+    """
+    comparisons = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = result["ops_per_sec"] / baseline[name]["ops_per_sec"]
+        comparisons.append((name, ratio, ratio < 1 - tolerance))
+    return comparisons
+
+
+class Options(usage.Options):
+
+    optFlags = [
+        ["riak", None, "Run benchmarks that need a Riak server."],
+        ["list", "l", "List the available benchmarks."],
+    ]
+
+    optParameters = [
+        ["output", "o", None, "Write the results to this file as JSON."],
+        ["baseline", "b", None,
+         "Compare the results with those stored in this file."],
+        ["tolerance", "t", 0.2,
+         "The fraction of throughput a benchmark may lose relative to the"
+         " baseline before it counts as a regression.", float],
+        ["repeat", "r", 3,
+         "Run each benchmark this many times and keep the fastest run.",
+         int],
+        ["scale", "s", 1.0,
+         "Multiply the number of operations of each benchmark by this.",
+         float],
+    ]
+
+    def __init__(self):
+        usage.Options.__init__(self)
+        self['benchmarks'] = []
+
+    def opt_benchmark(self, name):
+        """Only run this benchmark (may be given more than once)."""
+        self['benchmarks'].append(name)
+
+    opt_B = opt_benchmark
+
+
+class BenchmarkRunner(object):
+
+    def __init__(self, options):
+        self.options = options
+
+    def emit(self, s):
+        print s
+
+    def selected_benchmarks(self):
+        names = self.options['benchmarks']
+        for benchmark_class, operations in BENCHMARKS:
+            if names and benchmark_class.name not in names:
+                continue
+            if benchmark_class.requires_riak and not self.options['riak']:
+                self.emit("Skipping %s (needs --riak)." % (
+                    benchmark_class.name,))
+                continue
+            yield benchmark_class, max(
+                1, int(operations * self.options['scale']))
+
+    @inlineCallbacks
+    def run(self):
+        if self.options['list']:
+            for benchmark_class, _ in BENCHMARKS:
+                self.emit("%s: %s" % (
+                    benchmark_class.name, benchmark_class.description))
+            returnValue(0)
+
+        results = {}
+        for benchmark_class, operations in self.selected_benchmarks():
+            result = yield run_benchmark(
+                benchmark_class, operations, self.options['repeat'])
+            results[benchmark_class.name] = result
+            line = "%-24s %10.1f ops/s" % (
+                benchmark_class.name, result["ops_per_sec"])
+            if "latency_mean" in result:
+                line += "  (mean %.2f ms, p95 %.2f ms)" % (
+                    result["latency_mean"] * 1000,
+                    result["latency_p95"] * 1000)
+            self.emit(line)
+
+        if self.options['output'] is not None:
+            with open(self.options['output'], "wb") as output:
+                json.dump({
+                    "timestamp": datetime.utcnow().isoformat(),
+                    "python": sys.version,
+                    "platform": platform.platform(),
+                    "results": results,
+                }, output, indent=2, sort_keys=True)
+
+        if self.options['baseline'] is None:
+            returnValue(0)
+
+        with open(self.options['baseline'], "rb") as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        regressions = 0
+        self.emit("")
+        self.emit("Compared with %s:" % (self.options['baseline'],))
+        for name, ratio, regressed in compare(
+                results, baseline, self.options['tolerance']):
+            self.emit("%-24s %+6.1f%%%s" % (
+                name, (ratio - 1) * 100, "  REGRESSION" if regressed else ""))
+            regressions += regressed
+        returnValue(1 if regressions else 0)
+
+
+@inlineCallbacks
+def main(reactor, *argv):
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        raise SystemExit(1)
+    status = yield BenchmarkRunner(options).run()
+    raise SystemExit(status)
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
@@ -32,6 +32,8 @@ setup(
         'vumi/scripts/vumi_model_migrator.py',
         'vumi/scripts/vumi_count_models.py',
         'vumi/scripts/vumi_list_messages.py',
+        'vumi/scripts/vumi_export_messages.py',
+        'vumi/scripts/vumi_failures.py',
     ],
     install_requires=[
         cryptography,  # See above for pypy-version-dependent requirement.
@@ -1203,10 +1203,15 @@ class Sandbox(ApplicationWorker):
         self.resources = self.create_sandbox_resources(config.sandbox)
         self.resources.validate_config()
 
-    def get_config(self, msg):
+    def get_config_cache_key(self, msg, ctxt=None):
+        if ctxt is not None:
+            return None
+        return (self.sandbox_id_for_message(msg),)
+
+    def build_config(self, msg, ctxt=None):
         config = self.config.copy()
         config['sandbox_id'] = self.sandbox_id_for_message(msg)
-        return succeed(self.CONFIG_CLASS(config))
+        return self.CONFIG_CLASS(config)
 
     def _convert_rlimits(self, rlimits_config):
         rlimits = dict((getattr(resource, key, key), value) for key, value in
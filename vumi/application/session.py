@@ -7,6 +7,8 @@ import time
 
 from twisted.internet import task
 
+from vumi.components.session import write_session
+
 
 class SessionManager(object):
     """A manager for sessions.
@@ -50,14 +52,14 @@ class SessionManager(object):
         skey = self.r_key('active_sessions')
         sessions_to_expire = []
         for user_id in self.r_server.smembers(skey):
-            ukey = self.r_key('session', user_id)
-            if self.r_server.exists(ukey):
-                yield user_id, self.load_session(user_id)
+            session = self.load_session(user_id)
+            if session:
+                yield user_id, session
             else:
                 sessions_to_expire.append(user_id)
 
         # clear empty ones
-        for user_ids in sessions_to_expire:
+        for user_id in sessions_to_expire:
             self.r_server.srem(skey, user_id)
 
     def r_key(self, *args):
@@ -97,10 +99,8 @@ class SessionManager(object):
             'created_at': time.time()
         }
         defaults.update(kwargs)
-        self.save_session(user_id, defaults)
-        if self.max_session_length:
-            self.schedule_session_expiry(user_id, self.max_session_length)
-        return self.load_session(user_id)
+        return self._write_session(
+            user_id, defaults, expiry=self.max_session_length)
 
     def clear_session(self, user_id):
         ukey = self.r_key('session', user_id)
@@ -118,10 +118,26 @@ class SessionManager(object):
             The session info, nested dictionaries are not supported. Any
             values that are dictionaries are converted to strings by Redis.
 
+        """
+        self._write_session(user_id, session)
+        return session
+
+    def _write_session(self, user_id, session, expiry=None):
+        """
+        Write session fields, add the user to the active sessions and return
+        the stored session. Redis managers with script support do this in a
+        single round trip, plain Redis clients fall back to a command per
+        field.
         """
         ukey = self.r_key('session', user_id)
+        skey = self.r_key('active_sessions')
+        if hasattr(self.r_server, 'run_script'):
+            return write_session(
+                self.r_server, ukey, session, expiry=expiry,
+                index_key=skey, member=user_id)
         for s_key, s_value in session.items():
             self.r_server.hset(ukey, s_key, s_value)
-        skey = self.r_key('active_sessions')
         self.r_server.sadd(skey, user_id)
-        return session
+        if expiry:
+            self.schedule_session_expiry(user_id, expiry)
+        return self.load_session(user_id)
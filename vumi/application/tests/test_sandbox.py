@@ -85,6 +85,13 @@ class TestSandbox(SandboxTestCaseBase):
             sys.executable, ['-c', python_code],
             extra_config=extra_config)
 
+    @inlineCallbacks
+    def test_get_config_cache_key(self):
+        app = yield self.setup_app("pass")
+        msg = self.app_helper.make_inbound("foo", sandbox_id="sandbox1")
+        self.assertEqual(app.get_config_cache_key(msg), ("sandbox1",))
+        self.assertEqual(app.get_config_cache_key(msg, ctxt=object()), None)
+
     @inlineCallbacks
     def test_bad_command_from_sandbox(self):
         app = yield self.setup_app(
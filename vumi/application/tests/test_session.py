@@ -42,6 +42,20 @@ class TestSessionManager(VumiTestCase):
         loaded = self.sm.load_session("u1")
         self.assertEqual(loaded, session)
 
+    def test_create_session_expiry(self):
+        self.sm.max_session_length = 60.0
+        self.sm.create_session("u1")
+        ttl = self.fake_redis.ttl("test:session:u1")
+        self.assertTrue(0 < ttl <= 60)
+
+    def test_active_sessions_clears_expired(self):
+        self.sm.create_session("u1")
+        self.sm.create_session("u2")
+        self.fake_redis.delete("test:session:u1")
+        self.assertEqual([s[0] for s in self.sm.active_sessions()], ["u2"])
+        self.assertEqual(
+            self.fake_redis.smembers("test:active_sessions"), set(["u2"]))
+
     def test_save_session(self):
         test_session = {"foo": 5, "bar": "baz"}
         self.sm.create_session("u1")
@@ -55,3 +69,23 @@ class TestSessionManager(VumiTestCase):
     def test_lazy_clearing(self):
         self.sm.save_session('user_id', {})
         self.assertEqual(list(self.sm.active_sessions()), [])
+
+
+class PlainRedis(object):
+    """A Redis client without script support."""
+
+    def __init__(self, r_server):
+        self._r_server = r_server
+
+    def __getattr__(self, name):
+        if name == 'run_script':
+            raise AttributeError(name)
+        return getattr(self._r_server, name)
+
+
+class TestSessionManagerPlainClient(TestSessionManager):
+    def setUp(self):
+        self.fake_redis = FakeRedis()
+        self.add_cleanup(self.fake_redis.teardown)
+        self.sm = SessionManager(PlainRedis(self.fake_redis), prefix="test")
+        self.add_cleanup(self.sm.stop)
@@ -61,17 +61,26 @@ class Worker(object):
         self.worker_id = generate_worker_id(system_id, worker_name)
         self._instances = set()
         self._instances_active = set()
+        # Per-host instance counts and stats are kept up to date as
+        # heartbeats arrive rather than being rebuilt from the instance
+        # sets every period.
+        self._host_counts = {}
+        self._host_counts_active = {}
+        self._host_stats = {}
+        self._host_stats_active = {}
         self.procs_count = 0
 
     def to_dict(self):
         """Serializes information into basic dicts"""
-        counts = self._compute_host_info(self._instances)
         hosts = []
-        for host, count in counts.iteritems():
-            hosts.append({
-                    'host': host,
-                    'proc_count': count,
-            })
+        for host, count in self._host_counts.iteritems():
+            host_info = {
+                'host': host,
+                'proc_count': count,
+            }
+            if host in self._host_stats:
+                host_info['stats'] = self._host_stats[host]
+            hosts.append(host_info)
         obj = {
             'id': self.worker_id,
             'name': self.name,
@@ -81,32 +90,36 @@ class Worker(object):
         }
         return obj
 
-    def _compute_host_info(self, instances):
-        """Compute the number of worker instances running on each host."""
-        counts = {}
-        # initialize per-host counters
-        for ins in instances:
-            counts[ins.hostname] = 0
-        # update counters for each instance
-        for ins in instances:
-            counts[ins.hostname] = counts[ins.hostname] + 1
-        return counts
-
-    @inlineCallbacks
-    def audit(self, storage):
+    def check(self):
         """
         Verify whether enough workers checked in.
         Make sure to call snapshot() before running this method
+
+        Returns an ``(issue, cleared)`` pair. ``issue`` is a
+        :class:`WorkerIssue` to open or update (or ``None``) and ``cleared``
+        is ``True`` if a previously opened issue should be deleted.
         """
         count = len(self._instances)
         # if there was previously a min-procs-fail, but now enough
         # instances checked in, then clear the worker issue
-        if (count >= self.min_procs) and (self.procs_count < self.min_procs):
-            yield storage.delete_worker_issue(self.worker_id)
+        cleared = (count >= self.min_procs and
+                   self.procs_count < self.min_procs)
+        issue = None
         if count < self.min_procs:
             issue = WorkerIssue("min-procs-fail", time.time(), count)
-            yield storage.open_or_update_issue(self.worker_id, issue)
         self.procs_count = count
+        return issue, cleared
+
+    def audit(self, storage):
+        """
+        Verify whether enough workers checked in and update this worker's
+        issue in storage.
+        Make sure to call snapshot() before running this method
+        """
+        issue, cleared = self.check()
+        opened = {self.worker_id: issue} if issue is not None else {}
+        closed = [self.worker_id] if cleared else []
+        return storage.update_issues(opened, closed)
 
     def snapshot(self):
         """
@@ -120,10 +133,31 @@ class Worker(object):
         """
         self._instances = self._instances_active
         self._instances_active = set()
+        self._host_counts = self._host_counts_active
+        self._host_counts_active = {}
+        self._host_stats = self._host_stats_active
+        self._host_stats_active = {}
 
-    def record(self, hostname, pid):
-        """Record that process (hostname,pid) checked in."""
-        self._instances_active.add(WorkerInstance(hostname, pid))
+    def record(self, hostname, pid, stats=None):
+        """
+        Record that process (hostname,pid) checked in, along with the
+        performance stats from its heartbeat, if there are any.
+
+        For each host, the highest value of each stat reported during the
+        interval is kept.
+        """
+        instance = WorkerInstance(hostname, pid)
+        if instance not in self._instances_active:
+            self._instances_active.add(instance)
+            self._host_counts_active[hostname] = (
+                self._host_counts_active.get(hostname, 0) + 1)
+        if stats:
+            merged = self._host_stats_active.setdefault(hostname, {})
+            for name, value in stats.iteritems():
+                if value is None:
+                    continue
+                if merged.get(name) is None or value > merged[name]:
+                    merged[name] = value
 
 
 class System(object):
@@ -160,6 +194,10 @@ class HeartBeatMonitor(BaseWorker):
         monitored_systems = ConfigDict(
             "Tree of systems and workers.",
             required=True, static=True)
+        audit_batch_size = ConfigInt(
+            "The number of workers whose audit results are written to Redis"
+            " in a single pipeline.",
+            default=100, static=True)
 
     _task = None
 
@@ -169,6 +207,7 @@ class HeartBeatMonitor(BaseWorker):
         config = self.get_static_config()
 
         self.deadline = config.deadline
+        self.audit_batch_size = config.audit_batch_size
 
         redis_config = config.redis_manager
         self._redis = yield TxRedisManager.from_config(redis_config)
@@ -239,19 +278,14 @@ class HeartBeatMonitor(BaseWorker):
             log.msg("Discarding heartbeat from '%s'. Too old" % worker_id)
             return
 
-        wkr.record(hostname, pid)
+        wkr.record(hostname, pid, msg.get('stats'))
 
     @inlineCallbacks
     def _sync_to_storage(self):
         """
         Write systems data to storage
         """
-        # write system ids
-        system_ids = [sys.system_id for sys in self._systems]
-        yield self._storage.add_system_ids(system_ids)
-        # dump each system
-        for sys in self._systems:
-            yield self._storage.write_system(sys)
+        yield self._storage.write_systems(self._systems)
 
     @inlineCallbacks
     def _periodic_task(self):
@@ -262,12 +296,21 @@ class HeartBeatMonitor(BaseWorker):
         We call snapshot() first, since the execution of tasks here is
         interleaved with the processing of worker heartbeat messages.
         """
+        workers = self._workers.values()
         # snapshot the the set of checked-in instances
-        for wkr in self._workers.values():
+        for wkr in workers:
             wkr.snapshot()
-        # run diagnostic audits on all workers
-        for wkr in self._workers.values():
-            yield wkr.audit(self._storage)
+        # run diagnostic audits on all workers, writing the results for
+        # each batch of workers in one go
+        for i in xrange(0, len(workers), self.audit_batch_size):
+            opened, closed = {}, []
+            for wkr in workers[i:i + self.audit_batch_size]:
+                issue, cleared = wkr.check()
+                if issue is not None:
+                    opened[wkr.worker_id] = issue
+                if cleared:
+                    closed.append(wkr.worker_id)
+            yield self._storage.update_issues(opened, closed)
         # write everything to redis
         yield self._sync_to_storage()
 
@@ -280,5 +323,5 @@ class HeartBeatMonitor(BaseWorker):
         self._task_done.addErrback(errfn)
 
     def _consume_message(self, msg):
-        log.msg("Received message: %s" % msg)
+        log.debug("Received message: %s" % msg)
         self.update(msg.payload)
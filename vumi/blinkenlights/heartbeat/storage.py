@@ -45,6 +45,20 @@ class Storage(object):
         key = system_key(sys.system_id)
         yield self._redis.set(key, sys.dumps())
 
+    @Manager.calls_manager
+    def write_systems(self, systems):
+        """
+        Write the list of system ids and the state of each system in a
+        single pipeline.
+        """
+        if not systems:
+            return
+        pipe = self._redis.pipeline()
+        pipe.sadd(SYSTEMS_KEY, *[sys.system_id for sys in systems])
+        for sys in systems:
+            pipe.set(system_key(sys.system_id), sys.dumps())
+        yield pipe.execute()
+
     def _issue_to_dict(self, issue):
         return {
             'issue_type': issue.issue_type,
@@ -57,13 +71,31 @@ class Storage(object):
         key = issue_key(worker_id)
         yield self._redis.delete(key)
 
-    @Manager.calls_manager
     def open_or_update_issue(self, worker_id, issue):
-        key = issue_key(worker_id)
-        issue_raw = yield self._redis.get(key)
-        if issue_raw is None:
-            issue_data = self._issue_to_dict(issue)
-        else:
-            issue_data = json.loads(issue_raw)
-            issue_data['procs_count'] = issue.procs_count
-        yield self._redis.set(key, json.dumps(issue_data))
+        return self.update_issues({worker_id: issue}, [])
+
+    @Manager.calls_manager
+    def update_issues(self, opened, closed):
+        """
+        Open or update the issues in ``opened`` (a dict mapping worker ids
+        to issues) and delete the issues for the worker ids in ``closed``.
+
+        Existing issues are read in one pipeline and all the changes are
+        written in another.
+        """
+        worker_ids = sorted(opened)
+        pipe = self._redis.pipeline()
+        for worker_id in worker_ids:
+            pipe.get(issue_key(worker_id))
+        existing = yield pipe.execute()
+        for worker_id, issue_raw in zip(worker_ids, existing):
+            issue = opened[worker_id]
+            if issue_raw is None:
+                issue_data = self._issue_to_dict(issue)
+            else:
+                issue_data = json.loads(issue_raw)
+                issue_data['procs_count'] = issue.procs_count
+            pipe.set(issue_key(worker_id), json.dumps(issue_data))
+        for worker_id in closed:
+            pipe.delete(issue_key(worker_id))
+        yield pipe.execute()
@@ -71,15 +71,34 @@ class TestWorker(VumiTestCase):
         obj = wkr.to_dict()
         self.assertEqual(obj, expected_wkr_dict())
 
-    def test_compute_host_info(self):
+    def test_host_counts(self):
         wkr = monitor.Worker('system-1', 'foo', 1)
         wkr.record('host-1', 34)
         wkr.record('host-1', 546)
+        wkr.record('host-1', 546)
+        wkr.record('host-2', 34)
+        self.assertEqual(wkr._host_counts_active, {'host-1': 2, 'host-2': 1})
 
         wkr.snapshot()
 
-        counts = wkr._compute_host_info(wkr._instances)
-        self.assertEqual(counts['host-1'], 2)
+        self.assertEqual(wkr._host_counts, {'host-1': 2, 'host-2': 1})
+        self.assertEqual(wkr._host_counts_active, {})
+
+    def test_to_dict_stats(self):
+        wkr = monitor.Worker('system-1', 'foo', 1)
+        wkr.record('host-1', 34, {'reactor_lag': 0.5, 'in_progress': 3})
+        wkr.record('host-1', 35, {'reactor_lag': 0.25, 'in_progress': 7})
+        wkr.record('host-1', 36, {'reactor_lag': None})
+        wkr.record('host-2', 37)
+
+        wkr.snapshot()
+
+        hosts = sorted(wkr.to_dict()['hosts'], key=lambda h: h['host'])
+        self.assertEqual(hosts, [
+            {'host': 'host-1', 'proc_count': 3,
+             'stats': {'reactor_lag': 0.5, 'in_progress': 7}},
+            {'host': 'host-2', 'proc_count': 1},
+        ])
 
     def test_snapshot(self):
         wkr = monitor.Worker('system-1', 'foo', 1)
@@ -95,6 +114,35 @@ class TestWorker(VumiTestCase):
         self.assertEqual(len(wkr._instances_active), 0)
         self.assertEqual(len(wkr._instances), 2)
 
+    def test_snapshot_stats(self):
+        wkr = monitor.Worker('system-1', 'foo', 1)
+        wkr.record('host-1', 34, {'rss': 100})
+        self.assertEqual(wkr._host_stats, {})
+
+        wkr.snapshot()
+
+        self.assertEqual(wkr._host_stats_active, {})
+        self.assertEqual(wkr._host_stats, {'host-1': {'rss': 100}})
+
+    def test_check(self):
+        wkr = monitor.Worker('system-1', 'foo', 2)
+        wkr.record('host-1', 34)
+        wkr.snapshot()
+        issue, cleared = wkr.check()
+        self.assertEqual(issue.issue_type, 'min-procs-fail')
+        self.assertEqual(issue.procs_count, 1)
+        self.assertFalse(cleared)
+
+        wkr.record('host-1', 34)
+        wkr.record('host-1', 35)
+        wkr.snapshot()
+        self.assertEqual(wkr.check(), (None, True))
+
+        wkr.record('host-1', 34)
+        wkr.record('host-1', 35)
+        wkr.snapshot()
+        self.assertEqual(wkr.check(), (None, False))
+
 
 class TestSystem(VumiTestCase):
 
@@ -189,6 +237,16 @@ class TestHeartBeatMonitor(VumiTestCase):
         self.worker.update(attrs2)
         self.assertEqual(len(wkr._instances_active), 2)
 
+    @inlineCallbacks
+    def test_update_stats(self):
+        yield self.worker.startWorker()
+        attrs = self.gen_fake_attrs(time.time())
+        attrs['stats'] = {'reactor_lag': 0.1}
+        self.worker.update(attrs)
+        wkr = self.worker._workers[attrs['worker_id']]
+        self.assertEqual(
+            wkr._host_stats_active, {'test-host-1': {'reactor_lag': 0.1}})
+
     @inlineCallbacks
     def test_audit_fail(self):
         # here we test the verification of a worker who
@@ -272,3 +330,37 @@ class TestHeartBeatMonitor(VumiTestCase):
         system = json.loads((yield fkredis.get('system:system-1')))
         system['timestamp'] = 2
         self.assertEqual(system, expected)
+
+    @inlineCallbacks
+    def test_periodic_task_batches(self):
+        yield self.worker.startWorker()
+        self.worker.audit_batch_size = 2
+        fkredis = self.worker._redis
+        for i in range(5):
+            wkr = monitor.Worker('system-1', 'worker-%d' % (i,), 1)
+            self.worker._workers[wkr.worker_id] = wkr
+            if i % 2:
+                wkr.record('test-host-1', 100 + i)
+
+        calls = []
+        update_issues = self.worker._storage.update_issues
+
+        def record_update_issues(opened, closed):
+            calls.append((sorted(opened), sorted(closed)))
+            return update_issues(opened, closed)
+
+        self.worker._storage.update_issues = record_update_issues
+        yield self.worker._periodic_task()
+
+        self.assertEqual(len(calls), 3)
+        opened = sorted(sum([o for o, c in calls], []))
+        closed = sorted(sum([c for o, c in calls], []))
+        self.assertEqual(opened, [
+            'system-1:twitter_transport', 'system-1:worker-0',
+            'system-1:worker-2', 'system-1:worker-4'])
+        self.assertEqual(closed, ['system-1:worker-1', 'system-1:worker-3'])
+        for worker_id in opened:
+            issue = json.loads((yield fkredis.get(issue_key(worker_id))))
+            self.assertEqual(issue['issue_type'], 'min-procs-fail')
+        for worker_id in closed:
+            self.assertEqual((yield fkredis.get(issue_key(worker_id))), None)
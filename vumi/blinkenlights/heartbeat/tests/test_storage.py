@@ -51,6 +51,52 @@ class TestStorage(VumiTestCase):
         res = yield self.redis.get(storage.system_key('haha'))
         self.assertEqual(res, 'Ha!')
 
+    @inlineCallbacks
+    def test_write_systems(self):
+        sys1 = DummySystem()
+        sys2 = DummySystem()
+        sys2.system_id = 'hoho'
+        yield self.stg.write_systems([sys1, sys2])
+        res = yield self.redis.smembers(storage.SYSTEMS_KEY)
+        self.assertEqual(sorted(res), ['haha', 'hoho'])
+        self.assertEqual(
+            (yield self.redis.get(storage.system_key('haha'))), 'Ha!')
+        self.assertEqual(
+            (yield self.redis.get(storage.system_key('hoho'))), 'Ha!')
+
+    @inlineCallbacks
+    def test_write_systems_empty(self):
+        yield self.stg.write_systems([])
+        res = yield self.redis.smembers(storage.SYSTEMS_KEY)
+        self.assertEqual(res, set())
+
+    @inlineCallbacks
+    def test_update_issues(self):
+        yield self.stg.open_or_update_issue(
+            'worker-1', monitor.WorkerIssue('min-procs-fail', 5, 1))
+        yield self.stg.open_or_update_issue(
+            'worker-2', monitor.WorkerIssue('min-procs-fail', 5, 1))
+
+        yield self.stg.update_issues({
+            'worker-1': monitor.WorkerIssue('min-procs-fail', 10, 0),
+            'worker-3': monitor.WorkerIssue('min-procs-fail', 10, 2),
+        }, ['worker-2'])
+
+        res = yield self.redis.get(storage.issue_key('worker-1'))
+        self.assertEqual(json.loads(res), {
+            'issue_type': 'min-procs-fail',
+            'start_time': 5,
+            'procs_count': 0,
+        })
+        res = yield self.redis.get(storage.issue_key('worker-2'))
+        self.assertEqual(res, None)
+        res = yield self.redis.get(storage.issue_key('worker-3'))
+        self.assertEqual(json.loads(res), {
+            'issue_type': 'min-procs-fail',
+            'start_time': 10,
+            'procs_count': 2,
+        })
+
     @inlineCallbacks
     def test_delete_issue(self):
         iss = monitor.WorkerIssue('min-procs-fail', 5, 78)
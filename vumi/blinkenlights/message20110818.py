@@ -14,6 +14,13 @@ class MetricMessage(Message):
     * `timestamp` is a float giving seconds since the POSIX Epoch,
       e.g. time.time().
     * `value` is any float.
+
+    A value may also be a serialized
+    :class:`vumi.blinkenlights.sketches.MetricSummary` (a dict holding the
+    count, sum, min, max, last value and a quantile sketch of a set of
+    values) published by a pre-aggregating metric manager. Summaries for the
+    same metric can be merged, so they may be split across any number of
+    messages.
     """
 
     def __init__(self):
@@ -14,6 +14,7 @@ from zope.interface import Interface, implementer
 
 from vumi.service import Publisher, Consumer
 from vumi.blinkenlights.message20110818 import MetricMessage
+from vumi.blinkenlights.sketches import MetricSummary
 
 
 class IMetricPublisher(Interface):
@@ -48,11 +49,18 @@ class MetricManager(object):
     :type on_publish: f(metric_manager)
     :param on_publish:
         Function to call immediately after metrics after published.
+    :type preaggregate: bool
+    :param preaggregate:
+        If ``True``, registered metrics keep a :class:`MetricSummary` of
+        their values instead of a list of raw values and only the summary
+        is published. This greatly reduces the size of metric messages for
+        frequently updated metrics. Defaults to ``False``.
     """
 
     def __init__(self, prefix, publish_interval=5, on_publish=None,
-                 publisher=None):
+                 publisher=None, preaggregate=False):
         self.prefix = prefix
+        self.preaggregate = preaggregate
         self._metrics = []  # list of metrics to poll
         self._oneshot_msgs = []  # list of oneshot messages since last publish
         self._metrics_lookup = {}  # metric name -> metric
@@ -180,15 +188,20 @@ class Aggregator(object):
     :param func:
        The aggregation function. Should return a default value
        if the list of values is empty (usually this default is 0.0).
+    :type summary_func: f(:class:`MetricSummary`) -> float, optional
+    :param summary_func:
+       The aggregation function for pre-aggregated values. It is only called
+       with non-empty summaries.
     """
 
     REGISTRY = {}
 
-    def __init__(self, name, func):
+    def __init__(self, name, func, summary_func=None):
         if name in self.REGISTRY:
             raise AggregatorAlreadyDefinedError(name)
         self.name = name
         self.func = func
+        self.summary_func = summary_func
         self.REGISTRY[name] = self
 
     @classmethod
@@ -198,13 +211,61 @@ class Aggregator(object):
     def __call__(self, values):
         return self.func(values)
 
+    def summarize(self, summary):
+        """Apply the aggregation to a :class:`MetricSummary`."""
+        if summary.count == 0:
+            return self.func([])
+        if self.summary_func is None:
+            raise ValueError(
+                "Aggregator %r does not support pre-aggregated values." % (
+                    self.name,))
+        return self.summary_func(summary)
+
+    def aggregate(self, values, summary=None):
+        """Apply the aggregation to a list of raw values, or to ``summary``
+        if pre-aggregated values were merged into it.
+
+        Raises :class:`ValueError` if a summary is given and this aggregator
+        does not support pre-aggregated values.
+        """
+        if summary is None:
+            return self.func(values)
+        return self.summarize(summary)
+
 
-SUM = Aggregator("sum", sum)
+SUM = Aggregator("sum", sum, lambda summary: summary.sum)
 AVG = Aggregator("avg",
-                 lambda values: sum(values) / len(values) if values else 0.0)
-MAX = Aggregator("max", lambda values: max(values) if values else 0.0)
-MIN = Aggregator("min", lambda values: min(values) if values else 0.0)
-LAST = Aggregator("last", lambda values: values[-1] if values else 0.0)
+                 lambda values: sum(values) / len(values) if values else 0.0,
+                 lambda summary: summary.sum / summary.count)
+MAX = Aggregator("max", lambda values: max(values) if values else 0.0,
+                 lambda summary: summary.max)
+MIN = Aggregator("min", lambda values: min(values) if values else 0.0,
+                 lambda summary: summary.min)
+LAST = Aggregator("last", lambda values: values[-1] if values else 0.0,
+                  lambda summary: summary.last)
+
+
+def quantile_aggregator(name, q):
+    """Create an :class:`Aggregator` for the quantile ``q`` (between 0 and 1).
+
+    Lists of raw values are aggregated exactly, by sorting them. Summaries
+    are aggregated using their quantile sketch, which is accurate to within
+    one percent of the true value.
+    """
+    def func(values):
+        if not values:
+            return 0.0
+        values = sorted(values)
+        return values[int(q * (len(values) - 1))]
+
+    return Aggregator(
+        name, func, lambda summary: summary.sketch.quantile(q))
+
+
+P50 = quantile_aggregator("p50", 0.5)
+P90 = quantile_aggregator("p90", 0.9)
+P95 = quantile_aggregator("p95", 0.95)
+P99 = quantile_aggregator("p99", 0.99)
 
 
 class MetricRegistrationError(Exception):
@@ -247,6 +308,7 @@ class Metric(object):
         self.aggs = tuple(sorted(agg.name for agg in aggregators))
         self._manager = None
         self._values = []  # list of unpolled values
+        self._summary = None  # unpolled summary if pre-aggregating
 
     @property
     def managed(self):
@@ -259,13 +321,29 @@ class Metric(object):
                 "Metric %s already registered with MetricManager with"
                 " prefix %s." % (self.name, self._manager.prefix))
         self._manager = manager
+        if getattr(manager, 'preaggregate', False):
+            self._summary = MetricSummary()
 
     def set(self, value):
         """Append a value for later polling."""
-        self._values.append((int(time.time()), value))
+        if self._summary is not None:
+            self._summary.add(int(time.time()), value)
+        else:
+            self._values.append((int(time.time()), value))
 
     def poll(self):
-        """Called periodically by the :class:`MetricManager`."""
+        """Called periodically by the :class:`MetricManager`.
+
+        If the manager is pre-aggregating, this returns at most a single
+        value, which is the serialized :class:`MetricSummary` of all the
+        values set since the last poll, timestamped with the time of the
+        most recent one.
+        """
+        if self._summary is not None:
+            summary, self._summary = self._summary, MetricSummary()
+            if summary.count == 0:
+                return []
+            return [(summary.last_timestamp, summary.to_dict())]
         values, self._values = self._values, []
         return values
 
@@ -288,6 +366,62 @@ class Count(Metric):
         self.set(1.0)
 
 
+class Gauge(Metric):
+    """A value sampled from a function each time the metric is polled.
+
+    This is useful for things like queue lengths, which are cheap to look at
+    but change too often to set a value on every change. Nothing is
+    published if the function returns ``None``.
+
+    :type func: f()
+    :param func:
+        Function that returns the current value.
+
+    Examples:
+
+    >>> mm = MetricManager('vumi.worker0.')
+    >>> pending = {}
+    >>> my_gauge = mm.register(Gauge('pending', lambda: len(pending)))
+    """
+
+    #: Default aggregators are [:data:`LAST`]
+    DEFAULT_AGGREGATORS = [LAST]
+
+    def __init__(self, name, func, aggregators=None):
+        super(Gauge, self).__init__(name, aggregators)
+        self.func = func
+
+    def poll(self):
+        value = self.func()
+        if value is not None:
+            self.set(value)
+        return super(Gauge, self).poll()
+
+
+class CacheHitRate(Metric):
+    """The hit rate of a :class:`vumi.utils.LRUCache` since the last poll.
+
+    Nothing is published for polling periods without any lookups.
+    """
+
+    #: Default aggregators are [:data:`LAST`]
+    DEFAULT_AGGREGATORS = [LAST]
+
+    def __init__(self, name, cache, aggregators=None):
+        super(CacheHitRate, self).__init__(name, aggregators)
+        self.cache = cache
+        self._last_counts = (cache.hits, cache.misses)
+
+    def poll(self):
+        last_hits, last_misses = self._last_counts
+        hits = self.cache.hits - last_hits
+        misses = self.cache.misses - last_misses
+        self._last_counts = (self.cache.hits, self.cache.misses)
+        if hits + misses > 0:
+            self.set(float(hits) / (hits + misses))
+        return super(CacheHitRate, self).poll()
+
+
 class TimerError(Exception):
     """Raised when an error occurs in a call to an EventTimer method."""
 
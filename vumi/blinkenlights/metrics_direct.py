@@ -0,0 +1,279 @@
+# -*- test-case-name: vumi.blinkenlights.tests.test_metrics_direct -*-
+
+"""Publish metrics directly to a time series database.
+
+:class:`DirectMetricPublisher` can be given to a
+:class:`vumi.blinkenlights.metrics.MetricManager` in place of the default
+AMQP publisher. Each time the manager publishes, the values of each metric
+are aggregated in-process and the aggregates are written straight to a
+Graphite or statsd server, skipping the ``MetricTimeBucket`` and
+``MetricAggregator`` workers entirely.
+
+Since aggregation happens per publisher, this is only suitable when each
+metric name is only published by a single worker (which is usually the case,
+since worker metric prefixes are normally unique).
+"""
+
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+from twisted.internet.protocol import (
+    DatagramProtocol, Protocol, ReconnectingClientFactory)
+from zope.interface import implementer
+
+from vumi import log
+from vumi.blinkenlights.metrics import (
+    IMetricPublisher, Aggregator, MetricManager)
+from vumi.blinkenlights.sketches import MetricSummary
+
+
+def format_graphite(name, value, timestamp):
+    return "%s %r %d\n" % (name, float(value), timestamp)
+
+
+def format_statsd(name, value, timestamp):
+    # Values have already been aggregated, so we publish them as gauges.
+    return "%s:%r|g\n" % (name, float(value))
+
+
+LINE_FORMATS = {
+    'graphite': format_graphite,
+    'statsd': format_statsd,
+}
+
+
+class DirectUDPProtocol(DatagramProtocol):
+    def __init__(self, ip, port):
+        # NOTE: `ip` must be an IP, not a hostname.
+        self._ip = ip
+        self._port = port
+
+    def startProtocol(self):
+        self.transport.connect(self._ip, self._port)
+
+    def send_batch(self, data):
+        self.transport.write(data)
+
+
+class DirectTCPProtocol(Protocol):
+    def connectionMade(self):
+        self.factory.resetDelay()
+        self.factory.publisher._connection_made(self)
+
+    def connectionLost(self, reason):
+        self.factory.publisher._connection_lost(self)
+
+    def send_batch(self, data):
+        self.transport.write(data)
+
+
+class DirectTCPFactory(ReconnectingClientFactory):
+    protocol = DirectTCPProtocol
+    maxDelay = 30
+
+    def __init__(self, publisher):
+        self.publisher = publisher
+
+
+@implementer(IMetricPublisher)
+class DirectMetricPublisher(object):
+    """Aggregate metrics in-process and write them directly to a TSDB.
+
+    :param str host:
+        The host to send metrics to.
+    :param int port:
+        The port to send metrics to.
+    :param str protocol:
+        Either ``udp`` (the default) or ``tcp``. TCP connections are kept
+        open and reconnected with exponential back-off if they are lost.
+    :param str line_format:
+        Either ``graphite`` (the plaintext protocol, the default) or
+        ``statsd``.
+    :param int max_batch_size:
+        The maximum number of bytes to send in a single datagram or write.
+        Lines are never split across batches.
+    :param int max_buffered_lines:
+        The maximum number of lines to hold while a TCP connection is
+        unavailable. The oldest lines are dropped first.
+    """
+
+    DEFAULT_MAX_BATCH_SIZE = 1400
+    DEFAULT_MAX_BUFFERED_LINES = 10000
+
+    reactor = reactor  # hook for tests
+
+    def __init__(self, host, port, protocol='udp', line_format='graphite',
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 max_buffered_lines=DEFAULT_MAX_BUFFERED_LINES):
+        if protocol not in ('udp', 'tcp'):
+            raise ValueError("Unknown protocol: %r" % (protocol,))
+        if line_format not in LINE_FORMATS:
+            raise ValueError("Unknown line format: %r" % (line_format,))
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.format_line = LINE_FORMATS[line_format]
+        self.max_batch_size = max_batch_size
+        self._buffer = deque(maxlen=max_buffered_lines)
+        self._connection = None
+        self._udp_port = None
+        self._tcp_factory = None
+        self.lines_sent = 0
+        self.batches_sent = 0
+        self.lines_dropped = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a publisher from a worker config dict.
+
+        The ``host`` and ``port`` keys are required. The ``protocol``,
+        ``format``, ``max_batch_size`` and ``max_buffered_lines`` keys are
+        optional.
+        """
+        return cls(
+            config['host'], int(config['port']),
+            protocol=config.get('protocol', 'udp'),
+            line_format=config.get('format', 'graphite'),
+            max_batch_size=int(config.get(
+                'max_batch_size', cls.DEFAULT_MAX_BATCH_SIZE)),
+            max_buffered_lines=int(config.get(
+                'max_buffered_lines', cls.DEFAULT_MAX_BUFFERED_LINES)))
+
+    def start(self):
+        """Start the publisher's connection. Returns a Deferred."""
+        if self.protocol == 'udp':
+            return self._start_udp()
+        self._tcp_factory = DirectTCPFactory(self)
+        self.reactor.connectTCP(self.host, self.port, self._tcp_factory)
+        return succeed(None)
+
+    @inlineCallbacks
+    def _start_udp(self):
+        ip = yield self.reactor.resolve(self.host)
+        protocol = DirectUDPProtocol(ip, self.port)
+        self._udp_port = yield self.reactor.listenUDP(0, protocol)
+        self._connection = protocol
+
+    def stop(self):
+        """Stop the publisher and close its connection."""
+        if self._udp_port is not None:
+            port, self._udp_port = self._udp_port, None
+            self._connection = None
+            return port.stopListening()
+        if self._tcp_factory is not None:
+            self._tcp_factory.stopTrying()
+            self._tcp_factory = None
+            if self._connection is not None:
+                self._connection.transport.loseConnection()
+        return succeed(None)
+
+    def _connection_made(self, connection):
+        self._connection = connection
+        self._flush()
+
+    def _connection_lost(self, connection):
+        if self._connection is connection:
+            self._connection = None
+
+    def aggregate(self, msg):
+        """Return aggregated ``(name, value, timestamp)`` tuples for the
+        datapoints in a :class:`MetricMessage`."""
+        aggregates = []
+        for metric_name, aggs, values in msg.datapoints():
+            if not values:
+                continue
+            values = sorted(values)
+            summary = None
+            if any(MetricSummary.is_summary_value(v) for _, v in values):
+                summary = MetricSummary()
+                for timestamp, value in values:
+                    if MetricSummary.is_summary_value(value):
+                        summary.merge(
+                            timestamp, MetricSummary.from_dict(value))
+                    else:
+                        summary.add(timestamp, value)
+            timestamp = values[-1][0]
+            values = [v for _, v in values]
+            for agg_name in aggs:
+                name = "%s.%s" % (metric_name, agg_name)
+                try:
+                    agg_value = Aggregator.from_name(agg_name).aggregate(
+                        values, summary)
+                except ValueError as e:
+                    log.warning("Skipping %s: %s" % (name, e))
+                    continue
+                aggregates.append((name, agg_value, timestamp))
+        return aggregates
+
+    def publish_message(self, msg):
+        for name, value, timestamp in self.aggregate(msg):
+            if len(self._buffer) == self._buffer.maxlen:
+                self.lines_dropped += 1
+            self._buffer.append(self.format_line(name, value, timestamp))
+        self._flush()
+
+    def _flush(self):
+        if self._connection is None:
+            return
+        batch, batch_size = [], 0
+        while self._buffer:
+            line = self._buffer.popleft()
+            if batch and batch_size + len(line) > self.max_batch_size:
+                self._send_batch(batch)
+                batch, batch_size = [], 0
+            batch.append(line)
+            batch_size += len(line)
+        if batch:
+            self._send_batch(batch)
+
+    def _send_batch(self, lines):
+        try:
+            self._connection.send_batch(''.join(lines))
+        except Exception:
+            log.err(None, "Error sending metrics to %s:%s" % (
+                self.host, self.port))
+            return
+        self.lines_sent += len(lines)
+        self.batches_sent += 1
+
+
+@inlineCallbacks
+def start_metric_manager(worker, prefix, publish_interval=5,
+                         direct_config=None, **kw):
+    """Start a :class:`MetricManager` for a worker.
+
+    If ``direct_config`` is ``None``, the manager publishes over AMQP as
+    usual. Otherwise a :class:`DirectMetricPublisher` is built from it with
+    :meth:`DirectMetricPublisher.from_config` and started. The publisher is
+    available as the manager's ``direct_publisher`` attribute so that the
+    worker can stop it.
+
+    Extra keyword arguments are passed to :class:`MetricManager`.
+    """
+    if direct_config is None:
+        manager = yield worker.start_publisher(
+            MetricManager, prefix, publish_interval, **kw)
+        manager.direct_publisher = None
+        returnValue(manager)
+    publisher = DirectMetricPublisher.from_config(direct_config)
+    yield publisher.start()
+    manager = MetricManager(
+        prefix, publish_interval, publisher=publisher, **kw)
+    manager.direct_publisher = publisher
+    manager.start_polling()
+    returnValue(manager)
+
+
+def stop_metric_manager(manager):
+    """Stop a :class:`MetricManager` started with
+    :func:`start_metric_manager`, along with its direct publisher if it has
+    one.
+
+    Returns a deferred that fires once the direct publisher has stopped.
+    """
+    manager.stop()
+    direct_publisher = getattr(manager, 'direct_publisher', None)
+    if direct_publisher is None:
+        return succeed(None)
+    return direct_publisher.stop()
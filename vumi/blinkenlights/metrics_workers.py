@@ -5,16 +5,19 @@ import random
 import hashlib
 from datetime import datetime
 
-from twisted.python import log
 from twisted.internet.defer import inlineCallbacks, Deferred
 from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
 from twisted.internet.protocol import DatagramProtocol
 
+from vumi import log
 from vumi.service import Consumer, Publisher, Worker
-from vumi.blinkenlights.metrics import (MetricsConsumer, MetricManager, Count,
-                                        Metric, Timer, Aggregator)
+from vumi.blinkenlights.metrics import (MetricsConsumer, Count, Metric,
+                                        Timer, Aggregator)
+from vumi.blinkenlights.metrics_direct import (
+    start_metric_manager, stop_metric_manager)
 from vumi.blinkenlights.message20110818 import MetricMessage
+from vumi.blinkenlights.sketches import MetricSummary
 
 
 class AggregatedMetricConsumer(Consumer):
@@ -88,9 +91,27 @@ class TimeBucketConsumer(Consumer):
             self.callback(metric_name, aggregators, values)
 
 
+class BatchedMetricsConsumer(MetricsConsumer):
+    """Consume metrics messages a whole message at a time.
+
+    Parameters
+    ----------
+    callback : function, f(datapoints)
+        Called with the list of (metric_name, aggregators, values)
+        datapoints in each message as it arrives.
+    """
+
+    def consume_message(self, vumi_message):
+        msg = MetricMessage.from_dict(vumi_message.payload)
+        self.callback(msg.datapoints())
+
+
 class TimeBucketPublisher(Publisher):
     """Publish time bucketed metric messages.
 
+    All the datapoints passed to a single :meth:`publish_metrics` call that
+    are destined for the same bucket are published in a single message.
+
     Parameters
     ----------
     buckets : int
@@ -104,15 +125,36 @@ class TimeBucketPublisher(Publisher):
     durable = True
     ROUTING_KEY_TEMPLATE = "bucket.%d"
 
+    # Number of time bucket keys to cache bucket assignments for. Metrics
+    # arrive for recent time buckets, so older assignments are discarded.
+    CACHED_TS_KEYS = 4
+
     def __init__(self, buckets, bucket_size):
         self.buckets = buckets
         self.bucket_size = bucket_size
+        # ts_key -> { metric_name -> bucket }
+        self._bucket_cache = {}
+        self.flushes = 0
+        self.messages_published = 0
+        self.datapoints_published = 0
 
     def find_bucket(self, metric_name, ts_key):
         md5 = hashlib.md5("%s:%d" % (metric_name, ts_key))
         return int(md5.hexdigest(), 16) % self.buckets
 
-    def publish_metric(self, metric_name, aggregates, values):
+    def _cached_find_bucket(self, metric_name, ts_key):
+        ts_cache = self._bucket_cache.get(ts_key)
+        if ts_cache is None:
+            if len(self._bucket_cache) >= self.CACHED_TS_KEYS:
+                del self._bucket_cache[min(self._bucket_cache)]
+            ts_cache = self._bucket_cache[ts_key] = {}
+        bucket = ts_cache.get(metric_name)
+        if bucket is None:
+            bucket = ts_cache[metric_name] = self.find_bucket(
+                metric_name, ts_key)
+        return bucket
+
+    def _split_values(self, values):
         timestamp_buckets = {}
         for timestamp, value in values:
             ts_key = int(timestamp) / self.bucket_size
@@ -120,13 +162,33 @@ class TimeBucketPublisher(Publisher):
             if ts_bucket is None:
                 ts_bucket = timestamp_buckets[ts_key] = []
             ts_bucket.append((timestamp, value))
+        return timestamp_buckets.iteritems()
 
-        for ts_key, ts_bucket in timestamp_buckets.iteritems():
-            bucket = self.find_bucket(metric_name, ts_key)
+    def publish_metric(self, metric_name, aggregates, values):
+        return self.publish_metrics([(metric_name, aggregates, values)])
+
+    def publish_metrics(self, datapoints):
+        """Publish a list of (metric_name, aggregates, values) datapoints.
+
+        Returns the number of messages published.
+        """
+        bucket_msgs = {}
+        for metric_name, aggregates, values in datapoints:
+            for ts_key, ts_bucket in self._split_values(values):
+                bucket = self._cached_find_bucket(metric_name, ts_key)
+                msg = bucket_msgs.get(bucket)
+                if msg is None:
+                    msg = bucket_msgs[bucket] = MetricMessage()
+                msg.append((metric_name, aggregates, ts_bucket))
+
+        for bucket, msg in sorted(bucket_msgs.iteritems()):
             routing_key = self.ROUTING_KEY_TEMPLATE % bucket
-            msg = MetricMessage()
-            msg.append((metric_name, aggregates, ts_bucket))
             self.publish_message(msg, routing_key=routing_key)
+            self.datapoints_published += len(msg.datapoints())
+
+        self.flushes += 1
+        self.messages_published += len(bucket_msgs)
+        return len(bucket_msgs)
 
 
 class MetricTimeBucket(Worker):
@@ -134,7 +196,8 @@ class MetricTimeBucket(Worker):
 
     :class:`MetricTimeBuckets` take metrics from the vumi.metrics
     exchange and redistribute them to one of N :class:`MetricAggregator`
-    workers.
+    workers. Each incoming message results in at most one message per
+    aggregator.
 
     There can be any number of :class:`MetricTimeBucket` workers.
 
@@ -147,6 +210,9 @@ class MetricTimeBucket(Worker):
         somewhere).
     bucket_size : int, in seconds
         The amount of time each time bucket represents.
+    stats_interval : int, in seconds, optional
+        How often to log the number of messages published. Set to 0 to
+        disable. Default is 60s.
     """
     @inlineCallbacks
     def startWorker(self):
@@ -155,10 +221,35 @@ class MetricTimeBucket(Worker):
         log.msg("Total number of buckets %d" % buckets)
         bucket_size = int(self.config.get("bucket_size"))
         log.msg("Bucket size is %d seconds" % bucket_size)
+        stats_interval = int(self.config.get("stats_interval", 60))
         self.publisher = yield self.start_publisher(TimeBucketPublisher,
                                                     buckets, bucket_size)
-        self.consumer = yield self.start_consumer(MetricsConsumer,
-                self.publisher.publish_metric)
+        self.consumer = yield self.start_consumer(BatchedMetricsConsumer,
+                self.publisher.publish_metrics)
+
+        self._stats_task = None
+        self._last_stats = (0, 0, 0)
+        if stats_interval > 0:
+            self._stats_task = LoopingCall(self.log_publish_stats)
+            done = self._stats_task.start(stats_interval, False)
+            done.addErrback(lambda failure: log.err(failure,
+                            "MetricTimeBucket stats task died"))
+
+    def log_publish_stats(self):
+        """Log the publishing counts since the last call."""
+        stats = (self.publisher.flushes, self.publisher.messages_published,
+                 self.publisher.datapoints_published)
+        flushes, messages, datapoints = [
+            now - last for now, last in zip(stats, self._last_stats)]
+        self._last_stats = stats
+        log.msg("Published %d messages with %d datapoints for %d incoming"
+                " messages (%.1f messages per flush)." % (
+                    messages, datapoints, flushes,
+                    float(messages) / flushes if flushes else 0.0))
+
+    def stopWorker(self):
+        if self._stats_task is not None and self._stats_task.running:
+            self._stats_task.stop()
 
 
 class DiscardedMetricError(Exception):
@@ -180,6 +271,12 @@ class MetricAggregator(Worker):
     lag : int, seconds, optional
         The number of seconds after a bucket's time ends to wait
         before processing the bucket. Default is 5s.
+
+    Metric values may be raw floats or serialized :class:`MetricSummary`
+    partials published by a pre-aggregating :class:`MetricManager`. Raw
+    values are aggregated exactly. Once a summary arrives for a metric, all
+    its values in the bucket are merged into a single running summary and
+    aggregators that don't support summaries are skipped for it.
     """
 
     _time = time.time  # hook for faking time in tests
@@ -196,8 +293,8 @@ class MetricAggregator(Worker):
         log.msg("Bucket size is %d seconds" % self.bucket_size)
         self.lag = float(self.config.get("lag", 5.0))
 
-        # ts_key -> { metric_name -> (aggregate_set, values) }
-        # values is a list of (timestamp, value) pairs
+        # ts_key -> { metric_name -> [aggregate_set, values, summary] }
+        # where summary is None until a pre-aggregated value arrives
         self.buckets = {}
         # initialize last processed bucket
         self._last_ts_key = self._ts_key(self._time() - self.lag) - 2
@@ -224,12 +321,16 @@ class MetricAggregator(Worker):
                 aggregates = []
                 ts = ts_key * self.bucket_size
                 items = self.buckets[ts_key].iteritems()
-                for metric_name, (agg_set, values) in items:
+                for metric_name, (agg_set, values, summary) in items:
                     values = [v for t, v in sorted(values)]
                     for agg_name in agg_set:
                         agg_metric = "%s.%s" % (metric_name, agg_name)
                         agg_func = Aggregator.from_name(agg_name)
-                        agg_value = agg_func(values)
+                        try:
+                            agg_value = agg_func.aggregate(values, summary)
+                        except ValueError as e:
+                            log.warning("Skipping %s: %s" % (agg_metric, e))
+                            continue
                         aggregates.append((agg_metric, agg_value))
 
                 for agg_metric, agg_value in aggregates:
@@ -247,10 +348,21 @@ class MetricAggregator(Worker):
             metrics = self.buckets[ts_key] = {}
         metric = metrics.get(metric_name)
         if metric is None:
-            metric = metrics[metric_name] = (set(), [])
-        existing_aggregates, existing_values = metric
+            metric = metrics[metric_name] = [set(), [], None]
+        existing_aggregates, existing_values, summary = metric
         existing_aggregates.update(aggregates)
-        existing_values.extend(values)
+        for timestamp, value in values:
+            if MetricSummary.is_summary_value(value):
+                if summary is None:
+                    summary = metric[2] = MetricSummary()
+                    for t, v in existing_values:
+                        summary.add(t, v)
+                    del existing_values[:]
+                summary.merge(timestamp, MetricSummary.from_dict(value))
+            elif summary is not None:
+                summary.add(timestamp, value)
+            else:
+                existing_values.append((timestamp, value))
 
     def stopWorker(self):
         self._task.stop()
@@ -364,6 +476,10 @@ class RandomMetricsGenerator(Worker):
     generator_period: float in seconds, optional
         How often the random metric loop should send values to the
         metric manager. Default is 1s.
+    direct_metrics : dict, optional
+        If set, metrics are aggregated in-process and sent directly to a
+        Graphite or statsd server instead of over AMQP. See
+        :meth:`DirectMetricPublisher.from_config` for the keys.
     """
     # callback for tests, f(worker)
     # (or anyone else that wants to be notified when metrics are generated)
@@ -379,8 +495,9 @@ class RandomMetricsGenerator(Worker):
         log.msg("Random metrics values will be generated every %s seconds" %
                 generator_period)
 
-        self.mm = yield self.start_publisher(MetricManager, "vumi.random.",
-                                             manager_period)
+        self.mm = yield start_metric_manager(
+            self, "vumi.random.", manager_period,
+            direct_config=self.config.get("direct_metrics"))
         self.counter = self.mm.register(Count("count"))
         self.value = self.mm.register(Metric("value"))
         self.timer = self.mm.register(Timer("timer"))
@@ -401,7 +518,8 @@ class RandomMetricsGenerator(Worker):
         if self.on_run is not None:
             self.on_run(self)
 
+    @inlineCallbacks
     def stopWorker(self):
-        self.mm.stop()
         self.task.stop()
+        yield stop_metric_manager(self.mm)
         log.msg("Stopping the MetricsGenerator")
@@ -0,0 +1,425 @@
+# -*- test-case-name: vumi.blinkenlights.tests.test_profiler -*-
+
+"""Runtime profiling tools for workers.
+
+A :class:`WorkerProfiler` combines a statistical stack sampler, timing
+summaries for message handlers and a reactor lag monitor. It is switched on
+and off at runtime (see :class:`ProfilerResource` and
+:meth:`WorkerProfiler.handle_command`) and costs nothing more than an
+attribute check per message while it is off.
+"""
+
+import json
+import os
+import sys
+import thread
+import threading
+import time
+from collections import defaultdict
+
+from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred
+from twisted.web import http
+from twisted.web.resource import Resource
+
+from vumi.blinkenlights.metrics import Timer, AVG, MAX, P95, P99
+from vumi.blinkenlights.sketches import MetricSummary
+
+
+class StackSampler(object):
+    """Statistical profiler that periodically samples the stack of a thread.
+
+    Sampling happens in a separate daemon thread using
+    :func:`sys._current_frames`, so the sampled thread isn't interrupted
+    by signals. Each sample is stored as a folded stack (frames separated
+    by ``;``, outermost first), which is the input format used by
+    flamegraph tools.
+
+    :param float interval:
+        Seconds between samples.
+    :param thread_id:
+        The thread to sample. Defaults to the thread creating the sampler,
+        which is usually the reactor thread.
+    :param int max_depth:
+        The maximum number of frames kept for each sample.
+    """
+
+    def __init__(self, interval=0.005, thread_id=None, max_depth=100):
+        self.interval = interval
+        if thread_id is None:
+            thread_id = thread.get_ident()
+        self.thread_id = thread_id
+        self.max_depth = max_depth
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self._thread = None
+        self._stopping = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self.running:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="vumi-stack-sampler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    def reset(self):
+        self.stacks.clear()
+        self.samples = 0
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self.sample()
+
+    def sample(self, frame=None):
+        """
+        Record the current stack of the sampled thread, or the stack ending
+        at ``frame`` if one is given.
+        """
+        if frame is None:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+        self.stacks[self.fold(frame)] += 1
+        self.samples += 1
+
+    def fold(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append("%s (%s:%d)" % (
+                code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def folded(self):
+        """
+        Return a list of ``"<folded stack> <count>"`` lines.
+        """
+        # Copying the dict doesn't release the GIL, so this is safe while
+        # the sampler thread is adding to it.
+        stacks = dict(self.stacks)
+        return ["%s %d" % (stack, stacks[stack]) for stack in sorted(stacks)]
+
+
+class HandlerTimings(object):
+    """Timing summaries for named handlers.
+
+    :param metrics:
+        An optional :class:`vumi.blinkenlights.metrics.MetricManager`. A
+        :class:`vumi.blinkenlights.metrics.Timer` is registered on it for
+        each handler name and every recorded duration is also set on it.
+    """
+
+    AGGREGATORS = [AVG, MAX, P95, P99]
+
+    clock = staticmethod(time.time)
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.summaries = {}
+        self._timers = {}
+
+    def record(self, name, duration):
+        summary = self.summaries.get(name)
+        if summary is None:
+            summary = self.summaries[name] = MetricSummary()
+        summary.add(int(self.clock()), duration)
+        if self.metrics is not None:
+            timer = self._timers.get(name)
+            if timer is None:
+                timer = self._timers[name] = self.metrics.register(
+                    Timer(name, aggregators=self.AGGREGATORS))
+            timer.set(duration)
+
+    def timed(self, name, func):
+        """
+        Return a wrapper around ``func`` that records how long each call
+        takes (including the time taken to fire any deferred it returns)
+        under ``name``. The wrapper always returns a deferred.
+        """
+        def wrapper(*args, **kw):
+            start = self.clock()
+            d = maybeDeferred(func, *args, **kw)
+            d.addBoth(self._record_result, name, start)
+            return d
+        return wrapper
+
+    def _record_result(self, result, name, start):
+        self.record(name, self.clock() - start)
+        return result
+
+    def reset(self):
+        self.summaries.clear()
+
+    def report(self):
+        """
+        Return a dict mapping handler names to their call count and timing
+        statistics in seconds.
+        """
+        return dict(
+            (name, summary_stats(summary))
+            for name, summary in self.summaries.iteritems())
+
+
+def summary_stats(summary):
+    if summary.count == 0:
+        return {'count': 0}
+    return {
+        'count': summary.count,
+        'mean': summary.sum / summary.count,
+        'max': summary.max,
+        'p50': summary.sketch.quantile(0.5),
+        'p95': summary.sketch.quantile(0.95),
+        'p99': summary.sketch.quantile(0.99),
+    }
+
+
+class ReactorLagMonitor(object):
+    """Measures how late the reactor runs scheduled calls.
+
+    Every ``interval`` seconds a call is scheduled and the difference
+    between when it was due and when it actually ran is recorded. A busy
+    reactor (or one blocked by synchronous code) shows up as lag.
+
+    :param float interval:
+        Seconds between measurements.
+    :param callback:
+        Optional callable that is called with each lag measurement.
+    :param clock:
+        The reactor to monitor. Defaults to the global reactor.
+    """
+
+    def __init__(self, interval=1.0, callback=None, clock=None):
+        self.interval = interval
+        self.callback = callback
+        self.clock = clock if clock is not None else reactor
+        self.summary = MetricSummary()
+        self.lag = None
+        self._call = None
+        self._due = None
+
+    @property
+    def running(self):
+        return self._call is not None
+
+    def start(self):
+        if not self.running:
+            self._schedule()
+
+    def stop(self):
+        if self.running:
+            self._call.cancel()
+            self._call = None
+
+    def _schedule(self):
+        self._due = self.clock.seconds() + self.interval
+        self._call = self.clock.callLater(self.interval, self._measure)
+
+    def _measure(self):
+        self.lag = max(0.0, self.clock.seconds() - self._due)
+        self.summary.add(int(self._due), self.lag)
+        self._schedule()
+        if self.callback is not None:
+            self.callback(self.lag)
+
+    def report(self):
+        stats = summary_stats(self.summary)
+        stats['last'] = self.lag
+        return stats
+
+
+class WorkerProfiler(object):
+    """Profiling surface for a :class:`vumi.worker.BaseWorker`.
+
+    While the profiler is running, the worker's reactor thread is sampled,
+    calls to consumers, middleware and connector handlers are timed and
+    reactor lag is measured. Results are kept until the profiler is started
+    again so they can be inspected after it's stopped.
+
+    :param worker:
+        The worker to profile.
+    :param metrics:
+        An optional :class:`vumi.blinkenlights.metrics.MetricManager` that
+        handler timings and reactor lag are published through.
+    :param str dump_dir:
+        The directory the ``dump`` command writes stacks to. If ``None``,
+        the ``dump`` command is disabled.
+    """
+
+    REACTOR_LAG_METRIC = "reactor_lag"
+
+    def __init__(self, worker, metrics=None, dump_dir=None):
+        self.worker = worker
+        self.metrics = metrics
+        self.dump_dir = dump_dir
+        self.sampler = None
+        self.timings = None
+        self.lag_monitor = None
+        self.started_at = None
+
+    @property
+    def running(self):
+        return self.sampler is not None and self.sampler.running
+
+    def start(self, sample_interval=0.005, lag_interval=1.0):
+        """
+        Start (or restart) profiling, discarding any previous results.
+        """
+        self.stop()
+        self.sampler = StackSampler(sample_interval)
+        self.timings = HandlerTimings(self.metrics)
+        self.lag_monitor = ReactorLagMonitor(
+            lag_interval, callback=self._record_lag)
+        self.started_at = time.time()
+        for connector in self.worker.connectors.itervalues():
+            connector.set_timings(self.timings)
+        self.sampler.start()
+        self.lag_monitor.start()
+
+    def stop(self):
+        """
+        Stop profiling. Results are kept until the next :meth:`start`.
+        """
+        if not self.running:
+            return
+        for connector in self.worker.connectors.itervalues():
+            connector.set_timings(None)
+        self.sampler.stop()
+        self.lag_monitor.stop()
+
+    def instrument_connector(self, connector):
+        """
+        Time the handlers of a connector that was added after the profiler
+        was started.
+        """
+        if self.running:
+            connector.set_timings(self.timings)
+
+    def _record_lag(self, lag):
+        self.timings.record(self.REACTOR_LAG_METRIC, lag)
+
+    def folded_stacks(self):
+        if self.sampler is None:
+            return []
+        return self.sampler.folded()
+
+    def dump_stacks(self, filename):
+        """
+        Write the sampled stacks to ``filename`` in the folded format read
+        by flamegraph tools.
+        """
+        with open(filename, "wb") as f:
+            for line in self.folded_stacks():
+                f.write(line + "\n")
+
+    def _dump_path(self, filename):
+        if self.dump_dir is None:
+            raise ValueError("The dump command is disabled.")
+        if not filename:
+            raise ValueError("The dump command requires a filename.")
+        separators = [sep for sep in (os.sep, os.altsep) if sep]
+        if (filename in (os.curdir, os.pardir) or
+                any(sep in filename for sep in separators)):
+            raise ValueError("Invalid dump filename: %r" % (filename,))
+        return os.path.join(self.dump_dir, filename)
+
+    def status(self):
+        status = {
+            'running': self.running,
+            'started_at': self.started_at,
+            'samples': 0,
+            'reactor_lag': None,
+            'timings': {},
+        }
+        if self.sampler is not None:
+            status['samples'] = self.sampler.samples
+            status['reactor_lag'] = self.lag_monitor.report()
+            status['timings'] = self.timings.report()
+            status['timings'].pop(self.REACTOR_LAG_METRIC, None)
+        return status
+
+    def handle_command(self, command):
+        """
+        Handle a control command and return the profiler status.
+
+        Supported commands are ``start`` (with optional ``sample_interval``
+        and ``lag_interval`` fields), ``stop`` and ``dump`` (with a
+        ``filename`` field naming a file in :attr:`dump_dir`).
+        """
+        name = command.get('command')
+        if name == 'start':
+            kw = {}
+            for field in ('sample_interval', 'lag_interval'):
+                if command.get(field) is not None:
+                    kw[field] = float(command[field])
+            self.start(**kw)
+        elif name == 'stop':
+            self.stop()
+        elif name == 'dump':
+            self.dump_stacks(self._dump_path(command.get('filename')))
+        else:
+            raise ValueError("Unknown profiler command: %r" % (name,))
+        return self.status()
+
+
+class ProfilerResource(Resource):
+    """HTTP interface to a :class:`WorkerProfiler`.
+
+    * ``GET /`` returns the profiler status as JSON.
+    * ``GET /stacks`` returns the sampled stacks in folded format.
+    * ``POST /start`` starts the profiler. ``sample_interval`` and
+      ``lag_interval`` may be given as query parameters.
+    * ``POST /stop`` stops the profiler.
+    """
+
+    isLeaf = True
+
+    def __init__(self, profiler):
+        Resource.__init__(self)
+        self.profiler = profiler
+
+    def _json(self, request, data):
+        request.setHeader('Content-Type', 'application/json; charset=utf-8')
+        return json.dumps(data)
+
+    def _not_found(self, request):
+        request.setResponseCode(http.NOT_FOUND)
+        return ''
+
+    def render_GET(self, request):
+        path = request.postpath[:1]
+        if path in ([], ['']):
+            return self._json(request, self.profiler.status())
+        if path == ['stacks']:
+            request.setHeader('Content-Type', 'text/plain; charset=utf-8')
+            return ''.join(
+                line + "\n" for line in self.profiler.folded_stacks())
+        return self._not_found(request)
+
+    def render_POST(self, request):
+        path = request.postpath[:1]
+        if path not in (['start'], ['stop']):
+            return self._not_found(request)
+        command = {'command': path[0]}
+        for field in ('sample_interval', 'lag_interval'):
+            if field in request.args:
+                command[field] = request.args[field][0]
+        try:
+            status = self.profiler.handle_command(command)
+        except ValueError as e:
+            request.setResponseCode(http.BAD_REQUEST)
+            return self._json(request, {'error': str(e)})
+        return self._json(request, status)
@@ -0,0 +1,265 @@
+# -*- test-case-name: vumi.blinkenlights.tests.test_sketches -*-
+
+"""Compact, mergeable summaries of metric values.
+
+These allow metric values to be aggregated without keeping every raw value
+around, both in :class:`vumi.blinkenlights.metrics.MetricManager` (before
+values are published) and in
+:class:`vumi.blinkenlights.metrics_workers.MetricAggregator`.
+"""
+
+import math
+
+
+class QuantileSketch(object):
+    """A mergeable quantile sketch with bounded relative error.
+
+    Values are counted in logarithmically sized bins (as described in the
+    DDSketch paper), so any quantile estimate is within ``relative_accuracy``
+    of the true value. Two sketches with the same ``relative_accuracy`` can
+    be merged without losing any accuracy.
+
+    If there are more than ``max_bins`` bins for positive (or negative)
+    values, the bins for the values closest to zero are collapsed together.
+    This only affects the accuracy of the lowest quantiles.
+
+    :param float relative_accuracy:
+        The maximum relative error of quantile estimates.
+    :param int max_bins:
+        The maximum number of bins to keep for positive and negative values.
+    """
+
+    DEFAULT_RELATIVE_ACCURACY = 0.01
+    DEFAULT_MAX_BINS = 2048
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY,
+                 max_bins=DEFAULT_MAX_BINS):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(
+                "relative_accuracy must be between 0 and 1, not %r" % (
+                    relative_accuracy,))
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.count = 0
+        self.zero_count = 0
+        self.positive = {}
+        self.negative = {}
+
+    def __eq__(self, other):
+        if not isinstance(other, QuantileSketch):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def _index(self, value):
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def _bin_value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def _collapse(self, bins):
+        if len(bins) <= self.max_bins:
+            return
+        indexes = sorted(bins)
+        keep_from = indexes[-self.max_bins]
+        collapsed = sum(bins.pop(i) for i in indexes[:-self.max_bins])
+        bins[keep_from] += collapsed
+
+    def add(self, value, count=1):
+        """
+        Add ``value`` to the sketch ``count`` times.
+        """
+        if value > 0:
+            bins = self.positive
+            index = self._index(value)
+        elif value < 0:
+            bins = self.negative
+            index = self._index(-value)
+        else:
+            self.zero_count += count
+            self.count += count
+            return
+        bins[index] = bins.get(index, 0) + count
+        self.count += count
+        self._collapse(bins)
+
+    def merge(self, other):
+        """
+        Add all the values from ``other`` to this sketch.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError(
+                "Can't merge sketches with different relative accuracies:"
+                " %r != %r" % (
+                    self.relative_accuracy, other.relative_accuracy))
+        for bins, other_bins in [(self.positive, other.positive),
+                                 (self.negative, other.negative)]:
+            for index, count in other_bins.iteritems():
+                bins[index] = bins.get(index, 0) + count
+            self._collapse(bins)
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, q):
+        """
+        Estimate the value at quantile ``q`` (between 0 and 1). An empty
+        sketch returns ``0.0``.
+        """
+        if not 0 <= q <= 1:
+            raise ValueError("Quantile must be between 0 and 1, not %r" % (
+                q,))
+        if self.count == 0:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self._bin_value(index)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._bin_value(index)
+        return self._bin_value(max(self.positive))
+
+    def copy(self):
+        return self.from_dict(self.to_dict())
+
+    def to_dict(self):
+        """
+        Return a JSON-serializable representation of the sketch.
+        """
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'max_bins': self.max_bins,
+            'zero_count': self.zero_count,
+            'positive': [[i, c] for i, c in sorted(self.positive.items())],
+            'negative': [[i, c] for i, c in sorted(self.negative.items())],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['relative_accuracy'], data['max_bins'])
+        sketch.zero_count = data['zero_count']
+        sketch.positive = dict((int(i), c) for i, c in data['positive'])
+        sketch.negative = dict((int(i), c) for i, c in data['negative'])
+        sketch.count = (
+            sketch.zero_count + sum(sketch.positive.values()) +
+            sum(sketch.negative.values()))
+        return sketch
+
+
+class MetricSummary(object):
+    """Running sufficient statistics for a set of metric values.
+
+    A summary holds the count, sum, minimum, maximum and most recent value
+    of the values added to it, and a :class:`QuantileSketch` of their
+    distribution. Summaries can be merged, which makes them suitable for
+    aggregating partial results from several sources.
+
+    :param float relative_accuracy:
+        The relative accuracy of the quantile sketch.
+    """
+
+    def __init__(self,
+                 relative_accuracy=QuantileSketch.DEFAULT_RELATIVE_ACCURACY):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.last_timestamp = None
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def __repr__(self):
+        return '<MetricSummary count=%s sum=%s min=%s max=%s last=%s>' % (
+            self.count, self.sum, self.min, self.max, self.last)
+
+    def __eq__(self, other):
+        if not isinstance(other, MetricSummary):
+            return NotImplemented
+        return (self.last_timestamp == other.last_timestamp and
+                self.to_dict() == other.to_dict())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def _update_last(self, timestamp, last):
+        # When timestamps are equal we pick the larger value so that the
+        # result doesn't depend on the order values arrive in.
+        if (self.last_timestamp is None or
+                timestamp > self.last_timestamp or
+                (timestamp == self.last_timestamp and last > self.last)):
+            self.last_timestamp = timestamp
+            self.last = last
+
+    def add(self, timestamp, value):
+        """
+        Add a value recorded at ``timestamp``.
+        """
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self._update_last(timestamp, value)
+        self.sketch.add(value)
+
+    def merge(self, timestamp, other):
+        """
+        Merge ``other``, whose most recent value was recorded at
+        ``timestamp``, into this summary.
+        """
+        if other.count == 0:
+            return
+        self.count += other.count
+        self.sum += other.sum
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        self._update_last(timestamp, other.last)
+        self.sketch.merge(other.sketch)
+
+    def to_dict(self):
+        """
+        Return a JSON-serializable representation of the summary. This is
+        what is published in place of a raw value in a
+        :class:`vumi.blinkenlights.message20110818.MetricMessage`.
+        """
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'last': self.last,
+            'sketch': self.sketch.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = QuantileSketch.from_dict(data['sketch'])
+        summary = cls(sketch.relative_accuracy)
+        summary.count = data['count']
+        summary.sum = data['sum']
+        summary.min = data['min']
+        summary.max = data['max']
+        summary.last = data['last']
+        summary.sketch = sketch
+        return summary
+
+    @staticmethod
+    def is_summary_value(value):
+        """
+        Check whether a published metric value is a serialized summary
+        rather than a raw value.
+        """
+        return isinstance(value, dict)
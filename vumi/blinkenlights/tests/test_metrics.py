@@ -4,6 +4,7 @@ from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, Deferred
 
 from vumi.blinkenlights import metrics
+from vumi.blinkenlights.sketches import MetricSummary
 from vumi.message import Message
 from vumi.service import Worker
 from vumi.tests.helpers import VumiTestCase, WorkerHelper
@@ -311,6 +312,60 @@ class TestAggregators(VumiTestCase):
         self.assertRaises(metrics.AggregatorAlreadyDefinedError,
                           metrics.Aggregator, "sum", sum)
 
+    def test_summarize(self):
+        summary = MetricSummary()
+        summary.add(1234, 2.0)
+        summary.add(1235, 1.0)
+        summary.add(1234, 3.0)
+        self.assertEqual(metrics.SUM.summarize(summary), 6.0)
+        self.assertEqual(metrics.AVG.summarize(summary), 2.0)
+        self.assertEqual(metrics.MIN.summarize(summary), 1.0)
+        self.assertEqual(metrics.MAX.summarize(summary), 3.0)
+        self.assertEqual(metrics.LAST.summarize(summary), 1.0)
+
+    def test_summarize_empty(self):
+        summary = MetricSummary()
+        for agg in [metrics.SUM, metrics.AVG, metrics.MIN, metrics.MAX,
+                    metrics.LAST]:
+            self.assertEqual(agg.summarize(summary), 0.0)
+
+    def test_quantiles(self):
+        values = [float(v) for v in range(100, 0, -1)]
+        self.assertEqual(metrics.P50([]), 0.0)
+        self.assertEqual(metrics.P50(values), 50.0)
+        self.assertEqual(metrics.P90(values), 90.0)
+        self.assertEqual(metrics.P95(values), 95.0)
+        self.assertEqual(metrics.P99(values), 99.0)
+        self.assertEqual(metrics.P95.name, "p95")
+        self.assertEqual(metrics.Aggregator.from_name("p95"), metrics.P95)
+
+    def test_summarize_quantiles(self):
+        summary = MetricSummary()
+        for v in range(100, 0, -1):
+            summary.add(1234, float(v))
+        for agg, expected in [(metrics.P50, 50.0), (metrics.P90, 90.0),
+                              (metrics.P95, 95.0), (metrics.P99, 99.0)]:
+            value = agg.summarize(summary)
+            self.assertTrue(
+                abs(value - expected) <= 0.01 * expected,
+                "%s: %r not close to %r" % (agg.name, value, expected))
+
+    def test_summarize_unsupported(self):
+        agg = metrics.Aggregator("test_unsupported", sum)
+        self.add_cleanup(metrics.Aggregator.REGISTRY.pop, agg.name)
+        summary = MetricSummary()
+        summary.add(1234, 1.0)
+        self.assertRaises(ValueError, agg.summarize, summary)
+
+    def test_aggregate(self):
+        agg = metrics.Aggregator("test_count", len)
+        self.add_cleanup(metrics.Aggregator.REGISTRY.pop, agg.name)
+        self.assertEqual(agg.aggregate([1.0, 2.0]), 2)
+        summary = MetricSummary()
+        summary.add(1234, 1.0)
+        self.assertRaises(ValueError, agg.aggregate, [], summary)
+        self.assertEqual(metrics.SUM.aggregate([], summary), 1.0)
+
 
 class CheckValuesMixin(object):
 
@@ -362,6 +417,21 @@ class TestMetric(VumiTestCase, CheckValuesMixin):
         metric.set(2.0)
         self.check_poll(metric, [1.0, 2.0])
 
+    def test_poll_preaggregated(self):
+        mm = metrics.MetricManager("vumi.test.", preaggregate=True)
+        metric = mm.register(metrics.Metric("foo"))
+        self.check_poll(metric, [])
+        metric.set(1.0)
+        metric.set(3.0)
+        [summary_data] = self._check_poll_base(metric, 1)
+        summary = MetricSummary.from_dict(summary_data)
+        self.assertEqual(summary.count, 2)
+        self.assertEqual(summary.sum, 4.0)
+        self.assertEqual(summary.min, 1.0)
+        self.assertEqual(summary.max, 3.0)
+        self.assertEqual(summary.last, 3.0)
+        self.check_poll(metric, [])
+
 
 class TestCount(VumiTestCase, CheckValuesMixin):
     def test_inc_and_poll(self):
@@ -375,6 +445,17 @@ class TestCount(VumiTestCase, CheckValuesMixin):
         self.check_poll(metric, [1.0, 1.0])
 
 
+class TestGauge(VumiTestCase, CheckValuesMixin):
+    def test_poll(self):
+        values = [None, 3, 5]
+        metric = metrics.Gauge("foo", values.pop)
+        self.assertEqual(metric.aggs, ("last",))
+        self.check_poll(metric, [5])
+        self.check_poll(metric, [3])
+        # Nothing is published for None.
+        self.check_poll(metric, [])
+
+
 class TestTimer(VumiTestCase, CheckValuesMixin):
 
     def patch_time(self, starting_value):
@@ -0,0 +1,282 @@
+import logging
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, DeferredQueue)
+from twisted.internet.protocol import (
+    DatagramProtocol, Protocol, ServerFactory)
+
+from vumi.blinkenlights import metrics
+from vumi.blinkenlights.metrics_direct import (
+    DirectMetricPublisher, start_metric_manager, stop_metric_manager,
+    format_graphite, format_statsd)
+from vumi.blinkenlights.message20110818 import MetricMessage
+from vumi.blinkenlights.sketches import MetricSummary
+from vumi.service import Worker
+from vumi.tests.helpers import VumiTestCase, WorkerHelper
+from vumi.tests.utils import LogCatcher
+
+
+class UDPCatcher(DatagramProtocol):
+    def __init__(self):
+        self.queue = DeferredQueue()
+
+    def datagramReceived(self, datagram, addr):
+        self.queue.put(datagram)
+
+
+class TCPCatcher(Protocol):
+    def connectionMade(self):
+        self.factory.connections.append(self)
+        self.factory.connected.put(self)
+
+    def dataReceived(self, data):
+        self.factory.received.append(data)
+        self.factory.data.put(data)
+
+
+class TCPCatcherFactory(ServerFactory):
+    protocol = TCPCatcher
+
+    def __init__(self):
+        self.connections = []
+        self.received = []
+        self.connected = DeferredQueue()
+        self.data = DeferredQueue()
+
+
+def make_msg(*datapoints):
+    msg = MetricMessage()
+    msg.extend(datapoints)
+    return msg
+
+
+class TestLineFormats(VumiTestCase):
+    def test_graphite(self):
+        self.assertEqual(
+            format_graphite("vumi.test.foo.avg", 1.5, 1234),
+            "vumi.test.foo.avg 1.5 1234\n")
+
+    def test_statsd(self):
+        self.assertEqual(
+            format_statsd("vumi.test.foo.avg", 2, 1234),
+            "vumi.test.foo.avg:2.0|g\n")
+
+
+class TestDirectMetricPublisher(VumiTestCase):
+
+    def test_invalid_options(self):
+        self.assertRaises(
+            ValueError, DirectMetricPublisher, "localhost", 2003,
+            protocol="sctp")
+        self.assertRaises(
+            ValueError, DirectMetricPublisher, "localhost", 2003,
+            line_format="influx")
+
+    def test_from_config(self):
+        publisher = DirectMetricPublisher.from_config({
+            "host": "localhost",
+            "port": "8125",
+            "protocol": "tcp",
+            "format": "statsd",
+            "max_batch_size": "512",
+        })
+        self.assertEqual(publisher.host, "localhost")
+        self.assertEqual(publisher.port, 8125)
+        self.assertEqual(publisher.protocol, "tcp")
+        self.assertEqual(publisher.format_line, format_statsd)
+        self.assertEqual(publisher.max_batch_size, 512)
+
+    def test_aggregate(self):
+        publisher = DirectMetricPublisher("localhost", 2003)
+        summary = MetricSummary()
+        summary.add(1236, 4.0)
+        msg = make_msg(
+            ("vumi.test.foo", ["avg", "max"], [(1234, 1.0), (1235, 4.0)]),
+            ("vumi.test.bar", ["sum"], [(1236, summary.to_dict())]),
+            ("vumi.test.empty", ["sum"], []))
+        self.assertEqual(publisher.aggregate(msg), [
+            ("vumi.test.foo.avg", 2.5, 1235),
+            ("vumi.test.foo.max", 4.0, 1235),
+            ("vumi.test.bar.sum", 4.0, 1236),
+        ])
+
+    def test_aggregate_custom(self):
+        agg = metrics.Aggregator("test_count", len)
+        self.add_cleanup(metrics.Aggregator.REGISTRY.pop, agg.name)
+        publisher = DirectMetricPublisher("localhost", 2003)
+        summary = MetricSummary()
+        summary.add(1236, 4.0)
+        msg = make_msg(
+            ("vumi.test.foo", ["test_count"], [(1235, 1.0), (1234, 4.0)]),
+            ("vumi.test.bar", ["sum", "test_count"], [
+                (1236, summary.to_dict()), (1234, 2.0)]))
+        with LogCatcher(log_level=logging.WARNING) as lc:
+            aggregates = publisher.aggregate(msg)
+        self.assertEqual(aggregates, [
+            ("vumi.test.foo.test_count", 2, 1235),
+            ("vumi.test.bar.sum", 6.0, 1236),
+        ])
+        self.assertEqual(lc.messages(), [
+            "Skipping vumi.test.bar.test_count: Aggregator 'test_count'"
+            " does not support pre-aggregated values."])
+
+    def test_buffer_without_connection(self):
+        publisher = DirectMetricPublisher(
+            "localhost", 2003, max_buffered_lines=2)
+        publisher.publish_message(make_msg(
+            ("vumi.test.foo", ["avg", "max", "min"], [(1234, 1.0)])))
+        self.assertEqual(list(publisher._buffer), [
+            "vumi.test.foo.max 1.0 1234\n",
+            "vumi.test.foo.min 1.0 1234\n",
+        ])
+        self.assertEqual(publisher.lines_dropped, 1)
+        self.assertEqual(publisher.lines_sent, 0)
+
+    @inlineCallbacks
+    def start_udp(self, **kw):
+        catcher = UDPCatcher()
+        server = yield reactor.listenUDP(0, catcher, interface="127.0.0.1")
+        self.add_cleanup(server.stopListening)
+        publisher = DirectMetricPublisher(
+            "127.0.0.1", server.getHost().port, **kw)
+        yield publisher.start()
+        self.add_cleanup(publisher.stop)
+        self.udp_catcher = catcher
+        self.publisher = publisher
+
+    @inlineCallbacks
+    def test_udp(self):
+        yield self.start_udp()
+        self.publisher.publish_message(make_msg(
+            ("vumi.test.foo", ["avg", "sum"], [(1234, 1.0), (1235, 2.0)])))
+        datagram = yield self.udp_catcher.queue.get()
+        self.assertEqual(datagram, (
+            "vumi.test.foo.avg 1.5 1235\n"
+            "vumi.test.foo.sum 3.0 1235\n"))
+        self.assertEqual(self.publisher.lines_sent, 2)
+        self.assertEqual(self.publisher.batches_sent, 1)
+
+    @inlineCallbacks
+    def test_udp_batches(self):
+        yield self.start_udp(max_batch_size=60)
+        self.publisher.publish_message(make_msg(
+            ("vumi.test.foo", ["avg", "max", "min"], [(1234, 1.0)])))
+        datagrams = [(yield self.udp_catcher.queue.get()) for _ in range(2)]
+        self.assertEqual(datagrams, [
+            "vumi.test.foo.avg 1.0 1234\nvumi.test.foo.max 1.0 1234\n",
+            "vumi.test.foo.min 1.0 1234\n",
+        ])
+        self.assertEqual(self.publisher.batches_sent, 2)
+
+    @inlineCallbacks
+    def start_tcp_server(self, port=0):
+        factory = TCPCatcherFactory()
+        server = yield reactor.listenTCP(
+            port, factory, interface="127.0.0.1")
+        self.add_cleanup(server.stopListening)
+        self.add_cleanup(
+            lambda: [c.transport.loseConnection()
+                     for c in factory.connections])
+        server.factory = factory
+        returnValue(server)
+
+    @inlineCallbacks
+    def test_tcp(self):
+        server = yield self.start_tcp_server()
+        publisher = DirectMetricPublisher(
+            "127.0.0.1", server.getHost().port, protocol="tcp",
+            line_format="statsd")
+        yield publisher.start()
+        self.add_cleanup(publisher.stop)
+
+        # Lines published before we're connected are buffered.
+        publisher.publish_message(make_msg(
+            ("vumi.test.foo", ["sum"], [(1234, 1.0)])))
+        yield server.factory.connected.get()
+        data = yield server.factory.data.get()
+        self.assertEqual(data, "vumi.test.foo.sum:1.0|g\n")
+
+        publisher.publish_message(make_msg(
+            ("vumi.test.foo", ["sum"], [(1235, 2.0)])))
+        data = yield server.factory.data.get()
+        self.assertEqual(data, "vumi.test.foo.sum:2.0|g\n")
+        self.assertEqual(len(server.factory.connections), 1)
+
+    @inlineCallbacks
+    def test_tcp_reconnect(self):
+        server = yield self.start_tcp_server()
+        publisher = DirectMetricPublisher(
+            "127.0.0.1", server.getHost().port, protocol="tcp")
+        yield publisher.start()
+        self.add_cleanup(publisher.stop)
+        publisher._tcp_factory.initialDelay = 0.01
+        publisher._tcp_factory.delay = 0.01
+
+        conn = yield server.factory.connected.get()
+        conn.transport.loseConnection()
+        yield server.factory.connected.get()
+        # Wait for the publisher to see the new connection.
+        while publisher._connection is None:
+            d = Deferred()
+            reactor.callLater(0.01, d.callback, None)
+            yield d
+        publisher.publish_message(make_msg(
+            ("vumi.test.foo", ["sum"], [(1234, 1.0)])))
+        data = yield server.factory.data.get()
+        self.assertEqual(data, "vumi.test.foo.sum 1.0 1234\n")
+
+
+class TestStartMetricManager(VumiTestCase):
+
+    def setUp(self):
+        self.worker_helper = self.add_helper(WorkerHelper())
+
+    @inlineCallbacks
+    def test_amqp(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        manager = yield start_metric_manager(worker, "vumi.test.", 60)
+        self.add_cleanup(manager.stop)
+        self.assertEqual(manager.direct_publisher, None)
+        self.assertTrue(
+            isinstance(manager._publisher, metrics.MetricPublisher))
+
+    @inlineCallbacks
+    def test_direct(self):
+        catcher = UDPCatcher()
+        server = yield reactor.listenUDP(0, catcher, interface="127.0.0.1")
+        self.add_cleanup(server.stopListening)
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        manager = yield start_metric_manager(
+            worker, "vumi.test.", 60, direct_config={
+                "host": "127.0.0.1",
+                "port": server.getHost().port,
+            })
+        self.add_cleanup(manager.direct_publisher.stop)
+        self.add_cleanup(manager.stop)
+        self.assertTrue(manager._publisher is manager.direct_publisher)
+
+        manager.oneshot(metrics.Metric("foo", [metrics.SUM]), 2.0)
+        manager.publish_metrics()
+        datagram = yield catcher.queue.get()
+        name, value, _timestamp = datagram.split()
+        self.assertEqual((name, value), ("vumi.test.foo.sum", "2.0"))
+
+    @inlineCallbacks
+    def test_stop_metric_manager(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        manager = yield start_metric_manager(worker, "vumi.test.", 60)
+        yield stop_metric_manager(manager)
+        self.assertEqual(manager._task, None)
+
+    @inlineCallbacks
+    def test_stop_metric_manager_direct(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        manager = yield start_metric_manager(
+            worker, "vumi.test.", 60, direct_config={
+                "host": "127.0.0.1",
+                "port": 2003,
+            })
+        yield stop_metric_manager(manager)
+        self.assertEqual(manager._task, None)
+        self.assertEqual(manager.direct_publisher._udp_port, None)
@@ -1,10 +1,15 @@
+import logging
+
 from twisted.internet.defer import inlineCallbacks, Deferred, DeferredQueue
 from twisted.internet.protocol import DatagramProtocol
 from twisted.internet import reactor
 
 from vumi.blinkenlights import metrics_workers
+from vumi.blinkenlights.metrics import Aggregator
 from vumi.blinkenlights.message20110818 import MetricMessage
+from vumi.blinkenlights.sketches import MetricSummary
 from vumi.tests.helpers import VumiTestCase, WorkerHelper
+from vumi.tests.utils import LogCatcher
 
 
 class BrokerWrapper(object):
@@ -52,8 +57,8 @@ class TestMetricTimeBucket(VumiTestCase):
         expected_buckets = [
             [],
             [[[u'vumi.test.bar', ['sum'], [[1240, 1.0]]]]],
-            [[[u'vumi.test.foo', ['agg'], [[1230, 1.5]]]],
-             [[u'vumi.test.foo', ['agg'], [[1235, 2.0]]]]],
+            [[[u'vumi.test.foo', ['agg'], [[1230, 1.5]]],
+              [u'vumi.test.foo', ['agg'], [[1235, 2.0]]]]],
             [],
             ]
 
@@ -61,6 +66,64 @@ class TestMetricTimeBucket(VumiTestCase):
 
         yield worker.stopWorker()
 
+    @inlineCallbacks
+    def test_one_message_per_bucket(self):
+        config = {'buckets': 4, 'bucket_size': 5}
+        worker = yield self.worker_helper.get_worker(
+            metrics_workers.MetricTimeBucket, config=config)
+        broker = BrokerWrapper(self.worker_helper.broker)
+
+        datapoints = [
+            ("vumi.test.m%d" % i, ("sum",), [(1230, 1.0)]) for i in range(50)]
+        broker.send_datapoints("vumi.metrics", "vumi.metrics", datapoints)
+        yield broker.kick_delivery()
+
+        buckets = [broker.recv_datapoints("vumi.metrics.buckets",
+                                          "bucket.%d" % i) for i in range(4)]
+        self.assertTrue(all(len(msgs) <= 1 for msgs in buckets))
+        received = [dp for msgs in buckets for msg in msgs for dp in msg]
+        self.assertEqual(len(received), 50)
+        publisher = worker.publisher
+        self.assertEqual(publisher.flushes, 1)
+        self.assertEqual(
+            publisher.messages_published, sum(len(m) for m in buckets))
+        self.assertEqual(publisher.datapoints_published, 50)
+
+        yield worker.stopWorker()
+
+    def test_bucket_cache(self):
+        publisher = metrics_workers.TimeBucketPublisher(4, 5)
+        for ts_key in range(10):
+            self.assertEqual(
+                publisher._cached_find_bucket("vumi.test.foo", ts_key),
+                publisher.find_bucket("vumi.test.foo", ts_key))
+        self.assertEqual(
+            sorted(publisher._bucket_cache),
+            range(10 - publisher.CACHED_TS_KEYS, 10))
+
+    @inlineCallbacks
+    def test_log_publish_stats(self):
+        config = {'buckets': 4, 'bucket_size': 5}
+        worker = yield self.worker_helper.get_worker(
+            metrics_workers.MetricTimeBucket, config=config)
+        broker = BrokerWrapper(self.worker_helper.broker)
+        broker.send_datapoints("vumi.metrics", "vumi.metrics", [
+            ("vumi.test.foo", ("sum",), [(1230, 1.5), (1235, 2.0)]),
+        ])
+        yield broker.kick_delivery()
+
+        with LogCatcher() as lc:
+            worker.log_publish_stats()
+            worker.log_publish_stats()
+        self.assertEqual(lc.messages(), [
+            "Published 1 messages with 2 datapoints for 1 incoming messages"
+            " (1.0 messages per flush).",
+            "Published 0 messages with 0 datapoints for 0 incoming messages"
+            " (0.0 messages per flush).",
+        ])
+
+        yield worker.stopWorker()
+
 
 class TestMetricAggregator(VumiTestCase):
 
@@ -152,6 +215,129 @@ class TestMetricAggregator(VumiTestCase):
         worker.check_buckets()
         self.assertEqual(recv(), expected)
 
+    @inlineCallbacks
+    def test_aggregating_preaggregated(self):
+        config = {'bucket': 3, 'bucket_size': 5}
+        worker = yield self.worker_helper.get_worker(
+            metrics_workers.MetricAggregator, config, start=False)
+        worker._time = self.fake_time
+        yield worker.startWorker()
+
+        summary = MetricSummary()
+        summary.add(1235, 3.0)
+        summary.add(1236, 1.0)
+        aggs = ("avg", "last", "max", "min", "sum")
+        self.broker.send_datapoints("vumi.metrics.buckets", "bucket.3", [
+            ("vumi.test.foo", aggs, [(1236, summary.to_dict())]),
+            ("vumi.test.foo", aggs, [(1237, 2.0)]),
+        ])
+        yield self.broker.kick_delivery()
+
+        self.now = 1246
+        worker.check_buckets()
+        msgs = self.broker.recv_datapoints(
+            "vumi.metrics.aggregates", "vumi.metrics.aggregates")
+        self.assertEqual(sorted(dp for msg in msgs for dp in msg), [
+            ["vumi.test.foo.avg", [], [[1235, 2.0]]],
+            ["vumi.test.foo.last", [], [[1235, 2.0]]],
+            ["vumi.test.foo.max", [], [[1235, 3.0]]],
+            ["vumi.test.foo.min", [], [[1235, 1.0]]],
+            ["vumi.test.foo.sum", [], [[1235, 6.0]]],
+        ])
+
+    @inlineCallbacks
+    def test_aggregating_quantiles(self):
+        config = {'bucket': 3, 'bucket_size': 5}
+        worker = yield self.worker_helper.get_worker(
+            metrics_workers.MetricAggregator, config, start=False)
+        worker._time = self.fake_time
+        yield worker.startWorker()
+
+        # Values for the same metric arrive from different sources, some of
+        # them pre-aggregated.
+        summary = MetricSummary()
+        for v in range(1, 51):
+            summary.add(1235, float(v))
+        raw_values = [(1236, float(v)) for v in range(51, 101)]
+        self.broker.send_datapoints("vumi.metrics.buckets", "bucket.3", [
+            ("vumi.test.foo", ("p50",), [(1235, summary.to_dict())]),
+            ("vumi.test.foo", ("p99",), raw_values),
+        ])
+        yield self.broker.kick_delivery()
+
+        self.now = 1246
+        worker.check_buckets()
+        msgs = self.broker.recv_datapoints(
+            "vumi.metrics.aggregates", "vumi.metrics.aggregates")
+        results = dict(
+            (name, points[0][1]) for msg in msgs for name, _, points in msg)
+        self.assertEqual(sorted(results), [
+            "vumi.test.foo.p50", "vumi.test.foo.p99"])
+        self.assertTrue(abs(results["vumi.test.foo.p50"] - 50.0) <= 0.5)
+        self.assertTrue(abs(results["vumi.test.foo.p99"] - 99.0) <= 0.99)
+
+    def register_aggregator(self, name, func):
+        agg = Aggregator(name, func)
+        self.add_cleanup(Aggregator.REGISTRY.pop, name)
+        return agg
+
+    @inlineCallbacks
+    def test_aggregating_custom(self):
+        self.register_aggregator("test_count", len)
+        config = {'bucket': 3, 'bucket_size': 5}
+        worker = yield self.worker_helper.get_worker(
+            metrics_workers.MetricAggregator, config, start=False)
+        worker._time = self.fake_time
+        yield worker.startWorker()
+
+        self.broker.send_datapoints("vumi.metrics.buckets", "bucket.3", [
+            ("vumi.test.foo", ("test_count",), [(1235, 1.5), (1236, 2.0)]),
+            ("vumi.test.foo", ("test_count",), [(1237, 1.0)]),
+        ])
+        yield self.broker.kick_delivery()
+
+        self.now = 1246
+        worker.check_buckets()
+        self.assertEqual(self.broker.recv_datapoints(
+            "vumi.metrics.aggregates", "vumi.metrics.aggregates"), [
+            [["vumi.test.foo.test_count", [], [[1235, 3]]]],
+        ])
+        self.assertEqual(worker.buckets, {})
+
+    @inlineCallbacks
+    def test_aggregating_custom_preaggregated(self):
+        self.register_aggregator("test_count", len)
+        config = {'bucket': 3, 'bucket_size': 5}
+        worker = yield self.worker_helper.get_worker(
+            metrics_workers.MetricAggregator, config, start=False)
+        worker._time = self.fake_time
+        yield worker.startWorker()
+
+        summary = MetricSummary()
+        summary.add(1235, 3.0)
+        aggs = ("sum", "test_count")
+        self.broker.send_datapoints("vumi.metrics.buckets", "bucket.3", [
+            ("vumi.test.foo", aggs, [(1236, 2.0)]),
+            ("vumi.test.foo", aggs, [(1235, summary.to_dict())]),
+            ("vumi.test.bar", aggs, [(1237, 1.0)]),
+        ])
+        yield self.broker.kick_delivery()
+
+        self.now = 1246
+        with LogCatcher(log_level=logging.WARNING) as lc:
+            worker.check_buckets()
+        self.assertEqual(lc.messages(), [
+            "Skipping vumi.test.foo.test_count: Aggregator 'test_count'"
+            " does not support pre-aggregated values."])
+        msgs = self.broker.recv_datapoints(
+            "vumi.metrics.aggregates", "vumi.metrics.aggregates")
+        self.assertEqual(sorted(dp for msg in msgs for dp in msg), [
+            ["vumi.test.bar.sum", [], [[1235, 1.0]]],
+            ["vumi.test.bar.test_count", [], [[1235, 1]]],
+            ["vumi.test.foo.sum", [], [[1235, 5.0]]],
+        ])
+        self.assertEqual(worker.buckets, {})
+
     @inlineCallbacks
     def test_aggregating_lag(self):
         config = {'bucket': 3, 'bucket_size': 5, 'lag': 1}
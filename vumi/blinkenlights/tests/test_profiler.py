@@ -0,0 +1,295 @@
+import json
+import os
+import sys
+import time
+
+from twisted.internet.defer import inlineCallbacks, succeed, fail
+from twisted.internet.task import Clock
+from twisted.web.test.test_web import DummyRequest
+
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.blinkenlights.profiler import (
+    StackSampler, HandlerTimings, ReactorLagMonitor, WorkerProfiler,
+    ProfilerResource)
+from vumi.tests.helpers import VumiTestCase
+
+
+def outer(sampler):
+    return inner(sampler)
+
+
+def inner(sampler):
+    sampler.sample(sys._getframe())
+
+
+class TestStackSampler(VumiTestCase):
+
+    def test_sample_frame(self):
+        sampler = StackSampler()
+        outer(sampler)
+        outer(sampler)
+        self.assertEqual(sampler.samples, 2)
+        [(stack, count)] = sampler.stacks.items()
+        self.assertEqual(count, 2)
+        frames = stack.split(";")
+        self.assertTrue(frames[-2].startswith("outer ("))
+        self.assertTrue(frames[-1].startswith("inner ("))
+        self.assertTrue(frames[-3].startswith("test_sample_frame ("))
+
+    def test_max_depth(self):
+        sampler = StackSampler(max_depth=2)
+        outer(sampler)
+        [stack] = sampler.stacks.keys()
+        self.assertEqual(
+            [frame.split(" ")[0] for frame in stack.split(";")],
+            ["outer", "inner"])
+
+    def test_folded(self):
+        sampler = StackSampler()
+        sampler.stacks.update({"a;b": 3, "a": 1})
+        self.assertEqual(sampler.folded(), ["a 1", "a;b 3"])
+
+    def test_reset(self):
+        sampler = StackSampler()
+        outer(sampler)
+        sampler.reset()
+        self.assertEqual(sampler.samples, 0)
+        self.assertEqual(sampler.folded(), [])
+
+    def test_start_and_stop(self):
+        sampler = StackSampler(interval=0.001)
+        sampler.start()
+        self.add_cleanup(sampler.stop)
+        self.assertTrue(sampler.running)
+        # Block this thread so that the sampler has something to sample.
+        time.sleep(0.05)
+        sampler.stop()
+        self.assertFalse(sampler.running)
+        self.assertTrue(sampler.samples > 0)
+        self.assertTrue(any(
+            "test_start_and_stop" in stack for stack in sampler.stacks))
+
+
+class TestHandlerTimings(VumiTestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.timings = HandlerTimings()
+        self.timings.clock = lambda: self.now
+
+    def test_record(self):
+        for i in range(1, 101):
+            self.timings.record("foo", float(i))
+        report = self.timings.report()
+        self.assertEqual(report.keys(), ["foo"])
+        self.assertEqual(report["foo"]["count"], 100)
+        self.assertEqual(report["foo"]["mean"], 50.5)
+        self.assertEqual(report["foo"]["max"], 100.0)
+        self.assertTrue(abs(report["foo"]["p99"] - 99.0) < 1.0)
+
+    def test_record_metrics(self):
+        metrics = MetricManager("prefix.", preaggregate=True)
+        self.timings = HandlerTimings(metrics)
+        self.timings.record("foo", 1.0)
+        self.timings.record("foo", 2.0)
+        timer = metrics["foo"]
+        self.assertEqual(timer.aggs, ("avg", "max", "p95", "p99"))
+        [(_, summary)] = timer.poll()
+        self.assertEqual(summary["count"], 2)
+
+    @inlineCallbacks
+    def test_timed(self):
+        def handler(value):
+            self.now += 0.5
+            return succeed(value * 2)
+
+        result = yield self.timings.timed("double", handler)(2)
+        self.assertEqual(result, 4)
+        self.assertEqual(self.timings.report()["double"]["mean"], 0.5)
+
+    @inlineCallbacks
+    def test_timed_failure(self):
+        def handler():
+            return fail(ValueError("bad"))
+
+        d = self.timings.timed("bad", handler)()
+        yield self.assertFailure(d, ValueError)
+        self.assertEqual(self.timings.report()["bad"]["count"], 1)
+
+    def test_reset(self):
+        self.timings.record("foo", 1.0)
+        self.timings.reset()
+        self.assertEqual(self.timings.report(), {})
+
+
+class TestReactorLagMonitor(VumiTestCase):
+
+    def test_lag(self):
+        clock = Clock()
+        lags = []
+        monitor = ReactorLagMonitor(1.0, callback=lags.append, clock=clock)
+        monitor.start()
+        self.assertTrue(monitor.running)
+        clock.advance(1.0)
+        clock.advance(1.5)
+        self.assertEqual(lags, [0.0, 0.5])
+        self.assertEqual(monitor.lag, 0.5)
+        report = monitor.report()
+        self.assertEqual(report["count"], 2)
+        self.assertEqual(report["max"], 0.5)
+        self.assertEqual(report["last"], 0.5)
+
+    def test_stop(self):
+        clock = Clock()
+        monitor = ReactorLagMonitor(1.0, clock=clock)
+        monitor.start()
+        monitor.stop()
+        self.assertFalse(monitor.running)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+class FakeConnector(object):
+    timings = None
+
+    def set_timings(self, timings):
+        self.timings = timings
+
+
+class FakeWorker(object):
+    def __init__(self):
+        self.connectors = {"foo": FakeConnector()}
+
+
+class TestWorkerProfiler(VumiTestCase):
+
+    def setUp(self):
+        self.worker = FakeWorker()
+        self.profiler = WorkerProfiler(self.worker)
+        self.add_cleanup(self.profiler.stop)
+
+    def test_status_not_started(self):
+        self.assertEqual(self.profiler.status(), {
+            'running': False,
+            'started_at': None,
+            'samples': 0,
+            'reactor_lag': None,
+            'timings': {},
+        })
+
+    def test_start_and_stop(self):
+        connector = self.worker.connectors["foo"]
+        self.profiler.start()
+        self.assertTrue(self.profiler.running)
+        self.assertEqual(connector.timings, self.profiler.timings)
+        self.assertTrue(self.profiler.lag_monitor.running)
+        self.profiler.stop()
+        self.assertFalse(self.profiler.running)
+        self.assertEqual(connector.timings, None)
+        self.assertFalse(self.profiler.lag_monitor.running)
+
+    def test_instrument_connector(self):
+        connector = FakeConnector()
+        self.profiler.instrument_connector(connector)
+        self.assertEqual(connector.timings, None)
+        self.profiler.start()
+        self.profiler.instrument_connector(connector)
+        self.assertEqual(connector.timings, self.profiler.timings)
+
+    def test_status(self):
+        self.profiler.start()
+        self.profiler.timings.record("handler.foo.inbound", 0.25)
+        self.profiler._record_lag(0.1)
+        status = self.profiler.status()
+        self.assertTrue(status['running'])
+        self.assertEqual(status['timings'].keys(), ['handler.foo.inbound'])
+
+    def test_dump_stacks(self):
+        self.profiler.start()
+        self.profiler.stop()
+        self.profiler.sampler.stacks.update({"a;b": 2})
+        filename = self.mktemp()
+        self.profiler.dump_stacks(filename)
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), "a;b 2\n")
+
+    def test_handle_command(self):
+        status = self.profiler.handle_command(
+            {'command': 'start', 'sample_interval': '0.01'})
+        self.assertTrue(status['running'])
+        self.assertEqual(self.profiler.sampler.interval, 0.01)
+        status = self.profiler.handle_command({'command': 'stop'})
+        self.assertFalse(status['running'])
+
+    def test_handle_command_dump(self):
+        self.profiler.dump_dir = self.mktemp()
+        os.mkdir(self.profiler.dump_dir)
+        self.profiler.handle_command({'command': 'dump', 'filename': 'foo'})
+        with open(os.path.join(self.profiler.dump_dir, 'foo'), "rb") as f:
+            self.assertEqual(f.read(), "")
+        self.assertRaises(
+            ValueError, self.profiler.handle_command, {'command': 'dump'})
+
+    def test_handle_command_dump_bad_filename(self):
+        self.profiler.dump_dir = self.mktemp()
+        os.mkdir(self.profiler.dump_dir)
+        for filename in ['../foo', '/tmp/foo', 'a/b', '..', '.']:
+            self.assertRaises(
+                ValueError, self.profiler.handle_command,
+                {'command': 'dump', 'filename': filename})
+        self.assertEqual(os.listdir(self.profiler.dump_dir), [])
+
+    def test_handle_command_dump_disabled(self):
+        filename = self.mktemp()
+        self.assertRaises(
+            ValueError, self.profiler.handle_command,
+            {'command': 'dump', 'filename': filename})
+        self.assertFalse(os.path.exists(filename))
+
+    def test_handle_command_unknown(self):
+        self.assertRaises(
+            ValueError, self.profiler.handle_command, {'command': 'foo'})
+
+
+class TestProfilerResource(VumiTestCase):
+
+    def setUp(self):
+        self.profiler = WorkerProfiler(FakeWorker())
+        self.add_cleanup(self.profiler.stop)
+        self.resource = ProfilerResource(self.profiler)
+
+    def render(self, method, path, args=None):
+        request = DummyRequest(path)
+        request.method = method
+        request.args = args or {}
+        return request, self.resource.render(request)
+
+    def test_status(self):
+        request, body = self.render('GET', [''])
+        self.assertEqual(json.loads(body)['running'], False)
+
+    def test_stacks(self):
+        self.profiler.start()
+        self.profiler.stop()
+        self.profiler.sampler.stacks.update({"a;b": 2})
+        request, body = self.render('GET', ['stacks'])
+        self.assertEqual(body, "a;b 2\n")
+
+    def test_start_and_stop(self):
+        request, body = self.render(
+            'POST', ['start'], {'sample_interval': ['0.01']})
+        self.assertTrue(json.loads(body)['running'])
+        self.assertEqual(self.profiler.sampler.interval, 0.01)
+        request, body = self.render('POST', ['stop'])
+        self.assertFalse(json.loads(body)['running'])
+
+    def test_bad_interval(self):
+        request, body = self.render(
+            'POST', ['start'], {'sample_interval': ['soon']})
+        self.assertEqual(request.responseCode, 400)
+        self.assertFalse(self.profiler.running)
+
+    def test_not_found(self):
+        request, body = self.render('GET', ['nope'])
+        self.assertEqual(request.responseCode, 404)
+        request, body = self.render('POST', ['nope'])
+        self.assertEqual(request.responseCode, 404)
@@ -0,0 +1,139 @@
+import json
+import random
+
+from vumi.blinkenlights.sketches import QuantileSketch, MetricSummary
+from vumi.tests.helpers import VumiTestCase
+
+
+class TestQuantileSketch(VumiTestCase):
+
+    def assert_close(self, value, expected, accuracy=0.01):
+        self.assertTrue(
+            abs(value - expected) <= accuracy * abs(expected),
+            "%r not within %s of %r" % (value, accuracy, expected))
+
+    def test_empty(self):
+        sketch = QuantileSketch()
+        self.assertEqual(sketch.count, 0)
+        self.assertEqual(sketch.quantile(0.5), 0.0)
+
+    def test_invalid_relative_accuracy(self):
+        self.assertRaises(ValueError, QuantileSketch, 0)
+        self.assertRaises(ValueError, QuantileSketch, 1)
+
+    def test_invalid_quantile(self):
+        sketch = QuantileSketch()
+        self.assertRaises(ValueError, sketch.quantile, -0.1)
+        self.assertRaises(ValueError, sketch.quantile, 1.1)
+
+    def test_quantiles(self):
+        sketch = QuantileSketch()
+        values = range(1, 1001)
+        random.shuffle(values)
+        for value in values:
+            sketch.add(value)
+        self.assertEqual(sketch.count, 1000)
+        self.assert_close(sketch.quantile(0), 1)
+        self.assert_close(sketch.quantile(0.5), 500)
+        self.assert_close(sketch.quantile(0.95), 950)
+        self.assert_close(sketch.quantile(0.99), 990)
+        self.assert_close(sketch.quantile(1), 1000)
+
+    def test_zero_and_negative_values(self):
+        sketch = QuantileSketch()
+        for value in [-10, -1, 0, 0, 1, 10]:
+            sketch.add(value)
+        self.assert_close(sketch.quantile(0), -10)
+        self.assertEqual(sketch.quantile(0.5), 0.0)
+        self.assert_close(sketch.quantile(1), 10)
+
+    def test_add_count(self):
+        sketch = QuantileSketch()
+        sketch.add(5, count=3)
+        self.assertEqual(sketch.count, 3)
+        self.assert_close(sketch.quantile(0.5), 5)
+
+    def test_max_bins(self):
+        sketch = QuantileSketch(max_bins=10)
+        for value in range(1, 1001):
+            sketch.add(value)
+        self.assertEqual(len(sketch.positive), 10)
+        self.assertEqual(sketch.count, 1000)
+        self.assert_close(sketch.quantile(1), 1000)
+
+    def test_merge(self):
+        sketch1 = QuantileSketch()
+        sketch2 = QuantileSketch()
+        combined = QuantileSketch()
+        for value in range(1, 501):
+            sketch1.add(value)
+            combined.add(value)
+        for value in range(501, 1001):
+            sketch2.add(value)
+            combined.add(value)
+        sketch1.merge(sketch2)
+        self.assertEqual(sketch1, combined)
+
+    def test_merge_different_accuracy(self):
+        self.assertRaises(
+            ValueError, QuantileSketch(0.01).merge, QuantileSketch(0.02))
+
+    def test_serialization(self):
+        sketch = QuantileSketch()
+        for value in [-2.5, 0, 1, 2, 3.5]:
+            sketch.add(value)
+        data = json.loads(json.dumps(sketch.to_dict()))
+        self.assertEqual(QuantileSketch.from_dict(data), sketch)
+        self.assertEqual(QuantileSketch.from_dict(data).count, 5)
+
+
+class TestMetricSummary(VumiTestCase):
+
+    def test_empty(self):
+        summary = MetricSummary()
+        self.assertEqual(summary.count, 0)
+        self.assertEqual(summary.last, None)
+
+    def test_add(self):
+        summary = MetricSummary()
+        summary.add(1235, 2.0)
+        summary.add(1234, 3.0)
+        summary.add(1235, 1.0)
+        self.assertEqual(summary.count, 3)
+        self.assertEqual(summary.sum, 6.0)
+        self.assertEqual(summary.min, 1.0)
+        self.assertEqual(summary.max, 3.0)
+        self.assertEqual(summary.last, 2.0)
+        self.assertEqual(summary.last_timestamp, 1235)
+        self.assertEqual(summary.sketch.count, 3)
+
+    def test_merge(self):
+        summary1 = MetricSummary()
+        summary1.add(1234, 1.0)
+        summary1.add(1236, 5.0)
+        summary2 = MetricSummary()
+        summary2.add(1235, 0.5)
+        summary1.merge(1235, summary2)
+        self.assertEqual(summary1.count, 3)
+        self.assertEqual(summary1.sum, 6.5)
+        self.assertEqual(summary1.min, 0.5)
+        self.assertEqual(summary1.max, 5.0)
+        self.assertEqual(summary1.last, 5.0)
+        self.assertEqual(summary1.sketch.count, 3)
+
+    def test_merge_empty(self):
+        summary = MetricSummary()
+        summary.add(1234, 1.0)
+        summary.merge(1240, MetricSummary())
+        self.assertEqual(summary.count, 1)
+        self.assertEqual(summary.last_timestamp, 1234)
+
+    def test_serialization(self):
+        summary = MetricSummary()
+        summary.add(1234, 1.0)
+        summary.add(1235, 2.0)
+        data = json.loads(json.dumps(summary.to_dict()))
+        self.assertTrue(MetricSummary.is_summary_value(data))
+        self.assertFalse(MetricSummary.is_summary_value(1.0))
+        restored = MetricSummary.from_dict(data)
+        self.assertEqual(restored.to_dict(), summary.to_dict())
@@ -0,0 +1,117 @@
+from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.task import Clock
+
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.blinkenlights.worker_metrics import WorkerMetrics, get_rss
+from vumi.tests.helpers import VumiTestCase, MessageHelper, WorkerHelper
+from vumi.worker import BaseWorker
+
+
+class DummyWorker(BaseWorker):
+    def setup_connectors(self):
+        pass
+
+    def setup_worker(self):
+        pass
+
+    def teardown_worker(self):
+        pass
+
+
+class FakeThreadPool(object):
+    def __init__(self, queued):
+        self.q = FakeQueue(queued)
+
+
+class FakeQueue(object):
+    def __init__(self, queued):
+        self.queued = queued
+
+    def qsize(self):
+        return self.queued
+
+
+class TestGetRss(VumiTestCase):
+
+    def test_get_rss(self):
+        self.assertTrue(get_rss() > 0)
+
+
+class TestWorkerMetrics(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.msg_helper = self.add_helper(MessageHelper())
+        self.worker_helper = self.add_helper(WorkerHelper())
+        self.worker = yield self.worker_helper.get_worker(DummyWorker, {})
+        self.clock = Clock()
+        self.metrics = MetricManager('worker.', preaggregate=True)
+        self.worker_metrics = WorkerMetrics(
+            self.worker, self.metrics, clock=self.clock)
+        self.add_cleanup(self.worker_metrics.stop)
+
+    def test_metrics_registered(self):
+        self.assertEqual(sorted(m.name for m in self.metrics._metrics), [
+            'consumers.in_progress',
+            'consumers.prefetch_utilisation',
+            'memory.rss',
+            'publish_latency',
+            'reactor_lag',
+            'threadpool.queue',
+        ])
+
+    def test_reactor_lag(self):
+        self.worker_metrics.start()
+        self.clock.advance(1.5)
+        [(_, summary)] = self.worker_metrics.reactor_lag.poll()
+        self.assertEqual(summary['max'], 0.5)
+        self.assertEqual(self.worker_metrics.stats()['reactor_lag'], 0.5)
+
+    def test_stop(self):
+        self.worker_metrics.start()
+        self.worker_metrics.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    @inlineCallbacks
+    def test_in_progress(self):
+        handler_wait = Deferred()
+        handler_continue = Deferred()
+
+        def handler(msg):
+            handler_wait.callback(None)
+            return handler_continue
+
+        connector = yield self.worker.setup_ri_connector('foo')
+        connector.set_default_inbound_handler(handler)
+        connector.unpause()
+        self.assertEqual(self.worker_metrics.in_progress(), 0)
+        self.assertEqual(self.worker_metrics.prefetch_utilisation(), 0.0)
+        self.worker_helper.dispatch_inbound(
+            self.msg_helper.make_inbound("inbound"), 'foo')
+        yield handler_wait
+        self.assertEqual(self.worker_metrics.in_progress(), 1)
+        # Only the inbound consumer has a message out of the two consumers
+        # with a prefetch count of 20 each.
+        self.assertEqual(self.worker_metrics.prefetch_utilisation(), 0.025)
+        handler_continue.callback(None)
+        yield self.worker_helper.kick_delivery()
+        self.assertEqual(self.worker_metrics.in_progress(), 0)
+
+    def test_prefetch_utilisation_no_consumers(self):
+        self.assertEqual(self.worker_metrics.prefetch_utilisation(), None)
+
+    def test_threadpool_queue(self):
+        self.assertEqual(self.worker_metrics.threadpool_queue(), 0)
+        self.clock.threadpool = FakeThreadPool(3)
+        self.assertEqual(self.worker_metrics.threadpool_queue(), 3)
+
+    @inlineCallbacks
+    def test_publish_latency(self):
+        connector = yield self.worker.setup_ri_connector('foo')
+        self.worker_metrics.start()
+        self.assertEqual(
+            connector.publish_timer, self.worker_metrics.publish_latency)
+        yield connector.publish_outbound(
+            self.msg_helper.make_outbound("outbound"))
+        [(_, summary)] = self.worker_metrics.publish_latency.poll()
+        self.assertEqual(summary['count'], 1)
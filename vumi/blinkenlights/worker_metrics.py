@@ -0,0 +1,125 @@
+# -*- test-case-name: vumi.blinkenlights.tests.test_worker_metrics -*-
+
+"""Standard performance metrics for workers."""
+
+import resource
+import sys
+
+from twisted.internet import reactor
+
+from vumi.blinkenlights.metrics import Metric, Gauge, Timer, AVG, MAX, P95
+from vumi.blinkenlights.profiler import ReactorLagMonitor
+
+
+def get_rss():
+    """
+    Return the resident set size of this process in bytes.
+
+    Where ``/proc`` isn't available, the peak resident set size is returned
+    instead.
+    """
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, ValueError, IndexError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on OS X and kilobytes elsewhere.
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class WorkerMetrics(object):
+    """Gauges describing how busy a :class:`vumi.worker.BaseWorker` is.
+
+    The following metrics are registered on ``metrics``:
+
+    * ``reactor_lag``: how late the reactor runs scheduled calls.
+    * ``consumers.in_progress``: messages being processed by consumers.
+    * ``consumers.prefetch_utilisation``: the fraction of the prefetch
+      window of consumers with a prefetch count that is in use.
+    * ``memory.rss``: the resident set size of the process in bytes.
+    * ``threadpool.queue``: work waiting for a reactor thread pool thread.
+    * ``publish_latency``: the time taken to run publish middleware and
+      publish a message from a connector.
+
+    :param worker:
+        The worker to measure.
+    :param metrics:
+        The :class:`vumi.blinkenlights.metrics.MetricManager` to register
+        metrics on.
+    :param float lag_interval:
+        Seconds between reactor lag measurements.
+    :param clock:
+        The reactor to measure. Defaults to the global reactor.
+    """
+
+    def __init__(self, worker, metrics, lag_interval=1.0, clock=None):
+        self.worker = worker
+        self.metrics = metrics
+        self.clock = clock if clock is not None else reactor
+        self.lag_monitor = ReactorLagMonitor(
+            lag_interval, callback=self._record_lag, clock=self.clock)
+        self.reactor_lag = metrics.register(
+            Metric("reactor_lag", aggregators=[AVG, MAX]))
+        self.publish_latency = metrics.register(
+            Timer("publish_latency", aggregators=[AVG, MAX, P95]))
+        metrics.register(Gauge("consumers.in_progress", self.in_progress))
+        metrics.register(Gauge(
+            "consumers.prefetch_utilisation", self.prefetch_utilisation))
+        metrics.register(Gauge("memory.rss", get_rss))
+        metrics.register(Gauge("threadpool.queue", self.threadpool_queue))
+
+    def start(self):
+        for connector in self.worker.connectors.itervalues():
+            self.instrument_connector(connector)
+        self.lag_monitor.start()
+
+    def stop(self):
+        self.lag_monitor.stop()
+        for connector in self.worker.connectors.itervalues():
+            connector.publish_timer = None
+
+    def instrument_connector(self, connector):
+        connector.publish_timer = self.publish_latency
+
+    def _record_lag(self, lag):
+        self.reactor_lag.set(lag)
+
+    def _consumers(self):
+        for connector in self.worker.connectors.itervalues():
+            for consumer in connector._consumers.itervalues():
+                yield consumer
+
+    def in_progress(self):
+        return sum(getattr(consumer, '_in_progress', 0)
+                   for consumer in self._consumers())
+
+    def prefetch_utilisation(self):
+        in_progress, prefetch = 0, 0
+        for consumer in self._consumers():
+            if consumer.prefetch_count:
+                in_progress += getattr(consumer, '_in_progress', 0)
+                prefetch += consumer.prefetch_count
+        if not prefetch:
+            return None
+        return float(in_progress) / prefetch
+
+    def threadpool_queue(self):
+        # Don't use getThreadPool() here, because that creates a thread pool
+        # if there isn't one yet.
+        threadpool = getattr(self.clock, 'threadpool', None)
+        if threadpool is None:
+            return 0
+        return threadpool.q.qsize()
+
+    def stats(self):
+        """
+        Return the current value of each gauge, for including in
+        heartbeats.
+        """
+        return {
+            'reactor_lag': self.lag_monitor.lag,
+            'in_progress': self.in_progress(),
+            'prefetch_utilisation': self.prefetch_utilisation(),
+            'rss': get_rss(),
+            'threadpool_queue': self.threadpool_queue(),
+        }
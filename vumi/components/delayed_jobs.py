@@ -0,0 +1,269 @@
+# -*- test-case-name: vumi.components.tests.test_delayed_jobs -*-
+
+"""A Redis-backed queue of jobs to deliver at a later time.
+
+Each job has an id, a due time (in seconds since the epoch) and an optional
+string of data. Due times are kept in a single sorted set scored by due time
+and the data in a hash, so finding the jobs that are due is a single range
+query however far apart they are scheduled.
+
+Due jobs are claimed in batches by a Lua script that atomically pushes their
+scores forward by a lease timeout, so several processes can share a queue
+without delivering the same job twice. A claimed job is only removed once it
+has been delivered. If delivery fails (or the process dies part way through),
+the job becomes due again when its lease runs out, so delivery is at least
+once.
+"""
+
+from collections import namedtuple
+from uuid import uuid4
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, DeferredSemaphore,
+    gatherResults, succeed)
+from twisted.internet.task import LoopingCall
+
+from vumi import log
+from vumi.blinkenlights.metrics import Count, Gauge
+from vumi.persist.redis_base import Manager, RedisScript
+
+
+def _claim_due_jobs(redis, keys, args):
+    due_key, data_key = keys
+    now, limit, lease_until = args
+    claimed = []
+    for job_id, due in redis.zrangebyscore(
+            due_key, '-inf', now, start=0, num=int(limit), withscores=True):
+        redis.zadd(due_key, **{job_id: lease_until})
+        claimed.extend([job_id, repr(due), redis.hget(data_key, job_id)])
+    return claimed
+
+
+CLAIM_DUE_JOBS_SCRIPT = RedisScript("""
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                       'WITHSCORES', 'LIMIT', 0, ARGV[2])
+local claimed = {}
+for i = 1, #due, 2 do
+    redis.call('ZADD', KEYS[1], ARGV[3], due[i])
+    claimed[#claimed + 1] = due[i]
+    claimed[#claimed + 1] = due[i + 1]
+    claimed[#claimed + 1] = redis.call('HGET', KEYS[2], due[i])
+end
+return claimed
+""", _claim_due_jobs)
+
+
+class DelayedJob(namedtuple('DelayedJob', ['job_id', 'due', 'data'])):
+    """A claimed job.
+
+    :param str job_id:
+        The job's id.
+    :param float due:
+        The time the job was due, in seconds since the epoch.
+    :param str data:
+        The data stored with the job, or ``None``.
+    """
+
+
+class DelayedJobQueue(object):
+    """Jobs stored in Redis and delivered once they are due.
+
+    :param redis:
+        A Redis manager.
+    :param callback:
+        Called with a :class:`DelayedJob` for each due job. The job is removed
+        from the queue once the result (which may be a deferred) succeeds.
+    :param str name:
+        The prefix for the queue's Redis keys.
+    :param int batch_size:
+        The maximum number of jobs to claim at a time.
+    :param int concurrency:
+        The maximum number of jobs to deliver at the same time.
+    :param float claim_timeout:
+        The number of seconds a claimed job is held for before it is
+        delivered again if it hasn't been removed from the queue.
+    """
+
+    DEFAULT_BATCH_SIZE = 100
+    DEFAULT_CONCURRENCY = 10
+    DEFAULT_CLAIM_TIMEOUT = 60
+
+    reactor = reactor  # hook for tests
+
+    def __init__(self, redis, callback, name='delayed_jobs',
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 concurrency=DEFAULT_CONCURRENCY,
+                 claim_timeout=DEFAULT_CLAIM_TIMEOUT):
+        self.redis = redis
+        self.callback = callback
+        self.name = name
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.claim_timeout = claim_timeout
+        self._due_key = "%s:due" % (name,)
+        self._data_key = "%s:data" % (name,)
+        self._loop = None
+        self._loop_done = None
+        self._metrics = None
+        #: The number of jobs in the queue (including claimed jobs) after
+        #: the most recent delivery run, or ``None`` before the first run.
+        self.depth = None
+        #: How overdue (in seconds) the most overdue job claimed during the
+        #: most recent delivery run was, or ``None`` before the first run.
+        self.lag = None
+
+    def now(self):
+        return self.reactor.seconds()
+
+    @property
+    def is_running(self):
+        return self._loop is not None and self._loop.running
+
+    def start(self, interval):
+        """
+        Deliver due jobs every ``interval`` seconds, starting immediately.
+        """
+        if self.is_running:
+            return
+        self._loop = LoopingCall(self.deliver_due)
+        self._loop.clock = self.reactor
+        self._loop_done = self._loop.start(interval, now=True)
+
+    def stop(self):
+        """
+        Stop delivering jobs. Returns a deferred that fires once any delivery
+        run in progress has finished.
+        """
+        if not self.is_running:
+            return succeed(None)
+        self._loop.stop()
+        return self._loop_done
+
+    def add(self, job_id, due, data=None):
+        """
+        Add a job that is due at ``due`` seconds since the epoch. Adding a job
+        with the id of an existing job replaces it.
+        """
+        pipeline = self.redis.multi()
+        if data is None:
+            pipeline.hdel(self._data_key, job_id)
+        else:
+            pipeline.hset(self._data_key, job_id, data)
+        pipeline.zadd(self._due_key, **{job_id: due})
+        return pipeline.execute()
+
+    @Manager.calls_manager('redis')
+    def schedule(self, delay, data=None, job_id=None, now=None):
+        """
+        Add a job that is due ``delay`` seconds after ``now`` (which defaults
+        to the current time). If ``job_id`` is ``None``, a new one is
+        generated. Returns the job id.
+        """
+        if job_id is None:
+            job_id = uuid4().get_hex()
+        if now is None:
+            now = self.now()
+        yield self.add(job_id, now + delay, data)
+        returnValue(job_id)
+
+    def remove(self, job_id):
+        """
+        Remove a job from the queue, whether or not it has been claimed.
+        """
+        pipeline = self.redis.multi()
+        pipeline.zrem(self._due_key, job_id)
+        pipeline.hdel(self._data_key, job_id)
+        return pipeline.execute()
+
+    def get_due(self, job_id):
+        """
+        Return the time a job is due (or the time its claim expires), or
+        ``None`` if it isn't in the queue.
+        """
+        return self.redis.zscore(self._due_key, job_id)
+
+    def get_data(self, job_id):
+        return self.redis.hget(self._data_key, job_id)
+
+    def get_job_ids(self):
+        """
+        Return the ids of all the jobs in the queue, in due order.
+        """
+        return self.redis.zrange(self._due_key, 0, -1)
+
+    def count(self):
+        """
+        Return the number of jobs in the queue, including claimed jobs.
+        """
+        return self.redis.zcard(self._due_key)
+
+    @Manager.calls_manager('redis')
+    def claim_due(self, now=None, limit=None):
+        """
+        Claim up to ``limit`` (which defaults to the batch size) jobs that are
+        due at ``now`` (which defaults to the current time). Returns a list of
+        :class:`DelayedJob` instances in due order.
+        """
+        if now is None:
+            now = self.now()
+        if limit is None:
+            limit = self.batch_size
+        claimed = yield self.redis.run_script(
+            CLAIM_DUE_JOBS_SCRIPT, [self._due_key, self._data_key],
+            [repr(float(now)), limit, repr(float(now + self.claim_timeout))])
+        returnValue([
+            DelayedJob(claimed[i], float(claimed[i + 1]), claimed[i + 2])
+            for i in range(0, len(claimed), 3)])
+
+    @inlineCallbacks
+    def deliver_due(self, now=None):
+        """
+        Claim and deliver jobs that are due at ``now`` (which defaults to the
+        current time) until there are none left. Failed deliveries are logged
+        and retried once their claims expire.
+        """
+        if now is None:
+            now = self.now()
+        lag = 0.0
+        semaphore = DeferredSemaphore(self.concurrency)
+        while True:
+            jobs = yield self.claim_due(now)
+            if jobs:
+                lag = max(lag, now - jobs[0].due)
+            yield gatherResults([
+                semaphore.run(self._deliver_job, job) for job in jobs])
+            if len(jobs) < self.batch_size:
+                break
+        self.lag = lag
+        self.depth = yield self.count()
+
+    @inlineCallbacks
+    def _deliver_job(self, job):
+        try:
+            yield maybeDeferred(self.callback, job)
+        except Exception:
+            log.err(None, "Error delivering delayed job %r" % (job.job_id,))
+            self._count(failed=True)
+            return
+        yield self.remove(job.job_id)
+        self._count(failed=False)
+
+    def _count(self, failed):
+        if self._metrics is not None:
+            delivered, failures = self._metrics
+            (failures if failed else delivered).inc()
+
+    def register_metrics(self, manager, name):
+        """Publish queue statistics with a
+        :class:`vumi.blinkenlights.metrics.MetricManager`.
+
+        This registers ``<name>.delivered`` and ``<name>.failed`` counters and
+        ``<name>.depth`` and ``<name>.lag`` gauges holding :attr:`depth` and
+        :attr:`lag`.
+        """
+        self._metrics = (
+            manager.register(Count("%s.delivered" % (name,))),
+            manager.register(Count("%s.failed" % (name,))))
+        manager.register(Gauge("%s.depth" % (name,), lambda: self.depth))
+        manager.register(Gauge("%s.lag" % (name,), lambda: self.lag))
@@ -0,0 +1,330 @@
+# -*- test-case-name: vumi.components.tests.test_message_archive -*-
+
+"""
+A compressed, seekable archive format for bulk message exports.
+
+An archive is a sequence of gzip members, so the whole thing can be read with
+``zcat`` or :mod:`gzip` if all you want is the raw lines. It is laid out as
+follows:
+
+* One or more chunks. Each chunk is a gzip member holding up to
+  ``chunk_size`` line-delimited JSON messages, all with the same direction
+  (``inbound``, ``outbound`` or ``event``).
+
+* An index, which is a gzip member holding a single JSON line of the form
+  ``{"archive_index": {"version": 1, "chunks": [...]}}``. Each chunk entry
+  records the chunk's direction, byte offset, byte length, row count and the
+  earliest and latest message timestamps in the chunk.
+
+* A fixed-size trailer, which is an empty gzip member with the offset of the
+  index stored in its ``FEXTRA`` header field.
+
+Readers find the index through the trailer and can then decompress only the
+chunks that overlap the time range they're interested in, or hand different
+chunks to different workers.
+"""
+
+import json
+import struct
+import zlib
+
+from vumi.message import (
+    TransportUserMessage, TransportEvent, format_vumi_date)
+
+
+ARCHIVE_VERSION = 1
+DIRECTIONS = ('inbound', 'outbound', 'event')
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_COMPRESSION_LEVEL = 6
+
+TRAILER_SUBFIELD_ID = 'VA'
+# gzip header (10) + XLEN (2) + subfield header (4) + offset (8) + empty
+# deflate stream (2) + CRC32 (4) + ISIZE (4)
+TRAILER_SIZE = 34
+
+MESSAGE_CLASSES = {
+    'inbound': TransportUserMessage,
+    'outbound': TransportUserMessage,
+    'event': TransportEvent,
+}
+
+
+class ArchiveError(Exception):
+    """
+    Raised when an archive can't be read.
+    """
+
+
+def gzip_member(data, compresslevel=DEFAULT_COMPRESSION_LEVEL):
+    """
+    Compress ``data`` into a single standalone gzip member.
+    """
+    compressor = zlib.compressobj(
+        compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gunzip_member(data):
+    """
+    Decompress a single gzip member.
+    """
+    try:
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    except zlib.error as e:
+        raise ArchiveError("Corrupt archive chunk: %s" % (e,))
+
+
+def build_trailer(index_offset):
+    """
+    Build an empty gzip member with ``index_offset`` stored in its ``FEXTRA``
+    field.
+    """
+    extra = TRAILER_SUBFIELD_ID + struct.pack('<HQ', 8, index_offset)
+    compressor = zlib.compressobj(
+        DEFAULT_COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress('') + compressor.flush()
+    trailer = ''.join([
+        '\x1f\x8b\x08\x04',  # magic, deflate, FEXTRA
+        '\x00\x00\x00\x00',  # mtime
+        '\x00\xff',  # xfl, unknown OS
+        struct.pack('<H', len(extra)),
+        extra,
+        body,
+        struct.pack('<II', 0, 0),  # CRC32 and size of empty data
+    ])
+    assert len(trailer) == TRAILER_SIZE
+    return trailer
+
+
+def parse_trailer(trailer):
+    """
+    Extract the index offset from a trailer built by :func:`build_trailer`.
+    """
+    if (len(trailer) != TRAILER_SIZE or
+            not trailer.startswith('\x1f\x8b\x08\x04') or
+            trailer[12:14] != TRAILER_SUBFIELD_ID):
+        raise ArchiveError("Missing archive trailer.")
+    [index_offset] = struct.unpack('<Q', trailer[16:24])
+    return index_offset
+
+
+class ArchiveChunk(object):
+    """
+    Index entry describing a single chunk in an archive.
+    """
+
+    def __init__(self, direction, offset, length, rows, start, end):
+        self.direction = direction
+        self.offset = offset
+        self.length = length
+        self.rows = rows
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return '<ArchiveChunk %s offset=%s length=%s rows=%s %s..%s>' % (
+            self.direction, self.offset, self.length, self.rows, self.start,
+            self.end)
+
+    def __eq__(self, other):
+        if not isinstance(other, ArchiveChunk):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def overlaps(self, start=None, end=None):
+        """
+        Check whether any message in this chunk may have a timestamp in the
+        inclusive range ``start`` to ``end``. Both are optional timestamp
+        strings matching ``VUMI_DATE_FORMAT``.
+        """
+        if start is not None and self.end < start:
+            return False
+        if end is not None and self.start > end:
+            return False
+        return True
+
+    def to_dict(self):
+        return {
+            'direction': self.direction,
+            'offset': self.offset,
+            'length': self.length,
+            'rows': self.rows,
+            'start': self.start,
+            'end': self.end,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data['direction'], data['offset'], data['length'], data['rows'],
+            data['start'], data['end'])
+
+
+class _ChunkBuffer(object):
+    """
+    Lines waiting to be written as a single chunk.
+    """
+
+    def __init__(self, direction):
+        self.direction = direction
+        self.lines = []
+        self.start = None
+        self.end = None
+
+    def add(self, line, timestamp):
+        self.lines.append(line)
+        if self.start is None or timestamp < self.start:
+            self.start = timestamp
+        if self.end is None or timestamp > self.end:
+            self.end = timestamp
+
+
+class MessageArchiveWriter(object):
+    """
+    Write messages to a file-like object in the archive format.
+
+    Only ``write()`` is called on ``fileobj``, so an HTTP request works just
+    as well as a file. Messages are buffered per direction until there are
+    ``chunk_size`` of them and then written as a chunk. :meth:`close` must be
+    called to flush any partial chunks and write the index and trailer. It
+    does not close ``fileobj``.
+    """
+
+    def __init__(self, fileobj, chunk_size=DEFAULT_CHUNK_SIZE,
+                 compresslevel=DEFAULT_COMPRESSION_LEVEL):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.compresslevel = compresslevel
+        self.offset = 0
+        self.rows = 0
+        self.chunks = []
+        self.closed = False
+        self._buffers = dict((d, _ChunkBuffer(d)) for d in DIRECTIONS)
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def add_message(self, direction, message):
+        """
+        Add a message to the archive.
+        """
+        if self.closed:
+            raise ArchiveError("Archive writer is closed.")
+        if direction not in self._buffers:
+            raise ValueError("Invalid direction: %r" % (direction,))
+        buf = self._buffers[direction]
+        buf.add(message.to_json(), format_vumi_date(message['timestamp']))
+        self.rows += 1
+        if len(buf.lines) >= self.chunk_size:
+            self.flush(direction)
+
+    def flush(self, direction=None):
+        """
+        Write buffered messages for ``direction`` (or all directions if
+        ``direction`` is ``None``) as chunks.
+        """
+        directions = DIRECTIONS if direction is None else [direction]
+        for direction in directions:
+            buf = self._buffers[direction]
+            if not buf.lines:
+                continue
+            data = gzip_member(
+                '\n'.join(buf.lines) + '\n', self.compresslevel)
+            self.chunks.append(ArchiveChunk(
+                direction, self.offset, len(data), len(buf.lines), buf.start,
+                buf.end))
+            self._write(data)
+            self._buffers[direction] = _ChunkBuffer(direction)
+
+    def close(self):
+        """
+        Flush any buffered messages and write the index and trailer.
+        """
+        if self.closed:
+            return
+        self.flush()
+        index_offset = self.offset
+        index = {
+            'version': ARCHIVE_VERSION,
+            'chunks': [chunk.to_dict() for chunk in self.chunks],
+        }
+        self._write(gzip_member(
+            json.dumps({'archive_index': index}) + '\n', self.compresslevel))
+        self._write(build_trailer(index_offset))
+        self.closed = True
+
+
+class MessageArchiveReader(object):
+    """
+    Read an archive from a seekable file-like object.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.chunks = self._read_index()
+
+    def _read_at(self, offset, length):
+        self.fileobj.seek(offset)
+        data = self.fileobj.read(length)
+        if len(data) != length:
+            raise ArchiveError("Truncated archive.")
+        return data
+
+    def _read_index(self):
+        self.fileobj.seek(0, 2)
+        size = self.fileobj.tell()
+        if size < TRAILER_SIZE:
+            raise ArchiveError("Missing archive trailer.")
+        index_offset = parse_trailer(
+            self._read_at(size - TRAILER_SIZE, TRAILER_SIZE))
+        index_length = size - TRAILER_SIZE - index_offset
+        if index_length <= 0:
+            raise ArchiveError("Invalid archive index offset.")
+        data = gunzip_member(self._read_at(index_offset, index_length))
+        try:
+            index = json.loads(data)['archive_index']
+        except (ValueError, KeyError, TypeError):
+            raise ArchiveError("Invalid archive index.")
+        if index.get('version') != ARCHIVE_VERSION:
+            raise ArchiveError(
+                "Unsupported archive version: %r" % (index.get('version'),))
+        return [ArchiveChunk.from_dict(c) for c in index['chunks']]
+
+    def get_chunks(self, direction=None, start=None, end=None):
+        """
+        Return the chunks for ``direction`` (or all directions) that may
+        contain messages in the inclusive time range ``start`` to ``end``.
+        """
+        return [
+            chunk for chunk in self.chunks
+            if direction in (None, chunk.direction) and
+            chunk.overlaps(start, end)]
+
+    def read_chunk(self, chunk):
+        """
+        Decompress a chunk and return its messages.
+        """
+        data = gunzip_member(self._read_at(chunk.offset, chunk.length))
+        message_class = MESSAGE_CLASSES[chunk.direction]
+        return [
+            message_class.from_json(line) for line in data.splitlines()
+            if line]
+
+    def iter_messages(self, direction=None, start=None, end=None):
+        """
+        Yield ``(direction, message)`` pairs for ``direction`` (or all
+        directions) with timestamps in the inclusive range ``start`` to
+        ``end``. Only chunks that overlap the range are decompressed.
+        """
+        for chunk in self.get_chunks(direction, start, end):
+            for message in self.read_chunk(chunk):
+                timestamp = format_vumi_date(message['timestamp'])
+                if start is not None and timestamp < start:
+                    continue
+                if end is not None and timestamp > end:
+                    continue
+                yield chunk.direction, message
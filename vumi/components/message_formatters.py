@@ -4,6 +4,8 @@ from csv import writer
 
 from zope.interface import Interface, implements
 
+from vumi.components.message_archive import MessageArchiveWriter
+
 
 class IMessageFormatter(Interface):
     """ Interface for writing messages to an HTTP request. """
@@ -26,6 +28,15 @@ class IMessageFormatter(Interface):
         Write a :class:`TransportUserMessage` to the request.
         """
 
+    def write_row_footer(request):
+        """
+        Write any footer bytes that need to be written to the request after
+        all messages.
+
+        This method is optional. Formatters without it write nothing after
+        the last message.
+        """
+
 
 class JsonFormatter(object):
     """ Formatter for writing messages to requests as JSON. """
@@ -44,6 +55,9 @@ class JsonFormatter(object):
         request.write(message.to_json())
         request.write('\n')
 
+    def write_row_footer(self, request):
+        pass
+
 
 class CsvFormatter(object):
     """ Formatter for writing messages to requests as CSV. """
@@ -73,6 +87,9 @@ class CsvFormatter(object):
         writer(request).writerow([
             self._format_field(field, message) for field in self.FIELDS])
 
+    def write_row_footer(self, request):
+        pass
+
     def _format_field(self, field, message):
         field_formatter = getattr(self, '_format_field_%s' % (field,), None)
         if field_formatter is not None:
@@ -106,3 +123,36 @@ class CsvEventFormatter(CsvFormatter):
 
     def _format_field_nack_reason(self, message):
         return message.get('nack_reason', u'') or u''
+
+
+class ArchiveFormatter(object):
+    """
+    Formatter for writing messages to requests in the compressed, seekable
+    format described in :mod:`vumi.components.message_archive`.
+
+    A new formatter must be used for each request.
+    """
+
+    implements(IMessageFormatter)
+
+    def __init__(self, direction, chunk_size=None):
+        self.direction = direction
+        self.chunk_size = chunk_size
+        self.archive_writer = None
+
+    def add_http_headers(self, request):
+        resp_headers = request.responseHeaders
+        resp_headers.addRawHeader(
+            'Content-Type', 'application/x-vumi-message-archive')
+
+    def write_row_header(self, request):
+        kw = {}
+        if self.chunk_size is not None:
+            kw['chunk_size'] = self.chunk_size
+        self.archive_writer = MessageArchiveWriter(request, **kw)
+
+    def write_row(self, request, message):
+        self.archive_writer.add_message(self.direction, message)
+
+    def write_row_footer(self, request):
+        self.archive_writer.close()
@@ -5,7 +5,7 @@
 
 from calendar import timegm
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
 from uuid import uuid4
 import itertools
 import warnings
@@ -289,6 +289,8 @@ class MessageStore(object):
         while index_page is not None:
             for key, timestamp, addr in index_page:
                 yield self.cache.add_from_addr(batch_id, addr)
+                yield self.cache.add_stats(
+                    batch_id, 'inbound', timestamp, addr)
                 old_key = key_manager.add_key(key, timestamp)
                 if old_key is not None:
                     key_count += 1
@@ -316,6 +318,8 @@ class MessageStore(object):
         while index_page is not None:
             for key, timestamp, addr in index_page:
                 yield self.cache.add_to_addr(batch_id, addr)
+                yield self.cache.add_stats(
+                    batch_id, 'outbound', timestamp, addr)
                 old_key = key_manager.add_key(key, timestamp)
                 if old_key is not None:
                     key_count += 1
@@ -953,6 +957,106 @@ class MessageStore(object):
             key_with_ts_and_value_formatter, self, msg_id, results))
 
     @Manager.calls_manager
+    def _batch_stats(self, model_proxy, direction, batch_id, max_results,
+                     start, end):
+        bucket_size = yield self.cache.get_stats_bucket_size(batch_id)
+        if bucket_size is None:
+            # This batch predates the stats cache and hasn't been reconciled
+            # since, so we have to count everything from the index.
+            total, unique_addresses = yield self._scan_batch_stats(
+                model_proxy, batch_id, max_results, start, end)
+            returnValue({
+                "total": total,
+                "unique_addresses": len(unique_addresses),
+            })
+
+        # Find the bucket boundaries inside the time range. Buckets between
+        # these are counted from the cache and anything outside them is
+        # counted from the index.
+        if start is None:
+            first_bucket = None
+        else:
+            start_dt = parse_vumi_date(start)
+            first_bucket = self.cache.get_stats_bucket(start_dt, bucket_size)
+            if start_dt > datetime.utcfromtimestamp(first_bucket):
+                first_bucket += bucket_size
+        if end is None:
+            end_bucket = None
+        else:
+            end_dt = parse_vumi_date(end) + timedelta(microseconds=1)
+            end_bucket = self.cache.get_stats_bucket(end_dt, bucket_size)
+
+        if None not in (first_bucket, end_bucket) and (
+                first_bucket >= end_bucket):
+            # The whole range fits inside a single bucket.
+            total, unique_addresses = yield self._scan_batch_stats(
+                model_proxy, batch_id, max_results, start, end)
+            returnValue({
+                "total": total,
+                "unique_addresses": len(unique_addresses),
+            })
+
+        total = 0
+        edge_addresses = set()
+        if first_bucket is not None and (
+                start_dt < datetime.utcfromtimestamp(first_bucket)):
+            edge_end = format_vumi_date(
+                datetime.utcfromtimestamp(first_bucket) -
+                timedelta(microseconds=1))
+            edge_total, edge_addrs = yield self._scan_batch_stats(
+                model_proxy, batch_id, max_results, start, edge_end)
+            total += edge_total
+            edge_addresses.update(edge_addrs)
+        if end_bucket is not None and (
+                end_dt > datetime.utcfromtimestamp(end_bucket)):
+            edge_start = format_vumi_date(
+                datetime.utcfromtimestamp(end_bucket))
+            edge_total, edge_addrs = yield self._scan_batch_stats(
+                model_proxy, batch_id, max_results, edge_start, end)
+            total += edge_total
+            edge_addresses.update(edge_addrs)
+
+        all_buckets = yield self.cache.get_stats_buckets(batch_id, direction)
+        buckets = [
+            bucket for bucket in all_buckets
+            if (first_bucket is None or bucket >= first_bucket) and
+            (end_bucket is None or bucket < end_bucket)]
+        total += sum(all_buckets[bucket] for bucket in buckets)
+        unique_addresses = yield self.cache.count_stats_addrs(
+            batch_id, direction, buckets, edge_addresses)
+        returnValue({
+            "total": total,
+            "unique_addresses": unique_addresses,
+        })
+
+    @Manager.calls_manager
+    def _scan_batch_stats(self, model_proxy, batch_id, max_results, start,
+                          end):
+        """
+        Count messages and collect unique addresses from the
+        `batches_with_addresses` index.
+        """
+        total = 0
+        unique_addresses = set()
+
+        start_value, end_value = self._start_end_values(batch_id, start, end)
+        if max_results is None:
+            max_results = self.DEFAULT_MAX_RESULTS
+        stream = model_proxy.index_keys_stream(
+            'batches_with_addresses', start_value, end_value,
+            return_terms=True, max_results=max_results)
+
+        results = yield stream.next_batch()
+        while results is not None:
+            for result in results:
+                _key, _timestamp, addr = key_with_ts_and_value_formatter(
+                    batch_id, result)
+                total += 1
+                unique_addresses.add(addr)
+            results = yield stream.next_batch()
+
+        returnValue((total, unique_addresses))
+
     def batch_inbound_stats(self, batch_id, max_results=None,
                             start=None, end=None):
         """
@@ -976,32 +1080,16 @@ class MessageStore(object):
         :returns:
             ``dict`` containing 'total' and 'unique_addresses' entries.
 
-        This method performs multiple Riak index queries.
+        For batches that keep message stats in the cache, whole stats buckets
+        inside the time range are counted from the cache and only the parts
+        of the range outside them require Riak index queries. For other
+        batches, this method performs multiple Riak index queries. The unique
+        address count from the cache is approximate.
         """
-        total = 0
-        unique_addresses = set()
+        return self._batch_stats(
+            self.inbound_messages, 'inbound', batch_id, max_results, start,
+            end)
 
-        start_value, end_value = self._start_end_values(batch_id, start, end)
-        if max_results is None:
-            max_results = self.DEFAULT_MAX_RESULTS
-        raw_page = yield self.inbound_messages.index_keys_page(
-            'batches_with_addresses', start_value, end_value,
-            return_terms=True, max_results=max_results)
-        page = IndexPageWrapper(
-            key_with_ts_and_value_formatter, self, batch_id, raw_page)
-
-        while page is not None:
-            results = list(page)
-            total += len(results)
-            unique_addresses.update(addr for key, timestamp, addr in results)
-            page = yield page.next_page()
-
-        returnValue({
-            "total": total,
-            "unique_addresses": len(unique_addresses),
-        })
-
-    @Manager.calls_manager
     def batch_outbound_stats(self, batch_id, max_results=None,
                              start=None, end=None):
         """
@@ -1025,30 +1113,15 @@ class MessageStore(object):
         :returns:
             ``dict`` containing 'total' and 'unique_addresses' entries.
 
-        This method performs multiple Riak index queries.
+        For batches that keep message stats in the cache, whole stats buckets
+        inside the time range are counted from the cache and only the parts
+        of the range outside them require Riak index queries. For other
+        batches, this method performs multiple Riak index queries. The unique
+        address count from the cache is approximate.
         """
-        total = 0
-        unique_addresses = set()
-
-        start_value, end_value = self._start_end_values(batch_id, start, end)
-        if max_results is None:
-            max_results = self.DEFAULT_MAX_RESULTS
-        raw_page = yield self.outbound_messages.index_keys_page(
-            'batches_with_addresses', start_value, end_value,
-            return_terms=True, max_results=max_results)
-        page = IndexPageWrapper(
-            key_with_ts_and_value_formatter, self, batch_id, raw_page)
-
-        while page is not None:
-            results = list(page)
-            total += len(results)
-            unique_addresses.update(addr for key, timestamp, addr in results)
-            page = yield page.next_page()
-
-        returnValue({
-            "total": total,
-            "unique_addresses": len(unique_addresses),
-        })
+        return self._batch_stats(
+            self.outbound_messages, 'outbound', batch_id, max_results, start,
+            end)
 
 
 class IndexPageWrapper(object):
@@ -1,10 +1,12 @@
 # -*- test-case-name: vumi.components.tests.test_message_store_cache -*-
 # -*- coding: utf-8 -*-
 
+from calendar import timegm
 from datetime import datetime
 import hashlib
 import json
 import time
+from uuid import uuid4
 
 from twisted.internet.defer import returnValue
 
@@ -34,8 +36,14 @@ class MessageStoreCache(object):
     STATUS_KEY = 'status'
     SEARCH_TOKEN_KEY = 'search_token'
     SEARCH_RESULT_KEY = 'search_result'
+    STATS_BUCKET_SIZE_KEY = 'stats_bucket_size'
+    STATS_KEY = 'stats'
+    STATS_ADDR_KEY = 'stats_addr_hll'
     TRUNCATE_MESSAGE_KEY_COUNT_AT = 2000
 
+    # Message stats are counted in hourly buckets
+    STATS_BUCKET_SIZE = 60 * 60
+
     # Cache search results for 24 hrs
     DEFAULT_SEARCH_RESULT_TTL = 60 * 60 * 24
 
@@ -83,6 +91,15 @@ class MessageStoreCache(object):
     def search_result_key(self, batch_id, token):
         return self.batch_key(self.SEARCH_RESULT_KEY, batch_id, token)
 
+    def stats_bucket_size_key(self, batch_id):
+        return self.batch_key(self.STATS_BUCKET_SIZE_KEY, batch_id)
+
+    def stats_key(self, batch_id, direction):
+        return self.batch_key(self.STATS_KEY, direction, batch_id)
+
+    def stats_addr_key(self, batch_id, direction, bucket):
+        return self.batch_key(self.STATS_ADDR_KEY, direction, batch_id, bucket)
+
     def uses_counters(self, batch_id):
         """
         Returns ``True`` if ``batch_id`` has moved to the new system
@@ -165,7 +182,9 @@ class MessageStoreCache(object):
 
         :param bool use_counters:
             If ``True`` this batch is started and will use counters
-            rather than Redis zsets() to keep track of message counts.
+            rather than Redis zsets() to keep track of message counts. The
+            time-bucketed message stats are also only kept for batches that
+            use counters.
 
             Defaults to ``True``.
 
@@ -178,6 +197,8 @@ class MessageStoreCache(object):
             yield self.redis.set(self.inbound_count_key(batch_id), 0)
             yield self.redis.set(self.outbound_count_key(batch_id), 0)
             yield self.redis.set(self.event_count_key(batch_id), 0)
+            yield self.redis.set(
+                self.stats_bucket_size_key(batch_id), self.STATS_BUCKET_SIZE)
 
     @Manager.calls_manager
     def init_status(self, batch_id):
@@ -223,6 +244,7 @@ class MessageStoreCache(object):
         yield self.redis.delete(self.status_key(batch_id))
         yield self.redis.delete(self.to_addr_key(batch_id))
         yield self.redis.delete(self.from_addr_key(batch_id))
+        yield self.clear_stats(batch_id)
         yield self.redis.srem(self.batch_key(), batch_id)
 
     def get_timestamp(self, timestamp):
@@ -239,14 +261,18 @@ class MessageStoreCache(object):
         Add an outbound message to the cache for the given batch_id
         """
         timestamp = self.get_timestamp(msg['timestamp'])
-        yield self.add_outbound_message_key(
+        new_entry = yield self.add_outbound_message_key(
             batch_id, msg['message_id'], timestamp)
         yield self.add_to_addr(batch_id, msg['to_addr'])
+        if new_entry:
+            yield self.add_stats(
+                batch_id, 'outbound', msg['timestamp'], msg['to_addr'])
 
     @Manager.calls_manager
     def add_outbound_message_key(self, batch_id, message_key, timestamp):
         """
         Add a message key, weighted with the timestamp to the batch_id.
+        Returns ``True`` if the key wasn't already in the cache.
         """
         new_entry = yield self.redis.zadd(self.outbound_key(batch_id), **{
             message_key.encode('utf-8'): timestamp,
@@ -258,6 +284,7 @@ class MessageStoreCache(object):
             if uses_counters:
                 yield self.redis.incr(self.outbound_count_key(batch_id))
                 yield self.truncate_outbound_message_keys(batch_id)
+        returnValue(new_entry)
 
     @Manager.calls_manager
     def add_outbound_message_count(self, batch_id, count):
@@ -337,14 +364,18 @@ class MessageStoreCache(object):
         Add an inbound message to the cache for the given batch_id
         """
         timestamp = self.get_timestamp(msg['timestamp'])
-        yield self.add_inbound_message_key(
+        new_entry = yield self.add_inbound_message_key(
             batch_id, msg['message_id'], timestamp)
         yield self.add_from_addr(batch_id, msg['from_addr'])
+        if new_entry:
+            yield self.add_stats(
+                batch_id, 'inbound', msg['timestamp'], msg['from_addr'])
 
     @Manager.calls_manager
     def add_inbound_message_key(self, batch_id, message_key, timestamp):
         """
-        Add a message key, weighted with the timestamp to the batch_id
+        Add a message key, weighted with the timestamp to the batch_id.
+        Returns ``True`` if the key wasn't already in the cache.
         """
         new_entry = yield self.redis.zadd(self.inbound_key(batch_id), **{
             message_key.encode('utf-8'): timestamp,
@@ -355,6 +386,7 @@ class MessageStoreCache(object):
             if uses_counters:
                 yield self.redis.incr(self.inbound_count_key(batch_id))
                 yield self.truncate_inbound_message_keys(batch_id)
+        returnValue(new_entry)
 
     @Manager.calls_manager
     def add_inbound_message_count(self, batch_id, count):
@@ -422,6 +454,91 @@ class MessageStoreCache(object):
         """
         return self.redis.pfcount(self.to_addr_key(batch_id))
 
+    @Manager.calls_manager
+    def get_stats_bucket_size(self, batch_id):
+        """
+        Return the size (in seconds) of the buckets message stats are counted
+        in for this batch, or ``None`` if this batch doesn't keep stats.
+        """
+        bucket_size = yield self.redis.get(
+            self.stats_bucket_size_key(batch_id))
+        returnValue(None if bucket_size is None else int(bucket_size))
+
+    def get_stats_bucket(self, timestamp, bucket_size):
+        """
+        Return the start (in seconds since the epoch) of the stats bucket the
+        given timestamp falls in.
+        """
+        if isinstance(timestamp, basestring):
+            timestamp = parse_vumi_date(timestamp)
+        seconds = timegm(timestamp.utctimetuple())
+        return seconds - (seconds % bucket_size)
+
+    @Manager.calls_manager
+    def add_stats(self, batch_id, direction, timestamp, addr):
+        """
+        Count a message in the stats bucket for its timestamp and add its
+        address to that bucket's HyperLogLog. Generally this is done when
+        `add_inbound_message()` or `add_outbound_message()` is called.
+
+        :param str direction:
+            Either 'inbound' or 'outbound'.
+        """
+        bucket_size = yield self.get_stats_bucket_size(batch_id)
+        if bucket_size is None:
+            return
+        bucket = self.get_stats_bucket(timestamp, bucket_size)
+        yield self.redis.hincrby(
+            self.stats_key(batch_id, direction), str(bucket), 1)
+        yield self.redis.pfadd(
+            self.stats_addr_key(batch_id, direction, bucket),
+            addr.encode('utf-8'))
+
+    @Manager.calls_manager
+    def get_stats_buckets(self, batch_id, direction):
+        """
+        Return a dictionary mapping the start of each stats bucket to the
+        number of messages counted in it.
+        """
+        buckets = yield self.redis.hgetall(self.stats_key(batch_id, direction))
+        returnValue(dict((int(k), int(v)) for k, v in buckets.iteritems()))
+
+    @Manager.calls_manager
+    def count_stats_addrs(self, batch_id, direction, buckets, extra_addrs=()):
+        """
+        Return the approximate number of unique addresses across the given
+        stats buckets and any extra addresses provided. The count is subject
+        to the same error as `count_from_addrs()`.
+        """
+        hll_keys = [
+            self.stats_addr_key(batch_id, direction, bucket)
+            for bucket in buckets]
+        if extra_addrs:
+            extra_key = self.stats_addr_key(
+                batch_id, direction, 'tmp-%s' % (uuid4().get_hex(),))
+            yield self.redis.pfadd(
+                extra_key, *[addr.encode('utf-8') for addr in extra_addrs])
+            hll_keys.append(extra_key)
+        if not hll_keys:
+            returnValue(0)
+        count = yield self.redis.pfcount(*hll_keys)
+        if extra_addrs:
+            yield self.redis.delete(extra_key)
+        returnValue(count)
+
+    @Manager.calls_manager
+    def clear_stats(self, batch_id):
+        """
+        Remove all message stats for the given batch_id.
+        """
+        for direction in ('inbound', 'outbound'):
+            buckets = yield self.get_stats_buckets(batch_id, direction)
+            for bucket in buckets:
+                yield self.redis.delete(
+                    self.stats_addr_key(batch_id, direction, bucket))
+            yield self.redis.delete(self.stats_key(batch_id, direction))
+        yield self.redis.delete(self.stats_bucket_size_key(batch_id))
+
     def get_inbound_message_keys(self, batch_id, start=0, stop=-1, asc=False,
                                  with_timestamp=False):
         """
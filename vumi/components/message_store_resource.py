@@ -1,15 +1,21 @@
 # -*- test-case-name: vumi.components.tests.test_message_store_resource -*-
 
+from collections import deque
+from functools import partial
+
 import iso8601
+from zope.interface import implements
 
 from twisted.application.internet import StreamServerEndpointService
-from twisted.internet.defer import DeferredList, inlineCallbacks
+from twisted.internet.defer import Deferred, inlineCallbacks, maybeDeferred
+from twisted.internet.interfaces import IPushProducer
 from twisted.web.resource import NoResource, Resource
 from twisted.web.server import NOT_DONE_YET
 
+from vumi import log
 from vumi.components.message_store import MessageStore
 from vumi.components.message_formatters import (
-    JsonFormatter, CsvFormatter, CsvEventFormatter)
+    JsonFormatter, CsvFormatter, CsvEventFormatter, ArchiveFormatter)
 from vumi.config import (
     ConfigDict, ConfigText, ConfigServerEndpoint, ConfigInt,
     ServerEndpointFallback)
@@ -21,14 +27,6 @@ from vumi.utils import build_web_site
 from vumi.worker import BaseWorker
 
 
-# NOTE: Thanks Ned http://stackoverflow.com/a/312464!
-def chunks(l, n):
-    """ Yield successive n-sized chunks from l.
-    """
-    for i in xrange(0, len(l), n):
-        yield l[i:i + n]
-
-
 class ParameterError(Exception):
     """
     Exception raised while trying to parse a parameter.
@@ -36,6 +34,227 @@ class ParameterError(Exception):
     pass
 
 
+class MessageExportProducer(object):
+    """
+    Push producer that streams messages from a message store resource to an
+    HTTP request.
+
+    Rather than fetching messages in fixed-size chunks, we keep a sliding
+    window of up to ``concurrency`` outstanding fetches and start a new fetch
+    as soon as any outstanding one completes, so a single slow message
+    doesn't stall the whole export. Keys are read from the index one page at
+    a time and the next page is only requested once fewer than
+    ``concurrency`` keys from the current page are left to fetch.
+
+    We register ourselves as a streaming producer on the request, so no new
+    fetches (of messages or key pages) are started while the client
+    connection is paused. Fetches already in flight are allowed to complete.
+
+    If ``ordered`` is ``True``, rows are written in the order their keys were
+    returned from the index. Messages that arrive early are held in a reorder
+    buffer so that the fetch window keeps moving while we wait for a
+    straggler. To bound memory use, no new fetches are started while the
+    buffer holds ``reorder_limit`` or more messages.
+
+    When the export is finished, the number of rows written and the rows per
+    second achieved are logged.
+    """
+
+    implements(IPushProducer)
+
+    REORDER_LIMIT_FACTOR = 10
+
+    def __init__(self, resource, request, keys_page, concurrency,
+                 ordered=False, reorder_limit=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.resource = resource
+        self.request = request
+        self.concurrency = max(1, concurrency)
+        self.ordered = ordered
+        if reorder_limit is None:
+            reorder_limit = self.concurrency * self.REORDER_LIMIT_FACTOR
+        self.reorder_limit = reorder_limit
+        self.clock = clock
+
+        self.rows_written = 0
+        self.start_time = None
+        self.end_time = None
+
+        self._page = None
+        self._keys = deque()
+        self._next_page_d = None
+        self._outstanding = 0
+        self._paused = False
+        self._stopped = False
+        self._finished = False
+        self._registered = False
+        self._filling = False
+        self._next_seq = 0
+        self._emit_seq = 0
+        self._reorder_buffer = {}
+        self._done_d = Deferred()
+        self._set_page(keys_page)
+
+    def start(self):
+        """
+        Start streaming messages to the request.
+
+        Returns a deferred that fires when the export is finished or
+        abandoned.
+        """
+        self.start_time = self.clock.seconds()
+        if not self._connection_closed():
+            self.request.registerProducer(self, True)
+            self._registered = True
+        self._fill_window()
+        return self._done_d
+
+    def elapsed(self):
+        if self.start_time is None:
+            return 0.0
+        end_time = self.end_time
+        if end_time is None:
+            end_time = self.clock.seconds()
+        return end_time - self.start_time
+
+    def rows_per_second(self):
+        elapsed = self.elapsed()
+        if elapsed <= 0:
+            return 0.0
+        return self.rows_written / elapsed
+
+    # IPushProducer
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._fill_window()
+
+    def stopProducing(self):
+        self._stopped = True
+        self._check_done()
+
+    # Internals
+
+    def _connection_closed(self):
+        return getattr(self.request, 'connection_has_been_closed', False)
+
+    def _set_page(self, keys_page):
+        self._page = keys_page
+        self._keys.extend(keys_page)
+        self._next_page_d = None
+
+    def _fetch_next_page(self):
+        """
+        Request the next page of keys if we're running low on keys and
+        there's no request in flight already.
+        """
+        if self._next_page_d is not None or not self._page.has_next_page():
+            return
+        if len(self._keys) >= self.concurrency:
+            return
+        self._next_page_d = self._page.next_page()
+        self._next_page_d.addCallbacks(
+            self._next_page_received, self._next_page_failed)
+
+    def _next_page_received(self, keys_page):
+        if self._stopped:
+            # Nobody wants the rest of the pages.
+            self._next_page_d = None
+            self._check_done()
+            return
+        self._set_page(keys_page)
+        self._fill_window()
+
+    def _next_page_failed(self, failure):
+        log.err(failure, "Error fetching keys page for message export.")
+        self._stopped = True
+        self._check_done()
+
+    def _pages_remaining(self):
+        if self._next_page_d is not None:
+            return not self._next_page_d.called
+        return self._page.has_next_page()
+
+    def _fill_window(self):
+        """
+        Start new fetches until the window is full, we run out of keys or
+        we're paused.
+        """
+        if self._filling:
+            # Fetches that complete immediately land here. The loop further
+            # up the stack will carry on where they left off.
+            return
+        if self._connection_closed():
+            self._stopped = True
+        self._filling = True
+        try:
+            while not (self._stopped or self._paused):
+                self._fetch_next_page()
+                if self._outstanding >= self.concurrency:
+                    break
+                if len(self._reorder_buffer) >= self.reorder_limit:
+                    break
+                if not self._keys:
+                    break
+                seq = self._next_seq
+                self._next_seq += 1
+                self._fetch(self._keys.popleft(), seq)
+        finally:
+            self._filling = False
+        self._check_done()
+
+    def _fetch(self, message_key, seq):
+        self._outstanding += 1
+        d = maybeDeferred(
+            self.resource.get_message, self.resource.message_store,
+            message_key)
+        d.addCallbacks(
+            self._message_fetched, self._message_failed,
+            callbackArgs=(seq,), errbackArgs=(seq,))
+
+    def _message_fetched(self, message, seq):
+        self._outstanding -= 1
+        if self.ordered:
+            self._reorder_buffer[seq] = message
+            self._emit_ordered()
+        else:
+            self._write(message)
+        self._fill_window()
+
+    def _message_failed(self, failure, seq):
+        log.err(failure, "Error fetching message for message export.")
+        self._message_fetched(None, seq)
+
+    def _emit_ordered(self):
+        while self._emit_seq in self._reorder_buffer:
+            self._write(self._reorder_buffer.pop(self._emit_seq))
+            self._emit_seq += 1
+
+    def _write(self, message):
+        if message is None or self._stopped or self._connection_closed():
+            return
+        self.resource.write_message(message, self.request)
+        self.rows_written += 1
+
+    def _check_done(self):
+        if self._finished or self._outstanding > 0:
+            return
+        if not self._stopped and (self._keys or self._pages_remaining()):
+            return
+        self._finished = True
+        self.end_time = self.clock.seconds()
+        if self._registered and not self._connection_closed():
+            self.request.unregisterProducer()
+        log.msg("Exported %d rows in %.3fs (%.1f rows/s)." % (
+            self.rows_written, self.elapsed(), self.rows_per_second()))
+        self._done_d.callback(
+            self.resource.finish_request_cb(None, self.request))
+
+
 class MessageStoreProxyResource(Resource):
 
     isLeaf = True
@@ -61,11 +280,17 @@ class MessageStoreProxyResource(Resource):
             raise ParameterError(
                 "Invalid '%s' parameter: %s" % (argname, str(e)))
 
+    def _extract_bool_arg(self, request, argname):
+        if argname not in request.args:
+            return False
+        return request.args[argname][0].lower() in ('1', 'true', 'yes')
+
     def render_GET(self, request):
         if 'concurrency' in request.args:
             concurrency = int(request.args['concurrency'][0])
         else:
             concurrency = self.default_concurrency
+        ordered = self._extract_bool_arg(request, 'ordered')
 
         try:
             start = self._extract_date_arg(request, 'start')
@@ -85,7 +310,7 @@ class MessageStoreProxyResource(Resource):
         request.connection_has_been_closed = False
         request.notifyFinish().addBoth(
             lambda _: setattr(request, 'connection_has_been_closed', True))
-        d.addCallback(self.fetch_pages, concurrency, request)
+        d.addCallback(self.fetch_pages, concurrency, request, ordered)
         return NOT_DONE_YET
 
     def get_keys_page(self, message_store, batch_id):
@@ -97,63 +322,27 @@ class MessageStoreProxyResource(Resource):
     def get_message(self, message_store, message_id):
         raise NotImplementedError('To be implemented by sub-class.')
 
-    def fetch_pages(self, keys_page, concurrency, request):
+    def fetch_pages(self, keys_page, concurrency, request, ordered=False):
         """
-        Process a page of keys and each subsequent page.
+        Stream the messages for ``keys_page`` and all subsequent pages to the
+        request, closing the request when we're done.
 
-        The keys for the current page are handed off to :meth:`fetch_page` for
-        processing. If there is another page, we fetch that while the current
-        page is being handled and add a callback to process it when the
-        current page is finished.
-
-        When there are no more pages, we add a callback to close the request.
+        See :class:`MessageExportProducer` for details.
         """
-        if request.connection_has_been_closed:
-            # We're no longer connected, so stop doing work.
-            return
-        d = self.fetch_page(keys_page, concurrency, request)
-        if keys_page.has_next_page():
-            # We fetch the next page before waiting for the current page to be
-            # processed.
-            next_page_d = keys_page.next_page()
-            d.addCallback(lambda _: next_page_d)
-            # Add this method as a callback to operate on the next page. It's
-            # like recursion, but without worrying about stack size.
-            d.addCallback(self.fetch_pages, concurrency, request)
-        else:
-            # No more pages, so close the request.
-            d.addCallback(self.finish_request_cb, request)
-        return d
+        producer = MessageExportProducer(
+            self, request, keys_page, concurrency, ordered=ordered)
+        return producer.start()
 
     def finish_request_cb(self, _result, request):
         if not request.connection_has_been_closed:
             # We need to check for this here in case we lose the connection
             # while delivering the last page.
+            write_row_footer = getattr(
+                self.formatter, 'write_row_footer', None)
+            if write_row_footer is not None:
+                write_row_footer(request)
             return request.finish()
 
-    @inlineCallbacks
-    def fetch_page(self, keys_page, concurrency, request):
-        """
-        Process a page of keys in chunks of concurrently-fetched messages.
-        """
-        for keys in chunks(list(keys_page), concurrency):
-            if request.connection_has_been_closed:
-                # We're no longer connected, so stop doing work.
-                return
-            yield self.handle_chunk(keys, request)
-
-    def handle_chunk(self, message_keys, request):
-        """
-        Concurrently fetch a chunk of messages and write each to the response.
-        """
-        return DeferredList([
-            self.handle_message(key, request) for key in message_keys])
-
-    def handle_message(self, message_key, request):
-        d = self.get_message(self.message_store, message_key)
-        d.addCallback(self.write_message, request)
-        return d
-
     def write_message(self, message, request):
         if not request.content.closed:
             self.formatter.write_row(request, message)
@@ -213,6 +402,11 @@ class BatchResource(Resource):
         'inbound.csv': (InboundResource, CsvFormatter),
         'outbound.csv': (OutboundResource, CsvFormatter),
         'events.csv': (EventResource, CsvEventFormatter),
+        'inbound.archive': (
+            InboundResource, partial(ArchiveFormatter, 'inbound')),
+        'outbound.archive': (
+            OutboundResource, partial(ArchiveFormatter, 'outbound')),
+        'events.archive': (EventResource, partial(ArchiveFormatter, 'event')),
     }
 
     def __init__(self, message_store, batch_id):
@@ -0,0 +1,104 @@
+# -*- test-case-name: vumi.components.tests.test_routing_state -*-
+
+"""Routing state for dispatchers.
+
+Routers need to remember things like which group a user has been assigned to
+and which application sent an outbound message (so that events for it can be
+routed back). The stores in this module keep that state in Redis with a
+bounded in-process :class:`vumi.utils.LRUCache` in front of it, so that
+repeat lookups don't need a Redis round trip.
+
+Cached values are never updated in place (a user's group and a message's
+return route are written once), so it is safe for several processes to share
+the same Redis state while each keeps its own cache.
+"""
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from vumi.utils import LRUCache
+
+
+class UserGroupStore(object):
+    """Sticky assignments of users to groups.
+
+    :param redis:
+        A Redis manager.
+    :param int cache_size:
+        The maximum number of assignments to cache locally.
+    """
+
+    def __init__(self, redis, cache_size):
+        self.redis = redis
+        self.cache = LRUCache(cache_size)
+
+    def user_key(self, user_id):
+        return "user:%s" % (user_id,)
+
+    @inlineCallbacks
+    def get_group(self, user_id):
+        """
+        Return the group assigned to ``user_id``, or ``None`` if there isn't
+        one.
+        """
+        group = self.cache.get(user_id)
+        if group is None:
+            group = yield self.redis.get(self.user_key(user_id))
+            if group:
+                self.cache.set(user_id, group)
+        returnValue(group or None)
+
+    @inlineCallbacks
+    def assign_group(self, user_id, group):
+        """
+        Assign ``group`` to ``user_id`` unless another process has already
+        assigned one. Returns the group the user ended up in.
+        """
+        user_key = self.user_key(user_id)
+        created = yield self.redis.setnx(user_key, group)
+        if not created:
+            group = yield self.redis.get(user_key)
+        self.cache.set(user_id, group)
+        returnValue(group)
+
+
+class ReturnRouteStore(object):
+    """Which endpoint each outbound message came from.
+
+    Each route is stored as a single Redis string with an expiry, written
+    with one ``SETEX`` command.
+
+    :param redis:
+        A Redis manager.
+    :param int ttl:
+        The number of seconds to keep routes in Redis for.
+    :param int cache_size:
+        The maximum number of routes to cache locally.
+    """
+
+    def __init__(self, redis, ttl, cache_size):
+        self.redis = redis
+        self.ttl = ttl
+        self.cache = LRUCache(cache_size)
+
+    def route_key(self, message_id):
+        return "message:%s" % (message_id,)
+
+    def set_route(self, message_id, name):
+        """
+        Remember that message ``message_id`` came from endpoint ``name``.
+        """
+        self.cache.set(message_id, name)
+        return self.redis.setex(self.route_key(message_id), self.ttl, name)
+
+    @inlineCallbacks
+    def get_route(self, message_id):
+        """
+        Return the endpoint that message ``message_id`` came from, or
+        ``None`` if there is no route for it.
+        """
+        name = self.cache.get(message_id)
+        if name is None:
+            name = yield self.redis.get(self.route_key(message_id))
+            if name:
+                self.cache.set(message_id, name)
+        returnValue(name or None)
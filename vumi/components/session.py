@@ -4,9 +4,79 @@
 
 import time
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
 
 from vumi import log
+from vumi.persist.redis_base import RedisScript
+
+
+def _pairs_to_dict(pairs):
+    return dict(zip(pairs[::2], pairs[1::2]))
+
+
+def _write_session(redis, keys, args):
+    session_key = keys[0]
+    clear, expiry, member = args[:3]
+    fields = args[3:]
+    if clear == '1':
+        redis.delete(session_key)
+    if fields:
+        redis.hmset(session_key, _pairs_to_dict(fields))
+    if int(expiry) > 0:
+        redis.expire(session_key, int(expiry))
+    if len(keys) > 1:
+        redis.sadd(keys[1], member)
+    session = redis.hgetall(session_key)
+    return [item for pair in session.items() for item in pair]
+
+
+WRITE_SESSION_SCRIPT = RedisScript("""
+if ARGV[1] == '1' then
+    redis.call('DEL', KEYS[1])
+end
+if #ARGV > 3 then
+    redis.call('HMSET', KEYS[1], unpack(ARGV, 4))
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+if KEYS[2] then
+    redis.call('SADD', KEYS[2], ARGV[3])
+end
+return redis.call('HGETALL', KEYS[1])
+""", _write_session)
+
+
+def write_session(redis, session_key, session, clear=False, expiry=None,
+                  index_key=None, member=''):
+    """Write session fields to a Redis hash in a single round trip.
+
+    :param redis:
+        A Redis manager or client with a ``run_script`` method.
+    :param str session_key:
+        The key of the session hash.
+    :param dict session:
+        The fields to write. Nested dictionaries are not supported.
+    :param bool clear:
+        If ``True``, any existing fields are removed first.
+    :param int expiry:
+        If given, the session hash expires after this many seconds.
+    :param str index_key:
+        If given, ``member`` is added to the set at this key.
+
+    Returns the full contents of the session hash after the write, or a
+    deferred that fires with it for asynchronous managers.
+    """
+    args = ['1' if clear else '0', int(expiry or 0), member]
+    for field, value in session.iteritems():
+        args.extend([field, value])
+    keys = [session_key]
+    if index_key is not None:
+        keys.append(index_key)
+    result = redis.run_script(WRITE_SESSION_SCRIPT, keys, args)
+    if hasattr(result, 'addCallback'):
+        return result.addCallback(_pairs_to_dict)
+    return _pairs_to_dict(result)
 
 
 class SessionManager(object):
@@ -43,19 +113,41 @@ class SessionManager(object):
         return d.addCallback(lambda m: cls(m, max_session_length, gc_period))
 
     @inlineCallbacks
-    def active_sessions(self):
+    def active_sessions(self, batch_size=100):
         """Return a list of active user_ids and associated sessions.
 
-        Queries redis for keys starting with the session key prefix. This is
-        O(n) over the total number of keys in redis, but this is still pretty
-        quick even for millions of keys. Try not to hit this too often, though.
+        This uses :meth:`scan_sessions`, so it doesn't block Redis, but it
+        still holds every session in memory. Use :meth:`scan_sessions`
+        directly to process sessions in batches instead.
         """
-        keys = yield self.redis.keys('session:*')
-        sessions = []
-        for user_id in [key.split(':', 1)[1] for key in keys]:
-            sessions.append((user_id, (yield self.load_session(user_id))))
+        # A session may be returned in more than one batch.
+        sessions = {}
+        yield self.scan_sessions(sessions.update, batch_size)
+        returnValue(sessions.items())
 
-        returnValue(sessions)
+    @inlineCallbacks
+    def scan_sessions(self, callback, batch_size=100):
+        """Call ``callback`` with batches of active sessions.
+
+        Session keys are found with ``SCAN`` and the sessions in each batch
+        are fetched concurrently. ``callback`` is called with a list of
+        ``(user_id, session)`` pairs and may return a deferred, in which case
+        the scan waits for it before fetching the next batch. A batch may be
+        empty and a session may appear in more than one batch.
+        """
+        cursor = None
+        while True:
+            cursor, keys = yield self.redis.scan(
+                cursor, match='session:*', count=batch_size)
+            user_ids = [key.split(':', 1)[1] for key in keys]
+            sessions = yield gatherResults([
+                self.load_session(user_id) for user_id in user_ids])
+            # Sessions may expire between the scan and the load.
+            yield callback([
+                (user_id, session)
+                for user_id, session in zip(user_ids, sessions) if session])
+            if cursor is None:
+                break
 
     def load_session(self, user_id):
         """
@@ -78,27 +170,22 @@ class SessionManager(object):
         ukey = "%s:%s" % ('session', user_id)
         return self.redis.expire(ukey, timeout)
 
-    @inlineCallbacks
     def create_session(self, user_id, **kwargs):
         """
         Create a new session using the given user_id
         """
-        yield self.clear_session(user_id)
         defaults = {
             'created_at': time.time()
         }
         defaults.update(kwargs)
-        yield self.save_session(user_id, defaults)
-        if self.max_session_length:
-            yield self.schedule_session_expiry(user_id,
-                                               int(self.max_session_length))
-        returnValue((yield self.load_session(user_id)))
+        return write_session(
+            self.redis, "%s:%s" % ('session', user_id), defaults, clear=True,
+            expiry=self.max_session_length)
 
     def clear_session(self, user_id):
         ukey = "%s:%s" % ('session', user_id)
         return self.redis.delete(ukey)
 
-    @inlineCallbacks
     def save_session(self, user_id, session):
         """
         Save a session
@@ -113,6 +200,5 @@ class SessionManager(object):
 
         """
         ukey = "%s:%s" % ('session', user_id)
-        for s_key, s_value in session.items():
-            yield self.redis.hset(ukey, s_key, s_value)
-        returnValue(session)
+        d = write_session(self.redis, ukey, session)
+        return d.addCallback(lambda _: session)
@@ -9,13 +9,206 @@ import time
 from twisted.internet.defer import returnValue
 
 from vumi.errors import VumiError
-from vumi.persist.redis_base import Manager
+from vumi.persist.redis_base import Manager, RedisScript
 
 
 class TagpoolError(VumiError):
     """An error occurred during an operation on a tag pool."""
 
 
+# The free list may contain tags that aren't free, because acquiring a
+# specific tag only removes it from the free set (removing it from the list
+# would be O(N)). The free set is authoritative and stale list entries are
+# skipped when tags are popped. The listed set holds the tags that are in
+# the free list, so that a released tag is never pushed twice.
+
+def _acquire_tag(redis, keys, args):
+    (free_list_key, listed_key, free_set_key, inuse_set_key, reason_key,
+     owner_key) = keys
+    reason, owner_entry_prefix = args
+    while True:
+        tag = redis.lpop(free_list_key)
+        if tag is None:
+            return None
+        redis.srem(listed_key, tag)
+        if redis.smove(free_set_key, inuse_set_key, tag):
+            redis.hset(reason_key, tag, reason)
+            redis.sadd(owner_key, "%s%s]" % (
+                owner_entry_prefix, json.dumps(tag.decode("UTF-8"))))
+            return tag
+
+
+# Owner index entries are JSON encoded ``[pool, tag]`` lists. When we acquire
+# a tag we don't know which one we'll get, so the script is given the
+# encoded ``[pool, `` prefix and encodes the tag itself. The tag has to be
+# encoded exactly the way Python's json.dumps() does it, so that releasing
+# the tag removes the same entry.
+JSON_STRING_LUA = r"""
+local function json_string(s)
+    local out = {}
+    local i = 1
+    while i <= #s do
+        local c = s:byte(i)
+        local n
+        local cp
+        if c < 0x80 then
+            n, cp = 1, c
+        elseif c < 0xE0 then
+            n, cp = 2, c % 0x20
+        elseif c < 0xF0 then
+            n, cp = 3, c % 0x10
+        else
+            n, cp = 4, c % 0x08
+        end
+        for j = i + 1, i + n - 1 do
+            cp = cp * 0x40 + s:byte(j) % 0x40
+        end
+        i = i + n
+        if cp == 0x22 then
+            table.insert(out, '\\"')
+        elseif cp == 0x5C then
+            table.insert(out, '\\\\')
+        elseif cp == 0x0A then
+            table.insert(out, '\\n')
+        elseif cp == 0x0D then
+            table.insert(out, '\\r')
+        elseif cp == 0x09 then
+            table.insert(out, '\\t')
+        elseif cp == 0x08 then
+            table.insert(out, '\\b')
+        elseif cp == 0x0C then
+            table.insert(out, '\\f')
+        elseif cp < 0x20 or cp > 0x7E then
+            if cp > 0xFFFF then
+                cp = cp - 0x10000
+                table.insert(out, string.format(
+                    '\\u%04x\\u%04x', 0xD800 + math.floor(cp / 0x400),
+                    0xDC00 + cp % 0x400))
+            else
+                table.insert(out, string.format('\\u%04x', cp))
+            end
+        else
+            table.insert(out, string.char(cp))
+        end
+    end
+    return '"' .. table.concat(out) .. '"'
+end
+"""
+
+
+ACQUIRE_TAG_SCRIPT = RedisScript(JSON_STRING_LUA + """
+while true do
+    local tag = redis.call('LPOP', KEYS[1])
+    if not tag then
+        return false
+    end
+    redis.call('SREM', KEYS[2], tag)
+    if redis.call('SMOVE', KEYS[3], KEYS[4], tag) == 1 then
+        redis.call('HSET', KEYS[5], tag, ARGV[1])
+        redis.call('SADD', KEYS[6], ARGV[2] .. json_string(tag) .. ']')
+        return tag
+    end
+end
+""", _acquire_tag)
+
+
+def _acquire_specific_tag(redis, keys, args):
+    free_set_key, inuse_set_key, reason_key, owner_key = keys
+    tag, reason, owner_entry = args
+    if not redis.smove(free_set_key, inuse_set_key, tag):
+        return 0
+    redis.hset(reason_key, tag, reason)
+    redis.sadd(owner_key, owner_entry)
+    return 1
+
+
+ACQUIRE_SPECIFIC_TAG_SCRIPT = RedisScript("""
+if redis.call('SMOVE', KEYS[1], KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+redis.call('SADD', KEYS[4], ARGV[3])
+return 1
+""", _acquire_specific_tag)
+
+
+def _release_tag(redis, keys, args):
+    (inuse_set_key, free_set_key, free_list_key, listed_key, reason_key,
+     owners_key, unowned_key) = keys
+    tag, owner_entry = args
+    if not redis.smove(inuse_set_key, free_set_key, tag):
+        return None
+    if redis.sadd(listed_key, tag):
+        redis.rpush(free_list_key, tag)
+    reason = redis.hget(reason_key, tag)
+    if not reason:
+        return ''
+    owner = json.loads(reason).get('owner')
+    if owner is None:
+        owner_key = unowned_key
+    else:
+        owner_key = "%s:%s:tags" % (owners_key, owner.encode("UTF-8"))
+    redis.srem(owner_key, owner_entry)
+    return reason
+
+
+# The owner key depends on the owner recorded in the reason hash, so the
+# script builds it from the (prefixed) owners key it is given.
+RELEASE_TAG_SCRIPT = RedisScript("""
+if redis.call('SMOVE', KEYS[1], KEYS[2], ARGV[1]) == 0 then
+    return false
+end
+if redis.call('SADD', KEYS[4], ARGV[1]) == 1 then
+    redis.call('RPUSH', KEYS[3], ARGV[1])
+end
+local reason = redis.call('HGET', KEYS[5], ARGV[1])
+if not reason or reason == '' then
+    return ''
+end
+local owner = cjson.decode(reason)['owner']
+local owner_key = KEYS[7]
+if owner ~= nil and owner ~= cjson.null then
+    owner_key = KEYS[6] .. ':' .. owner .. ':tags'
+end
+redis.call('SREM', owner_key, ARGV[2])
+return reason
+""", _release_tag)
+
+
+def _declare_tags(redis, keys, args):
+    (pool_list_key, free_list_key, listed_key, free_set_key,
+     inuse_set_key) = keys
+    pool, tags = args[0], args[1:]
+    redis.sadd(pool_list_key, pool)
+    declared = 0
+    for tag in tags:
+        if (redis.sismember(free_set_key, tag) or
+                redis.sismember(inuse_set_key, tag)):
+            continue
+        redis.sadd(free_set_key, tag)
+        redis.sadd(listed_key, tag)
+        redis.rpush(free_list_key, tag)
+        declared += 1
+    return declared
+
+
+DECLARE_TAGS_SCRIPT = RedisScript("""
+redis.call('SADD', KEYS[1], ARGV[1])
+local declared = 0
+for i = 2, #ARGV do
+    local tag = ARGV[i]
+    if redis.call('SISMEMBER', KEYS[4], tag) == 0 and
+            redis.call('SISMEMBER', KEYS[5], tag) == 0 then
+        redis.call('SADD', KEYS[4], tag)
+        redis.call('SADD', KEYS[3], tag)
+        redis.call('RPUSH', KEYS[2], tag)
+        declared = declared + 1
+    end
+end
+return declared
+""", _declare_tags)
+
+
 class TagpoolManager(object):
     """Manage a set of tag pools.
 
@@ -61,7 +254,6 @@ class TagpoolManager(object):
         for pool, local_tag in tags:
             pools.setdefault(pool, []).append(local_tag)
         for pool, local_tags in pools.items():
-            yield self._register_pool(pool)
             yield self._declare_tags(pool, local_tags)
 
     @Manager.calls_manager
@@ -92,6 +284,7 @@ class TagpoolManager(object):
         else:
             yield self.redis.delete(free_set_key)
             yield self.redis.delete(free_list_key)
+            yield self.redis.delete(self._tag_pool_listed_key(pool))
             yield self.redis.delete(inuse_set_key)
             yield self.redis.delete(metadata_key)
             yield self._unregister_pool(pool)
@@ -157,6 +350,10 @@ class TagpoolManager(object):
         return tuple(":".join(["tagpools", pool, state])
                      for state in ("free:list", "free:set", "inuse:set"))
 
+    def _tag_pool_listed_key(self, pool):
+        pool = self._encode(pool)
+        return ":".join(["tagpools", pool, "free:listed"])
+
     def _tag_pool_metadata_key(self, pool):
         pool = self._encode(pool)
         return ":".join(["tagpools", pool, "metadata"])
@@ -164,70 +361,64 @@ class TagpoolManager(object):
     @Manager.calls_manager
     def _acquire_tag(self, pool, owner, reason):
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        tag = yield self.redis.lpop(free_list_key)
-        if tag is not None:
-            yield self.redis.smove(free_set_key, inuse_set_key, tag)
-            yield self._store_reason(pool, tag, owner, reason)
-        returnValue(self._decode(tag) if tag is not None else None)
+        # The script appends the encoded tag and closing bracket.
+        owner_entry_prefix = json.dumps([pool, u""])[:-3]
+        tag = yield self.redis.run_script(ACQUIRE_TAG_SCRIPT, [
+            free_list_key, self._tag_pool_listed_key(pool), free_set_key,
+            inuse_set_key, self._tag_pool_reason_key(pool),
+            self._owner_tag_list_key(owner),
+        ], [self._reason_json(owner, reason), owner_entry_prefix])
+        if tag is None:
+            returnValue(None)
+        returnValue(self._decode(tag))
 
     @Manager.calls_manager
     def _acquire_specific_tag(self, pool, local_tag, owner, reason):
+        owner_entry = json.dumps([pool, local_tag])
         local_tag = self._encode(local_tag)
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        moved = yield self.redis.lrem(free_list_key, local_tag, num=1)
-        if moved:
-            yield self.redis.smove(free_set_key, inuse_set_key, local_tag)
-            yield self._store_reason(pool, local_tag, owner, reason)
-        returnValue(moved)
+        acquired = yield self.redis.run_script(ACQUIRE_SPECIFIC_TAG_SCRIPT, [
+            free_set_key, inuse_set_key, self._tag_pool_reason_key(pool),
+            self._owner_tag_list_key(owner),
+        ], [local_tag, self._reason_json(owner, reason), owner_entry])
+        returnValue(acquired)
 
     @Manager.calls_manager
     def _release_tag(self, pool, local_tag):
+        owner_entry = json.dumps([pool, local_tag])
         local_tag = self._encode(local_tag)
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        count = yield self.redis.smove(inuse_set_key, free_set_key, local_tag)
-        if count == 1:
-            yield self.redis.rpush(free_list_key, local_tag)
-            yield self._remove_reason(pool, local_tag)
+        yield self.redis.run_script(RELEASE_TAG_SCRIPT, [
+            inuse_set_key, free_set_key, free_list_key,
+            self._tag_pool_listed_key(pool), self._tag_pool_reason_key(pool),
+            self._owners_key(), self._owner_tag_list_key(None),
+        ], [local_tag, owner_entry])
 
     @Manager.calls_manager
     def _declare_tags(self, pool, local_tags):
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        new_tags = set(self._encode(tag) for tag in local_tags)
-        old_tags = yield self.redis.sunion(free_set_key, inuse_set_key)
-        old_tags = set(old_tags)
-        for tag in sorted(new_tags - old_tags):
-            yield self.redis.sadd(free_set_key, tag)
-            yield self.redis.rpush(free_list_key, tag)
+        new_tags = sorted(set(self._encode(tag) for tag in local_tags))
+        yield self.redis.run_script(DECLARE_TAGS_SCRIPT, [
+            self._pool_list_key(), free_list_key,
+            self._tag_pool_listed_key(pool), free_set_key, inuse_set_key,
+        ], [self._encode(pool)] + new_tags)
 
     def _tag_pool_reason_key(self, pool):
         pool = self._encode(pool)
         return ":".join(["tagpools", pool, "reason:hash"])
 
+    def _owners_key(self):
+        return ":".join(["tagpools", "owners"])
+
     def _owner_tag_list_key(self, owner):
         if owner is None:
             return ":".join(["tagpools", "unowned", "tags"])
         owner = self._encode(owner)
-        return ":".join(["tagpools", "owners", owner, "tags"])
+        return ":".join([self._owners_key(), owner, "tags"])
 
-    @Manager.calls_manager
-    def _store_reason(self, pool, local_tag, owner, reason):
+    def _reason_json(self, owner, reason):
         if reason is None:
             reason = {}
         reason['timestamp'] = time.time()
         reason['owner'] = owner
-        reason_hash_key = self._tag_pool_reason_key(pool)
-        yield self.redis.hset(reason_hash_key, local_tag, json.dumps(reason))
-        owner_tag_list_key = self._owner_tag_list_key(owner)
-        yield self.redis.sadd(owner_tag_list_key,
-                              json.dumps([pool, self._decode(local_tag)]))
-
-    @Manager.calls_manager
-    def _remove_reason(self, pool, local_tag):
-        reason_hash_key = self._tag_pool_reason_key(pool)
-        reason = yield self.redis.hget(reason_hash_key, local_tag)
-        if reason is not None:
-            reason = json.loads(reason)
-            owner = reason.get('owner')
-            owner_tag_list_key = self._owner_tag_list_key(owner)
-            self.redis.srem(owner_tag_list_key,
-                            json.dumps([pool, self._decode(local_tag)]))
+        return json.dumps(reason)
@@ -0,0 +1,184 @@
+"""Tests for vumi.components.delayed_jobs."""
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock, deferLater
+
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.components.delayed_jobs import DelayedJobQueue, DelayedJob
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+
+class TestDelayedJobQueue(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        yield self.redis._purge_all()  # Just in case
+        self.delivered = []
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.queue = self.make_queue()
+
+    def make_queue(self, callback=None, **kw):
+        queue = DelayedJobQueue(
+            self.redis, callback or self.deliver, **kw)
+        queue.reactor = self.clock
+        self.add_cleanup(queue.stop)
+        return queue
+
+    def deliver(self, job):
+        self.delivered.append(job)
+
+    @inlineCallbacks
+    def test_schedule(self):
+        job_id = yield self.queue.schedule(10, "data")
+        self.assertEqual((yield self.queue.get_due(job_id)), 1010.0)
+        self.assertEqual((yield self.queue.get_data(job_id)), "data")
+        self.assertEqual((yield self.queue.get_job_ids()), [job_id])
+        self.assertEqual((yield self.queue.count()), 1)
+
+    @inlineCallbacks
+    def test_schedule_with_job_id_replaces_job(self):
+        yield self.queue.schedule(10, "data", job_id="job1")
+        yield self.queue.schedule(20, job_id="job1", now=0)
+        self.assertEqual((yield self.queue.get_due("job1")), 20.0)
+        self.assertEqual((yield self.queue.get_data("job1")), None)
+        self.assertEqual((yield self.queue.count()), 1)
+
+    @inlineCallbacks
+    def test_claim_due(self):
+        yield self.queue.add("job2", 990, "data2")
+        yield self.queue.add("job1", 980)
+        yield self.queue.add("job3", 1010, "data3")
+        jobs = yield self.queue.claim_due()
+        self.assertEqual(jobs, [
+            DelayedJob("job1", 980.0, None),
+            DelayedJob("job2", 990.0, "data2"),
+        ])
+        # Claimed jobs stay in the queue until their claims expire.
+        self.assertEqual((yield self.queue.count()), 3)
+        self.assertEqual((yield self.queue.get_due("job1")), 1060.0)
+        self.assertEqual((yield self.queue.claim_due()), [])
+        self.assertEqual(
+            [job.job_id for job in (yield self.queue.claim_due(now=1060))],
+            ["job3", "job1", "job2"])
+
+    @inlineCallbacks
+    def test_claim_due_limit(self):
+        for i in range(5):
+            yield self.queue.add("job%d" % (i,), 990 + i)
+        jobs = yield self.queue.claim_due(limit=2)
+        self.assertEqual([job.job_id for job in jobs], ["job0", "job1"])
+        jobs = yield self.queue.claim_due(limit=2)
+        self.assertEqual([job.job_id for job in jobs], ["job2", "job3"])
+
+    @inlineCallbacks
+    def test_remove(self):
+        yield self.queue.add("job1", 990, "data")
+        yield self.queue.remove("job1")
+        self.assertEqual((yield self.queue.count()), 0)
+        self.assertEqual((yield self.queue.get_data("job1")), None)
+
+    @inlineCallbacks
+    def test_deliver_due(self):
+        queue = self.make_queue(batch_size=2)
+        for i in range(5):
+            yield queue.add("job%d" % (i,), 990 + i, "data%d" % (i,))
+        yield queue.add("future", 1010)
+        yield queue.deliver_due()
+        self.assertEqual(
+            [(job.job_id, job.data) for job in self.delivered],
+            [("job%d" % (i,), "data%d" % (i,)) for i in range(5)])
+        self.assertEqual((yield queue.get_job_ids()), ["future"])
+        self.assertEqual((yield queue.get_data("job0")), None)
+        self.assertEqual(queue.depth, 1)
+        self.assertEqual(queue.lag, 10.0)
+
+    @inlineCallbacks
+    def test_deliver_due_nothing_due(self):
+        yield self.queue.add("future", 1010)
+        yield self.queue.deliver_due()
+        self.assertEqual(self.delivered, [])
+        self.assertEqual(self.queue.depth, 1)
+        self.assertEqual(self.queue.lag, 0.0)
+
+    @inlineCallbacks
+    def test_deliver_due_failure(self):
+        def callback(job):
+            if job.job_id == "bad":
+                raise ValueError("Bad job.")
+            self.delivered.append(job)
+
+        queue = self.make_queue(callback)
+        yield queue.add("bad", 990)
+        yield queue.add("good", 995)
+        yield queue.deliver_due()
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertEqual([job.job_id for job in self.delivered], ["good"])
+        # The failed job is delivered again once its claim expires.
+        self.assertEqual((yield queue.get_job_ids()), ["bad"])
+        self.assertEqual((yield queue.get_due("bad")), 1060.0)
+        yield queue.deliver_due(now=1060)
+        self.flushLoggedErrors(ValueError)
+        self.assertEqual((yield queue.get_due("bad")), 1120.0)
+
+    @inlineCallbacks
+    def test_deliver_due_concurrency(self):
+        in_flight = []
+        max_in_flight = []
+
+        def finish(job):
+            in_flight.remove(job)
+            self.delivered.append(job)
+
+        def callback(job):
+            in_flight.append(job)
+            max_in_flight.append(len(in_flight))
+            return deferLater(reactor, 0, finish, job)
+
+        queue = self.make_queue(callback, concurrency=2)
+        for i in range(5):
+            yield queue.add("job%d" % (i,), 990 + i)
+        yield queue.deliver_due()
+        self.assertEqual(max(max_in_flight), 2)
+        self.assertEqual(len(self.delivered), 5)
+        self.assertEqual((yield queue.count()), 0)
+
+    @inlineCallbacks
+    def test_start_and_stop(self):
+        yield self.queue.add("job1", 990)
+        self.queue.start(5)
+        self.assertTrue(self.queue.is_running)
+        # Stopping waits for the delivery run in progress.
+        yield self.queue.stop()
+        self.assertFalse(self.queue.is_running)
+        self.assertEqual([job.job_id for job in self.delivered], ["job1"])
+
+    @inlineCallbacks
+    def test_register_metrics(self):
+        def callback(job):
+            if job.job_id == "bad":
+                raise ValueError("Bad job.")
+
+        manager = MetricManager('vumi.test.', preaggregate=True)
+        queue = self.make_queue(callback)
+        queue.register_metrics(manager, 'jobs')
+        self.assertEqual(manager['jobs.depth'].poll(), [])
+        yield queue.add("bad", 990)
+        yield queue.add("good", 995)
+        yield queue.add("future", 1010)
+        yield queue.deliver_due()
+        self.flushLoggedErrors(ValueError)
+        [(_, depth)] = manager['jobs.depth'].poll()
+        [(_, lag)] = manager['jobs.lag'].poll()
+        [(_, delivered)] = manager['jobs.delivered'].poll()
+        [(_, failed)] = manager['jobs.failed'].poll()
+        self.assertEqual(depth['last'], 2.0)
+        self.assertEqual(lag['last'], 10.0)
+        self.assertEqual(delivered['sum'], 1.0)
+        self.assertEqual(failed['sum'], 1.0)
+
+    def test_stop_not_running(self):
+        return self.queue.stop()
@@ -0,0 +1,164 @@
+import gzip
+from datetime import datetime, timedelta
+from StringIO import StringIO
+
+from vumi.components.message_archive import (
+    MessageArchiveWriter, MessageArchiveReader, ArchiveChunk, ArchiveError,
+    build_trailer, parse_trailer, TRAILER_SIZE)
+from vumi.message import format_vumi_date
+from vumi.tests.helpers import VumiTestCase, MessageHelper
+
+
+class TestTrailer(VumiTestCase):
+
+    def test_round_trip(self):
+        trailer = build_trailer(123456789)
+        self.assertEqual(len(trailer), TRAILER_SIZE)
+        self.assertEqual(parse_trailer(trailer), 123456789)
+
+    def test_trailer_is_empty_gzip_member(self):
+        self.assertEqual(
+            gzip.GzipFile(fileobj=StringIO(build_trailer(42))).read(), '')
+
+    def test_invalid_trailer(self):
+        self.assertRaises(ArchiveError, parse_trailer, 'x' * TRAILER_SIZE)
+        self.assertRaises(ArchiveError, parse_trailer, 'short')
+
+
+class TestArchiveChunk(VumiTestCase):
+
+    def mk_chunk(self, start, end):
+        return ArchiveChunk('inbound', 0, 10, 2, start, end)
+
+    def test_overlaps(self):
+        chunk = self.mk_chunk('2014-11-02', '2014-11-04')
+        self.assertTrue(chunk.overlaps())
+        self.assertTrue(chunk.overlaps('2014-11-01', '2014-11-02'))
+        self.assertTrue(chunk.overlaps('2014-11-03', None))
+        self.assertTrue(chunk.overlaps(None, '2014-11-03'))
+        self.assertTrue(chunk.overlaps('2014-11-04', '2014-11-05'))
+        self.assertFalse(chunk.overlaps('2014-11-05', None))
+        self.assertFalse(chunk.overlaps(None, '2014-11-01'))
+
+    def test_dict_round_trip(self):
+        chunk = self.mk_chunk('2014-11-02', '2014-11-04')
+        self.assertEqual(ArchiveChunk.from_dict(chunk.to_dict()), chunk)
+
+
+class TestMessageArchive(VumiTestCase):
+
+    def setUp(self):
+        self.msg_helper = self.add_helper(MessageHelper())
+        self.start = datetime(2014, 11, 1, 12, 0, 0)
+
+    def mktime(self, hours):
+        return self.start + timedelta(hours=hours)
+
+    def mk_messages(self, count):
+        inbound = [
+            self.msg_helper.make_inbound('in %s' % i, timestamp=self.mktime(i))
+            for i in range(count)]
+        outbound = [
+            self.msg_helper.make_outbound(
+                'out %s' % i, timestamp=self.mktime(i))
+            for i in range(count)]
+        events = [
+            self.msg_helper.make_ack(msg, timestamp=self.mktime(i))
+            for i, msg in enumerate(outbound)]
+        return inbound, outbound, events
+
+    def write_archive(self, inbound, outbound, events, chunk_size=2):
+        output = StringIO()
+        writer = MessageArchiveWriter(output, chunk_size=chunk_size)
+        for msg in inbound:
+            writer.add_message('inbound', msg)
+        for msg in outbound:
+            writer.add_message('outbound', msg)
+        for event in events:
+            writer.add_message('event', event)
+        writer.close()
+        return output
+
+    def test_round_trip(self):
+        inbound, outbound, events = self.mk_messages(5)
+        reader = MessageArchiveReader(
+            self.write_archive(inbound, outbound, events))
+        self.assertEqual(len(reader.chunks), 9)
+        self.assertEqual(
+            [msg for _, msg in reader.iter_messages('inbound')], inbound)
+        self.assertEqual(
+            [msg for _, msg in reader.iter_messages('outbound')], outbound)
+        self.assertEqual(
+            [msg for _, msg in reader.iter_messages('event')], events)
+        self.assertEqual(
+            sorted(d for d, _ in reader.iter_messages()),
+            ['event'] * 5 + ['inbound'] * 5 + ['outbound'] * 5)
+
+    def test_chunk_index(self):
+        inbound, _, _ = self.mk_messages(3)
+        output = self.write_archive(inbound, [], [])
+        reader = MessageArchiveReader(output)
+        self.assertEqual(reader.chunks, [
+            ArchiveChunk(
+                'inbound', 0, reader.chunks[0].length, 2,
+                format_vumi_date(self.mktime(0)),
+                format_vumi_date(self.mktime(1))),
+            ArchiveChunk(
+                'inbound', reader.chunks[0].length, reader.chunks[1].length,
+                1, format_vumi_date(self.mktime(2)),
+                format_vumi_date(self.mktime(2))),
+        ])
+
+    def test_time_range(self):
+        inbound, outbound, events = self.mk_messages(6)
+        reader = MessageArchiveReader(
+            self.write_archive(inbound, outbound, events))
+        start = format_vumi_date(self.mktime(2))
+        end = format_vumi_date(self.mktime(3))
+        self.assertEqual(
+            [c.rows for c in reader.get_chunks('inbound', start, end)], [2])
+        self.assertEqual(
+            [msg for _, msg in reader.iter_messages('inbound', start, end)],
+            inbound[2:4])
+        end = format_vumi_date(self.mktime(4))
+        self.assertEqual(
+            len(reader.get_chunks('outbound', start, end)), 2)
+        self.assertEqual(
+            [msg for _, msg in reader.iter_messages('outbound', start, end)],
+            outbound[2:5])
+
+    def test_empty_archive(self):
+        reader = MessageArchiveReader(self.write_archive([], [], []))
+        self.assertEqual(reader.chunks, [])
+        self.assertEqual(list(reader.iter_messages()), [])
+
+    def test_readable_with_gzip(self):
+        inbound, _, _ = self.mk_messages(3)
+        output = self.write_archive(inbound, [], [])
+        output.seek(0)
+        lines = gzip.GzipFile(fileobj=output).read().splitlines()
+        self.assertEqual(lines[:3], [msg.to_json() for msg in inbound])
+        self.assertTrue(lines[3].startswith('{"archive_index": '))
+
+    def test_compresses(self):
+        inbound, _, _ = self.mk_messages(100)
+        output = self.write_archive(inbound, [], [], chunk_size=50)
+        raw_size = sum(len(msg.to_json()) + 1 for msg in inbound)
+        self.assertTrue(len(output.getvalue()) * 5 < raw_size)
+
+    def test_truncated_archive(self):
+        inbound, _, _ = self.mk_messages(3)
+        data = self.write_archive(inbound, [], []).getvalue()
+        self.assertRaises(
+            ArchiveError, MessageArchiveReader, StringIO(data[:-10]))
+
+    def test_writer_closed(self):
+        [msg], _, _ = self.mk_messages(1)
+        writer = MessageArchiveWriter(StringIO())
+        writer.close()
+        self.assertRaises(ArchiveError, writer.add_message, 'inbound', msg)
+
+    def test_invalid_direction(self):
+        [msg], _, _ = self.mk_messages(1)
+        writer = MessageArchiveWriter(StringIO())
+        self.assertRaises(ValueError, writer.add_message, 'sideways', msg)
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
+from StringIO import StringIO
+
 from twisted.web.test.test_web import DummyRequest
 
+from vumi.components.message_archive import MessageArchiveReader
 from vumi.components.message_formatters import (
-    IMessageFormatter, JsonFormatter, CsvFormatter, CsvEventFormatter)
+    IMessageFormatter, JsonFormatter, CsvFormatter, CsvEventFormatter,
+    ArchiveFormatter)
 
 from vumi.tests.helpers import VumiTestCase, MessageHelper
 
@@ -34,6 +38,10 @@ class TestJsonFormatter(VumiTestCase):
             msg.to_json(), "\n",
         ])
 
+    def test_write_row_footer(self):
+        self.formatter.write_row_footer(self.request)
+        self.assertEqual(self.request.written, [])
+
 
 class TestCsvFormatter(VumiTestCase):
     def setUp(self):
@@ -156,3 +164,30 @@ class TestCsvEventFormatter(VumiTestCase):
         self.assert_row_written(
             self.request.written,
             "%(ts)s,%(id)s,nack,%(msg_id)s,føø\r\n", event)
+
+
+class TestArchiveFormatter(VumiTestCase):
+    def setUp(self):
+        self.msg_helper = self.add_helper(MessageHelper())
+        self.request = DummyRequest([''])
+        self.formatter = ArchiveFormatter('inbound', chunk_size=2)
+
+    def test_implements_IMessageFormatter(self):
+        self.assertTrue(IMessageFormatter.providedBy(self.formatter))
+
+    def test_add_http_headers(self):
+        self.formatter.add_http_headers(self.request)
+        self.assertEqual(
+            self.request.responseHeaders.getRawHeaders('Content-Type'),
+            ['application/x-vumi-message-archive'])
+
+    def test_write_rows(self):
+        msgs = [self.msg_helper.make_inbound("foo %s" % i) for i in range(3)]
+        self.formatter.write_row_header(self.request)
+        for msg in msgs:
+            self.formatter.write_row(self.request, msg)
+        self.formatter.write_row_footer(self.request)
+        reader = MessageArchiveReader(StringIO(''.join(self.request.written)))
+        self.assertEqual([c.rows for c in reader.chunks], [2, 1])
+        self.assertEqual(list(reader.iter_messages()), [
+            ('inbound', msg) for msg in msgs])
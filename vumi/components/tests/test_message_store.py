@@ -1424,6 +1424,57 @@ class TestMessageStore(TestMessageStoreBase):
 
         self.assertEqual(inbound_stats_2, {"total": 2, "unique_addresses": 2})
 
+    @inlineCallbacks
+    def test_batch_inbound_stats_range_without_cached_stats(self):
+        """
+        batch_inbound_stats counts messages from the index for batches that
+        don't have message stats in the cache.
+        """
+        batch_id = yield self.store.batch_start([('pool', 'tag')])
+        yield self.store.cache.clear_stats(batch_id)
+
+        now = datetime.now()
+        yield self.create_inbound_messages(
+            batch_id, 5, start_timestamp=now, from_addr=u'00005')
+        messages = yield self.create_inbound_messages(
+            batch_id, 3, start_timestamp=now - timedelta(5),
+            from_addr=u'00003')
+        self.assertEqual(
+            (yield self.store.cache.get_stats_buckets(batch_id, 'inbound')),
+            {})
+
+        inbound_stats = yield self.store.batch_inbound_stats(batch_id)
+        self.assertEqual(inbound_stats, {"total": 8, "unique_addresses": 2})
+
+        inbound_stats = yield self.store.batch_inbound_stats(
+            batch_id, end=format_vumi_date(messages[0]['timestamp']))
+        self.assertEqual(inbound_stats, {"total": 3, "unique_addresses": 1})
+
+    @inlineCallbacks
+    def test_batch_inbound_stats_bucket_boundaries(self):
+        """
+        batch_inbound_stats counts messages correctly when the time range
+        starts and ends exactly on stats bucket boundaries.
+        """
+        batch_id = yield self.store.batch_start([('pool', 'tag')])
+        bucket_size = self.store.cache.STATS_BUCKET_SIZE
+        start = datetime(2015, 3, 1, 12, 0, 0)
+        yield self.create_inbound_messages(
+            batch_id, 3, start_timestamp=start + timedelta(hours=2),
+            time_multiplier=1.0 / 24, from_addr=u'00003')
+
+        inbound_stats = yield self.store.batch_inbound_stats(
+            batch_id, start=format_vumi_date(start),
+            end=format_vumi_date(
+                start + timedelta(seconds=3 * bucket_size) -
+                timedelta(microseconds=1)))
+        self.assertEqual(inbound_stats, {"total": 3, "unique_addresses": 1})
+
+        inbound_stats = yield self.store.batch_inbound_stats(
+            batch_id, start=format_vumi_date(start + timedelta(hours=1)),
+            end=format_vumi_date(start + timedelta(hours=2)))
+        self.assertEqual(inbound_stats, {"total": 2, "unique_addresses": 1})
+
     @inlineCallbacks
     def test_batch_outbound_stats(self):
         """
@@ -290,6 +290,69 @@ class TestMessageStoreCache(MessageStoreCacheTestCase):
             (yield self.cache.count_inbound_message_keys(self.batch_id)), 0)
         self.assertEqual(
             (yield self.cache.count_outbound_message_keys(self.batch_id)), 0)
+        self.assertEqual(
+            (yield self.cache.get_stats_buckets(self.batch_id, 'inbound')),
+            {})
+        self.assertEqual(
+            (yield self.cache.get_stats_buckets(self.batch_id, 'outbound')),
+            {})
+
+    @inlineCallbacks
+    def test_add_inbound_message_stats(self):
+        bucket_size = self.cache.STATS_BUCKET_SIZE
+        start = datetime(2015, 3, 1, 12, 59, 57)
+        yield self.add_messages(
+            self.batch_id, self.cache.add_inbound_message,
+            now=start + timedelta(seconds=5))
+        bucket = self.cache.get_stats_bucket(start, bucket_size)
+        self.assertEqual(
+            (yield self.cache.get_stats_buckets(self.batch_id, 'inbound')),
+            {bucket: 7, bucket + bucket_size: 3})
+        self.assertEqual(
+            (yield self.cache.get_stats_buckets(self.batch_id, 'outbound')),
+            {})
+        self.assertEqual(
+            (yield self.cache.count_stats_addrs(
+                self.batch_id, 'inbound', [bucket + bucket_size])), 3)
+        self.assertEqual(
+            (yield self.cache.count_stats_addrs(
+                self.batch_id, 'inbound', [bucket, bucket + bucket_size])),
+            10)
+
+    @inlineCallbacks
+    def test_add_outbound_message_stats(self):
+        yield self.add_messages(
+            self.batch_id, self.cache.add_outbound_message)
+        buckets = yield self.cache.get_stats_buckets(
+            self.batch_id, 'outbound')
+        self.assertEqual(sum(buckets.values()), 10)
+        self.assertEqual(
+            (yield self.cache.count_stats_addrs(
+                self.batch_id, 'outbound', buckets.keys())), 10)
+
+    @inlineCallbacks
+    def test_add_message_stats_duplicate(self):
+        [msg] = yield self.add_messages(
+            self.batch_id, self.cache.add_inbound_message, count=1)
+        yield self.cache.add_inbound_message(self.batch_id, msg)
+        buckets = yield self.cache.get_stats_buckets(self.batch_id, 'inbound')
+        self.assertEqual(buckets.values(), [1])
+
+    @inlineCallbacks
+    def test_count_stats_addrs_extra_addrs(self):
+        yield self.add_messages(
+            self.batch_id, self.cache.add_inbound_message, count=3)
+        buckets = yield self.cache.get_stats_buckets(self.batch_id, 'inbound')
+        self.assertEqual(
+            (yield self.cache.count_stats_addrs(
+                self.batch_id, 'inbound', buckets.keys(),
+                [u'from-0', u'from-99'])), 4)
+        self.assertEqual(
+            (yield self.cache.count_stats_addrs(
+                self.batch_id, 'inbound', [], [u'from-0'])), 1)
+        self.assertEqual(
+            (yield self.cache.count_stats_addrs(
+                self.batch_id, 'inbound', [])), 0)
 
     @inlineCallbacks
     def test_count_inbound_throughput(self):
@@ -514,3 +577,12 @@ class TestMessageStoreCacheWithCounters(MessageStoreCacheTestCase):
         self.assertEqual(
             set(cached_message_keys),
             set([m['message_id'] for m in received_messages[-truncate_at:]]))
+
+    @inlineCallbacks
+    def test_no_stats_without_batch_start(self):
+        yield self.add_messages(self.batch_id, self.cache.add_inbound_message)
+        self.assertEqual(
+            (yield self.cache.get_stats_bucket_size(self.batch_id)), None)
+        self.assertEqual(
+            (yield self.cache.get_stats_buckets(self.batch_id, 'inbound')),
+            {})
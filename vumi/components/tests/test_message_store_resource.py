@@ -2,11 +2,13 @@
 
 import json
 from datetime import datetime
+from StringIO import StringIO
 from urllib import urlencode
 
 from twisted.internet import reactor
 from twisted.internet.defer import (
     inlineCallbacks, Deferred, succeed, gatherResults)
+from twisted.internet.task import Clock
 from twisted.web.server import Site
 
 from vumi.components.message_formatters import JsonFormatter
@@ -197,6 +199,23 @@ class TestMessageStoreResource(VumiTestCase):
             ("%(ts)s,%(id)s,ack,%(msg_id)s,", ack2),
         ])
 
+    @inlineCallbacks
+    def test_get_inbound_archive(self):
+        from vumi.components.message_archive import MessageArchiveReader
+        yield self.start_server()
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg1 = yield self.make_inbound(batch_id, 'føø')
+        msg2 = yield self.make_inbound(batch_id, 'føø')
+        resp = yield self.make_request('GET', batch_id, 'inbound.archive')
+        self.assertEqual(
+            resp.headers.getRawHeaders('Content-Type'),
+            ['application/x-vumi-message-archive'])
+        reader = MessageArchiveReader(StringIO(resp.delivered_body))
+        self.assertEqual(
+            set((d, msg['message_id']) for d, msg in reader.iter_messages()),
+            set([('inbound', msg1['message_id']),
+                 ('inbound', msg2['message_id'])]))
+
     @inlineCallbacks
     def test_get_inbound_multiple_pages(self):
         yield self.start_server()
@@ -275,8 +294,13 @@ class TestMessageStoreResource(VumiTestCase):
         # Wait for all the in-progress loads to finish.
         fetched_msg_ids = yield gatherResults(res.fetch.values())
 
+        # With a sliding window of two fetches, the fifth fetch may or may
+        # not have started before the disconnect was noticed, but the last
+        # one never is.
         sorted_message_ids = sorted(msg['message_id'] for msg in msgs)
-        self.assertEqual(set(fetched_msg_ids), set(sorted_message_ids[:4]))
+        self.assertTrue(
+            set(sorted_message_ids[:4]) <= set(fetched_msg_ids) <=
+            set(sorted_message_ids[:5]))
 
     @inlineCallbacks
     def test_get_inbound_for_time_range(self):
@@ -497,3 +521,302 @@ class TestMessageStoreResource(VumiTestCase):
         self.assertEqual(
             set([ev['event_id'] for ev in events]),
             set([ack2['event_id'], ack3['event_id']]))
+
+
+class FakeKeysPage(object):
+    def __init__(self, keys, next_page=None):
+        self.keys = keys
+        self.next_page_d = None
+        self._next_page = next_page
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def has_next_page(self):
+        return self._next_page is not None
+
+    def next_page(self):
+        self.next_page_d = Deferred()
+        return self.next_page_d
+
+    def deliver_next_page(self):
+        self.next_page_d.callback(self._next_page)
+
+
+class FakeExportRequest(object):
+    def __init__(self):
+        self.rows = []
+        self.producer = None
+        self.finished = False
+        self.connection_has_been_closed = False
+
+    def registerProducer(self, producer, streaming):
+        assert streaming
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def finish(self):
+        self.finished = True
+
+
+class FakeExportResource(object):
+    message_store = object()
+
+    def __init__(self):
+        self.fetches = {}
+
+    def get_message(self, message_store, message_key):
+        self.fetches[message_key] = Deferred()
+        return self.fetches[message_key]
+
+    def deliver(self, message_key):
+        self.fetches[message_key].callback(message_key)
+
+    def write_message(self, message, request):
+        request.rows.append(message)
+
+    def finish_request_cb(self, _result, request):
+        if not request.connection_has_been_closed:
+            return request.finish()
+
+
+class TestMessageExportProducer(VumiTestCase):
+
+    def setUp(self):
+        try:
+            from vumi.components.message_store_resource import (
+                MessageExportProducer)
+        except ImportError, e:
+            import_skip(e, 'riak')
+        self.producer_class = MessageExportProducer
+        self.clock = Clock()
+        self.resource = FakeExportResource()
+        self.request = FakeExportRequest()
+
+    def mk_producer(self, keys_page, concurrency, **kw):
+        return self.producer_class(
+            self.resource, self.request, keys_page, concurrency,
+            clock=self.clock, **kw)
+
+    def test_sliding_window(self):
+        """
+        A new fetch is started as soon as any outstanding fetch completes,
+        without waiting for the rest of the window.
+        """
+        producer = self.mk_producer(FakeKeysPage(['a', 'b', 'c', 'd']), 2)
+        d = producer.start()
+        self.assertEqual(self.request.producer, producer)
+        self.assertEqual(sorted(self.resource.fetches), ['a', 'b'])
+        self.resource.deliver('b')
+        self.assertEqual(self.request.rows, ['b'])
+        self.assertEqual(sorted(self.resource.fetches), ['a', 'b', 'c'])
+        self.resource.deliver('c')
+        self.assertEqual(
+            sorted(self.resource.fetches), ['a', 'b', 'c', 'd'])
+        self.resource.deliver('d')
+        self.resource.deliver('a')
+        self.assertEqual(self.request.rows, ['b', 'c', 'd', 'a'])
+        self.assertTrue(d.called)
+        self.assertTrue(self.request.finished)
+        self.assertEqual(self.request.producer, None)
+
+    def test_immediate_fetches(self):
+        """
+        Fetches that complete immediately are written in order and don't
+        disturb the window.
+        """
+        self.resource.get_message = lambda store, key: succeed(key)
+        producer = self.mk_producer(
+            FakeKeysPage(['a', 'b', 'c']), 2, ordered=True)
+        d = producer.start()
+        self.assertEqual(self.request.rows, ['a', 'b', 'c'])
+        self.assertTrue(d.called)
+        self.assertTrue(self.request.finished)
+
+    def test_multiple_pages(self):
+        """
+        The next page is requested when we run low on keys and its keys are
+        fetched once it arrives.
+        """
+        page = FakeKeysPage(['a'], next_page=FakeKeysPage(['b']))
+        producer = self.mk_producer(page, 2)
+        d = producer.start()
+        self.assertNotEqual(page.next_page_d, None)
+        self.resource.deliver('a')
+        self.assertFalse(d.called)
+        page.deliver_next_page()
+        self.resource.deliver('b')
+        self.assertEqual(self.request.rows, ['a', 'b'])
+        self.assertTrue(d.called)
+        self.assertTrue(self.request.finished)
+
+    def test_next_page_low_water_mark(self):
+        """
+        The next page isn't requested while there are at least
+        ``concurrency`` keys left to fetch.
+        """
+        page = FakeKeysPage(
+            ['a', 'b', 'c', 'd', 'e'], next_page=FakeKeysPage(['f']))
+        producer = self.mk_producer(page, 2)
+        producer.start()
+        self.assertEqual(page.next_page_d, None)
+        self.resource.deliver('a')
+        self.assertEqual(sorted(self.resource.fetches), ['a', 'b', 'c'])
+        self.assertEqual(page.next_page_d, None)
+        self.resource.deliver('b')
+        self.assertEqual(
+            sorted(self.resource.fetches), ['a', 'b', 'c', 'd'])
+        self.assertNotEqual(page.next_page_d, None)
+
+    def test_pause_stops_page_fetches(self):
+        """
+        No new pages are requested while the producer is paused.
+        """
+        page = FakeKeysPage(['a', 'b'], next_page=FakeKeysPage(['c']))
+        producer = self.mk_producer(page, 1)
+        d = producer.start()
+        self.assertEqual(page.next_page_d, None)
+        producer.pauseProducing()
+        self.resource.deliver('a')
+        self.assertEqual(page.next_page_d, None)
+        self.assertEqual(sorted(self.resource.fetches), ['a'])
+        self.assertFalse(d.called)
+        producer.resumeProducing()
+        self.assertNotEqual(page.next_page_d, None)
+        page.deliver_next_page()
+        self.resource.deliver('b')
+        self.resource.deliver('c')
+        self.assertEqual(self.request.rows, ['a', 'b', 'c'])
+        self.assertTrue(d.called)
+
+    def test_pause_and_resume(self):
+        """
+        No new fetches are started while the producer is paused.
+        """
+        producer = self.mk_producer(FakeKeysPage(['a', 'b', 'c']), 1)
+        producer.start()
+        producer.pauseProducing()
+        self.resource.deliver('a')
+        self.assertEqual(self.request.rows, ['a'])
+        self.assertEqual(sorted(self.resource.fetches), ['a'])
+        producer.resumeProducing()
+        self.assertEqual(sorted(self.resource.fetches), ['a', 'b'])
+
+    def test_stop_producing(self):
+        """
+        Once stopped, we wait for outstanding fetches but start no new ones
+        and don't finish the request if the connection is gone.
+        """
+        producer = self.mk_producer(FakeKeysPage(['a', 'b', 'c']), 2)
+        d = producer.start()
+        self.request.connection_has_been_closed = True
+        producer.stopProducing()
+        self.resource.deliver('a')
+        self.assertFalse(d.called)
+        self.resource.deliver('b')
+        self.assertTrue(d.called)
+        self.assertEqual(sorted(self.resource.fetches), ['a', 'b'])
+        self.assertEqual(self.request.rows, [])
+        self.assertFalse(self.request.finished)
+
+    def test_ordered(self):
+        """
+        In ordered mode, rows are written in key order while later fetches
+        continue behind a straggler.
+        """
+        producer = self.mk_producer(
+            FakeKeysPage(['a', 'b', 'c', 'd']), 2, ordered=True)
+        d = producer.start()
+        self.resource.deliver('b')
+        self.assertEqual(sorted(self.resource.fetches), ['a', 'b', 'c'])
+        self.resource.deliver('c')
+        self.assertEqual(
+            sorted(self.resource.fetches), ['a', 'b', 'c', 'd'])
+        self.resource.deliver('d')
+        self.assertEqual(self.request.rows, [])
+        self.resource.deliver('a')
+        self.assertEqual(self.request.rows, ['a', 'b', 'c', 'd'])
+        self.assertTrue(d.called)
+
+    def test_ordered_reorder_limit(self):
+        """
+        No new fetches are started while the reorder buffer is full.
+        """
+        producer = self.mk_producer(
+            FakeKeysPage(['a', 'b', 'c', 'd']), 2, ordered=True,
+            reorder_limit=1)
+        producer.start()
+        self.resource.deliver('b')
+        self.assertEqual(sorted(self.resource.fetches), ['a', 'b'])
+        self.resource.deliver('a')
+        self.assertEqual(self.request.rows, ['a', 'b'])
+        self.assertEqual(
+            sorted(self.resource.fetches), ['a', 'b', 'c', 'd'])
+
+    def test_failed_fetch(self):
+        """
+        A failed fetch is logged and skipped.
+        """
+        producer = self.mk_producer(FakeKeysPage(['a', 'b']), 2)
+        d = producer.start()
+        self.resource.fetches['a'].errback(Exception("Riak is sad"))
+        self.resource.deliver('b')
+        self.assertEqual(self.request.rows, ['b'])
+        self.assertTrue(d.called)
+        [err] = self.flushLoggedErrors(Exception)
+        self.assertEqual(err.getErrorMessage(), "Riak is sad")
+
+    def test_rows_per_second(self):
+        producer = self.mk_producer(FakeKeysPage(['a', 'b']), 2)
+        producer.start()
+        self.clock.advance(2)
+        self.resource.deliver('a')
+        self.resource.deliver('b')
+        self.clock.advance(10)
+        self.assertEqual(producer.rows_written, 2)
+        self.assertEqual(producer.elapsed(), 2.0)
+        self.assertEqual(producer.rows_per_second(), 1.0)
+
+
+class FooterlessFormatter(object):
+    """
+    A formatter written before `write_row_footer` was added to
+    IMessageFormatter.
+    """
+
+    def add_http_headers(self, request):
+        pass
+
+    def write_row_header(self, request):
+        pass
+
+    def write_row(self, request, message):
+        request.rows.append(message)
+
+
+class TestMessageStoreProxyResource(VumiTestCase):
+
+    def setUp(self):
+        try:
+            from vumi.components.message_store_resource import (
+                MessageStoreProxyResource)
+        except ImportError, e:
+            import_skip(e, 'riak')
+        self.resource_class = MessageStoreProxyResource
+
+    def test_finish_request_without_row_footer(self):
+        resource = self.resource_class(None, 'batch', FooterlessFormatter())
+        request = FakeExportRequest()
+        resource.finish_request_cb(None, request)
+        self.assertTrue(request.finished)
+
+    def test_finish_request_with_row_footer(self):
+        formatter = FooterlessFormatter()
+        formatter.write_row_footer = lambda request: request.rows.append('/')
+        resource = self.resource_class(None, 'batch', formatter)
+        request = FakeExportRequest()
+        resource.finish_request_cb(None, request)
+        self.assertEqual(request.rows, ['/'])
+        self.assertTrue(request.finished)
@@ -0,0 +1,73 @@
+"""Tests for vumi.components.routing_state."""
+
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.components.routing_state import UserGroupStore, ReturnRouteStore
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+
+class TestUserGroupStore(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.store = UserGroupStore(self.redis, 10)
+
+    @inlineCallbacks
+    def test_get_group_unassigned(self):
+        group = yield self.store.get_group('user1')
+        self.assertEqual(group, None)
+        self.assertFalse('user1' in self.store.cache)
+
+    @inlineCallbacks
+    def test_assign_group(self):
+        group = yield self.store.assign_group('user1', 'group1')
+        self.assertEqual(group, 'group1')
+        self.assertEqual((yield self.redis.get('user:user1')), 'group1')
+        self.assertEqual((yield self.store.get_group('user1')), 'group1')
+        self.assertEqual(self.store.cache.hits, 1)
+
+    @inlineCallbacks
+    def test_assign_group_already_assigned(self):
+        yield self.redis.set('user:user1', 'group2')
+        group = yield self.store.assign_group('user1', 'group1')
+        self.assertEqual(group, 'group2')
+        self.assertEqual(self.store.cache.get('user1'), 'group2')
+
+    @inlineCallbacks
+    def test_get_group_from_redis(self):
+        yield self.redis.set('user:user1', 'group1')
+        self.assertEqual((yield self.store.get_group('user1')), 'group1')
+        self.assertEqual(self.store.cache.misses, 1)
+        self.assertEqual(self.store.cache.get('user1'), 'group1')
+
+
+class TestReturnRouteStore(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.store = ReturnRouteStore(self.redis, 60, 10)
+
+    @inlineCallbacks
+    def test_set_route(self):
+        yield self.store.set_route('msg1', 'app1')
+        self.assertEqual((yield self.redis.get('message:msg1')), 'app1')
+        ttl = yield self.redis.ttl('message:msg1')
+        self.assertTrue(0 < ttl <= 60)
+        self.assertEqual((yield self.store.get_route('msg1')), 'app1')
+        self.assertEqual(self.store.cache.hits, 1)
+
+    @inlineCallbacks
+    def test_get_route_from_redis(self):
+        yield self.redis.setex('message:msg1', 60, 'app1')
+        self.assertEqual((yield self.store.get_route('msg1')), 'app1')
+        self.assertEqual(self.store.cache.misses, 1)
+        self.assertEqual(self.store.cache.get('msg1'), 'app1')
+
+    @inlineCallbacks
+    def test_get_route_missing(self):
+        self.assertEqual((yield self.store.get_route('msg1')), None)
+        self.assertFalse('msg1' in self.store.cache)
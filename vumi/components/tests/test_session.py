@@ -2,7 +2,7 @@
 
 import time
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, succeed
 
 from vumi.components.session import SessionManager
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
@@ -40,6 +40,42 @@ class TestSessionManager(VumiTestCase):
         self.sm.max_session_length = 60.0
         yield self.sm.create_session("u1")
 
+    @inlineCallbacks
+    def test_scan_sessions(self):
+        for i in range(5):
+            yield self.sm.create_session("u%d" % (i,))
+        yield self.manager.set("not_a_session", "foo")
+        batches = []
+        yield self.sm.scan_sessions(batches.append, batch_size=2)
+        self.assertTrue(len(batches) > 1)
+        sessions = dict(s for batch in batches for s in batch)
+        self.assertEqual(sorted(sessions), ["u0", "u1", "u2", "u3", "u4"])
+        self.assertEqual(sessions["u0"], (yield self.sm.load_session("u0")))
+
+    @inlineCallbacks
+    def test_active_sessions_repeated_key(self):
+        yield self.sm.create_session("u1")
+        scan_results = [
+            ('1', ['session:u1']),
+            (None, ['session:u1']),
+        ]
+        self.manager.scan = lambda cursor, **kw: succeed(scan_results.pop(0))
+        sessions = yield self.sm.active_sessions()
+        self.assertEqual([user_id for user_id, _ in sessions], ["u1"])
+
+    @inlineCallbacks
+    def test_create_session_expiry(self):
+        self.sm.max_session_length = 60.0
+        yield self.sm.create_session("u1")
+        ttl = yield self.manager.ttl("session:u1")
+        self.assertTrue(0 < ttl <= 60)
+
+    @inlineCallbacks
+    def test_create_session_no_expiry(self):
+        yield self.sm.create_session("u1")
+        ttl = yield self.manager.ttl("session:u1")
+        self.assertEqual(ttl, None)
+
     @inlineCallbacks
     def test_create_and_retrieve_session(self):
         session = yield self.sm.create_session("u1")
@@ -114,13 +114,41 @@ class TestTxTagpoolManager(VumiTestCase):
         free_local_tags = [t[1] for t in tags]
         free_local_tags.remove("tag5")
         redis = self.redis
+        # The free list isn't updated, since that would be O(N).
         self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
-                         free_local_tags)
+                         [t[1] for t in tags])
         self.assertEqual((yield redis.smembers(tkey("free:set"))),
                          set(free_local_tags))
         self.assertEqual((yield redis.smembers(tkey("inuse:set"))),
                          set(["tag5"]))
 
+    @inlineCallbacks
+    def test_acquire_tag_skips_specifically_acquired_tags(self):
+        tkey = self.pool_key_generator("poolA")
+        tag1, tag2, tag3 = [("poolA", "tag%d" % i) for i in (1, 2, 3)]
+        yield self.tpm.declare_tags([tag1, tag2, tag3])
+        yield self.tpm.acquire_specific_tag(tag1)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag2)
+        self.assertEqual((yield self.redis.lrange(tkey("free:list"), 0, -1)),
+                         ["tag3"])
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag3)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), None)
+
+    @inlineCallbacks
+    def test_release_specifically_acquired_tag(self):
+        tkey = self.pool_key_generator("poolA")
+        tag1, tag2 = ("poolA", "tag1"), ("poolA", "tag2")
+        yield self.tpm.declare_tags([tag1, tag2])
+        for _ in range(3):
+            yield self.tpm.acquire_specific_tag(tag1)
+            yield self.tpm.release_tag(tag1)
+        # The tag is still in the free list, so it isn't added again.
+        self.assertEqual((yield self.redis.lrange(tkey("free:list"), 0, -1)),
+                         ["tag1", "tag2"])
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag1)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag2)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), None)
+
     @inlineCallbacks
     def test_acquire_specific_unicode_tag(self):
         tag = (u"poöl", u"tág")
@@ -275,6 +303,44 @@ class TestTxTagpoolManager(VumiTestCase):
         my_tags = yield self.tpm.owned_tags(u"me")
         self.assertEqual(my_tags, [tags[0]])
 
+    @inlineCallbacks
+    def test_release_removes_owned_tag(self):
+        tags = [[u"poöl1", u"tág/\"1"]]
+        yield self.tpm.declare_tags(tags)
+        tag = yield self.tpm.acquire_tag(u"poöl1", owner=u"mé")
+        self.assertEqual((yield self.tpm.owned_tags(u"mé")), [tags[0]])
+        yield self.tpm.release_tag(tag)
+        self.assertEqual((yield self.tpm.owned_tags(u"mé")), [])
+
+    @inlineCallbacks
+    def test_release_removes_unowned_tag(self):
+        tags = [["pool1", "tag1"]]
+        yield self.tpm.declare_tags(tags)
+        tag = yield self.tpm.acquire_tag("pool1")
+        yield self.tpm.release_tag(tag)
+        self.assertEqual((yield self.tpm.owned_tags(None)), [])
+
+    @inlineCallbacks
+    def test_owner_index_updated_by_scripts(self):
+        """
+        The owner index is updated by the acquire and release scripts, not
+        by separate calls.
+        """
+        tags = [["pool1", "tag1"], ["pool1", "tag2"]]
+        yield self.tpm.declare_tags(tags)
+
+        def unexpected_call(*args):
+            self.fail("Unexpected Redis call.")
+        self.patch(self.redis, 'sadd', unexpected_call)
+        self.patch(self.redis, 'srem', unexpected_call)
+        tag1 = yield self.tpm.acquire_tag("pool1", owner="me")
+        tag2 = yield self.tpm.acquire_specific_tag(("pool1", "tag2"), "me")
+        self.assertEqual(
+            sorted((yield self.tpm.owned_tags("me"))), sorted(tags))
+        yield self.tpm.release_tag(tag1)
+        yield self.tpm.release_tag(tag2)
+        self.assertEqual((yield self.tpm.owned_tags("me")), [])
+
 
 class TestTagpoolManager(TestTxTagpoolManager):
     sync_persistence = True
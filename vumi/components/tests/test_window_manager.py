@@ -1,4 +1,4 @@
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred
 from twisted.internet.task import Clock
 
 from vumi.components.window_manager import WindowManager, WindowException
@@ -80,6 +80,40 @@ class TestWindowManager(VumiTestCase):
         next_flight_key = yield self.wm.get_next_key(self.window_id)
         self.assertTrue(next_flight_key)
 
+    @inlineCallbacks
+    def test_fetching_batches_from_window(self):
+        for i in range(12):
+            yield self.wm.add(self.window_id, i)
+
+        flight_keys = yield self.wm.get_next_keys(self.window_id, limit=4)
+        self.assertEqual(len(flight_keys), 4)
+        # Only the room left in the window is filled.
+        flight_keys.extend((yield self.wm.get_next_keys(self.window_id)))
+        self.assertEqual(len(flight_keys), 10)
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id)), [])
+
+        data = []
+        for flight_key in flight_keys:
+            data.append((yield self.wm.get_data(self.window_id, flight_key)))
+        self.assertEqual(data, range(10))
+
+        stats = yield self.redis.zrange(
+            self.wm.stats_key(self.window_id), 0, -1, withscores=True)
+        self.assertEqual(sorted(stats), sorted(
+            (key, self.clock.seconds()) for key in flight_keys))
+
+    @inlineCallbacks
+    def test_remove_key(self):
+        yield self.wm.add(self.window_id, "data")
+        key = yield self.wm.get_next_key(self.window_id)
+        yield self.wm.remove_key(self.window_id, key)
+        self.assertEqual((yield self.wm.count_in_flight(self.window_id)), 0)
+        self.assertEqual(
+            (yield self.redis.get(self.wm.window_key(self.window_id, key))),
+            None)
+        self.assertEqual(
+            (yield self.redis.zcard(self.wm.stats_key(self.window_id))), 0)
+
     @inlineCallbacks
     def test_set_and_external_id(self):
         yield self.wm.set_external_id(self.window_id, "flight_key",
@@ -210,6 +244,32 @@ class TestWindowManager(VumiTestCase):
         self.assertEqual((yield self.wm.get_windows()), [])
         self.assertEqual(set(cleanup_callbacks), set(window_ids))
 
+    @inlineCallbacks
+    def test_monitor_windows_concurrent_callbacks(self):
+        for i in range(15):
+            yield self.wm.add(self.window_id, i)
+
+        pending = []
+        window_full = Deferred()
+
+        def callback(window_id, key):
+            d = Deferred()
+            pending.append(d)
+            if len(pending) == 10:
+                window_full.callback(None)
+            return d
+
+        d = self.wm._monitor_windows(callback, False)
+        # A full window of keys is dispatched without waiting for the
+        # callbacks to finish.
+        yield window_full
+        self.assertEqual(len(pending), 10)
+        self.assertFalse(d.called)
+        for callback_d in pending:
+            callback_d.callback(None)
+        yield d
+        self.assertEqual(len(pending), 10)
+
 
 class TestConcurrentWindowManager(VumiTestCase):
 
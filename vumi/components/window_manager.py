@@ -3,16 +3,78 @@ import json
 import uuid
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, maybeDeferred)
 from twisted.internet.task import LoopingCall
 
 from vumi import log
+from vumi.persist.redis_base import RedisScript
 
 
 class WindowException(Exception):
     pass
 
 
+def _pop_next_keys(redis, keys, args):
+    window_key, inflight_key, stats_key = keys
+    window_size, limit, clock_time = int(args[0]), int(args[1]), args[2]
+    limit = min(limit, window_size - redis.llen(inflight_key))
+    popped = []
+    for _ in range(limit):
+        key = redis.rpoplpush(window_key, inflight_key)
+        if not key:
+            break
+        redis.zadd(stats_key, **{key: clock_time})
+        popped.append(key)
+    return popped
+
+
+POP_NEXT_KEYS_SCRIPT = RedisScript("""
+local limit = tonumber(ARGV[2])
+local room = tonumber(ARGV[1]) - redis.call('LLEN', KEYS[2])
+if room < limit then
+    limit = room
+end
+local popped = {}
+for i = 1, limit do
+    local key = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+    if not key then
+        break
+    end
+    redis.call('ZADD', KEYS[3], ARGV[3], key)
+    popped[#popped + 1] = key
+end
+return popped
+""", _pop_next_keys)
+
+
+def _remove_key(redis, keys, args):
+    (inflight_key, data_key, key_stats_key, stats_key, external_key,
+     internal_key_prefix) = keys
+    [key] = args
+    redis.lrem(inflight_key, key, 1)
+    redis.delete(data_key)
+    redis.delete(key_stats_key)
+    redis.zrem(stats_key, key)
+    external_id = redis.get(external_key)
+    if external_id:
+        redis.delete(external_key)
+        redis.delete(internal_key_prefix + external_id)
+
+
+# The internal id map key depends on the external id, so we build it from the
+# (prefixed) key with an empty external id.
+REMOVE_KEY_SCRIPT = RedisScript("""
+redis.call('LREM', KEYS[1], 1, ARGV[1])
+redis.call('DEL', KEYS[2], KEYS[3])
+redis.call('ZREM', KEYS[4], ARGV[1])
+local external_id = redis.call('GET', KEYS[5])
+if external_id then
+    redis.call('DEL', KEYS[5], KEYS[6] .. external_id)
+end
+""", _remove_key)
+
+
 class WindowManager(object):
 
     WINDOW_KEY = 'windows'
@@ -89,42 +151,39 @@ class WindowManager(object):
     @inlineCallbacks
     def add(self, window_id, data, key=None):
         key = key or uuid.uuid4().get_hex()
-        # The redis.set() has to complete before redis.lpush(),
-        # otherwise the key can be popped from the window before the
-        # data is available.
-        yield self.redis.set(self.window_key(window_id, key),
-                             json.dumps(data))
-        yield self.redis.lpush(self.window_key(window_id), key)
+        # The data has to be set before the key is pushed, otherwise the
+        # key can be popped from the window before the data is available.
+        yield self.redis.multi().set(
+            self.window_key(window_id, key), json.dumps(data)).lpush(
+            self.window_key(window_id), key).execute()
         returnValue(key)
 
     @inlineCallbacks
-    def get_next_key(self, window_id):
-
-        window_key = self.window_key(window_id)
-        inflight_key = self.flight_key(window_id)
-
-        waiting_list = yield self.count_waiting(window_id)
-        if waiting_list == 0:
-            return
+    def get_next_keys(self, window_id, limit=None):
+        """
+        Move up to ``limit`` keys (or as many as there is room for if
+        ``limit`` is ``None``) from the window into flight and return them.
+        The keys are popped and their flight timestamps recorded in a single
+        atomic script, so concurrent window managers never exceed the window
+        size.
+        """
+        if limit is None:
+            limit = self.window_size
+        keys = yield self.redis.run_script(POP_NEXT_KEYS_SCRIPT, [
+            self.window_key(window_id),
+            self.flight_key(window_id),
+            self.stats_key(window_id),
+        ], [self.window_size, limit, self.get_clocktime()])
+        if keys:
+            log.debug('Window %s sent %s keys into flight' % (
+                self.window_key(window_id), len(keys)))
+        returnValue(keys)
 
-        flight_size = yield self.count_in_flight(window_id)
-        room_available = self.window_size - flight_size
-
-        if room_available > 0:
-            log.debug('Window %s has space for %s' % (window_key,
-                                                        room_available))
-            next_key = yield self.redis.rpoplpush(window_key, inflight_key)
-            if next_key:
-                yield self._set_timestamp(window_id, next_key)
-                returnValue(next_key)
-
-    def _set_timestamp(self, window_id, flight_key):
-        return self.redis.zadd(self.stats_key(window_id), **{
-                flight_key: self.get_clocktime(),
-        })
-
-    def _clear_timestamp(self, window_id, flight_key):
-        return self.redis.zrem(self.stats_key(window_id), flight_key)
+    @inlineCallbacks
+    def get_next_key(self, window_id):
+        keys = yield self.get_next_keys(window_id, limit=1)
+        if keys:
+            returnValue(keys[0])
 
     def count_waiting(self, window_id):
         window_key = self.window_key(window_id)
@@ -143,28 +202,34 @@ class WindowManager(object):
         windows = yield self.get_windows()
         for window_id in windows:
             expired_keys = yield self.get_expired_flight_keys(window_id)
+            if not expired_keys:
+                continue
+            pipe = self.redis.pipeline()
             for key in expired_keys:
-                yield self.redis.lrem(self.flight_key(window_id), key, 1)
+                pipe.lrem(self.flight_key(window_id), key, 1)
+            yield pipe.execute()
 
     @inlineCallbacks
     def get_data(self, window_id, key):
         json_data = yield self.redis.get(self.window_key(window_id, key))
         returnValue(json.loads(json_data))
 
-    @inlineCallbacks
     def remove_key(self, window_id, key):
-        yield self.redis.lrem(self.flight_key(window_id), key, 1)
-        yield self.redis.delete(self.window_key(window_id, key))
-        yield self.redis.delete(self.stats_key(window_id, key))
-        yield self.clear_external_id(window_id, key)
-        yield self._clear_timestamp(window_id, key)
+        return self.redis.run_script(REMOVE_KEY_SCRIPT, [
+            self.flight_key(window_id),
+            self.window_key(window_id, key),
+            self.stats_key(window_id, key),
+            self.stats_key(window_id),
+            self.map_key(window_id, 'external', key),
+            self.map_key(window_id, 'internal', ''),
+        ], [key])
 
-    @inlineCallbacks
     def set_external_id(self, window_id, flight_key, external_id):
-        yield self.redis.set(self.map_key(window_id, 'internal', external_id),
-            flight_key)
-        yield self.redis.set(self.map_key(window_id, 'external', flight_key),
-            external_id)
+        return self.redis.pipeline().set(
+            self.map_key(window_id, 'internal', external_id),
+            flight_key).set(
+            self.map_key(window_id, 'external', flight_key),
+            external_id).execute()
 
     def get_internal_id(self, window_id, external_id):
         return self.redis.get(self.map_key(window_id, 'internal', external_id))
@@ -197,10 +262,14 @@ class WindowManager(object):
                          cleanup_callback=None):
         windows = yield self.get_windows()
         for window_id in windows:
-            key = (yield self.get_next_key(window_id))
-            while key:
-                yield key_callback(window_id, key)
-                key = (yield self.get_next_key(window_id))
+            # Each batch fills the window, and the callbacks for the keys in
+            # a batch run concurrently.
+            keys = yield self.get_next_keys(window_id)
+            while keys:
+                yield gatherResults([
+                    maybeDeferred(key_callback, window_id, key)
+                    for key in keys], consumeErrors=True)
+                keys = yield self.get_next_keys(window_id)
 
             # Remove empty windows if required
             if cleanup and not ((yield self.count_waiting(window_id)) or
@@ -28,6 +28,19 @@ class BaseConnector(object):
         self._prefetch_count = prefetch_count
         self._middlewares = MiddlewareStack(middlewares
                                             if middlewares is not None else [])
+        self.timings = None
+        self.publish_timer = None
+
+    def set_timings(self, timings):
+        """Time message handling in this connector's consumers, middleware
+        and handlers with a
+        :class:`vumi.blinkenlights.profiler.HandlerTimings`, or stop timing
+        it if ``timings`` is ``None``.
+        """
+        self.timings = timings
+        self._middlewares.timings = timings
+        for consumer in self._consumers.itervalues():
+            consumer.timings = timings
 
     def _rkey(self, mtype):
         return '%s.%s' % (self.name, mtype)
@@ -69,6 +82,7 @@ class BaseConnector(object):
             self._rkey(mtype), handler, message_class=msg_class, paused=True,
             prefetch_count=self._prefetch_count)
         self._consumers[mtype] = consumer
+        consumer.timings = self.timings
         self._set_default_endpoint_handler(mtype, default_handler)
         returnValue(consumer)
 
@@ -87,6 +101,9 @@ class BaseConnector(object):
         handler = self._endpoint_handlers[mtype].get(endpoint_name)
         if handler is None:
             handler = self._default_handlers.get(mtype)
+        if self.timings is not None:
+            handler = self.timings.timed(
+                'handler.%s.%s' % (self.name, mtype), handler)
         d = self._middlewares.apply_consume(mtype, msg, self.name)
         d.addCallback(handler)
         return d.addErrback(self._ignore_message, msg)
@@ -94,8 +111,18 @@ class BaseConnector(object):
     def _publish_message(self, mtype, msg, endpoint_name):
         if endpoint_name is not None:
             msg.set_routing_endpoint(endpoint_name)
+        event_timer = None
+        if self.publish_timer is not None:
+            event_timer = self.publish_timer.timeit(start=True)
         d = self._middlewares.apply_publish(mtype, msg, self.name)
-        return d.addCallback(self._publishers[mtype].publish_message)
+        d.addCallback(self._publishers[mtype].publish_message)
+        if event_timer is not None:
+            d.addBoth(self._stop_publish_timer, event_timer)
+        return d
+
+    def _stop_publish_timer(self, result, event_timer):
+        event_timer.stop()
+        return result
 
     def _ignore_message(self, failure, msg):
         failure.trap(IgnoreMessage)
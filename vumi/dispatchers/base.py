@@ -5,7 +5,8 @@
 import re
 import functools
 
-from twisted.internet.defer import inlineCallbacks, returnValue, maybeDeferred
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, succeed)
 
 from vumi.service import Worker
 from vumi.errors import ConfigError, DispatcherError
@@ -13,7 +14,9 @@ from vumi.message import TransportUserMessage, TransportEvent
 from vumi.utils import load_class_by_string, get_first_word
 from vumi.middleware import MiddlewareStack, setup_middlewares_from_config
 from vumi import log
-from vumi.components.session import SessionManager
+from vumi.blinkenlights.metrics_direct import (
+    start_metric_manager, stop_metric_manager)
+from vumi.components.routing_state import UserGroupStore, ReturnRouteStore
 from vumi.persist.txredis_manager import TxRedisManager
 
 
@@ -370,6 +373,34 @@ class FromAddrMultiplexRouter(BaseDispatchRouter):
         self.dispatcher.publish_outbound_message(name, msg)
 
 
+@inlineCallbacks
+def setup_router_metrics(router):
+    """Start publishing metrics for a router with a `metrics_prefix`.
+
+    Metrics are published directly to Graphite or statsd if the dispatcher
+    has a `direct_metrics` config. Once the router's Redis manager is
+    available, its `register_metrics` method is called with the new
+    :class:`vumi.blinkenlights.metrics.MetricManager`.
+    """
+    router.metrics = None
+    metrics_prefix = router.config.get('metrics_prefix')
+    if metrics_prefix is None:
+        return
+    metrics = yield start_metric_manager(
+        router.dispatcher, metrics_prefix,
+        direct_config=router.config.get('direct_metrics'), preaggregate=True)
+    yield router._redis_d
+    router.metrics = metrics
+    router.register_metrics(metrics)
+
+
+def teardown_router_metrics(router):
+    if router.metrics is not None:
+        metrics, router.metrics = router.metrics, None
+        return stop_metric_manager(metrics)
+    return succeed(None)
+
+
 class UserGroupingRouter(SimpleDispatchRouter):
     """
     Router that dispatches based on msg `from_addr`. Each unique
@@ -390,11 +421,23 @@ class UserGroupingRouter(SimpleDispatchRouter):
     :param str dispatcher_name:
         The name of the dispatcher, used internally as
         the prefix for Redis keys.
+
+    :param int cache_size:
+        The maximum number of user group assignments to cache
+        in memory. Default is 10000.
+
+    :param str metrics_prefix:
+        Optional prefix for cache hit rate metrics. If omitted,
+        no metrics are published.
     """
 
+    DEFAULT_CACHE_SIZE = 10000
+
     def setup_routing(self):
         r_config = self.config.get('redis_manager', {})
         r_prefix = self.config['dispatcher_name']
+        self.cache_size = int(self.config.get(
+            'cache_size', self.DEFAULT_CACHE_SIZE))
         # FIXME: The following is a hack to deal with sync-only setup.
         self._redis_d = TxRedisManager.from_config(r_config)
         self._redis_d.addCallback(lambda m: m.sub_manager(r_prefix))
@@ -402,9 +445,17 @@ class UserGroupingRouter(SimpleDispatchRouter):
 
         self.groups = self.config['group_mappings']
         self.nr_of_groups = len(self.groups)
+        return setup_router_metrics(self)
+
+    def teardown_routing(self):
+        return teardown_router_metrics(self)
 
     def _setup_redis(self, redis):
         self.redis = redis
+        self.group_store = UserGroupStore(self.redis, self.cache_size)
+
+    def register_metrics(self, metrics):
+        self.group_store.cache.register_metrics(metrics, 'user_group_cache')
 
     @inlineCallbacks
     def get_next_group(self):
@@ -416,11 +467,10 @@ class UserGroupingRouter(SimpleDispatchRouter):
 
     @inlineCallbacks
     def get_group_for_user(self, user_id):
-        user_key = "user:%s" % (user_id,)
-        group = yield self.redis.get(user_key)
+        group = yield self.group_store.get_group(user_id)
         if not group:
             group, transport_name = yield self.get_next_group()
-            yield self.redis.set(user_key, group)
+            group = yield self.group_store.assign_group(user_id, group)
         returnValue(group)
 
     @inlineCallbacks
@@ -431,6 +481,55 @@ class UserGroupingRouter(SimpleDispatchRouter):
         self.dispatcher.publish_inbound_message(app, msg)
 
 
+class KeywordRuleIndex(object):
+    """Index of :class:`ContentKeywordRouter` routing rules.
+
+    Rules are indexed by keyword and then by `to_addr` (rules without a
+    `to_addr` are indexed under ``None``). Each of those holds a prefix trie
+    of the rules' `prefix` values, so finding the matching rules for a
+    message doesn't depend on the number of rules, only on the length of the
+    message's `from_addr`.
+
+    :param list rules:
+        The routing rules to index. Rule keywords must be lowercase.
+    """
+
+    # Key for the list of (position, rule) pairs in a trie node. Other keys
+    # are single characters.
+    RULES = None
+
+    def __init__(self, rules):
+        self._index = {}
+        for position, rule in enumerate(rules):
+            to_addrs = self._index.setdefault(rule['keyword'], {})
+            node = to_addrs.setdefault(rule.get('to_addr'), {})
+            for char in rule.get('prefix', ''):
+                node = node.setdefault(char, {})
+            node.setdefault(self.RULES, []).append((position, rule))
+
+    def _match_prefixes(self, node, from_addr):
+        matches = list(node.get(self.RULES, []))
+        for char in from_addr:
+            node = node.get(char)
+            if node is None:
+                break
+            matches.extend(node.get(self.RULES, []))
+        return matches
+
+    def match(self, keyword, to_addr, from_addr):
+        """Return the rules matching a message, in the order they were
+        given."""
+        to_addrs = self._index.get(keyword)
+        if to_addrs is None:
+            return []
+        matches = []
+        for rule_to_addr in set([None, to_addr]):
+            node = to_addrs.get(rule_to_addr)
+            if node is not None:
+                matches.extend(self._match_prefixes(node, from_addr or ''))
+        return [rule for _, rule in sorted(matches, key=lambda m: m[0])]
+
+
 class ContentKeywordRouter(SimpleDispatchRouter):
     """Router that dispatches based on the first word of the message
     content. In the context of SMSes the first word is sometimes called
@@ -470,9 +569,18 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         route events such as acknowledgements and delivery reports
         back to the application that sent the outgoing
         message. Default is seven days.
+
+    :param int cache_size:
+        The maximum number of return routes to cache in memory.
+        Default is 10000.
+
+    :param str metrics_prefix:
+        Optional prefix for cache hit rate metrics. If omitted,
+        no metrics are published.
     """
 
     DEFAULT_ROUTING_TIMEOUT = 60 * 60 * 24 * 7  # 7 days
+    DEFAULT_CACHE_SIZE = 10000
 
     def setup_routing(self):
         self.r_config = self.config.get('redis_manager', {})
@@ -490,24 +598,44 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         for transport_name, keyword in keyword_mappings.items():
             self.rules.append({'app': transport_name,
                                'keyword': keyword.lower()})
+        self.rule_index = KeywordRuleIndex(self.rules)
         self.fallback_application = self.config.get('fallback_application')
         self.transport_mappings = self.config['transport_mappings']
         self.expire_routing_timeout = int(self.config.get(
             'expire_routing_memory', self.DEFAULT_ROUTING_TIMEOUT))
+        self.cache_size = int(self.config.get(
+            'cache_size', self.DEFAULT_CACHE_SIZE))
 
         # FIXME: The following is a hack to deal with sync-only setup.
         self._redis_d = TxRedisManager.from_config(self.r_config)
         self._redis_d.addCallback(lambda m: m.sub_manager(self.r_prefix))
         self._redis_d.addCallback(self._setup_redis)
+        return setup_router_metrics(self)
+
+    def teardown_routing(self):
+        return teardown_router_metrics(self)
 
     def _setup_redis(self, redis):
         self.redis = redis
-        self.session_manager = SessionManager(
-            self.redis, self.expire_routing_timeout)
+        self.route_store = ReturnRouteStore(
+            self.redis, self.expire_routing_timeout, self.cache_size)
+
+    def register_metrics(self, metrics):
+        self.route_store.cache.register_metrics(metrics, 'return_route_cache')
 
     def get_message_key(self, message):
         return 'message:%s' % (message,)
 
+    @inlineCallbacks
+    def get_return_route(self, message_id):
+        name = yield self.route_store.get_route(message_id)
+        if name is None:
+            # Routes used to be stored in sessions, so we fall back to those
+            # until any that are left have expired.
+            name = yield self.redis.hget(
+                'session:%s' % (self.get_message_key(message_id),), 'name')
+        returnValue(name)
+
     def publish_transport(self, name, msg):
         self.dispatcher.publish_outbound_message(name, msg)
 
@@ -524,15 +652,24 @@ class ContentKeywordRouter(SimpleDispatchRouter):
                     (not 'prefix' in rule) or
                     (msg['from_addr'].startswith(rule['prefix']))])
 
+    def get_matching_rules(self, keyword, msg):
+        if (type(self).is_msg_matching_routing_rules is not
+                ContentKeywordRouter.is_msg_matching_routing_rules):
+            # A subclass has its own matching logic, so we can't use the
+            # index.
+            return [rule for rule in self.rules
+                    if self.is_msg_matching_routing_rules(keyword, msg, rule)]
+        return self.rule_index.match(
+            keyword, msg['to_addr'], msg['from_addr'])
+
     def dispatch_inbound_message(self, msg):
         keyword = get_first_word(msg['content']).lower()
         matched = False
-        for rule in self.rules:
-            if self.is_msg_matching_routing_rules(keyword, msg, rule):
-                matched = True
-                # copy message so that the middleware doesn't see a particular
-                # message instance multiple times
-                self.publish_exposed_inbound(rule['app'], msg.copy())
+        for rule in self.get_matching_rules(keyword, msg):
+            matched = True
+            # copy message so that the middleware doesn't see a particular
+            # message instance multiple times
+            self.publish_exposed_inbound(rule['app'], msg.copy())
         if not matched:
             if self.fallback_application is not None:
                 self.publish_exposed_inbound(self.fallback_application, msg)
@@ -543,9 +680,7 @@ class ContentKeywordRouter(SimpleDispatchRouter):
     @inlineCallbacks
     def dispatch_inbound_event(self, msg):
         yield self._redis_d  # Horrible hack to ensure we have it setup.
-        message_key = self.get_message_key(msg['user_message_id'])
-        session = yield self.session_manager.load_session(message_key)
-        name = session.get('name')
+        name = yield self.get_return_route(msg['user_message_id'])
         if not name:
             log.error(DispatcherError(
                 "No transport_name for return route found in Redis"
@@ -562,9 +697,8 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         transport_name = self.transport_mappings.get(msg['from_addr'])
         if transport_name is not None:
             self.publish_transport(transport_name, msg)
-            message_key = self.get_message_key(msg['message_id'])
-            yield self.session_manager.create_session(
-                message_key, name=msg['transport_name'])
+            yield self.route_store.set_route(
+                msg['message_id'], msg['transport_name'])
         else:
             log.error(DispatcherError(
                 "No transport for %s" % (msg['from_addr'],)))
@@ -1,7 +1,8 @@
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi.dispatchers.base import (
-    BaseDispatchWorker, ToAddrRouter, FromAddrMultiplexRouter)
+    BaseDispatchWorker, ToAddrRouter, FromAddrMultiplexRouter,
+    KeywordRuleIndex)
 from vumi.dispatchers.tests.helpers import DispatcherHelper, DummyDispatcher
 from vumi.errors import DispatcherError
 from vumi.tests.utils import LogCatcher
@@ -379,7 +380,7 @@ class TestUserGroupingRouter(VumiTestCase):
     def setUp(self):
         self.disp_helper = self.add_helper(
             DispatcherHelper(BaseDispatchWorker))
-        self.dispatcher = yield self.disp_helper.get_dispatcher({
+        self.config = {
             'dispatcher_name': 'user_group_dispatcher',
             'router_class': 'vumi.dispatchers.base.UserGroupingRouter',
             'transport_names': [
@@ -396,7 +397,8 @@ class TestUserGroupingRouter(VumiTestCase):
             'transport_mappings': {
                 'upstream1': 'transport1',
             },
-        })
+        }
+        self.dispatcher = yield self.disp_helper.get_dispatcher(self.config)
         self.router = self.dispatcher._router
         yield self.router._redis_d
         self.redis = self.router.redis
@@ -445,6 +447,61 @@ class TestUserGroupingRouter(VumiTestCase):
         self.assertEqual(app1_msgs, [msg1, msg3])
         self.assertEqual(app2_msgs, [msg2, msg4])
 
+    @inlineCallbacks
+    def test_group_assignment_cached(self):
+        group = yield self.router.get_group_for_user('from_1')
+        cache = self.router.group_store.cache
+        self.assertEqual(cache.get('from_1'), group)
+
+        # The cached assignment is used without looking in Redis.
+        yield self.redis.delete('user:from_1')
+        self.assertEqual(
+            (yield self.router.get_group_for_user('from_1')), group)
+
+        # Uncached assignments are loaded from Redis.
+        cache.clear()
+        yield self.redis.set('user:from_1', 'group2')
+        self.assertEqual(
+            (yield self.router.get_group_for_user('from_1')), 'group2')
+        self.assertEqual(cache.get('from_1'), 'group2')
+
+    @inlineCallbacks
+    def test_cache_metrics(self):
+        self.assertEqual(self.router.metrics, None)
+        config = self.config.copy()
+        config['metrics_prefix'] = 'vumi.test.'
+        dispatcher = yield self.disp_helper.get_dispatcher(config)
+        router = dispatcher._router
+        self.assertEqual(router.metrics.prefix, 'vumi.test.')
+        self.assertTrue('user_group_cache.hits' in router.metrics)
+        self.assertTrue('user_group_cache.misses' in router.metrics)
+
+        yield router.get_group_for_user('from_1')
+        yield router.get_group_for_user('from_1')
+        [(_, hit_rate)] = router.metrics['user_group_cache.hit_rate'].poll()
+        self.assertEqual(hit_rate['last'], 0.5)
+
+    @inlineCallbacks
+    def test_cache_metrics_direct(self):
+        config = self.config.copy()
+        config['metrics_prefix'] = 'vumi.test.'
+        config['direct_metrics'] = {'host': '127.0.0.1', 'port': 2003}
+        dispatcher = yield self.disp_helper.get_dispatcher(config)
+        router = dispatcher._router
+        publisher = router.metrics.direct_publisher
+        self.assertNotEqual(publisher, None)
+        yield dispatcher.teardown_router()
+        self.assertEqual(router.metrics, None)
+        self.assertEqual(publisher._udp_port, None)
+
+    @inlineCallbacks
+    def test_group_assignment_existing(self):
+        # Another dispatcher may assign a group between our lookup and
+        # our assignment, in which case we use theirs.
+        yield self.redis.set('user:from_1', 'group2')
+        group = yield self.router.group_store.assign_group('from_1', 'group1')
+        self.assertEqual(group, 'group2')
+
     @inlineCallbacks
     def test_routing_to_transport(self):
         app_msg = self.disp_helper.make_outbound(
@@ -462,6 +519,49 @@ class TestUserGroupingRouter(VumiTestCase):
         self.assertEqual(app_msg, tx_msg)
 
 
+class TestKeywordRuleIndex(VumiTestCase):
+
+    def test_match_keyword(self):
+        rule1 = {'app': 'app1', 'keyword': 'foo'}
+        rule2 = {'app': 'app2', 'keyword': 'bar'}
+        index = KeywordRuleIndex([rule1, rule2])
+        self.assertEqual(index.match('foo', '8181', '+27831234567'), [rule1])
+        self.assertEqual(index.match('bar', '8181', '+27831234567'), [rule2])
+        self.assertEqual(index.match('baz', '8181', '+27831234567'), [])
+
+    def test_match_to_addr(self):
+        rule1 = {'app': 'app1', 'keyword': 'foo', 'to_addr': '8181'}
+        rule2 = {'app': 'app2', 'keyword': 'foo', 'to_addr': '8282'}
+        index = KeywordRuleIndex([rule1, rule2])
+        self.assertEqual(index.match('foo', '8181', '+27831234567'), [rule1])
+        self.assertEqual(index.match('foo', '8282', '+27831234567'), [rule2])
+        self.assertEqual(index.match('foo', '8383', '+27831234567'), [])
+
+    def test_match_prefix(self):
+        rule1 = {'app': 'app1', 'keyword': 'foo', 'prefix': '+2783'}
+        rule2 = {'app': 'app2', 'keyword': 'foo', 'prefix': '+27'}
+        rule3 = {'app': 'app3', 'keyword': 'foo', 'prefix': '+256'}
+        index = KeywordRuleIndex([rule1, rule2, rule3])
+        self.assertEqual(
+            index.match('foo', '8181', '+27831234567'), [rule1, rule2])
+        self.assertEqual(index.match('foo', '8181', '+27721234567'), [rule2])
+        self.assertEqual(index.match('foo', '8181', '+256788601462'), [rule3])
+        self.assertEqual(index.match('foo', '8181', '+44'), [])
+        self.assertEqual(index.match('foo', '8181', None), [])
+
+    def test_match_order(self):
+        rules = [
+            {'app': 'app1', 'keyword': 'foo', 'prefix': '+27'},
+            {'app': 'app2', 'keyword': 'foo', 'to_addr': '8181'},
+            {'app': 'app3', 'keyword': 'foo'},
+            {'app': 'app4', 'keyword': 'foo', 'to_addr': '8181',
+             'prefix': '+2783'},
+            {'app': 'app1', 'keyword': 'foo'},
+        ]
+        index = KeywordRuleIndex(rules)
+        self.assertEqual(index.match('foo', '8181', '+27831234567'), rules)
+
+
 class TestContentKeywordRouter(VumiTestCase):
 
     @inlineCallbacks
@@ -494,8 +594,8 @@ class TestContentKeywordRouter(VumiTestCase):
         })
         self.router = self.dispatcher._router
         yield self.router._redis_d
-        self.add_cleanup(self.router.session_manager.stop)
         self.redis = self.router.redis
+        self.add_cleanup(self.redis._close)
         yield self.redis._purge_all()  # just in case
 
     def ch(self, connector_name):
@@ -521,6 +621,16 @@ class TestContentKeywordRouter(VumiTestCase):
         self.assert_dispatched('app2', [msg2, msg3])
         self.assert_dispatched('app3', [msg1])
 
+    @inlineCallbacks
+    def test_inbound_message_routing_rule_mismatch(self):
+        msg1 = yield self.send_inbound(
+            'KEYWORD1 rest of msg', to_addr='8282', from_addr='+256788601462')
+        msg2 = yield self.send_inbound(
+            'KEYWORD1 rest of msg', to_addr='8181', from_addr='+27831234567')
+
+        self.assert_dispatched('app1', [])
+        self.assert_dispatched('app3', [msg1, msg2])
+
     @inlineCallbacks
     def test_inbound_message_routing_empty_message_content(self):
         msg = yield self.send_inbound(None)
@@ -536,8 +646,7 @@ class TestContentKeywordRouter(VumiTestCase):
 
     @inlineCallbacks
     def test_inbound_event_routing_ok(self):
-        yield self.router.session_manager.create_session(
-            'message:1', name='app2')
+        yield self.router.route_store.set_route('1', 'app2')
         ack = yield self.ch('transport1').make_dispatch_ack(
             self.disp_helper.make_outbound("foo", message_id='1'),
             transport_name='transport1')
@@ -545,6 +654,27 @@ class TestContentKeywordRouter(VumiTestCase):
         self.assertEqual([], self.disp_helper.get_dispatched_events('app1'))
         self.assertEqual([ack], self.disp_helper.get_dispatched_events('app2'))
 
+    @inlineCallbacks
+    def test_inbound_event_routing_uncached(self):
+        yield self.router.route_store.set_route('1', 'app2')
+        self.router.route_store.cache.clear()
+        ack = yield self.ch('transport1').make_dispatch_ack(
+            self.disp_helper.make_outbound("foo", message_id='1'),
+            transport_name='transport1')
+
+        self.assertEqual([ack], self.disp_helper.get_dispatched_events('app2'))
+        self.assertEqual(self.router.route_store.cache.misses, 1)
+        self.assertTrue('1' in self.router.route_store.cache)
+
+    @inlineCallbacks
+    def test_inbound_event_routing_legacy_session(self):
+        yield self.redis.hset('session:message:1', 'name', 'app2')
+        ack = yield self.ch('transport1').make_dispatch_ack(
+            self.disp_helper.make_outbound("foo", message_id='1'),
+            transport_name='transport1')
+
+        self.assertEqual([ack], self.disp_helper.get_dispatched_events('app2'))
+
     @inlineCallbacks
     def test_inbound_event_routing_failing_no_routing_back_in_redis(self):
         ack = yield self.ch('transport1').make_dispatch_ack(
@@ -573,8 +703,11 @@ class TestContentKeywordRouter(VumiTestCase):
         self.assertEqual(
             [], self.disp_helper.get_dispatched_outbound('transport2'))
 
-        session = yield self.router.session_manager.load_session('message:1')
-        self.assertEqual(session['name'], 'app2')
+        route = yield self.redis.get('message:1')
+        self.assertEqual(route, 'app2')
+        ttl = yield self.redis.ttl('message:1')
+        self.assertTrue(0 < ttl <= 3)
+        self.assertEqual(self.router.route_store.cache.get('1'), 'app2')
 
 
 class TestRedirectOutboundRouterForSMPP(VumiTestCase):
@@ -63,6 +63,22 @@ class JSONMessageEncoder(json.JSONEncoder):
         return super(JSONMessageEncoder, self).default(obj)
 
 
+def copy_payload(obj):
+    """Copy a JSON-compatible message payload.
+
+    Dicts and lists are copied recursively and everything else (strings,
+    numbers, datetimes, etc.) is immutable and shared. This is much cheaper
+    than a JSON round trip.
+    """
+    if isinstance(obj, dict):
+        return dict((k, copy_payload(v)) for k, v in obj.iteritems())
+    if isinstance(obj, list):
+        return [copy_payload(v) for v in obj]
+    if isinstance(obj, tuple):
+        return tuple(copy_payload(v) for v in obj)
+    return obj
+
+
 def from_json(json_string):
     return json.loads(json_string, object_hook=date_time_decoder)
 
@@ -140,7 +156,7 @@ class Message(object):
         return self.payload.items()
 
     def copy(self):
-        return self.from_json(self.to_json())
+        return type(self)(_process_fields=False, **copy_payload(self.payload))
 
     @property
     def cache(self):
@@ -191,6 +191,10 @@ class MiddlewareStack(object):
     """Ordered list of middlewares to pass a Message through.
     """
 
+    #: Optional :class:`vumi.blinkenlights.profiler.HandlerTimings` used to
+    #: time each middleware handler.
+    timings = None
+
     def __init__(self, middlewares):
         self.consume_middlewares = self._sort_by_priority(
             middlewares, 'consume_priority')
@@ -208,6 +212,10 @@ class MiddlewareStack(object):
         method_name = 'handle_%s' % (handler_name,)
         for middleware in middlewares:
             handler = getattr(middleware, method_name)
+            if self.timings is not None:
+                handler = self.timings.timed(
+                    'middleware.%s.%s' % (middleware.name, handler_name),
+                    handler)
             message = yield handler(message, connector_name)
             if message is None:
                 raise MiddlewareError(
@@ -1,7 +1,7 @@
 # -*- test-case-name: vumi.persist.tests.test_fake_redis -*-
 
 import fnmatch
-from functools import wraps
+from functools import partial, wraps
 from itertools import takewhile, dropwhile
 import os
 from zlib import crc32
@@ -27,6 +27,22 @@ def call_to_deferred(deferred, func, *args, **kw):
     execute(func, *args, **kw).chainDeferred(deferred)
 
 
+class SyncFakeRedis(object):
+    """
+    Synchronous view of a :class:`FakeRedis`, for use in the Python versions
+    of Lua scripts. Operations return their results directly, even if the
+    underlying :class:`FakeRedis` is async.
+    """
+
+    def __init__(self, fake_redis):
+        self._fake_redis = fake_redis
+
+    def __getattr__(self, name):
+        func = getattr(type(self._fake_redis), name)
+        func = getattr(func, 'sync', func)
+        return partial(func, self._fake_redis)
+
+
 class ResponseError(Exception):
     """
     Exception class for things we throw to match the real Redis client
@@ -425,6 +441,11 @@ class FakeRedis(object):
         zval = self._setdefault_key(key, Zset())
         return zval.zremrangebyrank(start, stop)
 
+    @maybe_async
+    def zremrangebyscore(self, key, min, max):
+        zval = self._setdefault_key(key, Zset())
+        return zval.zremrangebyscore(min, max)
+
     # List operations
     @maybe_async
     def llen(self, key):
@@ -509,6 +530,10 @@ class FakeRedis(object):
         self._expiries[key] = delayed
         return 1
 
+    @maybe_async
+    def pexpire(self, key, milliseconds):
+        return self.expire.sync(self, key, milliseconds / 1000.0)
+
     @maybe_async
     def ttl(self, key):
         delayed = self._expiries.get(key)
@@ -516,6 +541,14 @@ class FakeRedis(object):
             return round(delayed.getTime() - self.clock.seconds())
         return None
 
+    @maybe_async
+    def pttl(self, key):
+        delayed = self._expiries.get(key)
+        if delayed is not None and delayed.active():
+            return int(round(
+                (delayed.getTime() - self.clock.seconds()) * 1000))
+        return None
+
     @maybe_async
     def persist(self, key):
         delayed = self._expiries.get(key)
@@ -535,10 +568,50 @@ class FakeRedis(object):
         return hll.card() != old_card
 
     @maybe_async
-    def pfcount(self, key):
-        hll = self._data.get(key, HyperLogLog(0.01))
+    def pfcount(self, key, *keys):
+        hll = HyperLogLog(0.01)
+        hlls = [self._data[k] for k in (key,) + keys if k in self._data]
+        if hlls:
+            hll.update(*hlls)
         return len(hll)
 
+    # Scripting operations
+
+    @maybe_async
+    def run_script(self, script, keys, args):
+        """
+        Run the Python version of a
+        :class:`vumi.persist.redis_base.RedisScript`, since we can't run Lua.
+        Arguments are converted to strings, as they would be when sent to a
+        real Redis server.
+        """
+        args = [self._encode(arg) for arg in args]
+        return script.fake_func(SyncFakeRedis(self), list(keys), args)
+
+    # Pipelines
+
+    @maybe_async
+    def execute_pipeline(self, calls, transaction):
+        """
+        Execute a list of ``(call, args, kw)`` tuples and return a list of
+        their results. All the calls are executed (atomically, since we do
+        them all at once) even if some fail, and then the first error is
+        raised.
+        """
+        results = []
+        error = None
+        for call, args, kw in calls:
+            func = getattr(type(self), call)
+            try:
+                results.append(getattr(func, 'sync', func)(self, *args, **kw))
+            except Exception as e:
+                results.append(e)
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+        return results
+
 
 class Zset(object):
     """A Redis-like ordered set implementation."""
@@ -627,3 +700,8 @@ class Zset(object):
         deleted_keys = self._zval[start:stop]
         del self._zval[start:stop]
         return len(deleted_keys)
+
+    def zremrangebyscore(self, min, max):
+        deleted = set(v for v, _ in self.zrangebyscore(min, max))
+        self._zval = [val for val in self._zval if val[1] not in deleted]
+        return len(deleted)
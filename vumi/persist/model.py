@@ -392,7 +392,7 @@ class Model(object):
     @classmethod
     def index_keys_page(cls, manager, field_name, value, end_value=None,
                         return_terms=None, max_results=None,
-                        continuation=None):
+                        continuation=None, term_regex=None):
         """Find object keys by index, using pagination.
 
         :param manager:
@@ -431,6 +431,11 @@ class Model(object):
             ``continuation`` attribute that contains this value. If ``None``,
             the first page of results will be returned.
 
+        :param str term_regex:
+            If provided, only results with raw index values matching this
+            regular expression will be returned. Pages filtered in the client
+            may contain fewer than ``max_results`` results.
+
         :returns:
             :class:`VumiIndexPage` or :class:`VumiTxIndexPage` object
             containing results. If ``return_terms`` is ``True``, the object
@@ -440,7 +445,74 @@ class Model(object):
             cls, field_name, value, end_value)
         return manager.index_keys_page(
             cls, index_name, start_value, end_value, return_terms=return_terms,
-            max_results=max_results, continuation=continuation)
+            max_results=max_results, continuation=continuation,
+            term_regex=term_regex)
+
+    @classmethod
+    def all_keys_stream(cls, manager, max_results=None):
+        """Stream all keys in this model's bucket.
+
+        Uses Riak's special `$bucket` index. Beware of tombstones (i.e.
+        the keys returned might have been deleted from Riak in the near past).
+
+        :param int max_results:
+            The maximum number of results to fetch per page.
+
+        :returns:
+            :class:`VumiIndexStream` or :class:`VumiTxIndexStream` object
+            that returns all keys from this model's bucket.
+        """
+        return manager.index_keys_stream(
+            cls, '$bucket', manager.bucket_name(cls), None,
+            max_results=max_results)
+
+    @classmethod
+    def index_keys_stream(cls, manager, field_name, value, end_value=None,
+                          return_terms=None, max_results=None,
+                          term_regex=None):
+        """Find object keys by index, streaming results across pages.
+
+        Unlike :meth:`index_keys`, results are never accumulated into a single
+        list. Call ``next_batch()`` on the returned stream to fetch each page
+        of results in turn and ``close()`` to stop early. Async managers
+        prefetch the next page while the current one is being processed.
+
+        :param manager:
+            A :class:`Manager` object.
+
+        :param str field_name:
+            The name of the field to get the index from.
+
+        :param value:
+            The index value to look up. If ``end_value`` is provided, ``value``
+            is used as the start of a range query, otherwise an exact match is
+            performed.
+
+        :param end_value:
+            The index value to use as the end of a range query.
+
+        :param bool return_terms:
+            If ``True``, the raw index values will be returned along with the
+            object keys in a ``(term, key)`` tuple.
+
+        :param int max_results:
+            The maximum number of results to fetch per page. If ``None``,
+            the manager's default is used.
+
+        :param str term_regex:
+            If provided, only results with raw index values matching this
+            regular expression will be returned. This is done by Riak for
+            range queries where the server supports it and in the client
+            otherwise.
+
+        :returns:
+            :class:`VumiIndexStream` or :class:`VumiTxIndexStream` object.
+        """
+        index_name, start_value, end_value = index_vals_for_field(
+            cls, field_name, value, end_value)
+        return manager.index_keys_stream(
+            cls, index_name, start_value, end_value, return_terms=return_terms,
+            max_results=max_results, term_regex=term_regex)
 
     @classmethod
     def index_lookup(cls, manager, field_name, value):
@@ -669,6 +741,7 @@ class Manager(object):
     """A wrapper around a Riak client."""
 
     DEFAULT_LOAD_BUNCH_SIZE = 100
+    DEFAULT_INDEX_PAGE_SIZE = 1000
     DEFAULT_MAPREDUCE_TIMEOUT = 4 * 60 * 1000  # in milliseconds
     # This is a temporary measure to give us an easy way to switch back to the
     # old mechanism if the new one causes problems.
@@ -884,7 +957,7 @@ class Manager(object):
 
     def index_keys_page(self, model, index_name, start_value, end_value=None,
                         return_terms=None, max_results=None,
-                        continuation=None):
+                        continuation=None, term_regex=None):
         bucket = self.bucket_for_modelcls(model)
         if self.should_quote_index_values():
             if start_value is not None:
@@ -893,7 +966,27 @@ class Manager(object):
                 end_value = urllib.quote(end_value)
         return bucket.get_index_page(
             index_name, start_value, end_value, return_terms=return_terms,
-            max_results=max_results, continuation=continuation)
+            max_results=max_results, continuation=continuation,
+            term_regex=term_regex)
+
+    def _wrap_index_stream(self, fetch_first_page):
+        """Construct an index stream object for this manager."""
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._wrap_index_stream(...)")
+
+    def index_keys_stream(self, model, index_name, start_value,
+                          end_value=None, return_terms=None, max_results=None,
+                          term_regex=None):
+        if max_results is None:
+            max_results = self.DEFAULT_INDEX_PAGE_SIZE
+
+        def fetch_first_page():
+            return self.index_keys_page(
+                model, index_name, start_value, end_value,
+                return_terms=return_terms, max_results=max_results,
+                term_regex=term_regex)
+
+        return self._wrap_index_stream(fetch_first_page)
 
     def mr_from_field(self, model, field_name, start_value, end_value=None):
         return VumiMapReduce.from_field(
@@ -966,11 +1059,23 @@ class ModelProxy(object):
 
     def index_keys_page(self, field_name, value, end_value=None,
                         return_terms=None, max_results=None,
-                        continuation=None):
+                        continuation=None, term_regex=None):
         return self._modelcls.index_keys_page(
             self._manager, field_name, value, end_value,
             return_terms=return_terms, max_results=max_results,
-            continuation=continuation)
+            continuation=continuation, term_regex=term_regex)
+
+    def all_keys_stream(self, max_results=None):
+        return self._modelcls.all_keys_stream(
+            self._manager, max_results=max_results)
+
+    def index_keys_stream(self, field_name, value, end_value=None,
+                          return_terms=None, max_results=None,
+                          term_regex=None):
+        return self._modelcls.index_keys_stream(
+            self._manager, field_name, value, end_value,
+            return_terms=return_terms, max_results=max_results,
+            term_regex=term_regex)
 
     def index_lookup(self, field_name, value):
         return self._modelcls.index_lookup(self._manager, field_name, value)
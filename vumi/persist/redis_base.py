@@ -1,5 +1,6 @@
 # -*- test-case-name: vumi.persist.tests.test_redis_base -*-
 
+import hashlib
 import os
 from functools import wraps
 
@@ -29,8 +30,10 @@ def make_callfunc(name, redis_call):
         return result
 
     fargs = ['self'] + list(redis_call.args)
-    return make_function(name, func, fargs, redis_call.vararg,
-                         redis_call.kwarg, redis_call.defaults)
+    callfunc = make_function(name, func, fargs, redis_call.vararg,
+                             redis_call.kwarg, redis_call.defaults)
+    callfunc.pipelineable = True
+    return callfunc
 
 
 class RedisCall(object):
@@ -44,6 +47,111 @@ class RedisCall(object):
         self.key_args = key_args
 
 
+class RedisScript(object):
+    """
+    A Lua script to run atomically on the Redis server.
+
+    Scripts are sent with ``EVALSHA`` and only fall back to ``EVAL`` (which
+    also loads them into the server's script cache) if the server doesn't
+    know about them yet.
+
+    :param str lua:
+        The Lua source of the script. Keys must only be accessed through
+        ``KEYS`` so that they are properly prefixed by the manager.
+    :param fake_func:
+        A Python implementation of the script for :class:`FakeRedis`, which
+        can't run Lua. It is called with a synchronous view of the fake
+        Redis, the list of (prefixed) keys and the list of arguments (as
+        strings) and must return the same result the Lua script would.
+    """
+
+    def __init__(self, lua, fake_func):
+        self.lua = lua
+        self.sha = hashlib.sha1(lua).hexdigest()
+        self.fake_func = fake_func
+
+
+class Pipeline(object):
+    """
+    A batch of Redis calls to send to the server together.
+
+    Pipelines are created with :meth:`Manager.pipeline` or
+    :meth:`Manager.multi`. Calls are made on the pipeline in the same way as
+    on the manager (keys are prefixed with the manager's key prefix), but
+    nothing is sent until :meth:`execute` is called. Each call returns the
+    pipeline so that calls can be chained.
+
+    :param manager:
+        The :class:`Manager` to send calls through.
+    :param bool transaction:
+        If ``True``, the calls are wrapped in ``MULTI``/``EXEC`` so that they
+        are executed atomically.
+    """
+
+    def __init__(self, manager, transaction=False):
+        self._manager = manager
+        self.transaction = transaction
+        self._calls = []
+        self._filters = []
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __getattr__(self, name):
+        func = getattr(type(self._manager), name, None)
+        if not getattr(func, 'pipelineable', False):
+            raise AttributeError(
+                "%r is not a Redis call that can be pipelined." % (name,))
+
+        def call(*args, **kw):
+            func.__func__(self, *args, **kw)
+            return self
+
+        return call
+
+    # These are used by the call functions built by make_callfunc().
+
+    def _key(self, key):
+        return self._manager._key(key)
+
+    def _unkeys(self, keys):
+        return self._manager._unkeys(keys)
+
+    def _unkeys_scan(self, scan_results):
+        return self._manager._unkeys_scan(scan_results)
+
+    def _make_redis_call(self, call, *args, **kw):
+        self._calls.append((call, args, kw))
+        self._filters.append(None)
+        return len(self._calls) - 1
+
+    def _filter_redis_results(self, func, index):
+        self._filters[index] = func
+        return index
+
+    def execute(self):
+        """
+        Send all the calls in the pipeline and return a list of their
+        results (or a deferred that fires with the list for asynchronous
+        managers). Every call is executed even if some fail, but if any of
+        them fail the first error is raised after they have all run.
+
+        The pipeline is empty again after this is called.
+        """
+        calls, self._calls = self._calls, []
+        filters, self._filters = self._filters, []
+        if calls:
+            results = self._manager._execute_pipeline(calls, self.transaction)
+        else:
+            results = []
+        return self._manager._pipeline_result(
+            results, self._apply_filters, filters)
+
+    def _apply_filters(self, results, filters):
+        return [(f(r) if f is not None else r)
+                for f, r in zip(filters, results)]
+
+
 class CallMakerMetaclass(type):
     def __new__(meta, classname, bases, class_dict):
         new_class_dict = {}
@@ -287,6 +395,7 @@ class Manager(object):
     zscore = RedisCall(['key', 'value'])
     zcount = RedisCall(['key', 'min', 'max'])
     zremrangebyrank = RedisCall(['key', 'start', 'stop'])
+    zremrangebyscore = RedisCall(['key', 'min', 'max'])
 
     # List operations
 
@@ -304,10 +413,55 @@ class Manager(object):
     # Expiry operations
 
     expire = RedisCall(['key', 'seconds'])
+    pexpire = RedisCall(['key', 'milliseconds'])
     persist = RedisCall(['key'])
     ttl = RedisCall(['key'])
+    pttl = RedisCall(['key'])
 
     # HyperLogLog operations
 
     pfadd = RedisCall(['key'], vararg='values')
-    pfcount = RedisCall(['key'])
+    pfcount = RedisCall(['key'], vararg='keys', key_args=['key', 'keys'])
+
+    # Scripting operations
+
+    def run_script(self, script, keys=(), args=()):
+        """
+        Run a :class:`RedisScript` with the given keys and arguments. The keys
+        are prefixed with this manager's key prefix.
+        """
+        return self._make_redis_call(
+            'run_script', script, [self._key(k) for k in keys], list(args))
+
+    run_script.pipelineable = True
+
+    # Pipelines
+
+    def pipeline(self):
+        """
+        Return a :class:`Pipeline` that sends a batch of calls in a single
+        round trip.
+        """
+        return Pipeline(self, transaction=False)
+
+    def multi(self):
+        """
+        Return a :class:`Pipeline` that sends a batch of calls in a single
+        round trip and executes them atomically.
+        """
+        return Pipeline(self, transaction=True)
+
+    def _execute_pipeline(self, calls, transaction):
+        """
+        Send a list of ``(call, args, kw)`` tuples to the server and return
+        their raw results.
+        """
+        return self._client.execute_pipeline(calls, transaction)
+
+    def _pipeline_result(self, results, func, *args):
+        """
+        Apply ``func`` to the results of :meth:`_execute_pipeline`, which may
+        be a deferred.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._pipeline_result()")
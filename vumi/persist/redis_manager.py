@@ -9,11 +9,25 @@ from vumi.persist.fake_redis import (
 from vumi.utils import flatten_generator
 
 
+def parse_scan(response, **options):
+    cursor, keys = response
+    if cursor == '0' or cursor == 0:
+        cursor = None
+    return (cursor, keys)
+
+
 class VumiRedis(redis.Redis):
     """
     Custom Vumi redis client implementation.
     """
 
+    RESPONSE_CALLBACKS = dict(redis.Redis.RESPONSE_CALLBACKS, SCAN=parse_scan)
+
+    def __init__(self, *args, **kw):
+        super(VumiRedis, self).__init__(*args, **kw)
+        # SHAs of the scripts we know the server has cached.
+        self._loaded_scripts = set()
+
     def setex(self, key, seconds, value):
         """
         The underlying .setex() signature doesn't match our implementation
@@ -42,10 +56,63 @@ class VumiRedis(redis.Redis):
             args.extend(("MATCH", match))
         if count is not None:
             args.extend(("COUNT", count))
-        cursor, keys = self.execute_command("SCAN", cursor, *args)
-        if cursor == '0' or cursor == 0:
-            cursor = None
-        return (cursor, keys)
+        return self.execute_command("SCAN", cursor, *args)
+
+    def run_script(self, script, keys, args):
+        """
+        Run a :class:`vumi.persist.redis_base.RedisScript`, loading it if the
+        server doesn't have it cached.
+
+        We remember which scripts we've loaded so that we only send the
+        script source the first time it is run.
+        """
+        keys_and_args = list(keys) + list(args)
+        if script.sha in self._loaded_scripts:
+            try:
+                return self.evalsha(script.sha, len(keys), *keys_and_args)
+            except redis.exceptions.NoScriptError:
+                self._loaded_scripts.discard(script.sha)
+        result = self.eval(script.lua, len(keys), *keys_and_args)
+        self._loaded_scripts.add(script.sha)
+        return result
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return VumiRedisPipeline(
+            self.connection_pool, self.response_callbacks, transaction,
+            shard_hint)
+
+    def execute_pipeline(self, calls, transaction):
+        """
+        Send a list of ``(call, args, kw)`` tuples in a single round trip and
+        return a list of their results. If any of the calls fail, the first
+        error is raised once they have all completed.
+
+        If ``transaction`` is ``True``, the calls are wrapped in
+        ``MULTI``/``EXEC``.
+        """
+        pipe = self.pipeline(transaction=transaction)
+        for call, args, kw in calls:
+            getattr(pipe, call)(*args, **kw)
+        results = pipe.execute(raise_on_error=False)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+
+class VumiRedisPipeline(redis.client.BasePipeline, VumiRedis):
+    """
+    Pipeline for the :class:`VumiRedis` client.
+    """
+
+    def run_script(self, script, keys, args):
+        """
+        Queue a :class:`vumi.persist.redis_base.RedisScript`. We always send
+        the script source, since there's no way to recover from a missing
+        script once the pipeline has been sent.
+        """
+        keys_and_args = list(keys) + list(args)
+        return self.eval(script.lua, len(keys), *keys_and_args)
 
 
 class RedisManager(Manager):
@@ -99,3 +166,6 @@ class RedisManager(Manager):
         """Filter results of a redis call.
         """
         return func(results)
+
+    def _pipeline_result(self, results, func, *args):
+        return func(results, *args)
@@ -1,6 +1,7 @@
 """Basic tools for building a Riak manager."""
 
 import json
+import re
 
 from riak import RiakClient
 
@@ -87,6 +88,47 @@ class VumiRiakClientBase(object):
             self.close()
 
 
+class TermRegexFilter(object):
+    """
+    Client-side equivalent of Riak's ``term_regex`` index query option.
+
+    This is used when the server (or the query type) doesn't support
+    filtering index terms itself. Range queries must be made with
+    ``return_terms=True`` so that we have terms to match against.
+
+    Riak ignores ``return_terms`` on exact match queries and returns plain
+    keys, so for those the single term being queried for is given as
+    ``term`` and either all of the keys or none of them are returned.
+
+    :param str term_regex:
+        The regular expression to search index terms with.
+
+    :param bool return_terms:
+        If ``False``, the terms are stripped from the filtered results and
+        only the keys are returned.
+
+    :param str term:
+        The term queried for, if this is an exact match query.
+    """
+
+    def __init__(self, term_regex, return_terms, term=None):
+        self.term_regex = term_regex
+        self.return_terms = return_terms
+        self.term = term
+        self._pattern = re.compile(term_regex)
+
+    def __call__(self, results):
+        if self.term is not None:
+            if self._pattern.search(self.term) is not None:
+                for key in results:
+                    yield key
+            return
+        for term, key in results:
+            if self._pattern.search(term) is None:
+                continue
+            yield (term, key) if self.return_terms else key
+
+
 class VumiIndexPageBase(object):
     """
     Wrapper around a page of index query results.
@@ -94,17 +136,26 @@ class VumiIndexPageBase(object):
     Iterating over this object will return the results for the current page.
     """
 
-    def __init__(self, index_page):
+    def __init__(self, index_page, term_filter=None):
         self._index_page = index_page
+        self._term_filter = term_filter
 
     def __iter__(self):
         if self._index_page.stream:
             raise NotImplementedError("Streaming is not currently supported.")
-        return (_to_unicode(item) for item in self._index_page)
+        results = (_to_unicode(item) for item in self._index_page)
+        if self._term_filter is not None:
+            results = self._term_filter(results)
+        return results
 
     def __len__(self):
+        if self._term_filter is not None:
+            return len(list(self))
         return len(self._index_page)
 
+    def _wrap_next_page(self, index_page):
+        return type(self)(index_page, self._term_filter)
+
     def __eq__(self, other):
         return self._index_page.__eq__(other)
 
@@ -128,6 +179,54 @@ class VumiIndexPageBase(object):
         raise NotImplementedError("Subclasses must implement this.")
 
 
+class VumiIndexStreamBase(object):
+    """
+    Stream of index query results that spans multiple pages.
+
+    Only the page currently being consumed and (for async managers) the next
+    prefetched page are held in memory, so memory use doesn't depend on the
+    total number of results.
+
+    :param fetch_first_page:
+        Callable that returns the first index page (or a deferred that fires
+        with it).
+    """
+
+    def __init__(self, fetch_first_page):
+        self._fetch_first_page = fetch_first_page
+        self._started = False
+        self._finished = False
+
+    @property
+    def finished(self):
+        """
+        ``True`` if the stream has been exhausted or closed.
+        """
+        return self._finished
+
+    def close(self):
+        """
+        Stop the stream early. Any further calls to :meth:`next_batch` will
+        return ``None``.
+        """
+        self._finished = True
+
+    # Methods that touch the network.
+
+    def next_batch(self):
+        """
+        Fetch the next batch of results.
+
+        :returns:
+            A (possibly deferred) list of results from the next page, or
+            ``None`` if there are no more results. Batches may be empty
+            if all the results in a page were filtered out client-side.
+
+        Only one batch may be requested at a time.
+        """
+        raise NotImplementedError("Subclasses must implement this.")
+
+
 class VumiRiakBucketBase(object):
     """
     Wrapper around a RiakBucket to manage network access better.
@@ -146,9 +245,45 @@ class VumiRiakBucketBase(object):
         raise NotImplementedError("Subclasses must implement this.")
 
     def get_index_page(self, index_name, start_value, end_value=None,
-                       return_terms=None, max_results=None, continuation=None):
+                       return_terms=None, max_results=None, continuation=None,
+                       term_regex=None):
         raise NotImplementedError("Subclasses must implement this.")
 
+    def _get_index_page_raw(self, index_name, start_value, end_value=None,
+                            return_terms=None, max_results=None,
+                            continuation=None, term_regex=None):
+        """
+        Perform an index query, filtering terms server-side if possible.
+
+        Riak only supports ``term_regex`` on range queries (and only in
+        versions 2.0 and newer), so we fall back to filtering client-side
+        if necessary.
+
+        :returns:
+            A ``(riak_index_page, term_filter)`` tuple. If ``term_filter`` is
+            not ``None``, it must be applied to the results.
+        """
+        if term_regex is not None and end_value is not None:
+            try:
+                result = self._riak_bucket.get_index(
+                    index_name, start_value, end_value,
+                    return_terms=return_terms, max_results=max_results,
+                    continuation=continuation, term_regex=term_regex)
+                return result, None
+            except NotImplementedError:
+                pass
+        term_filter = None
+        if term_regex is not None and end_value is None:
+            term_filter = TermRegexFilter(
+                term_regex, return_terms, term=start_value)
+        elif term_regex is not None:
+            term_filter = TermRegexFilter(term_regex, return_terms)
+            return_terms = True
+        result = self._riak_bucket.get_index(
+            index_name, start_value, end_value, return_terms=return_terms,
+            max_results=max_results, continuation=continuation)
+        return result, term_filter
+
 
 class VumiRiakObjectBase(object):
     """
@@ -6,8 +6,8 @@ from riak import RiakObject, RiakMapReduce, RiakError
 
 from vumi.persist.model import Manager, VumiRiakError
 from vumi.persist.riak_base import (
-    VumiRiakClientBase, VumiIndexPageBase, VumiRiakBucketBase,
-    VumiRiakObjectBase)
+    VumiRiakClientBase, VumiIndexPageBase, VumiIndexStreamBase,
+    VumiRiakBucketBase, VumiRiakObjectBase)
 from vumi.utils import flatten_generator
 
 
@@ -40,7 +40,47 @@ class VumiIndexPage(VumiIndexPageBase):
             result = self._index_page.next_page()
         except RiakError as e:
             raise VumiRiakError(e)
-        return type(self)(result)
+        return self._wrap_next_page(result)
+
+
+class VumiIndexStream(VumiIndexStreamBase):
+    """
+    Stream of index query results that spans multiple pages.
+
+    Iterating over this object will return the results from all pages,
+    fetching each page as it is needed.
+    """
+
+    def __init__(self, fetch_first_page):
+        super(VumiIndexStream, self).__init__(fetch_first_page)
+        self._page = None
+
+    def __iter__(self):
+        batch = self.next_batch()
+        while batch is not None:
+            for result in batch:
+                yield result
+            batch = self.next_batch()
+
+    def close(self):
+        super(VumiIndexStream, self).close()
+        self._page = None
+
+    # Methods that touch the network.
+
+    def next_batch(self):
+        if self._finished:
+            return None
+        if not self._started:
+            self._started = True
+            page = self._fetch_first_page()
+        else:
+            page = self._page.next_page()
+        if page is None:
+            self.close()
+            return None
+        self._page = page
+        return list(page)
 
 
 class VumiRiakBucket(VumiRiakBucketBase):
@@ -57,14 +97,16 @@ class VumiRiakBucket(VumiRiakBucketBase):
         return list(keys)
 
     def get_index_page(self, index_name, start_value, end_value=None,
-                       return_terms=None, max_results=None, continuation=None):
+                       return_terms=None, max_results=None, continuation=None,
+                       term_regex=None):
         try:
-            result = self._riak_bucket.get_index(
+            result, term_filter = self._get_index_page_raw(
                 index_name, start_value, end_value, return_terms=return_terms,
-                max_results=max_results, continuation=continuation)
+                max_results=max_results, continuation=continuation,
+                term_regex=term_regex)
         except RiakError as e:
             raise VumiRiakError(e)
-        return VumiIndexPage(result)
+        return VumiIndexPage(result, term_filter)
 
 
 class VumiRiakObject(VumiRiakObjectBase):
@@ -179,6 +221,9 @@ class RiakManager(Manager):
         objs = (self.load(modelcls, key) for key in keys)
         return [obj for obj in objs if obj is not None]
 
+    def _wrap_index_stream(self, fetch_first_page):
+        return VumiIndexStream(fetch_first_page)
+
     def riak_map_reduce(self):
         return RiakMapReduce(self.client)
 
@@ -6,9 +6,23 @@ from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
 
 from vumi.persist.fake_redis import FakeRedis, ResponseError
+from vumi.persist.redis_base import RedisScript
 from vumi.tests.helpers import VumiTestCase
 
 
+def fake_incr_and_copy(redis, keys, args):
+    value = redis.incr(keys[0], int(args[0]))
+    redis.set(keys[1], value)
+    return [value, redis.get(keys[1])]
+
+
+INCR_AND_COPY_SCRIPT = RedisScript("""
+local value = redis.call('INCRBY', KEYS[1], ARGV[1])
+redis.call('SET', KEYS[2], value)
+return {value, redis.call('GET', KEYS[2])}
+""", fake_incr_and_copy)
+
+
 class FakeRedisTestMixin(object):
     """
     Test methods (and some unimplemented stubs) for FakeRedis.
@@ -266,6 +280,16 @@ class FakeRedisTestMixin(object):
             redis, [('one', 1), ('two', 2), ('three', 3)],
             'zrange', 'set', 0, -1, withscores=True)
 
+    @inlineCallbacks
+    def test_zremrangebyscore(self):
+        redis = yield self.get_redis()
+        yield redis.zadd('set', one=1, two=2, three=3)
+        yield self.assert_redis_op(
+            redis, 2, 'zremrangebyscore', 'set', '-inf', 2)
+        yield self.assert_redis_op(
+            redis, [('three', 3)], 'zrange', 'set', 0, -1, withscores=True)
+        yield self.assert_redis_op(redis, 0, 'zremrangebyscore', 'set', 4, 5)
+
     @inlineCallbacks
     def test_zscore(self):
         redis = yield self.get_redis()
@@ -485,6 +509,23 @@ class FakeRedisTestMixin(object):
         yield self.assert_redis_op(redis, 0, 'persist', "tempval")
         yield self.assert_redis_op(redis, 1, 'expire', "tempval", 10)
 
+    @inlineCallbacks
+    def test_pexpire_pttl(self):
+        redis = yield self.get_redis()
+        # Missing key.
+        yield self.assert_redis_op(redis, None, 'pttl', "tempval")
+        yield self.assert_redis_op(redis, 0, 'pexpire', "tempval", 10000)
+        # Persistent key.
+        yield redis.set("tempval", 1)
+        yield self.assert_redis_op(redis, None, 'pttl', "tempval")
+        yield self.assert_redis_op(redis, 1, 'pexpire', "tempval", 10000)
+        # Temporary key.
+        pttl = yield redis.pttl("tempval")
+        self.assertTrue(9000 < pttl <= 10000)
+        yield self.assert_redis_op(redis, 10, 'ttl', "tempval")
+        yield self.assert_redis_op(redis, 1, 'persist', "tempval")
+        yield self.assert_redis_op(redis, None, 'pttl', "tempval")
+
     @inlineCallbacks
     def test_type(self):
         redis = yield self.get_redis()
@@ -549,6 +590,26 @@ class FakeRedisTestMixin(object):
         yield self.assert_redis_op(redis, 0, 'pfadd', 'hll2', 'a', 'b')
         yield self.assert_redis_op(redis, 2, 'pfcount', 'hll2')
 
+    @inlineCallbacks
+    def test_pfcount_multiple_keys(self):
+        redis = yield self.get_redis()
+        yield redis.pfadd('hll1', 'a', 'b')
+        yield redis.pfadd('hll2', 'b', 'c')
+        yield self.assert_redis_op(redis, 3, 'pfcount', 'hll1', 'hll2')
+        yield self.assert_redis_op(redis, 2, 'pfcount', 'hll1', 'hll3')
+
+    @inlineCallbacks
+    def test_run_script(self):
+        redis = yield self.get_redis()
+        yield redis.set('counter', 3)
+        yield self.assert_redis_op(
+            redis, [5, '5'], 'run_script', INCR_AND_COPY_SCRIPT,
+            ['counter', 'copy'], [2])
+        yield self.assert_redis_op(redis, '5', 'get', 'copy')
+        yield self.assert_redis_op(
+            redis, [6, '6'], 'run_script', INCR_AND_COPY_SCRIPT,
+            ['counter', 'copy'], [1])
+
 
 class FakeRedisUnverifiedTestMixin(object):
     """
@@ -778,6 +778,124 @@ class ModelTestMixin(object):
         keys1 = yield indexed_model.index_keys_page('a', 1)
         self.assertEqual(len(keys1), 0)
 
+    @Manager.calls_manager
+    def collect_stream(self, stream):
+        batches = []
+        batch = yield stream.next_batch()
+        while batch is not None:
+            batches.append(batch)
+            batch = yield stream.next_batch()
+        returnValue(batches)
+
+    @Manager.calls_manager
+    def test_index_keys_stream(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("foo1", a=1, b=u"one").save()
+        yield indexed_model("foo2", a=1, b=u"one").save()
+        yield indexed_model("foo3", a=1, b=None).save()
+
+        stream = indexed_model.index_keys_stream('a', 1, max_results=2)
+        batches = yield self.collect_stream(stream)
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+        self.assertEqual(
+            sorted(sum(batches, [])), [u"foo1", u"foo2", u"foo3"])
+        self.assertEqual(stream.finished, True)
+
+        no_batch = yield stream.next_batch()
+        self.assertEqual(no_batch, None)
+
+    @Manager.calls_manager
+    def test_index_keys_stream_return_terms(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("foo1", a=1, b=u"one").save()
+        yield indexed_model("foo2", a=2, b=u"one").save()
+        yield indexed_model("foo3", a=3, b=None).save()
+
+        stream = indexed_model.index_keys_stream(
+            'a', 1, 2, return_terms=True, max_results=1)
+        batches = yield self.collect_stream(stream)
+        self.assertEqual(
+            sorted(sum(batches, [])), [(u"1", u"foo1"), (u"2", u"foo2")])
+
+    @Manager.calls_manager
+    def test_index_keys_stream_empty(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("foo1", a=2, b=u"one").save()
+
+        stream = indexed_model.index_keys_stream('a', 1)
+        batches = yield self.collect_stream(stream)
+        self.assertEqual(batches, [[]])
+
+    @Manager.calls_manager
+    def test_index_keys_stream_close(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("foo1", a=1, b=u"one").save()
+        yield indexed_model("foo2", a=1, b=u"one").save()
+        yield indexed_model("foo3", a=1, b=None).save()
+
+        stream = indexed_model.index_keys_stream('a', 1, max_results=1)
+        batch = yield stream.next_batch()
+        self.assertEqual(len(batch), 1)
+        self.assertEqual(stream.finished, False)
+
+        stream.close()
+        self.assertEqual(stream.finished, True)
+        no_batch = yield stream.next_batch()
+        self.assertEqual(no_batch, None)
+
+    @Manager.calls_manager
+    def test_index_keys_stream_term_regex(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("foo1", a=1, b=u"one").save()
+        yield indexed_model("foo2", a=2, b=u"two").save()
+        yield indexed_model("foo3", a=3, b=u"three").save()
+
+        stream = indexed_model.index_keys_stream(
+            'b', u"a", u"z", term_regex=u"^t", max_results=1)
+        batches = yield self.collect_stream(stream)
+        self.assertEqual(sorted(sum(batches, [])), [u"foo2", u"foo3"])
+
+        stream = indexed_model.index_keys_stream(
+            'b', u"a", u"z", return_terms=True, term_regex=u"^t")
+        batches = yield self.collect_stream(stream)
+        self.assertEqual(
+            sorted(sum(batches, [])),
+            [(u"three", u"foo3"), (u"two", u"foo2")])
+
+    @Manager.calls_manager
+    def test_index_keys_page_term_regex_exact_match(self):
+        """
+        Riak doesn't support term_regex on exact match queries, so the
+        results are filtered client-side.
+        """
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("foo1", a=1, b=u"one").save()
+        yield indexed_model("foo2", a=1, b=u"one").save()
+
+        keys = yield indexed_model.index_keys_page('b', u"one")
+        self.assertEqual(sorted(keys), [u"foo1", u"foo2"])
+
+        keys = yield indexed_model.index_keys_page(
+            'b', u"one", term_regex=u"^o")
+        self.assertEqual(sorted(keys), [u"foo1", u"foo2"])
+        self.assertEqual(len(keys), 2)
+
+        keys = yield indexed_model.index_keys_page(
+            'b', u"one", term_regex=u"^t")
+        self.assertEqual(list(keys), [])
+        self.assertEqual(len(keys), 0)
+
+    @Manager.calls_manager
+    def test_all_keys_stream(self):
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("foo-1", a=5, b=u'1').save()
+        yield simple_model("foo-2", a=5, b=u'2').save()
+
+        stream = simple_model.all_keys_stream(max_results=1)
+        batches = yield self.collect_stream(stream)
+        keys = yield self.filter_tombstones(simple_model, sum(batches, []))
+        self.assertEqual(sorted(keys), [u"foo-1", u"foo-2"])
+
     @Manager.calls_manager
     def test_index_keys_quoting(self):
         indexed_model = self.manager.proxy(IndexedModel)
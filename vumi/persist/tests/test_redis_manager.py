@@ -38,6 +38,58 @@ class TestRedisManager(VumiTestCase):
         self.assertEqual(['foo'], self.manager.keys())
         self.assertEqual('baz', self.manager.get('foo'))
 
+    def test_run_script(self):
+        from vumi.persist.tests.test_fake_redis import INCR_AND_COPY_SCRIPT
+        sub_manager = self.manager.sub_manager('sub')
+        sub_manager.set("counter", "3")
+        result = sub_manager.run_script(
+            INCR_AND_COPY_SCRIPT, ["counter", "copy"], [2])
+        self.assertEqual(result, [5, "5"])
+        self.assertEqual(self.manager.get("sub:copy"), "5")
+
+    def test_pipeline(self):
+        sub_manager = self.manager.sub_manager('sub')
+        pipe = sub_manager.pipeline()
+        pipe.set("foo", "1").incr("foo").get("foo").keys()
+        self.assertEqual(self.manager.keys(), [])
+        self.assertEqual(pipe.execute(), [True, 2, "2", ["foo"]])
+        self.assertEqual(len(pipe), 0)
+        self.assertEqual(self.manager.get("sub:foo"), "2")
+
+    def test_pipeline_run_script(self):
+        from vumi.persist.tests.test_fake_redis import INCR_AND_COPY_SCRIPT
+        pipe = self.manager.pipeline()
+        pipe.set("counter", "3")
+        pipe.run_script(INCR_AND_COPY_SCRIPT, ["counter", "copy"], [2])
+        self.assertEqual(pipe.execute(), [True, [5, "5"]])
+
+    def test_pipeline_error(self):
+        pipe = self.manager.pipeline()
+        pipe.set("foo", "bar").rename("missing", "foo").set("baz", "quux")
+        self.assertRaises(self.manager.RESPONSE_ERROR, pipe.execute)
+        # The calls after the failed one were still made.
+        self.assertEqual(self.manager.get("baz"), "quux")
+
+    def test_multi(self):
+        pipe = self.manager.multi()
+        self.assertTrue(pipe.transaction)
+        pipe.sadd("set", "a", "b").smembers("set").delete("set")
+        self.assertEqual(pipe.execute(), [2, set(["a", "b"]), True])
+        self.assertEqual(self.manager.exists("set"), False)
+
+    def test_client_pipeline(self):
+        from vumi.persist.redis_manager import VumiRedis, VumiRedisPipeline
+        client = VumiRedis()
+        pipe = client.pipeline(transaction=False)
+        self.assertTrue(isinstance(pipe, VumiRedisPipeline))
+        pipe.setex("foo", 30, "bar").scan(None, match="f*")
+        self.assertEqual(
+            [args for args, _ in pipe.command_stack],
+            [("SETEX", "foo", 30, "bar"), ("SCAN", "0", "MATCH", "f*")])
+        parse_scan = pipe.response_callbacks["SCAN"]
+        self.assertEqual(parse_scan(["0", ["foo"]]), (None, ["foo"]))
+        self.assertEqual(parse_scan(["12", ["foo"]]), ("12", ["foo"]))
+
     def test_disconnect_twice(self):
         self.manager._close()
         self.manager._close()
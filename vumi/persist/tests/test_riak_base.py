@@ -0,0 +1,32 @@
+"""Tests for vumi.persist.riak_base."""
+
+from vumi.tests.helpers import VumiTestCase, import_skip
+
+
+class TestTermRegexFilter(VumiTestCase):
+
+    def setUp(self):
+        try:
+            from vumi.persist.riak_base import TermRegexFilter
+        except ImportError, e:
+            import_skip(e, 'riak')
+        self.filter_class = TermRegexFilter
+
+    def test_range_query(self):
+        term_filter = self.filter_class(u"^t", False)
+        results = [(u"one", u"foo1"), (u"two", u"foo2"), (u"three", u"foo3")]
+        self.assertEqual(list(term_filter(results)), [u"foo2", u"foo3"])
+
+    def test_range_query_return_terms(self):
+        term_filter = self.filter_class(u"^t", True)
+        results = [(u"one", u"foo1"), (u"two", u"foo2")]
+        self.assertEqual(list(term_filter(results)), [(u"two", u"foo2")])
+
+    def test_exact_match_query(self):
+        term_filter = self.filter_class(u"^o", False, term=u"one")
+        self.assertEqual(
+            list(term_filter([u"foo1", u"foo2"])), [u"foo1", u"foo2"])
+
+    def test_exact_match_query_no_match(self):
+        term_filter = self.filter_class(u"^t", True, term=u"one")
+        self.assertEqual(list(term_filter([u"foo1", u"foo2"])), [])
@@ -5,9 +5,12 @@ from functools import wraps
 
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.test.proto_helpers import StringTransport
 from twisted.trial.unittest import SkipTest
+import txredis.exceptions
 
-from vumi.persist.txredis_manager import TxRedisManager
+from vumi.persist.txredis_manager import TxRedisManager, VumiRedis
+from vumi.persist.tests.test_fake_redis import INCR_AND_COPY_SCRIPT
 from vumi.tests.helpers import VumiTestCase
 
 
@@ -107,6 +110,69 @@ class TestTxRedisManager(VumiTestCase):
         ttl = yield manager.ttl("key-ttl")
         self.assertTrue(10 <= ttl <= 30)
 
+    @inlineCallbacks
+    def test_run_script(self):
+        manager = yield self.get_manager()
+        sub_manager = manager.sub_manager('sub')
+        yield sub_manager.set("counter", "3")
+        result = yield sub_manager.run_script(
+            INCR_AND_COPY_SCRIPT, ["counter", "copy"], [2])
+        self.assertEqual(result, [5, "5"])
+        self.assertEqual((yield manager.get("sub:copy")), "5")
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        manager = yield self.get_manager()
+        sub_manager = manager.sub_manager('sub')
+        pipe = sub_manager.pipeline()
+        pipe.set("foo", "1").incr("foo").get("foo").keys()
+        self.assertEqual(len(pipe), 4)
+        self.assertEqual((yield manager.keys()), [])
+        results = yield pipe.execute()
+        self.assertEqual(results, [True, 2, "2", ["foo"]])
+        self.assertEqual(len(pipe), 0)
+        self.assertEqual((yield manager.get("sub:foo")), "2")
+
+    @inlineCallbacks
+    def test_pipeline_empty(self):
+        manager = yield self.get_manager()
+        self.assertEqual((yield manager.pipeline().execute()), [])
+
+    @inlineCallbacks
+    def test_pipeline_run_script(self):
+        manager = yield self.get_manager()
+        pipe = manager.pipeline()
+        pipe.set("counter", "3")
+        pipe.run_script(INCR_AND_COPY_SCRIPT, ["counter", "copy"], [2])
+        results = yield pipe.execute()
+        self.assertEqual(results, [True, [5, "5"]])
+
+    @inlineCallbacks
+    def test_pipeline_error(self):
+        manager = yield self.get_manager()
+        pipe = manager.pipeline()
+        pipe.set("foo", "bar").rename("missing", "foo").set("baz", "quux")
+        yield self.assertFailure(pipe.execute(), manager.RESPONSE_ERROR)
+        # The calls after the failed one were still made.
+        self.assertEqual((yield manager.get("baz")), "quux")
+
+    def test_pipeline_unknown_call(self):
+        manager = TxRedisManager(None, {}, 'redistest', client_proxy=object())
+        self.assertRaises(
+            AttributeError, getattr, manager.pipeline(), 'get_key_prefix')
+        self.assertRaises(
+            AttributeError, getattr, manager.pipeline(), 'sub_manager')
+
+    @inlineCallbacks
+    def test_multi(self):
+        manager = yield self.get_manager()
+        pipe = manager.multi()
+        self.assertTrue(pipe.transaction)
+        pipe.sadd("set", "a", "b").smembers("set").delete("set")
+        results = yield pipe.execute()
+        self.assertEqual(results, [2, set(["a", "b"]), True])
+        self.assertEqual((yield manager.exists("set")), False)
+
     @skip_fake_redis
     @inlineCallbacks
     def test_reconnect_sub_managers(self):
@@ -133,3 +199,115 @@ class TestTxRedisManager(VumiTestCase):
         f2 = yield sub_manager.get("foo")
         f3 = yield sub_sub_manager.get("foo")
         self.assertEqual([f1, f2, f3], ["1", "2", "3"])
+
+
+class TestVumiRedisPipelines(VumiTestCase):
+    """
+    Tests for the pipelining in VumiRedis, using a fake transport so that we
+    can see exactly what is sent and control the replies.
+    """
+
+    def setUp(self):
+        self.transport = StringTransport()
+        self.client = VumiRedis()
+        self.client.makeConnection(self.transport)
+
+    def encode_command(self, *args):
+        args = [self.client._encode(arg) for arg in args]
+        return '*%s\r\n%s' % (len(args), ''.join(
+            '$%s\r\n%s\r\n' % (len(arg), arg) for arg in args))
+
+    def assert_sent(self, *commands):
+        expected = ''.join(
+            self.encode_command(*command) for command in commands)
+        self.assertEqual(self.transport.value(), expected)
+        self.transport.clear()
+
+    def test_pipeline(self):
+        d = self.client.execute_pipeline([
+            ('set', ('foo', 'bar'), {}),
+            ('get', ('foo',), {}),
+        ], False)
+        self.assert_sent(['SET', 'foo', 'bar'], ['GET', 'foo'])
+        self.assertNoResult(d)
+        self.client.dataReceived("+OK\r\n$3\r\nbar\r\n")
+        self.assertEqual(self.successResultOf(d), [True, 'bar'])
+
+    def test_pipeline_error(self):
+        d = self.client.execute_pipeline([
+            ('incr', ('foo',), {}),
+            ('get', ('foo',), {}),
+        ], False)
+        self.client.dataReceived("-ERR not an integer\r\n$3\r\nbar\r\n")
+        self.failureResultOf(d, txredis.exceptions.ResponseError)
+
+    def test_transaction(self):
+        d = self.client.execute_pipeline([
+            ('set', ('foo', '1'), {}),
+            ('incr', ('foo',), {}),
+            ('ttl', ('foo',), {}),
+        ], True)
+        self.assert_sent(
+            ['MULTI'], ['SET', 'foo', '1'], ['INCR', 'foo'], ['TTL', 'foo'],
+            ['EXEC'])
+        self.client.dataReceived("+OK\r\n" + "+QUEUED\r\n" * 3)
+        self.assertNoResult(d)
+        self.client.dataReceived("*3\r\n+OK\r\n:2\r\n:-1\r\n")
+        # Each call's usual result processing is applied.
+        self.assertEqual(self.successResultOf(d), [True, 2, None])
+
+    def test_transaction_error(self):
+        d = self.client.execute_pipeline([
+            ('incr', ('foo',), {}),
+            ('get', ('foo',), {}),
+        ], True)
+        self.client.dataReceived("+OK\r\n+QUEUED\r\n+QUEUED\r\n")
+        self.client.dataReceived(
+            "*2\r\n-ERR not an integer\r\n$3\r\nbar\r\n")
+        f = self.failureResultOf(d, txredis.exceptions.ResponseError)
+        self.assertEqual(str(f.value), "not an integer")
+        # The connection is still usable.
+        d = self.client.get('foo')
+        self.client.dataReceived("$3\r\nbar\r\n")
+        self.assertEqual(self.successResultOf(d), 'bar')
+
+    def test_transaction_aborted(self):
+        d = self.client.execute_pipeline([
+            ('incr', ('foo',), {}),
+        ], True)
+        self.client.dataReceived("+OK\r\n-ERR bad command\r\n")
+        self.client.dataReceived("-EXECABORT Transaction discarded\r\n")
+        self.failureResultOf(d, txredis.exceptions.ResponseError)
+
+    def test_transaction_run_script_sends_source(self):
+        self.client._loaded_scripts.add(INCR_AND_COPY_SCRIPT.sha)
+        d = self.client.execute_pipeline([
+            ('run_script', (INCR_AND_COPY_SCRIPT, ['a', 'b'], [1]), {}),
+        ], True)
+        self.assert_sent(
+            ['MULTI'], ['EVAL', INCR_AND_COPY_SCRIPT.lua, 2, 'a', 'b', 1],
+            ['EXEC'])
+        self.client.dataReceived("+OK\r\n+QUEUED\r\n*1\r\n:1\r\n")
+        self.assertEqual(self.successResultOf(d), [1])
+
+    def test_run_script_caches_sha(self):
+        script = INCR_AND_COPY_SCRIPT
+        d = self.client.run_script(script, ['a', 'b'], [1])
+        self.assert_sent(['EVAL', script.lua, 2, 'a', 'b', 1])
+        self.client.dataReceived(":1\r\n")
+        self.assertEqual(self.successResultOf(d), 1)
+
+        d = self.client.run_script(script, ['a', 'b'], [1])
+        self.assert_sent(['EVALSHA', script.sha, 2, 'a', 'b', 1])
+        self.client.dataReceived(":2\r\n")
+        self.assertEqual(self.successResultOf(d), 2)
+
+    def test_run_script_noscript(self):
+        script = INCR_AND_COPY_SCRIPT
+        self.client._loaded_scripts.add(script.sha)
+        d = self.client.run_script(script, ['a', 'b'], [1])
+        self.assert_sent(['EVALSHA', script.sha, 2, 'a', 'b', 1])
+        self.client.dataReceived("-NOSCRIPT No matching script.\r\n")
+        self.assert_sent(['EVAL', script.lua, 2, 'a', 'b', 1])
+        self.client.dataReceived(":1\r\n")
+        self.assertEqual(self.successResultOf(d), 1)
@@ -13,7 +13,8 @@ except ImportError:
 import txredis.exceptions
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, succeed, Deferred
+from twisted.internet.defer import (
+    inlineCallbacks, succeed, Deferred, DeferredList, maybeDeferred)
 
 from vumi.persist.redis_base import Manager
 from vumi.persist.fake_redis import (
@@ -37,6 +38,12 @@ class VumiRedis(txr.Redis):
         self.connected_d = Deferred()
         self._disconnected_d = Deferred()
         self._client_shutdown_called = False
+        # SHAs of the scripts we know the server has cached.
+        self._loaded_scripts = set()
+        # While we're queueing commands in a transaction, this holds the
+        # deferreds for the "QUEUED" replies and the placeholder deferreds
+        # for the real replies.
+        self._transaction = None
 
     def connectionMade(self):
         d = super(VumiRedis, self).connectionMade()
@@ -63,6 +70,19 @@ class VumiRedis(txr.Redis):
             d.addCallback(lambda _: self.quit())
         return d.addCallback(lambda _: self._disconnected_d)
 
+    def errorReceived(self, data):
+        # txredis doesn't expect errors inside multi-bulk replies, but an
+        # EXEC reply contains one for each command that failed.
+        if not self._multi_bulk_stack:
+            return super(VumiRedis, self).errorReceived(data)
+        if data[:4] == 'ERR ':
+            error = txredis.exceptions.ResponseError(data[4:])
+        elif data[:9] == 'NOSCRIPT ':
+            error = txredis.exceptions.NoScript(data[9:])
+        else:
+            error = txredis.exceptions.ResponseError(data)
+        self.handleMultiBulkElement(error)
+
     def _ok_to_true(self, r):
         """
         Some commands return 'OK', but we expect True.
@@ -122,17 +142,13 @@ class VumiRedis(txr.Redis):
                                  "values and scores")
         pieces = zip(args[::2], args[1::2])
         pieces.extend(kwargs.iteritems())
-        orig_zadd = super(VumiRedis, self).zadd
-        d = succeed(0)
-
-        def do_zadd(s, key, member, score):
-            d = orig_zadd(key, member, score)
-            d.addCallback(lambda r: r + s)
-            return d
-
+        # We send a single variadic ZADD (redis >= 2.4) rather than one
+        # command per member so that this works in pipelines.
+        command = ['ZADD', key]
         for member, score in pieces:
-            d.addCallback(do_zadd, key, member, score)
-        return d
+            command.extend([score, member])
+        self._send(*command)
+        return self.getResponse()
 
     def zrange(self, key, start, end, desc=False, withscores=False):
         return super(VumiRedis, self).zrange(key, start, end,
@@ -181,6 +197,18 @@ class VumiRedis(txr.Redis):
         d.addCallback(lambda r: (None if r < 0 else r))
         return d
 
+    # txredis doesn't implement this.
+    def pttl(self, key):
+        self._send('PTTL', key)
+        d = self.getResponse()
+        d.addCallback(lambda r: (None if r < 0 else r))
+        return d
+
+    # txredis doesn't implement this.
+    def pexpire(self, key, milliseconds):
+        self._send('PEXPIRE', key, milliseconds)
+        return self.getResponse()
+
     # txredis doesn't implement this.
     def persist(self, key):
         """
@@ -208,17 +236,129 @@ class VumiRedis(txr.Redis):
         return self.getResponse()
 
     # txredis doesn't implement this.
-    def pfcount(self, key):
+    def pfcount(self, key, *keys):
         """
         Return the approximate cardinality of the HyperLogLog at the given key.
+        If more than one key is given, the cardinality of the union of the
+        HyperLogLogs is returned.
 
         .. note::
 
            Requires redis server 2.8.9 or later.
         """
-        self._send('PFCOUNT', key)
+        self._send('PFCOUNT', key, *keys)
         return self.getResponse()
 
+    def run_script(self, script, keys, args):
+        """
+        Run a :class:`vumi.persist.redis_base.RedisScript`, loading it if the
+        server doesn't have it cached.
+
+        We remember which scripts we've loaded on this connection so that
+        we only send the script source the first time it is run. Inside a
+        transaction we always send the source, since there's no way to
+        recover from a missing script once ``EXEC`` has been sent.
+        """
+        def loaded_cb(r):
+            self._loaded_scripts.add(script.sha)
+            return r
+
+        def noscript_eb(f):
+            f.trap(txredis.exceptions.NoScript)
+            self._loaded_scripts.discard(script.sha)
+            return self.eval(script.lua, keys, args).addCallback(loaded_cb)
+
+        if self._transaction is not None:
+            return self.eval(script.lua, keys, args)
+        if script.sha not in self._loaded_scripts:
+            return self.eval(script.lua, keys, args).addCallback(loaded_cb)
+        d = self.evalsha(script.sha, keys, args)
+        return d.addErrback(noscript_eb)
+
+    # Pipelines
+
+    def execute_pipeline(self, calls, transaction):
+        """
+        Send a list of ``(call, args, kw)`` tuples without waiting for any
+        replies in between and return a deferred that fires with a list of
+        their results. If any of the calls fail, the deferred errbacks with
+        the first error once they have all completed.
+
+        If ``transaction`` is ``True``, the calls are wrapped in
+        ``MULTI``/``EXEC``.
+        """
+        if transaction:
+            return self._execute_transaction(calls)
+        return gather_results(
+            [getattr(self, call)(*args, **kw) for call, args, kw in calls])
+
+    def _execute_transaction(self, calls):
+        # Each command inside MULTI gets a "QUEUED" reply and the real
+        # replies arrive together in the reply to EXEC. To keep the result
+        # processing each method adds to its deferred, getResponse() gives
+        # each command a placeholder deferred in place of its usual response
+        # and we fire the placeholders with the EXEC reply.
+        queued = [self.multi()]
+        placeholders = []
+        self._transaction = (queued, placeholders)
+        ds = []
+        try:
+            for call, args, kw in calls:
+                expected = len(placeholders) + 1
+                ds.append(getattr(self, call)(*args, **kw))
+                if len(placeholders) != expected:
+                    raise ValueError(
+                        "%r can't be used in a transaction because it doesn't"
+                        " send exactly one command." % (call,))
+        except Exception:
+            self._transaction = None
+            queued.append(self.discard())
+            DeferredList(queued, consumeErrors=True)
+            raise
+        self._transaction = None
+
+        def fire_placeholders(replies):
+            for placeholder, reply in zip(placeholders, replies):
+                if isinstance(reply, Exception):
+                    placeholder.errback(reply)
+                else:
+                    placeholder.callback(reply)
+
+        def fail_placeholders(f):
+            for placeholder in placeholders:
+                placeholder.errback(f)
+
+        self.execute().addCallbacks(fire_placeholders, fail_placeholders)
+        # Errors queueing commands also cause EXEC to fail, so we don't need
+        # to report them separately.
+        DeferredList(queued, consumeErrors=True)
+        return gather_results(ds)
+
+    def getResponse(self):
+        d = super(VumiRedis, self).getResponse()
+        if self._transaction is None:
+            return d
+        queued, placeholders = self._transaction
+        queued.append(d)
+        placeholder = Deferred()
+        placeholders.append(placeholder)
+        return placeholder
+
+
+def gather_results(ds):
+    """
+    Return a deferred that fires with a list of the results of ``ds`` once
+    they have all fired, or errbacks with the first failure if any of them
+    failed.
+    """
+    def check_results(results):
+        for success, result in results:
+            if not success:
+                return result
+        return [result for _, result in results]
+
+    return DeferredList(ds, consumeErrors=True).addCallback(check_results)
+
 
 class VumiRedisClientFactory(txr.RedisClientFactory):
     protocol = VumiRedis
@@ -333,3 +473,6 @@ class TxRedisManager(Manager):
         """Filter results of a redis call.
         """
         return results.addCallback(func)
+
+    def _pipeline_result(self, results, func, *args):
+        return maybeDeferred(lambda: results).addCallback(func, *args)
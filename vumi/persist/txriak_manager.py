@@ -9,8 +9,8 @@ from twisted.internet.defer import (
 
 from vumi.persist.model import Manager, VumiRiakError
 from vumi.persist.riak_base import (
-    VumiRiakClientBase, VumiIndexPageBase, VumiRiakBucketBase,
-    VumiRiakObjectBase)
+    VumiRiakClientBase, VumiIndexPageBase, VumiIndexStreamBase,
+    VumiRiakBucketBase, VumiRiakObjectBase)
 
 
 def riakErrorHandler(failure):
@@ -44,11 +44,56 @@ class VumiTxIndexPage(VumiIndexPageBase):
         if not self.has_next_page():
             return succeed(None)
         d = deferToThread(self._index_page.next_page)
-        d.addCallback(type(self))
+        d.addCallback(self._wrap_next_page)
         d.addErrback(riakErrorHandler)
         return d
 
 
+class VumiTxIndexStream(VumiIndexStreamBase):
+    """
+    Stream of index query results that spans multiple pages.
+
+    As soon as a page is delivered, the request for the following page is
+    made so that it is fetched while the current page is being processed.
+    """
+
+    def __init__(self, fetch_first_page):
+        super(VumiTxIndexStream, self).__init__(fetch_first_page)
+        self._next_page_d = None
+
+    def close(self):
+        super(VumiTxIndexStream, self).close()
+        if self._next_page_d is not None:
+            # Nobody is going to consume the prefetched page, so we need to
+            # make sure any errors it produces don't get logged as unhandled.
+            self._next_page_d.addErrback(lambda f: None)
+            self._next_page_d = None
+
+    def _page_received(self, page):
+        if page is None or self._finished:
+            self.close()
+            return None
+        if page.has_next_page():
+            self._next_page_d = page.next_page()
+        else:
+            self._finished = True
+        return list(page)
+
+    # Methods that touch the network.
+
+    def next_batch(self):
+        if not self._started:
+            self._started = True
+            d = maybeDeferred(self._fetch_first_page)
+        elif self._next_page_d is not None:
+            d, self._next_page_d = self._next_page_d, None
+        else:
+            self.close()
+            return succeed(None)
+        d.addCallback(self._page_received)
+        return d
+
+
 class VumiTxRiakBucket(VumiRiakBucketBase):
     """
     Wrapper around a RiakBucket to manage network access better.
@@ -64,12 +109,13 @@ class VumiTxRiakBucket(VumiRiakBucketBase):
         return d
 
     def get_index_page(self, index_name, start_value, end_value=None,
-                       return_terms=None, max_results=None, continuation=None):
+                       return_terms=None, max_results=None, continuation=None,
+                       term_regex=None):
         d = deferToThread(
-            self._riak_bucket.get_index, index_name, start_value, end_value,
+            self._get_index_page_raw, index_name, start_value, end_value,
             return_terms=return_terms, max_results=max_results,
-            continuation=continuation)
-        d.addCallback(VumiTxIndexPage)
+            continuation=continuation, term_regex=term_regex)
+        d.addCallback(lambda r: VumiTxIndexPage(*r))
         d.addErrback(riakErrorHandler)
         return d
 
@@ -194,6 +240,9 @@ class TxRiakManager(Manager):
         d.addCallback(lambda objs: [obj for obj in objs if obj is not None])
         return d
 
+    def _wrap_index_stream(self, fetch_first_page):
+        return VumiTxIndexStream(fetch_first_page)
+
     def riak_map_reduce(self):
         mapreduce = RiakMapReduce(self.client)
         # Hack: We replace the two methods that hit the network with
@@ -7,6 +7,8 @@ import re
 import time
 import calendar
 import copy
+import gzip
+import zlib
 from datetime import datetime
 
 import yaml
@@ -16,11 +18,76 @@ from vumi.persist.redis_manager import RedisManager
 from vumi.errors import ConfigError
 
 
+GZIP_MAGIC = "\x1f\x8b"
+
+
 def vumi_version():
     vumi = pkg_resources.get_distribution("vumi")
     return str(vumi)
 
 
+def scan_keys(redis, count=None):
+    """
+    Iterate over all keys using ``SCAN`` so that Redis isn't blocked and the
+    key names don't all have to be held in memory.
+    """
+    prev_cursor = None
+    while True:
+        cursor, keys = redis.scan(prev_cursor, count=count)
+        for key in keys:
+            yield key
+        if cursor is None:
+            break
+        if cursor == prev_cursor:
+            raise RuntimeError("Redis scan stuck on cursor %r" % (cursor,))
+        prev_cursor = cursor
+
+
+def batched(items, size):
+    """
+    Group an iterable into lists of at most ``size`` items.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def key_shard(key, shards):
+    """
+    Return the shard (between ``0`` and ``shards - 1``) a key belongs to.
+    """
+    return (zlib.crc32(key) & 0xffffffff) % shards
+
+
+def parse_shard(shard):
+    """
+    Parse a shard description of the form ``<shard>/<shards>``.
+    """
+    shard, _, shards = shard.partition("/")
+    shard, shards = int(shard), int(shards)
+    if not 0 <= shard < shards:
+        raise ValueError("Shard must be between 0 and %d." % (shards - 1,))
+    return shard, shards
+
+
+def open_backup(filename):
+    """
+    Open a backup for reading, decompressing it if it was written with
+    ``--compress``.
+    """
+    backup = open(filename, "rb")
+    magic = backup.read(len(GZIP_MAGIC))
+    backup.seek(0)
+    if magic == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=backup, mode="rb")
+    return backup
+
+
 class KeyHandler(object):
 
     REDIS_TYPES = ('string', 'list', 'set', 'zset', 'hash')
@@ -31,25 +98,56 @@ class KeyHandler(object):
         self._set_handlers = dict((ktype, getattr(self, '%s_set' % ktype))
                                   for ktype in self.REDIS_TYPES)
 
-    def dump_key(self, redis, key):
-        key_type = redis.type(key)
-        record = {
-            'type': key_type,
-            'key': key,
-            'value': self._get_handlers[key_type](redis, key),
-            'ttl': redis.ttl(key),
-        }
-        return record
+    def dump_keys(self, redis, keys):
+        """
+        Return backup records for a batch of keys. This takes two pipelined
+        round trips, one to fetch the types and TTLs of the keys and one to
+        fetch their values. Keys that disappear while they're being dumped
+        are skipped.
+        """
+        pipe = redis.pipeline()
+        for key in keys:
+            pipe.type(key).pttl(key)
+        metadata = pipe.execute()
+
+        dumped = []
+        for key, key_type, pttl in zip(keys, metadata[::2], metadata[1::2]):
+            if key_type in self._get_handlers:
+                self._get_handlers[key_type](pipe, key)
+                dumped.append((key, key_type, pttl))
+        values = pipe.execute()
+
+        records = []
+        for (key, key_type, pttl), value in zip(dumped, values):
+            if value is None or (key_type != 'string' and not value):
+                # Redis doesn't store empty containers, so the key has
+                # expired or been deleted since we looked up its type.
+                continue
+            if key_type == 'set':
+                value = sorted(value)
+            records.append({
+                'type': key_type,
+                'key': key,
+                'value': value,
+                'ttl': pttl / 1000.0 if pttl is not None else None,
+            })
+        return records
 
     def restore_key(self, redis, record, ttl_offset=0):
+        """
+        Restore a key from a backup record. ``redis`` may be a pipeline.
+        Returns ``False`` if the key has expired and was not restored.
+        """
         key, key_type, ttl = record['key'], record['type'], record['ttl']
         if ttl is not None:
             ttl -= ttl_offset
             if ttl <= 0:
-                return
+                return False
+        redis.delete(key)
         self._set_handlers[key_type](redis, key, record['value'])
         if ttl is not None:
-            redis.expire(key, int(round(ttl)))
+            redis.pexpire(key, max(1, int(round(ttl * 1000))))
+        return True
 
     def record_okay(self, record):
         if not isinstance(record, dict):
@@ -73,18 +171,19 @@ class KeyHandler(object):
             redis.rpush(key, item)
 
     def set_get(self, redis, key):
-        return sorted(redis.smembers(key))
+        return redis.smembers(key)
 
     def set_set(self, redis, key, value):
-        for item in value:
-            redis.sadd(key, item)
+        if value:
+            redis.sadd(key, *value)
 
     def zset_get(self, redis, key):
         return redis.zrange(key, 0, -1, withscores=True)
 
     def zset_set(self, redis, key, value):
-        for item, score in value:
-            redis.zadd(key, **{item.encode('utf8'): score})
+        if value:
+            redis.zadd(key, **dict(
+                (item.encode('utf8'), score) for item, score in value))
 
     def hash_get(self, redis, key):
         return redis.hgetall(key)
@@ -98,16 +197,34 @@ class BackupDbsCmd(usage.Options):
     synopsis = "<db-config.yaml> <db-backup-output.json>"
 
     optFlags = [
-        ["not-sorted", None, "Don't sort keys when doing backup."],
+        ["not-sorted", None, "Don't sort keys when doing backup. Unsorted "
+                             "backups stream keys from Redis without "
+                             "holding all the key names in memory."],
+        ["compress", "z", "Compress the backup with gzip."],
+    ]
+
+    optParameters = [
+        ["batch-size", "b", 1000,
+         "The number of keys to fetch from Redis in each round trip.", int],
+        ["shard", None, None,
+         "Only back up a slice of the key space, given as <shard>/<shards> "
+         "(e.g. 0/4). Run one backup process for each shard to back up a "
+         "large database in parallel.", parse_shard],
     ]
 
     def parseArgs(self, db_config, db_backup):
         self.db_config = yaml.safe_load(open(db_config))
-        self.db_backup = open(db_backup, "wb")
+        self.db_backup_name = db_backup
         self.redis_config = self.db_config.get('redis_manager', {})
 
+    def postOptions(self):
+        self.db_backup = open(self.db_backup_name, "wb")
+        if self['compress']:
+            self.db_backup = gzip.GzipFile(
+                fileobj=self.db_backup, mode="wb")
+
     def header(self, cfg):
-        return {
+        header = {
             'vumi_version': vumi_version(),
             'format': 'LF separated JSON',
             'backup_type': 'redis',
@@ -115,24 +232,36 @@ class BackupDbsCmd(usage.Options):
             'sorted': not bool(self['not-sorted']),
             'redis_config': self.redis_config,
         }
+        if self['shard'] is not None:
+            header['shard'] = "%d/%d" % self['shard']
+        return header
 
     def write_line(self, data):
         self.db_backup.write(json.dumps(data))
         self.db_backup.write("\n")
 
+    def keys(self, redis):
+        keys = scan_keys(redis, self['batch-size'])
+        if self['shard'] is not None:
+            shard, shards = self['shard']
+            keys = (key for key in keys if key_shard(key, shards) == shard)
+        if not self['not-sorted']:
+            # SCAN may return a key more than once.
+            keys = sorted(set(keys))
+        return keys
+
     def run(self, cfg):
         cfg.emit("Backing up dbs ...")
         redis = cfg.get_redis(self.redis_config)
         key_handler = KeyHandler()
-        keys = redis.keys()
-        if not self.opts['not-sorted']:
-            keys = sorted(keys)
         self.write_line(self.header(cfg))
-        for key in keys:
-            record = key_handler.dump_key(redis, key)
-            self.write_line(record)
+        count = 0
+        for keys in batched(self.keys(redis), self['batch-size']):
+            for record in key_handler.dump_keys(redis, keys):
+                self.write_line(record)
+                count += 1
         self.db_backup.close()
-        cfg.emit("Backed up %d keys." % (len(keys),))
+        cfg.emit("Backed up %d keys." % (count,))
 
 
 class RestoreDbsCmd(usage.Options):
@@ -150,9 +279,14 @@ class RestoreDbsCmd(usage.Options):
                               "keys whose TTLs are then zero or negative."],
     ]
 
+    optParameters = [
+        ["batch-size", "b", 1000,
+         "The number of keys to send to Redis in each round trip.", int],
+    ]
+
     def parseArgs(self, db_config, db_backup):
         self.db_config = yaml.safe_load(open(db_config))
-        self.db_backup = open(db_backup, "rb")
+        self.db_backup = open_backup(db_backup)
         self.redis_config = self.db_config.get('redis_manager', {})
 
     def check_header(self, header):
@@ -198,7 +332,8 @@ class RestoreDbsCmd(usage.Options):
         if self.opts['purge']:
             redis._purge_all()
         key_handler = KeyHandler()
-        keys, skipped = 0, 0
+        pipe = redis.pipeline()
+        keys, skipped, batch = 0, 0, 0
         for i, line in enumerate(line_iter):
             try:
                 record = json.loads(line)
@@ -212,8 +347,13 @@ class RestoreDbsCmd(usage.Options):
                 cfg.emit("Skipping bad backup record on line %d." % (i + 1,))
                 skipped += 1
                 continue
-            key_handler.restore_key(redis, record, ttl_offset)
+            key_handler.restore_key(pipe, record, ttl_offset)
             keys += 1
+            batch += 1
+            if batch >= self['batch-size']:
+                pipe.execute()
+                batch = 0
+        pipe.execute()
 
         cfg.emit("%d keys successfully restored." % keys)
         if skipped != 0:
@@ -227,7 +367,7 @@ class MigrateDbsCmd(usage.Options):
 
     def parseArgs(self, migration_config, db_backup, migrated_backup):
         self.migration_config = yaml.safe_load(open(migration_config))
-        self.db_backup = open(db_backup, "rb")
+        self.db_backup = open_backup(db_backup)
         self.migrated_backup = open(migrated_backup, "wb")
 
     def postOptions(self):
@@ -358,7 +498,7 @@ class AnalyzeCmd(usage.Options):
     ]
 
     def parseArgs(self, db_backup):
-        self.db_backup = open(db_backup, "rb")
+        self.db_backup = open_backup(db_backup)
 
     def run(self, cfg):
         backup_lines = iter(self.db_backup)
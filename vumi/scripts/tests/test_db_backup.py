@@ -1,9 +1,11 @@
 """Tests for vumi.scripts.db_backup."""
 
+import gzip
 import json
 import datetime
 
 import yaml
+from twisted.python.usage import UsageError
 
 from vumi.scripts.db_backup import ConfigHolder, Options, vumi_version
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
@@ -146,6 +148,67 @@ class TestBackupDbCmd(DbBackupBaseTestCase):
             self.assertEqual(record, {'key': 's', 'type': 'string',
                                       'value': "foo"})
 
+    def test_backup_batches(self):
+        for i in range(5):
+            self.redis.set("bar:s%d" % (i,), str(i))
+        self.redis.rpush("bar:l", "a")
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--batch-size", "2",
+                             self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        self.assertEqual(cfg.output[-1], 'Backed up 6 keys.')
+        with open(db_backup) as backup:
+            records = [json.loads(x) for x in backup][1:]
+        self.assertEqual([r['key'] for r in records],
+                         ['l'] + ['s%d' % (i,) for i in range(5)])
+
+    def test_backup_not_sorted(self):
+        for i in range(5):
+            self.redis.set("bar:s%d" % (i,), str(i))
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--not-sorted", "--batch-size", "2",
+                             self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        with open(db_backup) as backup:
+            records = [json.loads(x) for x in backup]
+        self.assertEqual(records[0]['sorted'], False)
+        self.assertEqual(sorted(r['key'] for r in records[1:]),
+                         ['s%d' % (i,) for i in range(5)])
+
+    def test_backup_compressed(self):
+        self.redis.set("bar:s", "foo")
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--compress",
+                             self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        backup = gzip.open(db_backup)
+        self.assertEqual([json.loads(x) for x in backup][1:], [
+            {'key': 's', 'type': 'string', 'value': "foo", 'ttl': None},
+        ])
+
+    def test_backup_shards(self):
+        keys = ["s%d" % (i,) for i in range(20)]
+        for key in keys:
+            self.redis.set("bar:%s" % (key,), "foo")
+        backed_up = []
+        for shard in range(3):
+            db_backup = self.mktemp()
+            cfg = self.make_cfg(["backup", "--shard", "%d/3" % (shard,),
+                                 self.mkdbconfig("bar"), db_backup])
+            cfg.run()
+            with open(db_backup) as backup:
+                records = [json.loads(x) for x in backup]
+            self.assertEqual(records[0]['shard'], "%d/3" % (shard,))
+            self.assertTrue(len(records) < 21)
+            backed_up.extend(r['key'] for r in records[1:])
+        self.assertEqual(sorted(backed_up), sorted(keys))
+
+    def test_backup_bad_shard(self):
+        self.assertRaises(
+            UsageError, self.make_cfg,
+            ["backup", "--shard", "3/3", self.mkdbconfig("bar"),
+             self.mktemp()])
+
 
 class TestRestoreDbCmd(DbBackupBaseTestCase):
 
@@ -282,6 +345,42 @@ class TestRestoreDbCmd(DbBackupBaseTestCase):
                            args=["--frozen-ttls"], key_prefix="bar")
         self.assertTrue(0 < self.redis.ttl("bar:s") <= 30)
 
+    def test_restore_batches(self):
+        records = [{'key': 's%d' % (i,), 'type': 'string', 'value': str(i),
+                    'ttl': None} for i in range(5)]
+        self.check_restore(records,
+                           dict(('s%d' % (i,), str(i)) for i in range(5)),
+                           self.redis.get, args=["--batch-size", "2"])
+
+    def test_restore_replaces_existing_keys(self):
+        self.redis.rpush("bar:l", "old")
+        self.check_restore([{'key': 'l', 'type': 'list', 'value': ['a'],
+                             'ttl': None}],
+                           {'l': ['a']},
+                           lambda k: self.redis.lrange(k, 0, -1))
+
+    def test_restore_expired_ttl(self):
+        yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        self.check_restore([{'key': 's', 'type': 'string', 'value': 'ping',
+                             'ttl': 30}],
+                           {}, self.redis.get, timestamp=yesterday)
+
+    def test_restore_compressed(self):
+        header = {'backup_type': 'redis',
+                  'timestamp': datetime.datetime.utcnow().isoformat()}
+        record = {'key': 's', 'type': 'string', 'value': 'ping', 'ttl': None}
+        db_backup = self.mktemp()
+        backup = gzip.open(db_backup, "wb")
+        backup.write("\n".join(json.dumps(x) for x in [header, record]))
+        backup.close()
+        cfg = self.make_cfg(["restore", self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        self.assertEqual(cfg.output, [
+            'Restoring dbs ...',
+            '1 keys successfully restored.',
+        ])
+        self.assertEqual(self.redis.get("bar:s"), "ping")
+
 
 class TestMigrateDbCmd(DbBackupBaseTestCase):
 
@@ -0,0 +1,153 @@
+"""Tests for vumi.scripts.vumi_export_messages."""
+
+import sys
+from datetime import datetime, timedelta
+from uuid import uuid4
+from StringIO import StringIO
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.python import usage
+
+from vumi.components.message_archive import MessageArchiveReader
+from vumi.components.message_store import MessageStore
+from vumi.scripts.vumi_export_messages import MessageExporter, Options, main
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper, MessageHelper
+
+
+class StubbedMessageExporter(MessageExporter):
+    def __init__(self, testcase, *args, **kwargs):
+        self.testcase = testcase
+        self.output = []
+        self.archive = StringIO()
+        self.archive.close = lambda: None
+        super(StubbedMessageExporter, self).__init__(*args, **kwargs)
+
+    def emit(self, s):
+        self.output.append(s)
+
+    def get_riak_manager(self, riak_config):
+        return self.testcase.get_riak_manager(riak_config)
+
+    def open_output(self):
+        return self.archive
+
+
+class TestMessageExporter(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(
+            PersistenceHelper(use_riak=True, is_sync=False))
+        self.msg_helper = self.add_helper(MessageHelper())
+        # Since we're never loading the actual objects, we can't detect
+        # tombstones. Therefore, each test needs its own bucket prefix.
+        self.expected_bucket_prefix = "bucket-%s" % (uuid4().hex,)
+        self.riak_manager = self.persistence_helper.get_riak_manager({
+            "bucket_prefix": self.expected_bucket_prefix,
+        })
+        self.add_cleanup(self.riak_manager.close_manager)
+        self.redis_manager = yield self.persistence_helper.get_redis_manager()
+        self.mdb = MessageStore(self.riak_manager, self.redis_manager)
+        self.default_args = [
+            "-b", self.expected_bucket_prefix,
+            "--output", "archive.out",
+        ]
+
+    def make_exporter(self, args=None, batch=None, chunk_size=None,
+                      index_page_size=None):
+        if args is None:
+            args = self.default_args
+        if batch is not None:
+            args.extend(["--batch", batch])
+        if chunk_size is not None:
+            args.extend(["--chunk-size", str(chunk_size)])
+        if index_page_size is not None:
+            args.extend(["--index-page-size", str(index_page_size)])
+        options = Options()
+        options.parseOptions(args)
+        return StubbedMessageExporter(self, options)
+
+    def get_riak_manager(self, config):
+        self.assertEqual(config["bucket_prefix"], self.expected_bucket_prefix)
+        return self.persistence_helper.get_riak_manager(config)
+
+    @inlineCallbacks
+    def make_messages(self, batch_id, count):
+        start = datetime.utcnow() - timedelta(seconds=count * 2)
+        inbound, outbound, events = [], [], []
+        for i in range(count):
+            timestamp = start + timedelta(seconds=i)
+            msg = self.msg_helper.make_inbound("in", timestamp=timestamp)
+            yield self.mdb.add_inbound_message(msg, batch_id=batch_id)
+            inbound.append(msg)
+            msg = self.msg_helper.make_outbound("out", timestamp=timestamp)
+            yield self.mdb.add_outbound_message(msg, batch_id=batch_id)
+            outbound.append(msg)
+            ack = self.msg_helper.make_ack(msg, timestamp=timestamp)
+            yield self.mdb.add_event(ack, batch_ids=[batch_id])
+            events.append(ack)
+        # Events are exported newest first.
+        events.reverse()
+        returnValue((inbound, outbound, events))
+
+    def read_archive(self, data):
+        reader = MessageArchiveReader(StringIO(data))
+        messages = {"inbound": [], "outbound": [], "event": []}
+        for direction, msg in reader.iter_messages():
+            messages[direction].append(msg)
+        return reader, messages
+
+    def test_batch_required(self):
+        self.assertRaises(usage.UsageError, self.make_exporter, [
+            "-b", self.expected_bucket_prefix,
+            "--output", "archive.out",
+        ])
+
+    def test_bucket_required(self):
+        self.assertRaises(usage.UsageError, self.make_exporter, [
+            "--batch", "gingercookies",
+            "--output", "archive.out",
+        ])
+
+    def test_output_required(self):
+        self.assertRaises(usage.UsageError, self.make_exporter, [
+            "--batch", "gingercookies",
+            "-b", self.expected_bucket_prefix,
+        ])
+
+    @inlineCallbacks
+    def test_main(self):
+        """
+        The exporter runs via `main()`.
+        """
+        inbound, outbound, events = yield self.make_messages(
+            "gingercookies", 1)
+        output_path = self.mktemp()
+        self.patch(sys, "stdout", StringIO())
+        yield main(
+            None, "name",
+            "--batch", "gingercookies",
+            "--output", output_path,
+            "-b", self.riak_manager.bucket_prefix)
+        data = open(output_path, "rb").read()
+        self.assertEqual(
+            sys.stdout.getvalue(),
+            "Exported 3 messages in 3 chunks (%d bytes).\n" % (len(data),))
+        _, messages = self.read_archive(data)
+        self.assertEqual(messages, {
+            "inbound": inbound, "outbound": outbound, "event": events})
+
+    @inlineCallbacks
+    def test_export(self):
+        """
+        All messages and events in the batch are exported in timestamp order.
+        """
+        inbound, outbound, events = yield self.make_messages(
+            "gingercookies", 5)
+        exporter = self.make_exporter(
+            batch="gingercookies", chunk_size=2, index_page_size=3)
+        yield exporter.run()
+        reader, messages = self.read_archive(exporter.archive.getvalue())
+        self.assertEqual(messages, {
+            "inbound": inbound, "outbound": outbound, "event": events})
+        self.assertEqual(len(reader.chunks), 9)
@@ -0,0 +1,110 @@
+"""Tests for vumi.scripts.vumi_failures."""
+
+import yaml
+
+from twisted.python.usage import UsageError
+
+from vumi.scripts.vumi_failures import ConfigHolder, Options
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+
+class TestConfigHolder(ConfigHolder):
+    def __init__(self, *args, **kwargs):
+        self.output = []
+        super(TestConfigHolder, self).__init__(*args, **kwargs)
+
+    def emit(self, s):
+        self.output.append(s)
+
+
+class TestVumiFailures(VumiTestCase):
+    def setUp(self):
+        self.persistence_helper = self.add_helper(
+            PersistenceHelper(is_sync=True))
+        self.config_file = self.mktemp()
+        redis_config = self.persistence_helper.mk_config({})['redis_manager']
+        with open(self.config_file, "wb") as config_file:
+            config_file.write(yaml.safe_dump({
+                'transport_name': 'sphex',
+                'redis_manager': redis_config,
+            }))
+
+    def make_cfg(self, args):
+        options = Options()
+        options.parseOptions(["--config", self.config_file] + args)
+        return TestConfigHolder(options)
+
+    def store_dead_letter(self, cfg, key, reason):
+        cfg.redis.hmset(key, {
+            "message": "{}", "reason": reason, "retry_delay": "0"})
+        cfg.dead_letters.add(key)
+
+    def test_no_config(self):
+        exc = self.assertRaises(
+            UsageError, Options().parseOptions, ["stats"])
+        self.assertEqual(str(exc), "Please specify a config file.")
+
+    def test_no_sub_command(self):
+        exc = self.assertRaises(
+            UsageError, Options().parseOptions, ["-c", self.config_file])
+        self.assertEqual(str(exc), "Please specify a sub-command.")
+
+    def test_stats(self):
+        cfg = self.make_cfg(["stats"])
+        self.store_dead_letter(cfg, "failure.1", "reason")
+        cfg.retry_queue.add("failure.2", 0)
+        cfg.redis.hincrby("failure_counts", "permanent", 3)
+        cfg.redis.hincrby("failure_counts", "temporary", 1)
+        cfg.run()
+        self.assertEqual(cfg.output, [
+            "Dead letters: 1",
+            "Pending retries: 1",
+            "Failures received:",
+            "  permanent: 3",
+            "  temporary: 1",
+        ])
+
+    def test_stats_empty(self):
+        cfg = self.make_cfg(["stats"])
+        cfg.run()
+        self.assertEqual(cfg.output, [
+            "Dead letters: 0",
+            "Pending retries: 0",
+            "Failures received:",
+            "  -- None --",
+        ])
+
+    def test_list_dead_letters(self):
+        cfg = self.make_cfg(["list-dead-letters", "--limit", "2"])
+        for i in range(3):
+            self.store_dead_letter(cfg, "failure.%d" % (i,), "reason %d" % i)
+        cfg.run()
+        self.assertEqual(cfg.output, [
+            "failure.0: reason 0",
+            "failure.1: reason 1",
+        ])
+
+    def test_requeue(self):
+        cfg = self.make_cfg(["requeue"])
+        for i in range(3):
+            self.store_dead_letter(cfg, "failure.%d" % (i,), "reason")
+        cfg.run()
+        self.assertEqual(cfg.output, [
+            "Requeuing dead letters ...",
+            "  Requeued 3 dead letter(s).",
+            "  Done.",
+        ])
+        self.assertEqual(cfg.dead_letters.count(), 0)
+        self.assertEqual(
+            cfg.retry_queue.get_job_ids(),
+            ["failure.0", "failure.1", "failure.2"])
+
+    def test_requeue_limit(self):
+        cfg = self.make_cfg(["requeue", "-l", "1"])
+        for i in range(3):
+            self.store_dead_letter(cfg, "failure.%d" % (i,), "reason")
+        cfg.run()
+        self.assertEqual(cfg.output[1], "  Requeued 1 dead letter(s).")
+        self.assertEqual(
+            cfg.dead_letters.keys(), ["failure.1", "failure.2"])
+        self.assertEqual(cfg.retry_queue.get_job_ids(), ["failure.0"])
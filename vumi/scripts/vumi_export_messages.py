@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- test-case-name: vumi.scripts.tests.test_vumi_export_messages -*-
+
+import sys
+
+from twisted.internet.defer import (
+    inlineCallbacks, gatherResults, DeferredSemaphore)
+from twisted.internet.task import react
+from twisted.python import usage
+
+from vumi.components.message_archive import MessageArchiveWriter
+from vumi.components.message_store import MessageStore
+from vumi.persist.txriak_manager import TxRiakManager
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["batch", None, None,
+         "Batch identifier to export messages for."],
+        ["bucket-prefix", "b", None,
+         "The bucket prefix for the Riak manager."],
+        ["output", "o", None,
+         "File to write the archive to."],
+        ["chunk-size", None, "1000",
+         "The maximum number of messages in each compressed chunk."],
+        ["concurrency", None, "10",
+         "The maximum number of messages to fetch at the same time."],
+        ["index-page-size", None, "1000",
+         "The number of keys to fetch in each index query."],
+    ]
+
+    longdesc = """
+    Message store exporter. The inbound messages, outbound messages and events
+    for a batch are written to a compressed archive with an index of chunk
+    timestamps. See vumi.components.message_archive for details of the format.
+    """
+
+    def postOptions(self):
+        if self["batch"] is None:
+            raise usage.UsageError("Please specify a batch.")
+        if self["bucket-prefix"] is None:
+            raise usage.UsageError("Please specify a bucket prefix.")
+        if self["output"] is None:
+            raise usage.UsageError("Please specify an output file.")
+        self["chunk-size"] = int(self["chunk-size"])
+        self["concurrency"] = int(self["concurrency"])
+        self["index-page-size"] = int(self["index-page-size"])
+
+
+class MessageExporter(object):
+    def __init__(self, options):
+        self.options = options
+        riak_config = {
+            'bucket_prefix': options['bucket-prefix'],
+        }
+        self.manager = self.get_riak_manager(riak_config)
+        self.mdb = MessageStore(self.manager, None)
+
+    def cleanup(self):
+        return self.manager.close_manager()
+
+    def get_riak_manager(self, riak_config):
+        return TxRiakManager.from_config(riak_config)
+
+    def open_output(self):
+        return open(self.options["output"], "wb")
+
+    def emit(self, s):
+        print s
+
+    def get_exports(self):
+        """
+        Return ``(direction, keys_page_func, get_message_func)`` for each
+        direction to export. Keys are fetched in timestamp order so that the
+        chunks in the archive cover mostly disjoint time ranges.
+        """
+        page_size = self.options["index-page-size"]
+
+        def inbound_keys(batch_id):
+            return self.mdb.batch_inbound_keys_with_timestamps(
+                batch_id, max_results=page_size, with_timestamps=False)
+
+        def outbound_keys(batch_id):
+            return self.mdb.batch_outbound_keys_with_timestamps(
+                batch_id, max_results=page_size, with_timestamps=False)
+
+        def event_keys(batch_id):
+            return self.mdb.batch_event_keys_with_statuses_reverse(
+                batch_id, max_results=page_size)
+
+        def get_event(event_index):
+            event_id, _, _ = event_index
+            return self.mdb.get_event(event_id)
+
+        return [
+            ("inbound", inbound_keys, self.mdb.get_inbound_message),
+            ("outbound", outbound_keys, self.mdb.get_outbound_message),
+            ("event", event_keys, get_event),
+        ]
+
+    @inlineCallbacks
+    def export_pages(self, writer, direction, index_page, get_message):
+        semaphore = DeferredSemaphore(self.options["concurrency"])
+        while index_page is not None:
+            next_page_d = index_page.next_page()
+            messages = yield gatherResults([
+                semaphore.run(get_message, key) for key in index_page])
+            for message in messages:
+                if message is not None:
+                    writer.add_message(direction, message)
+            index_page = yield next_page_d
+
+    @inlineCallbacks
+    def _run(self):
+        output = self.open_output()
+        try:
+            writer = MessageArchiveWriter(
+                output, chunk_size=self.options["chunk-size"])
+            for direction, keys_func, get_message in self.get_exports():
+                index_page = yield keys_func(self.options["batch"])
+                yield self.export_pages(
+                    writer, direction, index_page, get_message)
+            writer.close()
+        finally:
+            output.close()
+        self.emit("Exported %d messages in %d chunks (%d bytes)." % (
+            writer.rows, len(writer.chunks), writer.offset))
+
+    @inlineCallbacks
+    def run(self):
+        try:
+            yield self._run()
+        finally:
+            yield self.cleanup()
+
+
+def main(_reactor, name, *args):
+    try:
+        options = Options()
+        options.parseOptions(args)
+    except usage.UsageError, errortext:
+        print '%s: %s' % (name, errortext)
+        print '%s: Try --help for usage details.' % (name,)
+        sys.exit(1)
+
+    exporter = MessageExporter(options)
+    return exporter.run()
+
+
+if __name__ == '__main__':
+    react(main, sys.argv)
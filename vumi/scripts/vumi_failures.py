@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- test-case-name: vumi.scripts.tests.test_vumi_failures -*-
+import sys
+
+import yaml
+from twisted.python import usage
+
+from vumi.components.delayed_jobs import DelayedJobQueue
+from vumi.persist.redis_manager import RedisManager
+from vumi.transports.failures import (
+    DeadLetterStore, RETRY_QUEUE_NAME, failures_redis)
+
+
+class LimitSubCmd(usage.Options):
+
+    optParameters = [
+        ["limit", "l", None,
+         "The maximum number of dead letters to process (oldest first).",
+         int],
+    ]
+
+
+class StatsCmd(usage.Options):
+    def run(self, cfg):
+        cfg.emit("Dead letters: %d" % (cfg.dead_letters.count(),))
+        cfg.emit("Pending retries: %d" % (cfg.retry_queue.count(),))
+        counts = cfg.redis.hgetall("failure_counts")
+        cfg.emit("Failures received:")
+        for failure_code in sorted(counts):
+            cfg.emit("  %s: %s" % (failure_code, counts[failure_code]))
+        if not counts:
+            cfg.emit("  -- None --")
+
+
+class ListDeadLettersCmd(LimitSubCmd):
+    def run(self, cfg):
+        limit = self['limit']
+        stop = -1 if limit is None else limit - 1
+        for failure_key in cfg.dead_letters.keys(0, stop):
+            reason = cfg.redis.hget(failure_key, "reason")
+            cfg.emit("%s: %s" % (failure_key, reason))
+
+
+class RequeueCmd(LimitSubCmd):
+    def run(self, cfg):
+        cfg.emit("Requeuing dead letters ...")
+        requeued = cfg.dead_letters.requeue(cfg.retry_queue, self['limit'])
+        cfg.emit("  Requeued %d dead letter(s)." % (len(requeued),))
+        cfg.emit("  Done.")
+
+
+class Options(usage.Options):
+    subCommands = [
+        ["stats", None, StatsCmd,
+         "Show the number of dead letters, pending retries and failures"
+         " received for each failure code."],
+        ["list-dead-letters", None, ListDeadLettersCmd,
+         "List dead letters and their failure reasons."],
+        ["requeue", None, RequeueCmd,
+         "Move dead letters into the retry queue so that they are retried"
+         " by the failure worker."],
+    ]
+
+    optParameters = [
+        ["config", "c", None,
+         "The config file of the failure worker to work with."],
+    ]
+
+    longdesc = """Utilities for working with the failures stored by a
+                  vumi.transports.failures.FailureWorker."""
+
+    def postOptions(self):
+        if self['config'] is None:
+            raise usage.UsageError("Please specify a config file.")
+        if self.subCommand is None:
+            raise usage.UsageError("Please specify a sub-command.")
+
+
+class ConfigHolder(object):
+    def __init__(self, options):
+        self.options = options
+        config = yaml.safe_load(open(options['config'], "rb"))
+        redis = RedisManager.from_config(config.get('redis_manager', {}))
+        self.redis = failures_redis(redis, config['transport_name'])
+        self.dead_letters = DeadLetterStore(self.redis)
+        self.retry_queue = DelayedJobQueue(
+            self.redis, None, name=RETRY_QUEUE_NAME)
+
+    def emit(self, s):
+        print s
+
+    def run(self):
+        self.options.subOptions.run(self)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    cfg = ConfigHolder(options)
+    cfg.run()
@@ -256,6 +256,9 @@ class Consumer(object):
     message_class = Message
     start_paused = False
     prefetch_count = None
+    #: Optional :class:`vumi.blinkenlights.profiler.HandlerTimings` used to
+    #: time each call to :meth:`consume_message`.
+    timings = None
 
     def __init__(self, channel):
         self.channel = channel
@@ -333,8 +336,12 @@ class Consumer(object):
     @inlineCallbacks
     def consume(self, message):
         self._in_progress += 1
+        consume_message = self.consume_message
+        if self.timings is not None:
+            consume_message = self.timings.timed(
+                'consumer.%s' % (self.routing_key,), consume_message)
         try:
-            result = yield self.consume_message(
+            result = yield consume_message(
                 self.message_class.from_json(message.content.body))
         finally:
             # If we get an exception here the consumer's already pretty much
@@ -3,6 +3,7 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 from vumi.connectors import (
     BaseConnector, ReceiveInboundConnector, ReceiveOutboundConnector,
     PublishStatusConnector, ReceiveStatusConnector, IgnoreMessage)
+from vumi.blinkenlights.metrics import MetricManager, Timer
 from vumi.tests.utils import LogCatcher
 from vumi.worker import BaseWorker
 from vumi.message import TransportUserMessage
@@ -191,6 +192,16 @@ class TestBaseConnector(BaseConnectorTestCase):
         msgs = self.worker_helper.get_dispatched_outbound('foo')
         self.assertEqual(msgs, [msg])
 
+    @inlineCallbacks
+    def test_publish_message_timed(self):
+        conn = yield self.mk_connector(connector_name='foo')
+        yield conn._setup_publisher('outbound')
+        metrics = MetricManager('prefix.')
+        conn.publish_timer = metrics.register(Timer('publish_latency'))
+        msg = self.msg_helper.make_outbound("outbound")
+        yield conn._publish_message('outbound', msg, 'dummy_endpoint')
+        self.assertEqual(len(conn.publish_timer.poll()), 1)
+
 
 class TestReceiveInboundConnector(BaseConnectorTestCase):
 
@@ -96,6 +96,25 @@ class MessageTest(VumiTestCase):
             "thing": "dont_store_me",
         })
 
+    def test_message_copy(self):
+        msg = TransportUserMessage(
+            to_addr='+1234', from_addr='+5678', transport_name='sphex',
+            transport_type='sms', content='hi',
+            transport_metadata={'nested': {'list': [1, 2]}})
+        copy = msg.copy()
+        self.assertEqual(copy, msg)
+        self.assertTrue(type(copy) is TransportUserMessage)
+        self.assertTrue(isinstance(copy['timestamp'], datetime))
+        copy['transport_metadata']['nested']['list'].append(3)
+        copy['helper_metadata']['foo'] = 'bar'
+        self.assertEqual(
+            msg['transport_metadata'], {'nested': {'list': [1, 2]}})
+        self.assertEqual(msg['helper_metadata'], {})
+
+    def test_message_copy_keeps_date_like_strings(self):
+        msg = Message(a='2015-01-02 23:14:11')
+        self.assertEqual(msg.copy()['a'], '2015-01-02 23:14:11')
+
 
 class TransportMessageTestMixin(object):
     def make_message(self, **fields):
@@ -14,7 +14,8 @@ from vumi.utils import (
     normalize_msisdn, vumi_resource_path, cleanup_msisdn, get_operator_name,
     http_request, http_request_full, get_first_word, redis_from_config,
     build_web_site, LogFilterSite, PkgResources, HttpTimeoutError,
-    StatusEdgeDetector)
+    StatusEdgeDetector, LRUCache)
+from vumi.blinkenlights.metrics import MetricManager
 from vumi.message import TransportStatus
 from vumi.persist.fake_redis import FakeRedis
 from vumi.tests.fake_connection import (
@@ -527,3 +528,80 @@ class TestStatusEdgeDetector(VumiTestCase):
             'type': 'baz',
             'message': 'test'}
         self.assertEqual(sed.check_status(**status2), status2)
+
+
+class TestLRUCache(VumiTestCase):
+
+    def test_get_and_set(self):
+        cache = LRUCache(10)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 'default'), 'default')
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertTrue('a' in cache)
+        self.assertEqual(len(cache), 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_set_existing_key_refreshes_it(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('a', 3)
+        cache.set('c', 4)
+        self.assertEqual(cache.get('a'), 3)
+        self.assertFalse('b' in cache)
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get('a'), None)
+
+    def test_delete_and_clear(self):
+        cache = LRUCache(10)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.delete('a')
+        cache.delete('missing')
+        self.assertFalse('a' in cache)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_hit_rate(self):
+        cache = LRUCache(10)
+        self.assertEqual(cache.hit_rate(), 0.0)
+        cache.get('a')
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('a')
+        cache.get('b')
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        self.assertEqual(cache.hit_rate(), 0.5)
+
+    def test_register_metrics(self):
+        manager = MetricManager('vumi.test.', preaggregate=True)
+        cache = LRUCache(10)
+        cache.get('a')
+        cache.register_metrics(manager, 'cache')
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('a')
+        cache.get('b')
+        [(_, hits)] = manager['cache.hits'].poll()
+        [(_, misses)] = manager['cache.misses'].poll()
+        [(_, hit_rate)] = manager['cache.hit_rate'].poll()
+        self.assertEqual(hits['sum'], 2.0)
+        self.assertEqual(misses['sum'], 1.0)
+        self.assertAlmostEqual(hit_rate['last'], 2.0 / 3)
+        # No lookups since the last poll.
+        self.assertEqual(manager['cache.hit_rate'].poll(), [])
@@ -1,12 +1,19 @@
+import json
+import os
+
 from twisted.internet.defer import inlineCallbacks, succeed, Deferred
 
+from vumi.blinkenlights.profiler import WorkerProfiler
+from vumi.config import ConfigContext
 from vumi.worker import BaseConfig, BaseWorker
 from vumi.connectors import (
     ReceiveInboundConnector, ReceiveOutboundConnector,
     PublishStatusConnector, ReceiveStatusConnector)
 from vumi.tests.utils import LogCatcher
 from vumi.middleware.base import BaseMiddleware
+from vumi.message import Message
 from vumi.tests.helpers import VumiTestCase, MessageHelper, WorkerHelper
+from vumi.utils import http_request_full
 
 
 class DummyWorker(BaseWorker):
@@ -20,6 +27,14 @@ class DummyWorker(BaseWorker):
         pass
 
 
+class DynamicConfigWorker(DummyWorker):
+    CONFIG_MESSAGE_FIELDS = ('transport_name',)
+
+    def build_config(self, msg, ctxt=None):
+        self.built.append(msg)
+        return super(DynamicConfigWorker, self).build_config(msg, ctxt)
+
+
 class DummyMiddleware(BaseMiddleware):
     setup_called = False
     teardown_called = False
@@ -66,6 +81,9 @@ class TestBaseWorker(VumiTestCase):
     def test_start_worker(self):
         worker, calls = self.worker, []
         worker.setup_heartbeat = CallRecorder(worker.setup_heartbeat, calls)
+        worker.setup_worker_metrics = CallRecorder(
+            worker.setup_worker_metrics, calls)
+        worker.setup_profiler = CallRecorder(worker.setup_profiler, calls)
         worker.setup_middleware = CallRecorder(worker.setup_middleware, calls)
         worker.setup_connectors = CallRecorder(worker.setup_connectors, calls)
         worker.setup_worker = CallRecorder(worker.setup_worker, calls)
@@ -79,6 +97,8 @@ class TestBaseWorker(VumiTestCase):
                               'Started the publisher'])
         self.assertEqual(calls, [
             ('setup_heartbeat', (), {}),
+            ('setup_worker_metrics', (), {}),
+            ('setup_profiler', (), {}),
             ('setup_middleware', (), {}),
             ('setup_connectors', (), {}),
             ('setup_worker', (), {}),
@@ -93,6 +113,10 @@ class TestBaseWorker(VumiTestCase):
                                                   calls)
         worker.teardown_connectors = CallRecorder(worker.teardown_connectors,
                                                   calls)
+        worker.teardown_profiler = CallRecorder(worker.teardown_profiler,
+                                                calls)
+        worker.teardown_worker_metrics = CallRecorder(
+            worker.teardown_worker_metrics, calls)
         worker.teardown_worker = CallRecorder(worker.teardown_worker, calls)
         yield worker.startWorker()
         with LogCatcher() as lc:
@@ -102,6 +126,8 @@ class TestBaseWorker(VumiTestCase):
             ('teardown_worker', (), {}),
             ('teardown_connectors', (), {}),
             ('teardown_middleware', (), {}),
+            ('teardown_profiler', (), {}),
+            ('teardown_worker_metrics', (), {}),
             ('teardown_heartbeat', (), {}),
         ])
 
@@ -154,6 +180,63 @@ class TestBaseWorker(VumiTestCase):
         cfg = yield self.worker.get_config(msg)
         self.assertEqual(cfg.amqp_prefetch_count, 20)
 
+    @inlineCallbacks
+    def test_get_config_cached(self):
+        msg1 = self.msg_helper.make_inbound("inbound")
+        msg2 = self.msg_helper.make_inbound("inbound")
+        cfg1 = yield self.worker.get_config(msg1)
+        cfg2 = yield self.worker.get_config(msg2)
+        cfg3 = yield self.worker.get_config(None)
+        self.assertTrue(cfg1 is cfg2)
+        self.assertTrue(cfg1 is cfg3)
+
+    @inlineCallbacks
+    def test_get_config_with_ctxt_not_cached(self):
+        msg = self.msg_helper.make_inbound("inbound")
+        cfg1 = yield self.worker.get_config(msg)
+        cfg2 = yield self.worker.get_config(msg, ConfigContext(foo='bar'))
+        self.assertFalse(cfg1 is cfg2)
+
+    @inlineCallbacks
+    def test_get_config_message_fields(self):
+        worker = yield self.worker_helper.get_worker(
+            DynamicConfigWorker, {}, False)
+        worker.built = []
+        msg1 = self.msg_helper.make_inbound("a", transport_name="t1")
+        msg2 = self.msg_helper.make_inbound("b", transport_name="t2")
+        msg3 = self.msg_helper.make_inbound("c", transport_name="t1")
+        cfg1 = yield worker.get_config(msg1)
+        cfg2 = yield worker.get_config(msg2)
+        cfg3 = yield worker.get_config(msg3)
+        self.assertFalse(cfg1 is cfg2)
+        self.assertTrue(cfg1 is cfg3)
+        self.assertEqual(worker.built, [msg1, msg2])
+
+    @inlineCallbacks
+    def test_get_config_cache_bounded(self):
+        worker = yield self.worker_helper.get_worker(
+            DynamicConfigWorker, {}, False)
+        worker.built = []
+        worker._config_cache.max_size = 1
+        msg1 = self.msg_helper.make_inbound("a", transport_name="t1")
+        msg2 = self.msg_helper.make_inbound("b", transport_name="t2")
+        yield worker.get_config(msg1)
+        yield worker.get_config(msg2)
+        yield worker.get_config(msg1)
+        self.assertEqual(worker.built, [msg1, msg2, msg1])
+
+    @inlineCallbacks
+    def test_invalidate_config(self):
+        msg = self.msg_helper.make_inbound("inbound")
+        cfg1 = yield self.worker.get_config(msg)
+        self.worker.config = {'amqp_prefetch_count': 5}
+        self.worker.invalidate_config()
+        cfg2 = yield self.worker.get_config(msg)
+        self.assertEqual(cfg1.amqp_prefetch_count, 20)
+        self.assertEqual(cfg2.amqp_prefetch_count, 5)
+        self.assertEqual(
+            self.worker.get_static_config().amqp_prefetch_count, 5)
+
     def test__validate_config(self):
         # should call .validate_config()
         self.worker.validate_config = CallRecorder(self.worker.validate_config)
@@ -245,3 +328,173 @@ class TestBaseWorker(VumiTestCase):
         handler_continue.callback(None)
         yield d
         self.assertTrue(connector.paused)
+
+    @inlineCallbacks
+    def test_setup_worker_metrics_disabled(self):
+        yield self.worker.setup_worker_metrics()
+        self.assertEqual(self.worker.worker_metrics, None)
+
+    @inlineCallbacks
+    def test_setup_worker_metrics(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'worker_metrics_prefix': 'worker.',
+        })
+        metrics = worker.worker_metrics.metrics
+        self.assertEqual(metrics.prefix, 'worker.')
+        self.assertTrue('reactor_lag' in metrics)
+        self.assertTrue(worker.worker_metrics.lag_monitor.running)
+        connector = yield worker.setup_ri_connector('foo')
+        self.assertEqual(
+            connector.publish_timer, worker.worker_metrics.publish_latency)
+
+        yield worker.teardown_worker_metrics()
+        self.assertEqual(worker.worker_metrics, None)
+        self.assertEqual(connector.publish_timer, None)
+
+    @inlineCallbacks
+    def test_heartbeat_stats(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'worker_metrics_prefix': 'worker.',
+        })
+        attrs = worker._gen_heartbeat_attrs()
+        self.assertEqual(sorted(attrs['stats']), [
+            'in_progress', 'prefetch_utilisation', 'reactor_lag', 'rss',
+            'threadpool_queue'])
+
+    @inlineCallbacks
+    def test_worker_metrics_direct(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'worker_metrics_prefix': 'worker.',
+            'direct_metrics': {'host': '127.0.0.1', 'port': 2003},
+        })
+        publisher = worker.worker_metrics.metrics.direct_publisher
+        self.assertNotEqual(publisher, None)
+        yield worker.teardown_worker_metrics()
+        self.assertEqual(publisher._udp_port, None)
+
+    @inlineCallbacks
+    def test_heartbeat_no_stats(self):
+        yield self.worker.startWorker()
+        self.assertFalse('stats' in self.worker._gen_heartbeat_attrs())
+
+    @inlineCallbacks
+    def test_setup_profiler(self):
+        yield self.worker.setup_profiler()
+        self.assertTrue(isinstance(self.worker.profiler, WorkerProfiler))
+        self.assertFalse(self.worker.profiler.running)
+        self.assertEqual(self.worker.profiler.metrics, None)
+
+    @inlineCallbacks
+    def test_teardown_profiler(self):
+        yield self.worker.setup_profiler()
+        profiler = self.worker.profiler
+        profiler.start()
+        yield self.worker.teardown_profiler()
+        self.assertFalse(profiler.running)
+        self.assertEqual(self.worker.profiler, None)
+
+    @inlineCallbacks
+    def test_profiler_metrics(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'profiler_metrics_prefix': 'worker.profile.',
+        })
+        self.assertEqual(worker.profiler.metrics.prefix, 'worker.profile.')
+        self.assertTrue(worker.profiler.metrics.preaggregate)
+
+    @inlineCallbacks
+    def test_profiler_metrics_direct(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'profiler_metrics_prefix': 'worker.profile.',
+            'direct_metrics': {'host': '127.0.0.1', 'port': 2003},
+        })
+        publisher = worker.profiler.metrics.direct_publisher
+        self.assertNotEqual(publisher, None)
+        yield worker.teardown_profiler()
+        self.assertEqual(publisher._udp_port, None)
+
+    @inlineCallbacks
+    def test_profiler_times_connector(self):
+        yield self.worker.startWorker()
+        connector = yield self.worker.setup_ri_connector('foo')
+        self.worker.profiler.start()
+        self.add_cleanup(self.worker.profiler.stop)
+        connector.set_default_inbound_handler(lambda msg: None)
+        connector.unpause()
+        yield self.worker_helper.dispatch_inbound(
+            self.msg_helper.make_inbound("inbound"), 'foo')
+        timings = self.worker.profiler.status()['timings']
+        self.assertEqual(sorted(timings), [
+            'consumer.foo.inbound', 'handler.foo.inbound'])
+        self.assertEqual(timings['handler.foo.inbound']['count'], 1)
+
+    @inlineCallbacks
+    def test_profiler_instruments_new_connectors(self):
+        yield self.worker.startWorker()
+        self.worker.profiler.start()
+        self.add_cleanup(self.worker.profiler.stop)
+        connector = yield self.worker.setup_ri_connector('foo')
+        self.assertEqual(connector.timings, self.worker.profiler.timings)
+        self.assertEqual(
+            connector._consumers['inbound'].timings,
+            self.worker.profiler.timings)
+        self.worker.profiler.stop()
+        self.assertEqual(connector.timings, None)
+        self.assertEqual(connector._consumers['inbound'].timings, None)
+
+    @inlineCallbacks
+    def test_profiler_control_queue(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'profiler_control_queue': 'unnamed.profiler',
+        })
+        self.add_cleanup(worker.profiler.stop)
+        yield self.worker_helper.dispatch_raw(
+            'unnamed.profiler', Message(command='start'))
+        self.assertTrue(worker.profiler.running)
+        yield self.worker_helper.dispatch_raw(
+            'unnamed.profiler', Message(command='stop'))
+        self.assertFalse(worker.profiler.running)
+
+    @inlineCallbacks
+    def test_profiler_control_queue_bad_command(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'profiler_control_queue': 'unnamed.profiler',
+        })
+        with LogCatcher() as lc:
+            yield self.worker_helper.dispatch_raw(
+                'unnamed.profiler', Message(command='explode'))
+        [warning] = lc.messages()
+        self.assertTrue(warning.startswith("Ignoring profiler command"))
+        self.assertFalse(worker.profiler.running)
+
+    @inlineCallbacks
+    def test_profiler_control_queue_dump(self):
+        dump_dir = self.mktemp()
+        os.mkdir(dump_dir)
+        yield self.worker_helper.get_worker(DummyWorker, {
+            'profiler_control_queue': 'unnamed.profiler',
+            'profiler_dump_dir': dump_dir,
+        })
+        yield self.worker_helper.dispatch_raw(
+            'unnamed.profiler', Message(command='dump', filename='stacks'))
+        self.assertEqual(os.listdir(dump_dir), ['stacks'])
+        with LogCatcher() as lc:
+            yield self.worker_helper.dispatch_raw(
+                'unnamed.profiler',
+                Message(command='dump', filename='../stacks'))
+        [warning] = lc.messages()
+        self.assertTrue(warning.startswith("Ignoring profiler command"))
+        self.assertEqual(os.listdir(dump_dir), ['stacks'])
+
+    @inlineCallbacks
+    def test_profiler_web_port(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'profiler_web_port': 0,
+        })
+        self.add_cleanup(worker.profiler.stop)
+        addr = worker._profiler_resource.getHost()
+        url = "http://%s:%s/profiler/" % (addr.host, addr.port)
+        response = yield http_request_full(url + "start", method='POST')
+        self.assertTrue(json.loads(response.delivered_body)['running'])
+        self.assertTrue(worker.profiler.running)
+        response = yield http_request_full(url, method='GET')
+        self.assertTrue(json.loads(response.delivered_body)['running'])
@@ -1,14 +1,23 @@
 # -*- test-case-name: vumi.transports.tests.test_failures -*-
 
+import calendar
+import json
+import math
+import random
 import time
 from datetime import datetime
 from uuid import uuid4
 
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.internet.task import LoopingCall
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, DeferredSemaphore)
 
+from vumi.blinkenlights.metrics import Count
+from vumi.blinkenlights.metrics_direct import (
+    start_metric_manager, stop_metric_manager)
+from vumi.components.delayed_jobs import DelayedJobQueue
 from vumi.service import Worker
 from vumi.message import TransportMessage, to_json
+from vumi.persist.redis_base import Manager
 from vumi.persist.txredis_manager import TxRedisManager
 
 
@@ -52,24 +61,178 @@ class TemporaryFailure(FailureCodeException):
                                                msg)
 
 
+def failures_redis(redis, transport_name):
+    """
+    Return the Redis sub-manager that failures for ``transport_name`` are
+    stored in.
+    """
+    return redis.sub_manager("failures:%s" % (transport_name,))
+
+
+#: The name of the :class:`DelayedJobQueue` that retries are kept in.
+RETRY_QUEUE_NAME = 'retries'
+
+
+class DeadLetterStore(object):
+    """Failures that won't be retried.
+
+    Each dead letter is a failure hash written by
+    :meth:`FailureWorker.store_failure`. The hashes expire after ``ttl``
+    seconds and are indexed in a sorted set scored by the time they were
+    stored. Whenever a dead letter is added, index entries for expired hashes
+    are dropped and the oldest dead letters are deleted if there are more
+    than ``max_size`` of them.
+
+    :param redis:
+        A Redis manager.
+    :param int max_size:
+        The maximum number of dead letters to keep.
+    :param int ttl:
+        The number of seconds to keep each dead letter for.
+    """
+
+    DEFAULT_MAX_SIZE = 100000
+    DEFAULT_TTL = 7 * 24 * 60 * 60
+
+    INDEX_KEY = "dead_letters"
+
+    def __init__(self, redis, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        self.redis = redis
+        self.max_size = max_size
+        self.ttl = ttl
+
+    @Manager.calls_manager('redis')
+    def add(self, failure_key, stored_at=None):
+        """
+        Add the failure stored with ``failure_key`` at ``stored_at`` seconds
+        since the epoch (which defaults to the current time). The failure is
+        deleted straight away if it is older than the TTL.
+        """
+        now = time.time()
+        if stored_at is None:
+            stored_at = now
+        ttl = int(math.ceil(stored_at + self.ttl - now))
+        if ttl <= 0:
+            yield self.remove(failure_key)
+            return
+        pipeline = self.redis.pipeline()
+        pipeline.expire(failure_key, ttl)
+        pipeline.zadd(self.INDEX_KEY, **{failure_key: stored_at})
+        pipeline.zremrangebyscore(self.INDEX_KEY, '-inf', now - self.ttl)
+        pipeline.zcard(self.INDEX_KEY)
+        results = yield pipeline.execute()
+        excess = results[-1] - self.max_size
+        if excess > 0:
+            yield self._delete_oldest(excess)
+
+    @Manager.calls_manager('redis')
+    def _delete_oldest(self, count):
+        failure_keys = yield self.keys(0, count - 1)
+        pipeline = self.redis.pipeline()
+        for failure_key in failure_keys:
+            pipeline.zrem(self.INDEX_KEY, failure_key)
+            pipeline.delete(failure_key)
+        yield pipeline.execute()
+
+    def remove(self, failure_key):
+        """
+        Delete a dead letter.
+        """
+        pipeline = self.redis.pipeline()
+        pipeline.zrem(self.INDEX_KEY, failure_key)
+        pipeline.delete(failure_key)
+        return pipeline.execute()
+
+    def keys(self, start=0, stop=-1):
+        """
+        Return the keys of the dead letters from ``start`` to ``stop``
+        (inclusive), oldest first.
+        """
+        return self.redis.zrange(self.INDEX_KEY, start, stop)
+
+    def count(self):
+        return self.redis.zcard(self.INDEX_KEY)
+
+    @Manager.calls_manager('redis')
+    def requeue(self, retry_queue, limit=None, now=None):
+        """
+        Move up to ``limit`` (or all, if ``limit`` is ``None``) of the oldest
+        dead letters into ``retry_queue``, due at ``now`` (which defaults to
+        the current time). Returns the keys of the requeued failures.
+        """
+        if now is None:
+            now = time.time()
+        stop = -1 if limit is None else limit - 1
+        failure_keys = yield self.keys(0, stop)
+        pipeline = self.redis.pipeline()
+        for failure_key in failure_keys:
+            pipeline.zrem(self.INDEX_KEY, failure_key)
+            pipeline.persist(failure_key)
+            pipeline.exists(failure_key)
+        results = yield pipeline.execute()
+        requeued = []
+        for failure_key, exists in zip(failure_keys, results[2::3]):
+            if exists:
+                yield retry_queue.add(failure_key, now)
+                requeued.append(failure_key)
+        returnValue(requeued)
+
+
 class FailureWorker(Worker):
     """
     Base class for transport failure handlers.
 
     Subclasses should implement :meth:`handle_failure`.
+
+    Temporary failures are retried with exponential backoff. Each retry delay
+    is the previous one multiplied by ``retry_delay_factor`` (starting at
+    ``retry_initial_delay`` and capped at ``retry_max_delay``) and then
+    reduced by a random fraction of up to ``retry_jitter`` so that retries
+    for messages that failed together are spread out. Retries are kept in a
+    :class:`vumi.components.delayed_jobs.DelayedJobQueue` and published to
+    the retry routing key once they are due, with at most
+    ``retry_destination_concurrency`` retries for the same destination (see
+    :meth:`get_retry_destination`) being published at a time.
+
+    Other failures, and messages that have been retried more than
+    ``retry_max_retries`` times, are kept in a :class:`DeadLetterStore`
+    bounded by ``dead_letter_max_size`` and ``dead_letter_ttl``.
+
+    The number of failures received for each failure code is counted in
+    Redis. If ``metrics_prefix`` is set in the config, these counts and the
+    retry queue's depth and lag are also published as metrics (directly to
+    Graphite or statsd if ``direct_metrics`` is set).
     """
 
-    GRANULARITY = 5  # seconds
     DELIVERY_PERIOD = 3
 
     MAX_DELAY = 3600
     INITIAL_DELAY = 1
     DELAY_FACTOR = 3
+    JITTER = 0.5
+    MAX_RETRIES = None
+
+    BATCH_SIZE = DelayedJobQueue.DEFAULT_BATCH_SIZE
+    CONCURRENCY = DelayedJobQueue.DEFAULT_CONCURRENCY
+    DESTINATION_CONCURRENCY = None
+
+    DEAD_LETTER_MAX_SIZE = DeadLetterStore.DEFAULT_MAX_SIZE
+    DEAD_LETTER_TTL = DeadLetterStore.DEFAULT_TTL
 
     @inlineCallbacks
     def startWorker(self):
         self.configure_retries()
+        self.configure_dead_letters()
         yield self.set_up_redis()
+        self.retry_queue = DelayedJobQueue(
+            self.redis, self.deliver_retry_job, name=RETRY_QUEUE_NAME,
+            batch_size=self.BATCH_SIZE, concurrency=self.CONCURRENCY)
+        self.dead_letters = DeadLetterStore(
+            self.redis, self.DEAD_LETTER_MAX_SIZE, self.DEAD_LETTER_TTL)
+        self._destination_semaphores = {}
+        yield self.migrate_bucketed_retries()
+        yield self.migrate_failure_keys()
+        yield self.set_up_metrics()
         retry_rkey = self.get_rkey('retry')
         failures_rkey = self.get_rkey('failures')
         self.retry_publisher = yield self.publish_to(retry_rkey)
@@ -79,30 +242,45 @@ class FailureWorker(Worker):
 
     @inlineCallbacks
     def stopWorker(self):
-        if self.delivery_loop and self.delivery_loop.running:
-            self.delivery_loop.stop()
-            yield self.delivery_done
+        yield self.retry_queue.stop()
+        if self.metrics is not None:
+            yield stop_metric_manager(self.metrics)
         yield self.consumer.stop()
         yield self.redis.close_manager()
 
     def configure_retries(self):
-        for param in ['GRANULARITY', 'MAX_DELAY', 'INITIAL_DELAY',
-                      'DELAY_FACTOR', 'DELIVERY_PERIOD']:
+        for param in ['MAX_DELAY', 'INITIAL_DELAY', 'DELAY_FACTOR', 'JITTER',
+                      'MAX_RETRIES', 'DELIVERY_PERIOD', 'BATCH_SIZE',
+                      'CONCURRENCY', 'DESTINATION_CONCURRENCY']:
             setattr(self, param, self.config.get('retry_' + param.lower(),
                                                  getattr(self, param)))
 
+    def configure_dead_letters(self):
+        for param in ['MAX_SIZE', 'TTL']:
+            attr = 'DEAD_LETTER_' + param
+            setattr(self, attr, self.config.get(attr.lower(),
+                                                getattr(self, attr)))
+
     @inlineCallbacks
     def set_up_redis(self):
         r_config = self.config.get('redis_manager', {})
         redis = yield TxRedisManager.from_config(r_config)
-        self.redis = redis.sub_manager("failures:%s" % (
-                self.config['transport_name'],))
+        self.redis = failures_redis(redis, self.config['transport_name'])
+
+    @inlineCallbacks
+    def set_up_metrics(self):
+        self.metrics = None
+        self._failure_counters = {}
+        metrics_prefix = self.config.get('metrics_prefix')
+        if metrics_prefix:
+            self.metrics = yield start_metric_manager(
+                self, metrics_prefix,
+                direct_config=self.config.get('direct_metrics'))
+            self.retry_queue.register_metrics(self.metrics, 'retries')
 
     def start_retry_delivery(self):
-        self.delivery_loop = None
         if self.DELIVERY_PERIOD:
-            self.delivery_loop = LoopingCall(self.deliver_retries)
-            self.delivery_done = self.delivery_loop.start(self.DELIVERY_PERIOD)
+            self.retry_queue.start(self.DELIVERY_PERIOD)
 
     def get_rkey(self, route_name):
         return self.config['%s_routing_key' % route_name] % self.config
@@ -116,11 +294,22 @@ class FailureWorker(Worker):
         timestamp = timestamp.isoformat().split('.')[0]
         return ".".join(("failure", timestamp, failure_id))
 
-    def add_to_failure_set(self, key):
-        return self.redis.sadd("failure_keys", key)
+    def failure_key_timestamp(self, failure_key):
+        """
+        Return the time (in seconds since the epoch) encoded in a failure key.
+        """
+        timestamp = failure_key.split('.')[1]
+        return calendar.timegm(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%S"))
 
+    @inlineCallbacks
     def get_failure_keys(self):
-        return self.redis.smembers("failure_keys")
+        """
+        Return the keys of all the stored failures, both dead letters and
+        failures waiting to be retried.
+        """
+        dead_letter_keys = yield self.dead_letters.keys()
+        retry_keys = yield self.get_retry_keys()
+        returnValue(set(dead_letter_keys) | set(retry_keys))
 
     @inlineCallbacks
     def store_failure(self, message, reason, retry_delay=None):
@@ -132,7 +321,8 @@ class FailureWorker(Worker):
         :param retry_delay: The (optional) retry delay in seconds.
 
         If ``retry_delay`` is not ``None``, a retry will be scheduled
-        approximately ``retry_delay`` seconds in the future.
+        ``retry_delay`` seconds in the future. Otherwise the failure is added
+        to the dead letter store.
         """
         message_json = message
         if not isinstance(message, basestring):
@@ -146,71 +336,141 @@ class FailureWorker(Worker):
                 "reason": reason,
                 "retry_delay": str(retry_delay),
                 })
-        yield self.add_to_failure_set(key)
         if retry_delay:
             yield self.store_retry(key, retry_delay)
+        else:
+            yield self.dead_letters.add(key)
         returnValue(key)
 
     def get_failure(self, failure_key):
         return self.redis.hgetall(failure_key)
 
-    @inlineCallbacks
     def store_retry(self, failure_key, retry_delay, now=None):
-        timestamp = self.get_next_write_timestamp(retry_delay, now=now)
-        bucket_key = "retry_keys." + timestamp
-        yield self.redis.sadd(bucket_key, failure_key)
-        yield self.store_read_timestamp(timestamp)
+        """
+        Schedule a retry of the failure stored with ``failure_key``
+        ``retry_delay`` seconds after ``now`` (which defaults to the current
+        time).
+        """
+        return self.retry_queue.schedule(
+            retry_delay, job_id=failure_key, now=now)
 
-    def store_read_timestamp(self, timestamp):
-        score = time.mktime(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%S"))
-        return self.redis.zadd('retry_timestamps', **{timestamp: score})
+    def get_retry_keys(self):
+        """
+        Return the keys of the failures with pending retries, in due order.
+        """
+        return self.retry_queue.get_job_ids()
 
-    def get_next_write_timestamp(self, delta, now=None):
-        if now is None:
-            now = int(time.time())
-        timestamp = now + delta
-        timestamp += self.GRANULARITY - (timestamp % self.GRANULARITY)
-        return datetime.utcfromtimestamp(timestamp).isoformat().split('.')[0]
+    def requeue_dead_letters(self, limit=None):
+        """
+        Retry up to ``limit`` (or all, if ``limit`` is ``None``) of the
+        oldest dead letters now. Returns the keys of the requeued failures.
+        """
+        return self.dead_letters.requeue(self.retry_queue, limit)
 
     @inlineCallbacks
-    def get_next_read_timestamp(self):
-        now = int(time.time())
-        timestamp = datetime.utcfromtimestamp(now).isoformat().split('.')[0]
-        next_timestamp = yield self.redis.zrange('retry_timestamps', 0, 0)
-        if next_timestamp and next_timestamp[0] <= timestamp:
-            returnValue(next_timestamp[0])
-        returnValue(None)
+    def migrate_bucketed_retries(self):
+        """
+        Move retries stored in the per-timestamp buckets used by older
+        versions of this worker into the retry queue.
+        """
+        timestamps = yield self.redis.zrange('retry_timestamps', 0, -1)
+        for timestamp in timestamps:
+            bucket_key = "retry_keys." + timestamp
+            due = calendar.timegm(
+                time.strptime(timestamp, "%Y-%m-%dT%H:%M:%S"))
+            for failure_key in (yield self.redis.smembers(bucket_key)):
+                yield self.retry_queue.add(failure_key, due)
+            yield self.redis.delete(bucket_key)
+            yield self.redis.zrem('retry_timestamps', timestamp)
 
     @inlineCallbacks
-    def get_next_retry_key(self):
-        timestamp = yield self.get_next_read_timestamp()
-        if not timestamp:
-            return
-        bucket_key = "retry_keys." + timestamp
-        failure_key = yield self.redis.spop(bucket_key)
-        if (yield self.redis.scard(bucket_key)) < 1:
-            yield self.redis.zrem('retry_timestamps', timestamp)
-        returnValue(failure_key)
+    def migrate_failure_keys(self):
+        """
+        Move failures listed in the unbounded ``failure_keys`` set used by
+        older versions of this worker into the dead letter store. Failures
+        that were retried (and are no longer waiting to be) are deleted.
+        """
+        failure_keys = yield self.redis.smembers("failure_keys")
+        for failure_key in failure_keys:
+            if (yield self.retry_queue.get_due(failure_key)) is not None:
+                continue
+            retry_delay = yield self.redis.hget(failure_key, "retry_delay")
+            if retry_delay == "0":
+                yield self.dead_letters.add(
+                    failure_key, self.failure_key_timestamp(failure_key))
+            elif retry_delay is not None:
+                yield self.redis.delete(failure_key)
+        yield self.redis.delete("failure_keys")
+
+    def get_retry_destination(self, failure):
+        """
+        Return the destination of a failure (as returned by
+        :meth:`get_failure`) for limiting concurrent retries, or ``None`` if
+        retries for it shouldn't be limited.
+
+        This returns the failed message's ``to_addr`` and may be overridden
+        in subclasses to group destinations differently.
+        """
+        return json.loads(failure['message']).get('to_addr')
+
+    def run_for_destination(self, destination, func, *args, **kw):
+        """
+        Call ``func``, waiting first if ``retry_destination_concurrency``
+        calls for ``destination`` are already in progress.
+        """
+        if not self.DESTINATION_CONCURRENCY or destination is None:
+            return maybeDeferred(func, *args, **kw)
+        semaphore = self._destination_semaphores.get(destination)
+        if semaphore is None:
+            semaphore = DeferredSemaphore(self.DESTINATION_CONCURRENCY)
+            self._destination_semaphores[destination] = semaphore
+        d = semaphore.run(func, *args, **kw)
+        d.addBoth(self._release_destination, destination)
+        return d
+
+    def _release_destination(self, result, destination):
+        semaphore = self._destination_semaphores.get(destination)
+        if semaphore is not None and semaphore.tokens == semaphore.limit:
+            del self._destination_semaphores[destination]
+        return result
 
     @inlineCallbacks
     def deliver_retry(self, retry_key, publisher):
+        """
+        Publish the failed message stored with ``retry_key`` and delete the
+        failure.
+        """
         failure = yield self.get_failure(retry_key)
-        published = yield publisher.publish_raw(failure['message'])
+        if not failure:
+            # The failure has been deleted, so there's nothing to retry.
+            return
+        destination = self.get_retry_destination(failure)
+        published = yield self.run_for_destination(
+            destination, publisher.publish_raw, failure['message'])
+        yield self.redis.delete(retry_key)
         returnValue(published)
 
-    @inlineCallbacks
-    def deliver_retries(self):
-        while True:
-            retry_key = yield self.get_next_retry_key()
-            if not retry_key:
-                return
-            yield self.deliver_retry(retry_key, self.retry_publisher)
+    def deliver_retry_job(self, job):
+        return self.deliver_retry(job.job_id, self.retry_publisher)
+
+    def deliver_retries(self, now=None):
+        """
+        Publish all the retries that are due at ``now`` (which defaults to
+        the current time).
+        """
+        return self.retry_queue.deliver_due(now)
 
     def next_retry_delay(self, delay):
         if not delay:
             return self.INITIAL_DELAY
         return min(delay * self.DELAY_FACTOR, self.MAX_DELAY)
 
+    def jitter_delay(self, delay):
+        """
+        Return ``delay`` reduced by a random fraction of up to ``JITTER``.
+        """
+        return delay * (1 - self.JITTER * random.random())
+
     def update_retry_metadata(self, message):
         rmd = message.get('retry_metadata', {})
         message['retry_metadata'] = {
@@ -237,11 +497,40 @@ class FailureWorker(Worker):
 
     def do_retry(self, message, reason):
         message = self.update_retry_metadata(message)
+        rmd = message['retry_metadata']
+        if self.MAX_RETRIES is not None and rmd['retries'] > self.MAX_RETRIES:
+            return self.store_failure(message, reason)
         return self.store_failure(
-            message, reason, message['retry_metadata']['delay'])
+            message, reason, self.jitter_delay(rmd['delay']))
+
+    def count_failure(self, failure_code):
+        """
+        Count a failure with ``failure_code`` in Redis and, if metrics are
+        enabled, in a ``failures.<failure_code>`` counter.
+        """
+        failure_code = failure_code or 'unspecified'
+        if self.metrics is not None:
+            counter = self._failure_counters.get(failure_code)
+            if counter is None:
+                counter = self.metrics.register(
+                    Count("failures.%s" % (failure_code,)))
+                self._failure_counters[failure_code] = counter
+            counter.inc()
+        return self.redis.hincrby("failure_counts", failure_code)
 
+    @inlineCallbacks
+    def get_failure_counts(self):
+        """
+        Return a dict mapping failure codes to the number of failures
+        received with them.
+        """
+        counts = yield self.redis.hgetall("failure_counts")
+        returnValue(dict((code, int(n)) for code, n in counts.iteritems()))
+
+    @inlineCallbacks
     def process_message(self, failure_message):
         message = failure_message.payload['message']
         failure_code = failure_message.payload['failure_code']
         reason = failure_message.payload['reason']
-        return self.handle_failure(message, failure_code, reason)
+        yield self.count_failure(failure_code)
+        yield self.handle_failure(message, failure_code, reason)
@@ -1,16 +1,19 @@
 # -*- test-case-name: vumi.transports.httprpc.tests.test_httprpc -*-
 
+import heapq
 import json
 
 from twisted.cred.portal import Portal
 from twisted.internet.defer import inlineCallbacks, succeed
 from twisted.internet import reactor
-from twisted.internet.task import LoopingCall
 from twisted.web import http
 from twisted.web.guard import BasicCredentialFactory, HTTPAuthSessionWrapper
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 
+from vumi.blinkenlights.metrics import Count, Gauge
+from vumi.blinkenlights.metrics_direct import (
+    start_metric_manager, stop_metric_manager)
 from vumi.config import (
     ConfigText, ConfigInt, ConfigBool, ConfigError, ConfigFloat)
 from vumi.message import TransportStatus
@@ -45,11 +48,12 @@ class HttpRpcTransportConfig(Transport.CONFIG_CLASS):
         "The path to listen for downstream health checks on"
         " (useful with HAProxy)", default='health', static=True)
     request_cleanup_interval = ConfigInt(
-        "How often should we actively look for old connections that should"
-        " manually be timed out. Anything less than `1` disables the request"
-        " cleanup meaning that all request objects will be kept in memory"
-        " until the server is restarted, regardless if the remote side has"
-        " dropped the connection or not. Defaults to 5 seconds.",
+        "Whether old connections should manually be timed out. Requests are"
+        " timed out as soon as they have waited for `request_timeout`"
+        " seconds, so the only effect of this is that anything less than `1`"
+        " disables the request cleanup meaning that all request objects will"
+        " be kept in memory until the server is restarted, regardless if the"
+        " remote side has dropped the connection or not. Defaults to 5.",
         default=5, static=True)
     request_timeout = ConfigInt(
         "How long should we wait for the remote side generating the response"
@@ -79,12 +83,32 @@ class HttpRpcTransportConfig(Transport.CONFIG_CLASS):
         "The maximum time allowed for a response before the service is "
         "considered `degraded`",
         default=1.0, static=True)
+    instance_id = ConfigText(
+        "A unique, lower case identifier for this instance of the transport."
+        " If set, several instances with the same `transport_name` can run"
+        " behind a load balancer. Each instance stamps its id on the inbound"
+        " messages it publishes and replies that are received by another"
+        " instance are forwarded to the instance that holds the request."
+        " Instance ids must stay the same across restarts so that forwarded"
+        " replies aren't left in an unused queue.",
+        default=None, static=True)
+    metrics_prefix = ConfigText(
+        "The prefix for metrics published by this transport. If ``None``,"
+        " no metrics are published. The metrics are `pending_requests`, the"
+        " number of requests waiting for a response, and `request_timeouts`,"
+        " the number of requests that were timed out.",
+        default=None, static=True)
 
     def post_validate(self):
         auth_supplied = (self.web_username is None, self.web_password is None)
         if any(auth_supplied) and not all(auth_supplied):
             raise ConfigError("If either web_username or web_password is"
                               " specified, both must be specified")
+        if self.instance_id is not None:
+            if not self.instance_id or self.instance_id.lower() != \
+                    self.instance_id:
+                raise ConfigError("instance_id must be a non-empty lower"
+                                  " case string")
 
 
 class HttpRpcHealthResource(Resource):
@@ -129,9 +153,16 @@ class HttpRpcTransport(Transport):
 
     Because a reply from an application worker is needed before the HTTP
     response can be completed, a reply needs to be returned to the same
-    transport worker that generated the inbound message. This means that
-    currently there many only be one transport worker for each instance
+    transport worker that generated the inbound message. By default this
+    means that there may only be one transport worker for each instance
     of this transport of a given name.
+
+    If `instance_id` is configured, several transport workers may share a
+    transport name. Inbound messages are stamped with the instance id of
+    the worker that received them (in the `transport_metadata`, which is
+    copied to replies). Replies arrive on the shared outbound queue and any
+    reply for a request held by another instance is forwarded to that
+    instance's own outbound queue.
     """
     content_type = 'text/plain'
 
@@ -141,6 +172,10 @@ class HttpRpcTransport(Transport):
     PERMISSIVE_MODE = 'permissive'
     DEFAULT_VALIDATION_MODE = STRICT_MODE
     KNOWN_VALIDATION_MODES = [STRICT_MODE, PERMISSIVE_MODE]
+    INSTANCE_ID_METADATA_KEY = 'httprpc_instance_id'
+    # The request expiry heap is rebuilt once it has this many entries and
+    # more than twice as many entries as there are pending requests.
+    MIN_EXPIRY_HEAP_REBUILD_SIZE = 1024
 
     def validate_config(self):
         config = self.get_static_config()
@@ -158,6 +193,8 @@ class HttpRpcTransport(Transport):
         self._validation_mode = config.validation_mode
         self.response_time_down = config.response_time_down
         self.response_time_degraded = config.response_time_degraded
+        self.metrics_prefix = config.metrics_prefix
+        self.instance_id = config.instance_id
         if self._validation_mode not in self.KNOWN_VALIDATION_MODES:
             raise ConfigError('Invalid validation mode: %s' % (
                 self._validation_mode,))
@@ -186,13 +223,61 @@ class HttpRpcTransport(Transport):
         ]
         return HTTPAuthSessionWrapper(portal, cred_factories)
 
+    def get_instance_connector_name(self, instance_id):
+        return '%s.instance.%s' % (self.transport_name, instance_id)
+
+    @inlineCallbacks
+    def setup_connectors(self):
+        yield super(HttpRpcTransport, self).setup_connectors()
+        self._forward_publishers = {}
+        if self.instance_id is None:
+            return
+        self.add_outbound_handler(self.route_outbound_message)
+        # Forwarded messages have already been through the middleware on
+        # the shared connector, so we don't apply it again here.
+        instance_connector = yield self.setup_ro_connector(
+            self.get_instance_connector_name(self.instance_id),
+            middleware=False)
+        self.add_outbound_handler(
+            self.handle_outbound_message, connector=instance_connector)
+
+    def route_outbound_message(self, message):
+        """
+        Handle an outbound message from the shared outbound queue, or forward
+        it to the instance that holds the request it is a reply to.
+        """
+        owner = (message['transport_metadata'] or {}).get(
+            self.INSTANCE_ID_METADATA_KEY)
+        if (owner is None or owner == self.instance_id or
+                self.get_request(message['in_reply_to']) is not None):
+            return self.handle_outbound_message(message)
+        return self.forward_outbound_message(owner, message)
+
+    @inlineCallbacks
+    def forward_outbound_message(self, instance_id, message):
+        """
+        Publish an outbound message to the outbound queue of another instance
+        of this transport.
+        """
+        publisher = self._forward_publishers.get(instance_id)
+        if publisher is None:
+            publisher = yield self.publish_to('%s.outbound' % (
+                self.get_instance_connector_name(instance_id),))
+            self._forward_publishers[instance_id] = publisher
+        self.emit("HttpRpcTransport forwarding %s to %s" % (
+            message['message_id'], instance_id))
+        yield publisher.publish_message(message)
+
     @inlineCallbacks
     def setup_transport(self):
         self._requests = {}
-        self.request_gc = LoopingCall(self.manually_close_requests)
+        # A heap of (expiry time, request_id) pairs. Entries aren't removed
+        # when requests finish, so they need to be checked against
+        # self._requests when they're popped.
+        self._request_expiries = []
+        self._request_expiry_call = None
         self.clock = self.get_clock()
-        self.request_gc.clock = self.clock
-        self.request_gc.start(self.gc_requests_interval)
+        yield self.setup_metrics()
 
         rpc_resource = HttpRpcResource(self)
         rpc_resource = self.get_authenticated_resource(rpc_resource)
@@ -214,11 +299,29 @@ class HttpRpcTransport(Transport):
             return self.publish_status(**kw)
         return succeed(None)
 
+    @inlineCallbacks
+    def setup_metrics(self):
+        self.metrics = None
+        if self.metrics_prefix is None:
+            return
+        self.metrics = yield start_metric_manager(
+            self, self.metrics_prefix,
+            direct_config=self.get_static_config().direct_metrics)
+        self.metrics.register(
+            Gauge('pending_requests', lambda: len(self._requests)))
+        self._timeouts_metric = self.metrics.register(
+            Count('request_timeouts'))
+
     @inlineCallbacks
     def teardown_transport(self):
         yield self.web_resource.loseConnection()
-        if self.request_gc.running:
-            self.request_gc.stop()
+        if self._request_expiry_call is not None:
+            if self._request_expiry_call.active():
+                self._request_expiry_call.cancel()
+            self._request_expiry_call = None
+        if self.metrics is not None:
+            metrics, self.metrics = self.metrics, None
+            yield stop_metric_manager(metrics)
 
     def get_clock(self):
         """
@@ -249,13 +352,54 @@ class HttpRpcTransport(Transport):
                 missing_fields.append(field)
         return missing_fields
 
+    @property
+    def request_cleanup_enabled(self):
+        return self.gc_requests_interval >= 1
+
     def manually_close_requests(self):
-        for request_id, request_data in self._requests.items():
-            timestamp = request_data['timestamp']
-            response_time = self.clock.seconds() - timestamp
-            if response_time > self.request_timeout:
-                self.on_timeout(request_id, response_time)
-                self.close_request(request_id)
+        """
+        Time out all the requests that have waited for longer than
+        `request_timeout` and schedule the next check for when the oldest
+        remaining request expires.
+        """
+        now = self.clock.seconds()
+        # Timing out requests removes them, which may rebuild the heap, so
+        # we can't hold on to a reference to it here.
+        while (self._request_expiries and
+               self._request_expiries[0][0] <= now):
+            expiry, request_id = heapq.heappop(self._request_expiries)
+            request_data = self._requests.get(request_id)
+            if not self._expiry_is_current(expiry, request_data):
+                continue
+            response_time = now - request_data['timestamp']
+            if self.metrics is not None:
+                self._timeouts_metric.inc()
+            self.on_timeout(request_id, response_time)
+            self.close_request(request_id)
+        self._schedule_request_expiry()
+
+    def _expiry_is_current(self, expiry, request_data):
+        return (request_data is not None and
+                request_data['timestamp'] + self.request_timeout == expiry)
+
+    def _schedule_request_expiry(self):
+        if not self._request_expiries:
+            return
+        expiry = self._request_expiries[0][0]
+        call = self._request_expiry_call
+        if call is not None and call.active():
+            if call.getTime() <= expiry:
+                return
+            call.cancel()
+        self._request_expiry_call = self.clock.callLater(
+            max(0, expiry - self.clock.seconds()),
+            self.manually_close_requests)
+
+    def _rebuild_request_expiries(self):
+        self._request_expiries = [
+            (request_data['timestamp'] + self.request_timeout, request_id)
+            for request_id, request_data in self._requests.iteritems()]
+        heapq.heapify(self._request_expiries)
 
     def close_request(self, request_id):
         self.log.warning('Timing out %s' % (self.get_request_to_addr(request_id),))
@@ -263,9 +407,12 @@ class HttpRpcTransport(Transport):
                             self.request_timeout_status_code)
 
     def get_health_response(self):
-        return json.dumps({
+        health = {
             'pending_requests': len(self._requests)
-        })
+        }
+        if self.instance_id is not None:
+            health['instance_id'] = self.instance_id
+        return json.dumps(health)
 
     def set_request(self, request_id, request_object, timestamp=None):
         if timestamp is None:
@@ -274,6 +421,11 @@ class HttpRpcTransport(Transport):
             'timestamp': timestamp,
             'request': request_object,
         }
+        if self.request_cleanup_enabled:
+            heapq.heappush(
+                self._request_expiries,
+                (timestamp + self.request_timeout, request_id))
+            self._schedule_request_expiry()
 
     def get_request(self, request_id):
         if request_id in self._requests:
@@ -281,6 +433,10 @@ class HttpRpcTransport(Transport):
 
     def remove_request(self, request_id):
         del self._requests[request_id]
+        heap_size = len(self._request_expiries)
+        if (heap_size >= self.MIN_EXPIRY_HEAP_REBUILD_SIZE and
+                heap_size > 2 * len(self._requests)):
+            self._rebuild_request_expiries()
 
     def emit(self, msg):
         if self.noisy:
@@ -335,6 +491,11 @@ class HttpRpcTransport(Transport):
     #       in a consistent manner.
     def publish_message(self, **kwargs):
         self.set_request_to_addr(kwargs['message_id'], kwargs['to_addr'])
+        if self.instance_id is not None:
+            transport_metadata = kwargs.get('transport_metadata') or {}
+            transport_metadata[self.INSTANCE_ID_METADATA_KEY] = (
+                self.instance_id)
+            kwargs['transport_metadata'] = transport_metadata
         return super(HttpRpcTransport, self).publish_message(**kwargs)
 
     def get_request_to_addr(self, request_id):
@@ -1,8 +1,11 @@
 import json
 
+from twisted.internet.address import IPv4Address
 from twisted.internet.defer import inlineCallbacks
 from twisted.internet.task import Clock
+from twisted.web.test.requesthelper import DummyRequest
 
+from vumi.config import ConfigError
 from vumi.utils import http_request, http_request_full, basic_auth_string
 from vumi.tests.helpers import VumiTestCase
 from vumi.tests.utils import LogCatcher
@@ -84,6 +87,110 @@ class TestTransport(VumiTestCase):
         self.assertEqual(response.delivered_body, 'I am a teapot')
         self.assertEqual(response.code, 418)
 
+    def make_request(self, request_id, timestamp=None):
+        request = DummyRequest([''])
+        request.client = IPv4Address('TCP', '127.0.0.1', 1234)
+        self.transport.set_request(request_id, request, timestamp=timestamp)
+        return request
+
+    def test_timeout_is_precise(self):
+        request = self.make_request('req1')
+        self.clock.advance(9.9)
+        self.assertFalse(request.finished)
+        self.clock.advance(0.1)
+        self.assertTrue(request.finished)
+        self.assertEqual(request.responseCode, 418)
+        self.assertEqual(self.transport._requests, {})
+
+    def test_timeout_order(self):
+        req1 = self.make_request('req1')
+        self.clock.advance(3)
+        req2 = self.make_request('req2')
+        # An older request is added after a newer one.
+        req3 = self.make_request('req3', timestamp=self.clock.seconds() - 5)
+        self.clock.advance(5)
+        self.assertEqual([r.finished for r in req1, req2, req3], [0, 0, 1])
+        self.clock.advance(2)
+        self.assertEqual([r.finished for r in req1, req2, req3], [1, 0, 1])
+        self.clock.advance(3)
+        self.assertEqual([r.finished for r in req1, req2, req3], [1, 1, 1])
+        self.assertEqual(self.transport._request_expiries, [])
+
+    def test_finished_requests_not_timed_out(self):
+        timeouts = []
+        self.patch(self.transport, 'on_timeout',
+                   lambda request_id, time: timeouts.append(request_id))
+        self.make_request('req1')
+        self.transport.finish_request('req1', 'done')
+        # Reusing the request id resets its timeout.
+        self.clock.advance(5)
+        self.make_request('req1')
+        self.clock.advance(5)
+        self.assertEqual(timeouts, [])
+        self.clock.advance(5)
+        self.assertEqual(timeouts, ['req1'])
+
+    def test_expiry_heap_rebuilt(self):
+        self.patch(self.transport, 'MIN_EXPIRY_HEAP_REBUILD_SIZE', 4)
+        for i in range(4):
+            self.make_request('req%d' % (i,))
+        self.make_request('pending')
+        for i in range(3):
+            self.transport.finish_request('req%d' % (i,), 'done')
+        # The heap was rebuilt when it had more than twice as many entries
+        # as there are pending requests.
+        self.assertEqual(
+            sorted(self.transport._request_expiries),
+            [(10, 'pending'), (10, 'req3')])
+
+    @inlineCallbacks
+    def test_request_cleanup_disabled(self):
+        transport = yield self.tx_helper.get_transport({
+            'web_path': "foo",
+            'web_port': 0,
+            'request_timeout': 10,
+            'request_cleanup_interval': 0,
+        })
+        transport.set_request('req1', DummyRequest(['']))
+        self.clock.advance(20)
+        self.assertTrue('req1' in transport._requests)
+        self.assertEqual(transport._request_expiries, [])
+
+    @inlineCallbacks
+    def test_metrics(self):
+        transport = yield self.tx_helper.get_transport({
+            'web_path': "foo",
+            'web_port': 0,
+            'request_timeout': 10,
+            'metrics_prefix': 'vumi.test.',
+        })
+        transport.set_request('req1', DummyRequest(['']))
+        self.clock.advance(5)
+        transport.set_request('req2', DummyRequest(['']))
+        [(_, pending)] = transport.metrics['pending_requests'].poll()
+        self.assertEqual(pending, 2)
+        transport.get_request('req1').client = IPv4Address(
+            'TCP', '127.0.0.1', 1234)
+        self.clock.advance(5)
+        [(_, timeouts)] = transport.metrics['request_timeouts'].poll()
+        self.assertEqual(timeouts, 1.0)
+        [(_, pending)] = transport.metrics['pending_requests'].poll()
+        self.assertEqual(pending, 1)
+
+    @inlineCallbacks
+    def test_metrics_direct(self):
+        transport = yield self.tx_helper.get_transport({
+            'web_path': "foo",
+            'web_port': 0,
+            'metrics_prefix': 'vumi.test.',
+            'direct_metrics': {'host': '127.0.0.1', 'port': 2003},
+        })
+        publisher = transport.metrics.direct_publisher
+        self.assertNotEqual(publisher, None)
+        yield transport.teardown_transport()
+        self.assertEqual(transport.metrics, None)
+        self.assertEqual(publisher._udp_port, None)
+
     @inlineCallbacks
     def test_publish_health_status_repeated(self):
         '''Repeated statuses should not be published, new ones should be.'''
@@ -113,6 +220,83 @@ class TestTransport(VumiTestCase):
         self.assertEqual(status['status'], 'degraded')
 
 
+class TestMultiInstanceTransport(VumiTestCase):
+
+    def setUp(self):
+        self.tx_helper = self.add_helper(TransportHelper(OkTransport))
+
+    def get_transport(self, instance_id, **config):
+        config.update({
+            'web_path': "foo",
+            'web_port': 0,
+            'instance_id': instance_id,
+        })
+        return self.tx_helper.get_transport(config)
+
+    def test_invalid_instance_id(self):
+        for instance_id in ['', 'Upper']:
+            self.assertRaises(ConfigError, OkTransport.CONFIG_CLASS, {
+                'transport_name': 'sphex',
+                'web_path': 'foo',
+                'instance_id': instance_id,
+            })
+
+    @inlineCallbacks
+    def test_inbound_stamped_with_instance_id(self):
+        transport = yield self.get_transport('a')
+        d = http_request(transport.get_transport_url('foo'), '', method='GET')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(
+            msg['transport_metadata'], {'httprpc_instance_id': 'a'})
+        yield self.tx_helper.make_dispatch_reply(msg, 'OK')
+        yield d
+
+    @inlineCallbacks
+    def test_health(self):
+        transport = yield self.get_transport('a')
+        result = yield http_request(
+            transport.get_transport_url('health'), '', method='GET')
+        self.assertEqual(json.loads(result), {
+            'pending_requests': 0,
+            'instance_id': 'a',
+        })
+
+    @inlineCallbacks
+    def test_reply_forwarded_to_owner(self):
+        transport = yield self.get_transport('a')
+        msg = self.tx_helper.make_inbound(
+            'hi', transport_metadata={'httprpc_instance_id': 'b'})
+        reply = msg.reply('OK')
+        yield transport.route_outbound_message(reply)
+        [forwarded] = self.tx_helper.get_dispatched_outbound(
+            'sphex.instance.b')
+        self.assertEqual(forwarded, reply)
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+
+    @inlineCallbacks
+    def test_reply_for_local_request(self):
+        transport = yield self.get_transport('a')
+        d = http_request(transport.get_transport_url('foo'), '', method='GET')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        yield self.tx_helper.make_dispatch_reply(msg, 'OK')
+        self.assertEqual((yield d), 'OK')
+        self.assertEqual(
+            self.tx_helper.get_dispatched_outbound('sphex.instance.a'), [])
+
+    @inlineCallbacks
+    def test_reply_via_other_instance(self):
+        transport_a = yield self.get_transport('a')
+        transport_b = yield self.get_transport('b')
+        d = http_request(
+            transport_a.get_transport_url('foo'), '', method='GET')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        yield transport_b.route_outbound_message(msg.reply('OK'))
+        yield self.tx_helper.kick_delivery()
+        self.assertEqual((yield d), 'OK')
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['event_type'], 'ack')
+
+
 class TestTransportWithAuthentication(VumiTestCase):
 
     @inlineCallbacks
@@ -1,16 +1,13 @@
 # -*- test-case-name: vumi.transports.tests.test_scheduler -*-
-import time
-import iso8601
-import pytz
 import json
 from datetime import datetime
-from uuid import uuid4
 import warnings
 
-from twisted.internet.defer import inlineCallbacks
-from twisted.internet.task import LoopingCall
+from twisted.internet.defer import returnValue
 
 from vumi import message
+from vumi.components.delayed_jobs import DelayedJobQueue
+from vumi.persist.redis_base import Manager
 
 
 warnings.warn("vumi.transport.scheduler is deprecated. A replacement is coming"
@@ -21,82 +18,48 @@ class Scheduler(object):
     """
     Base class for stuff that needs to be published to a given queue
     at a given time.
+
+    Scheduled payloads are stored in a
+    :class:`vumi.components.delayed_jobs.DelayedJobQueue`.
+
+    :param redis:
+        A Redis manager.
+    :param callback:
+        Called with the time a payload was scheduled at (as an ISO 8601
+        string) and the payload once the payload is due.
+    :param str prefix:
+        The prefix for the scheduler's Redis keys.
+    :param granularity:
+        Ignored. Payloads used to be delivered in buckets of this many
+        seconds, but are now delivered as soon as they are due.
+    :param delivery_period:
+        The number of seconds between checks for due payloads.
     """
 
     def __init__(self, redis, callback, prefix='scheduler',
-                    granularity=5, delivery_period=3, json_encoder=None,
-                    json_decoder=None):
-        self.r_server = redis
+                 granularity=None, delivery_period=3, json_encoder=None,
+                 json_decoder=None,
+                 batch_size=DelayedJobQueue.DEFAULT_BATCH_SIZE,
+                 concurrency=DelayedJobQueue.DEFAULT_CONCURRENCY):
+        self.redis = redis.sub_manager(prefix)
         self.r_prefix = prefix
-        self.granularity = granularity
         self.delivery_period = delivery_period
-        self._scheduled_timestamps_key = self.r_key("scheduled_timestamps")
         self.callback = callback
         self.json_encoder = json_encoder or message.JSONMessageEncoder
         self.json_decoder = json_decoder or message.date_time_decoder
-        self.loop = LoopingCall(self.deliver_scheduled)
+        self.queue = DelayedJobQueue(
+            self.redis, self.deliver_job, name='scheduled',
+            batch_size=batch_size, concurrency=concurrency)
 
     @property
     def is_running(self):
-        return self.loop.running
+        return self.queue.is_running
 
     def start(self):
-        if not self.loop.running:
-            self.loop.start(self.delivery_period, now=True)
+        self.queue.start(self.delivery_period)
 
     def stop(self):
-        if self.loop.running:
-            self.loop.stop()
-
-    def r_key(self, key):
-        """
-        Prefix ``key`` with a worker-specific string.
-        """
-        return "#".join((self.r_prefix, key))
-
-    def scheduled_key(self):
-        """
-        Construct a unique scheduled key.
-        """
-        timestamp = datetime.utcnow()
-        unique_id = uuid4().get_hex()
-        timestamp = timestamp.isoformat().split('.')[0]
-        return self.r_key(".".join(("scheduled", timestamp, unique_id)))
-
-    def get_scheduled(self, scheduled_key):
-        return self.r_server.hgetall(scheduled_key)
-
-    def get_next_write_timestamp(self, delta, now):
-        now = int(now)
-        return self.get_time_bucket(now + delta)
-
-    def get_time_bucket(self, timestamp):
-        timestamp += self.granularity - (timestamp % self.granularity)
-        return datetime.utcfromtimestamp(timestamp).isoformat().split('.')[0]
-
-    def get_read_timestamp(self, now):
-        now = int(now)
-        timestamp = datetime.utcfromtimestamp(now).replace(tzinfo=pytz.UTC)
-        next_timestamp = self.r_server.zrange(self._scheduled_timestamps_key,
-                                                0, 0)
-        if next_timestamp:
-            if iso8601.parse_date(next_timestamp[0]) <= timestamp:
-                return next_timestamp[0]
-        return None
-
-    def get_next_read_timestamp(self):
-        return self.get_read_timestamp(time.time())
-
-    def get_scheduled_key(self, time):
-        timestamp = self.get_time_bucket(time)
-        bucket_key = self.r_key("scheduled_keys." + timestamp)
-        # key of message to be delivered
-        scheduled_key = self.r_server.spop(bucket_key)
-        # if the set is empty, remove the timestamp entry from the
-        # scheduled timestamps key
-        if self.r_server.scard(bucket_key) < 1:
-            self.r_server.zrem(self._scheduled_timestamps_key, timestamp)
-        return scheduled_key
+        return self.queue.stop()
 
     def schedule(self, delta, payload, now=None):
         """
@@ -109,59 +72,44 @@ class Scheduler(object):
         :param now: Used to calculate the delta (timestamp in
                     seconds since epoch)
 
-        If ``now`` is ``None`` then it will default to ``time.time()``
+        If ``now`` is ``None`` then it will default to the current time.
+
+        Returns a deferred that fires with the key of the scheduled payload.
         """
         # do this first as we want it to blow up before any keys
         # are set should the content not be JSON encodable
-        if not now:
-            now = int(time.time())
-
-        key = self.scheduled_key()
-        self.add_to_scheduled_set(key)
-        bucket_key = self.store_scheduled(key, delta, now)
-        self.r_server.hmset(key, {
+        data = json.dumps({
             'payload': json.dumps(payload, cls=self.json_encoder),
             'scheduled_at': datetime.utcnow().isoformat(),
-            'bucket_key': bucket_key,
-        })
-        return key, bucket_key
-
-    def add_to_scheduled_set(self, key):
-        self.r_server.sadd(self.r_key("scheduled_keys"), key)
-
-    def store_scheduled(self, scheduled_key, delta, now):
-        timestamp = self.get_next_write_timestamp(delta, now)
-        bucket_key = self.r_key("scheduled_keys." + timestamp)
-        self.r_server.sadd(bucket_key, scheduled_key)
-        self.store_read_timestamp(timestamp)
-        return bucket_key
-
-    def store_read_timestamp(self, timestamp):
-        score = time.mktime(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%S"))
-        self.r_server.zadd(self._scheduled_timestamps_key, **{
-            timestamp: score
         })
+        return self.queue.schedule(delta, data, now=now)
 
+    @Manager.calls_manager('redis')
+    def get_scheduled(self, scheduled_key):
+        """
+        Return the payload scheduled with ``scheduled_key`` and the time it
+        was scheduled at as a dict with ``payload`` and ``scheduled_at`` keys,
+        or ``None`` if there isn't one.
+        """
+        data = yield self.queue.get_data(scheduled_key)
+        returnValue(json.loads(data) if data else None)
+
+    @Manager.calls_manager('redis')
     def get_all_scheduled_keys(self):
-        return self.r_server.smembers(self.r_key("scheduled_keys"))
+        returnValue(set((yield self.queue.get_job_ids())))
+
+    def deliver_job(self, job):
+        scheduled_data = json.loads(job.data)
+        payload = json.loads(scheduled_data['payload'],
+                             object_hook=self.json_decoder)
+        return self.callback(scheduled_data['scheduled_at'], payload)
 
-    @inlineCallbacks
     def deliver_scheduled(self, _time=None):
-        _time = _time or int(time.time())
-        while True:
-            scheduled_key = self.get_scheduled_key(_time - self.granularity)
-            if not scheduled_key:
-                return
-            scheduled_data = self.get_scheduled(scheduled_key)
-            scheduled_at = scheduled_data['scheduled_at']
-            payload = json.loads(scheduled_data['payload'],
-                                    object_hook=self.json_decoder)
-            yield self.callback(scheduled_at, payload)
-            self.clear_scheduled(scheduled_key)
+        """
+        Deliver all the payloads due at ``_time`` (which defaults to the
+        current time).
+        """
+        return self.queue.deliver_due(_time)
 
     def clear_scheduled(self, key):
-        self.r_server.srem(self.r_key("scheduled_keys"), key)
-        message_data = self.get_scheduled(key)
-        bucket_key = message_data['bucket_key']
-        self.r_server.srem(bucket_key, key)
-        self.r_server.delete(key)
+        return self.queue.remove(key)
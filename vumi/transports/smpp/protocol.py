@@ -322,22 +322,24 @@ class EsmeProtocol(Protocol):
             SMPP specification for full list of options.
         """
         message_stash = self.service.message_stash
-        d = message_stash.get_sequence_number_message_id(sequence_number)
-
-        # only set the remote message id if the submission was successful, we
-        # use remote message ids for delivery reports, so we won't need remote
-        # message ids for failed submissions
-        if command_status == 'ESME_ROK':
+        if command_status in self.service.throttle_statuses:
+            # The cached PDU is needed to retry the submission, so we leave
+            # everything in place.
+            d = message_stash.get_sequence_number_message_id(sequence_number)
             d.addCallback(
-                message_stash.set_remote_message_id, smpp_message_id)
-
-        d.addCallback(
-            self._handle_submit_sm_resp_callback, smpp_message_id,
-            command_status, sequence_number)
+                self._handle_submit_sm_resp_callback, sequence_number)
+            return d
+
+        # We only store the remote message id if the submission was
+        # successful, we use remote message ids for delivery reports, so we
+        # won't need remote message ids for failed submissions
+        event_type = 'ack' if command_status == 'ESME_ROK' else 'fail'
+        d = message_stash.complete_submit_sm(
+            sequence_number, smpp_message_id, event_type)
+        d.addCallback(self._handle_submit_sm_result_callback, command_status)
         return d
 
-    def _handle_submit_sm_resp_callback(self, message_id, smpp_message_id,
-                                        command_status, sequence_number):
+    def _handle_submit_sm_resp_callback(self, message_id, sequence_number):
         if message_id is None:
             # We have no message_id, so log a warning instead of calling the
             # callback.
@@ -345,8 +347,16 @@ class EsmeProtocol(Protocol):
                 "Failed to retrieve message id for deliver_sm_resp."
                 " ack/nack from %s discarded." % self.service.transport_name)
         else:
-            return self.service.handle_submit_sm_resp(
-                message_id, smpp_message_id, command_status, sequence_number)
+            return self.service.handle_submit_sm_throttled(sequence_number)
+
+    def _handle_submit_sm_result_callback(self, result, command_status):
+        if result is None:
+            self.log.warning(
+                "Failed to retrieve message id for deliver_sm_resp."
+                " ack/nack from %s discarded." % self.service.transport_name)
+        else:
+            return self.service.handle_submit_sm_result(
+                result, command_status)
 
     @inlineCallbacks
     def handle_deliver_sm(self, pdu):
@@ -527,9 +537,7 @@ class EsmeProtocol(Protocol):
 
     @inlineCallbacks
     def send_submit_sm(self, vumi_message_id, pdu):
-        yield self.service.message_stash.cache_pdu(vumi_message_id, pdu)
-        yield self.service.message_stash.set_sequence_number_message_id(
-            seq_no(pdu.obj), vumi_message_id)
+        yield self.service.message_stash.cache_submit_sm(vumi_message_id, pdu)
         self.send_pdu(pdu)
 
     @require_bind
@@ -215,16 +215,8 @@ class SmppService(ReconnectingClientService):
         yield self.transport.pause_connectors()
         yield self.transport.on_connection_lost(reason)
 
-    def handle_submit_sm_resp(self, message_id, smpp_id, pdu_status, seq_no):
-        if pdu_status in self.throttle_statuses:
-            return self.handle_submit_sm_throttled(seq_no)
-        func = self.transport.handle_submit_sm_failure
-        if pdu_status == 'ESME_ROK':
-            func = self.transport.handle_submit_sm_success
-        ms = self.message_stash
-        d = func(message_id, smpp_id, pdu_status)
-        d.addCallback(lambda _: ms.delete_cached_pdu(seq_no))
-        d.addCallback(lambda _: ms.delete_sequence_number_message_id(seq_no))
+    def handle_submit_sm_result(self, result, pdu_status):
+        d = self.transport.handle_submit_sm_result(result, pdu_status)
         return d.addCallback(self.check_stop_throttling_cb, 0)
 
     def handle_submit_sm_throttled(self, message_id):
@@ -10,6 +10,7 @@ from twisted.internet.defer import inlineCallbacks, returnValue, succeed
 from smpp.pdu import decode_pdu
 from smpp.pdu_builder import PDU
 from vumi.message import TransportUserMessage
+from vumi.persist.redis_base import RedisScript
 from vumi.persist.txredis_manager import TxRedisManager
 from vumi.transports.base import Transport
 from vumi.transports.smpp.config import SmppTransportConfig
@@ -40,6 +41,164 @@ def remote_message_key(message_id):
     return 'remote_message:%s' % (message_id,)
 
 
+def _init_multipart_info(redis, keys, args):
+    [mp_key] = keys
+    part_count, expiry = args
+    redis.hmset(mp_key, {'parts': part_count})
+    redis.expire(mp_key, int(expiry))
+    return 1
+
+
+INIT_MULTIPART_INFO_SCRIPT = RedisScript("""
+redis.call('HSET', KEYS[1], 'parts', ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+""", _init_multipart_info)
+
+
+def _cache_submit_sm(redis, keys, args):
+    pdu_key, seq_key = keys
+    expiry, pdu_json, message_id = args
+    redis.setex(pdu_key, int(expiry), pdu_json)
+    redis.setex(seq_key, int(expiry), message_id)
+    return 1
+
+
+CACHE_SUBMIT_SM_SCRIPT = RedisScript("""
+redis.call('SETEX', KEYS[1], ARGV[1], ARGV[2])
+redis.call('SETEX', KEYS[2], ARGV[1], ARGV[3])
+return 1
+""", _cache_submit_sm)
+
+
+def _complete_submit_sm(redis, keys, args):
+    seq_key, pdu_key, remote_key, message_prefix, mp_prefix = keys
+    event_type, remote_id, remote_expiry, mp_expiry = args
+    message_id = redis.get(seq_key)
+    if message_id is None:
+        return []
+    if event_type == 'ack':
+        redis.setex(remote_key, int(remote_expiry), message_id)
+    message_key = message_prefix + message_id
+    mp_key = mp_prefix + message_id
+    event_required = 1
+    if redis.exists(mp_key):
+        redis.hset(mp_key, 'part:%s' % (remote_id,), event_type)
+        if event_type == 'fail':
+            redis.hset(mp_key, 'event_result', 'fail')
+        mp_info = redis.hgetall(mp_key)
+        part_statuses = dict(
+            (k[5:], v) for k, v in mp_info.items() if k.startswith('part:'))
+        remote_id = ','.join(sorted(part_statuses.keys()))
+        if 'event_result' in mp_info:
+            event_type = mp_info['event_result']
+        elif ('parts' in mp_info and
+                len(part_statuses) >= int(mp_info['parts'])):
+            if all(v == 'ack' for v in part_statuses.values()):
+                event_type = 'ack'
+            else:
+                event_type = 'fail'
+        else:
+            event_required = 0
+        if event_required and redis.hincrby(mp_key, 'event_counter', 1) != 1:
+            event_required = 0
+    message_json = ''
+    if event_required:
+        if event_type != 'ack':
+            message_json = redis.get(message_key) or ''
+        if event_type == 'ack' or message_json:
+            redis.delete(message_key)
+            redis.expire(mp_key, int(mp_expiry))
+    redis.delete(pdu_key)
+    redis.delete(seq_key)
+    return [message_id, event_required, event_type, remote_id, message_json]
+
+
+COMPLETE_SUBMIT_SM_SCRIPT = RedisScript("""
+local message_id = redis.call('GET', KEYS[1])
+if not message_id then
+    return {}
+end
+local event_type = ARGV[1]
+local remote_id = ARGV[2]
+if event_type == 'ack' then
+    redis.call('SETEX', KEYS[3], ARGV[3], message_id)
+end
+local message_key = KEYS[4] .. message_id
+local mp_key = KEYS[5] .. message_id
+local event_required = 1
+if redis.call('EXISTS', mp_key) == 1 then
+    redis.call('HSET', mp_key, 'part:' .. remote_id, event_type)
+    if event_type == 'fail' then
+        redis.call('HSET', mp_key, 'event_result', 'fail')
+    end
+    local mp_info = redis.call('HGETALL', mp_key)
+    local parts, event_result, part_ids, all_acked = nil, nil, {}, true
+    for i = 1, #mp_info, 2 do
+        local field, value = mp_info[i], mp_info[i + 1]
+        if field == 'parts' then
+            parts = tonumber(value)
+        elseif field == 'event_result' then
+            event_result = value
+        elseif string.sub(field, 1, 5) == 'part:' then
+            table.insert(part_ids, string.sub(field, 6))
+            if value ~= 'ack' then
+                all_acked = false
+            end
+        end
+    end
+    table.sort(part_ids)
+    remote_id = table.concat(part_ids, ',')
+    if event_result then
+        event_type = event_result
+    elseif parts and #part_ids >= parts then
+        if all_acked then
+            event_type = 'ack'
+        else
+            event_type = 'fail'
+        end
+    else
+        event_required = 0
+    end
+    if event_required == 1 and
+            redis.call('HINCRBY', mp_key, 'event_counter', 1) ~= 1 then
+        event_required = 0
+    end
+end
+local message_json = ''
+if event_required == 1 then
+    if event_type ~= 'ack' then
+        message_json = redis.call('GET', message_key) or ''
+    end
+    if event_type == 'ack' or message_json ~= '' then
+        redis.call('DEL', message_key)
+        redis.call('EXPIRE', mp_key, ARGV[4])
+    end
+end
+redis.call('DEL', KEYS[2])
+redis.call('DEL', KEYS[1])
+return {message_id, event_required, event_type, remote_id, message_json}
+""", _complete_submit_sm)
+
+
+def _get_and_expire(redis, keys, args):
+    [key] = keys
+    [expiry] = args
+    value = redis.get(key)
+    if value is not None:
+        redis.expire(key, int(expiry))
+    return value
+
+
+GET_AND_EXPIRE_SCRIPT = RedisScript("""
+local value = redis.call('GET', KEYS[1])
+if value then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return value
+""", _get_and_expire)
+
+
 class CachedPDU(object):
     """
     A cached PDU with its associated vumi message_id.
@@ -67,6 +226,30 @@ class CachedPDU(object):
         })
 
 
+class SubmitSmResult(object):
+    """
+    The outcome of :meth:`SmppMessageDataStash.complete_submit_sm`.
+
+    :ivar str message_id: The vumi message id.
+    :ivar bool event_required: Whether an event should be published.
+    :ivar str event_type: ``'ack'`` or ``'fail'``, if an event is required.
+    :ivar str remote_id:
+        The remote message id, or a comma-separated list of part ids for
+        multipart messages.
+    :ivar message:
+        The cached :class:`TransportUserMessage`. This is only provided for
+        failures, and is ``None`` if the message is no longer cached.
+    """
+
+    def __init__(self, message_id, event_required, event_type, remote_id,
+                 message):
+        self.message_id = message_id
+        self.event_required = event_required
+        self.event_type = event_type
+        self.remote_id = remote_id
+        self.message = message
+
+
 class SmppMessageDataStash(object):
     """
     Stash message data in Redis.
@@ -79,11 +262,8 @@ class SmppMessageDataStash(object):
     def init_multipart_info(self, message_id, part_count):
         key = multipart_info_key(message_id)
         expiry = self.config.submit_sm_expiry
-        d = self.redis.hmset(key, {
-            'parts': part_count,
-        })
-        d.addCallback(lambda _: self.redis.expire(key, expiry))
-        return d
+        return self.redis.run_script(
+            INIT_MULTIPART_INFO_SCRIPT, [key], [part_count, expiry])
 
     def get_multipart_info(self, message_id):
         key = multipart_info_key(message_id)
@@ -212,6 +392,19 @@ class SmppMessageDataStash(object):
         expiry = self.config.submit_sm_expiry
         return self.redis.setex(key, expiry, cached_pdu.to_json())
 
+    def cache_submit_sm(self, vumi_message_id, pdu):
+        """
+        Cache a ``submit_sm`` PDU and map its sequence number to the vumi
+        message id in a single round trip.
+        """
+        cached_pdu = CachedPDU(vumi_message_id, pdu)
+        expiry = self.config.submit_sm_expiry
+        return self.redis.run_script(
+            CACHE_SUBMIT_SM_SCRIPT,
+            [pdu_key(cached_pdu.seq_no),
+             sequence_number_key(cached_pdu.seq_no)],
+            [expiry, cached_pdu.to_json(), vumi_message_id])
+
     def get_cached_pdu(self, seq_no):
         d = self.redis.get(pdu_key(seq_no))
         return d.addCallback(CachedPDU.from_json)
@@ -232,8 +425,17 @@ class SmppMessageDataStash(object):
         d.addCallback(lambda _: message_id)
         return d
 
-    def get_internal_message_id(self, smpp_message_id):
-        return self.redis.get(remote_message_key(smpp_message_id))
+    def get_internal_message_id(self, smpp_message_id, final=False):
+        """
+        Look up the vumi message id for a remote message id. If ``final`` is
+        ``True``, the mapping is also set to expire after
+        ``final_dr_third_party_id_expiry`` seconds in the same round trip.
+        """
+        key = remote_message_key(smpp_message_id)
+        if not final:
+            return self.redis.get(key)
+        expiry = self.config.final_dr_third_party_id_expiry
+        return self.redis.run_script(GET_AND_EXPIRE_SCRIPT, [key], [expiry])
 
     def delete_remote_message_id(self, smpp_message_id):
         key = remote_message_key(smpp_message_id)
@@ -244,6 +446,49 @@ class SmppMessageDataStash(object):
         expire = self.config.final_dr_third_party_id_expiry
         return self.redis.expire(key, expire)
 
+    def _complete_submit_sm_cb(self, result):
+        if not result:
+            return None
+        message_id, event_required, event_type, remote_id, msg_json = result
+        message = (
+            TransportUserMessage.from_json(msg_json) if msg_json else None)
+        return SubmitSmResult(
+            message_id, bool(event_required), event_type, remote_id, message)
+
+    def complete_submit_sm(self, seq_no, smpp_message_id, event_type):
+        """
+        Process a ``submit_sm_resp`` in a single round trip.
+
+        This looks up the vumi message id for the sequence number, stores the
+        remote message id (for acks), updates any multipart info, determines
+        whether an event needs to be published, clears the cached message if
+        it does, and deletes the cached PDU and sequence number mapping.
+
+        :param int seq_no:
+            The sequence number of the ``submit_sm_resp``.
+        :param str smpp_message_id:
+            The message id the SMSC assigned to the message.
+        :param str event_type:
+            Either ``'ack'`` or ``'fail'``.
+
+        :returns:
+            A :class:`SubmitSmResult`, or ``None`` if the sequence number is
+            unknown.
+        """
+        d = self.redis.run_script(COMPLETE_SUBMIT_SM_SCRIPT, [
+            sequence_number_key(seq_no),
+            pdu_key(seq_no),
+            remote_message_key(smpp_message_id),
+            message_key(''),
+            multipart_info_key(''),
+        ], [
+            event_type,
+            smpp_message_id,
+            self.config.third_party_id_expiry,
+            self.config.completed_multipart_info_expiry,
+        ])
+        return d.addCallback(self._complete_submit_sm_cb)
+
 
 class SmppTransceiverTransport(Transport):
 
@@ -408,62 +653,41 @@ class SmppTransceiverTransport(Transport):
         if not self._check_address_valid(message, 'from_addr'):
             yield self._reject_for_invalid_address(message, 'from_addr')
             return
-        yield self.message_stash.cache_message(message)
+        # The message is cached concurrently with the submission. Redis
+        # executes commands in order, so it will be there by the time the
+        # submit_sm_resp is processed.
+        cache_d = self.message_stash.cache_message(message)
         yield self.submit_sm_processor.handle_outbound_message(
             message, self.service)
+        yield cache_d
 
     @inlineCallbacks
-    def process_submit_sm_event(self, message_id, event_type, remote_id,
-                                command_status):
-        if event_type == 'ack':
-            yield self.message_stash.delete_cached_message(message_id)
-            yield self.message_stash.expire_multipart_info(message_id)
+    def handle_submit_sm_result(self, result, command_status):
+        """
+        Publish the event (if any) for a processed ``submit_sm_resp``.
+
+        :param SubmitSmResult result:
+            The result of :meth:`SmppMessageDataStash.complete_submit_sm`.
+        :param str command_status:
+            The SMPP command_status of the ``submit_sm_resp``.
+        """
+        if not result.event_required:
+            return
+        if result.event_type == 'ack':
             if not self.disable_ack:
-                yield self.publish_ack(message_id, remote_id)
+                yield self.publish_ack(result.message_id, result.remote_id)
+            return
+        command_status = command_status or 'Unspecified'
+        if result.message is None:
+            self.log.warning(
+                "Could not retrieve failed message: %s" % (
+                    result.message_id,))
         else:
-            if event_type != 'fail':
-                self.log.warning(
-                    "Unexpected multipart event type %r, assuming 'fail'" % (
-                        event_type,))
-            err_msg = yield self.message_stash.get_cached_message(message_id)
-            command_status = command_status or 'Unspecified'
-            if err_msg is None:
-                self.log.warning(
-                    "Could not retrieve failed message: %s" % (message_id,))
-            else:
-                yield self.message_stash.delete_cached_message(message_id)
-                yield self.message_stash.expire_multipart_info(message_id)
-                yield self.publish_nack(message_id, command_status)
-                yield self.failure_publisher.publish_message(
-                    FailureMessage(message=err_msg.payload,
-                                   failure_code=None,
-                                   reason=command_status))
-
-    @inlineCallbacks
-    def handle_submit_sm_success(self, message_id, smpp_message_id,
-                                 command_status):
-        yield self.message_stash.update_multipart_info_success(
-            message_id, smpp_message_id)
-
-        event_info = yield self.message_stash.get_multipart_event_info(
-            message_id, 'ack', smpp_message_id)
-        event_required, event_type, remote_id = event_info
-        if event_required:
-            yield self.process_submit_sm_event(
-                message_id, event_type, remote_id, command_status)
-
-    @inlineCallbacks
-    def handle_submit_sm_failure(self, message_id, smpp_message_id,
-                                 command_status):
-        yield self.message_stash.update_multipart_info_failure(
-            message_id, smpp_message_id)
-
-        event_info = yield self.message_stash.get_multipart_event_info(
-            message_id, 'fail', smpp_message_id)
-        event_required, event_type, remote_id = event_info
-        if event_required:
-            yield self.process_submit_sm_event(
-                message_id, event_type, remote_id, command_status)
+            yield self.publish_nack(result.message_id, command_status)
+            yield self.failure_publisher.publish_message(
+                FailureMessage(message=result.message.payload,
+                               failure_code=None,
+                               reason=command_status))
 
     def handle_raw_inbound_message(self, **kwargs):
         # TODO: drop the kwargs, list the allowed key word arguments
@@ -500,7 +724,8 @@ class SmppTransceiverTransport(Transport):
             self, receipted_message_id, delivery_status,
             smpp_delivery_status):
         message_id = yield self.message_stash.get_internal_message_id(
-            receipted_message_id)
+            receipted_message_id,
+            final=delivery_status in ('delivered', 'failed'))
         if message_id is None:
             self.log.info(
                 "Failed to retrieve message id for delivery report."
@@ -518,10 +743,6 @@ class SmppTransceiverTransport(Transport):
                     'smpp_delivery_status': smpp_delivery_status,
                 })
 
-        if delivery_status in ('delivered', 'failed'):
-            yield self.message_stash.expire_remote_message_id(
-                receipted_message_id)
-
         returnValue(dr)
 
 
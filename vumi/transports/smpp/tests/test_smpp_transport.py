@@ -5,7 +5,7 @@ import logging
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.task import Clock
 
-from smpp.pdu_builder import DeliverSM, SubmitSMResp
+from smpp.pdu_builder import DeliverSM, SubmitSM, SubmitSMResp
 from vumi.config import ConfigError
 from vumi.message import TransportUserMessage
 from vumi.tests.helpers import VumiTestCase
@@ -1316,10 +1316,12 @@ class SmppTransceiverTransportTestCase(SmppTransportTestCase):
         # After all parts are acknowledged, our multipart_info hash should have
         # the details of the responses and a much shorter TTL.
         mstash = transport.message_stash
+        # Each response is processed atomically, so only the second one sees
+        # all the parts and increments the event counter.
         multipart_info = yield mstash.get_multipart_info(msg['message_id'])
         self.assertEqual(multipart_info, {
             "parts": "2",
-            "event_counter": "2",
+            "event_counter": "1",
             "part:foo": "ack",
             "part:bar": "ack",
         })
@@ -1498,6 +1500,68 @@ class SmppTransceiverTransportTestCase(SmppTransportTestCase):
         message_id = yield message_stash.get_sequence_number_message_id(37)
         self.assertEqual(message_id, None)
 
+    @inlineCallbacks
+    def test_complete_submit_sm(self):
+        """
+        Completing a submit_sm returns the event to publish and clears the
+        cached PDU, sequence number mapping and message.
+        """
+        transport = yield self.get_transport()
+        message_stash = transport.message_stash
+        msg = self.tx_helper.make_outbound('hello world')
+        pdu = SubmitSM(sequence_number=37, short_message='hello world')
+
+        yield message_stash.cache_message(msg)
+        yield message_stash.cache_submit_sm(msg['message_id'], pdu)
+        cached_pdu = yield message_stash.get_cached_pdu(37)
+        self.assertEqual(cached_pdu.vumi_message_id, msg['message_id'])
+
+        result = yield message_stash.complete_submit_sm(37, 'foo', 'ack')
+        self.assertEqual(result.message_id, msg['message_id'])
+        self.assertEqual(result.event_required, True)
+        self.assertEqual(result.event_type, 'ack')
+        self.assertEqual(result.remote_id, 'foo')
+        self.assertEqual(result.message, None)
+
+        self.assertEqual(
+            (yield message_stash.get_internal_message_id('foo')),
+            msg['message_id'])
+        self.assertEqual((yield message_stash.get_cached_pdu(37)), None)
+        self.assertEqual(
+            (yield message_stash.get_sequence_number_message_id(37)), None)
+        self.assertEqual(
+            (yield message_stash.get_cached_message(msg['message_id'])), None)
+
+    @inlineCallbacks
+    def test_complete_submit_sm_failure(self):
+        """
+        Completing a failed submit_sm returns the cached message and doesn't
+        store the remote message id.
+        """
+        transport = yield self.get_transport()
+        message_stash = transport.message_stash
+        msg = self.tx_helper.make_outbound('hello world')
+
+        yield message_stash.cache_message(msg)
+        yield message_stash.set_sequence_number_message_id(
+            37, msg['message_id'])
+
+        result = yield message_stash.complete_submit_sm(37, 'foo', 'fail')
+        self.assertEqual(result.event_required, True)
+        self.assertEqual(result.event_type, 'fail')
+        self.assertEqual(result.message, msg)
+        self.assertEqual(
+            (yield message_stash.get_internal_message_id('foo')), None)
+        self.assertEqual(
+            (yield message_stash.get_cached_message(msg['message_id'])), None)
+
+    @inlineCallbacks
+    def test_complete_submit_sm_unknown_sequence_number(self):
+        transport = yield self.get_transport()
+        result = yield transport.message_stash.complete_submit_sm(
+            37, 'foo', 'ack')
+        self.assertEqual(result, None)
+
     @inlineCallbacks
     def test_link_remote_message_id(self):
         transport = yield self.get_transport()
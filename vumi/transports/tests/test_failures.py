@@ -1,19 +1,16 @@
 import time
 import json
-from datetime import datetime, timedelta
+import random
 
+from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import deferLater
 
 from vumi.message import Message
-from vumi.transports.failures import FailureWorker
+from vumi.transports.failures import FailureMessage, FailureWorker
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper, WorkerHelper
 
 
-def mktimestamp(delta=0):
-    timestamp = datetime.utcnow() + timedelta(seconds=delta)
-    return timestamp.isoformat().split('.')[0]
-
-
 class TestFailureWorker(VumiTestCase):
 
     def setUp(self):
@@ -21,7 +18,7 @@ class TestFailureWorker(VumiTestCase):
         return self.make_worker()
 
     @inlineCallbacks
-    def make_worker(self, retry_delivery_period=0):
+    def make_worker(self, retry_delivery_period=0, **kw):
         self.worker_helper = self.add_helper(WorkerHelper('sphex'))
         config = self.persistence_helper.mk_config({
             'transport_name': 'sphex',
@@ -29,39 +26,22 @@ class TestFailureWorker(VumiTestCase):
             'failures_routing_key': 'sms.failures.%(transport_name)s',
             'retry_delivery_period': retry_delivery_period,
         })
+        config.update(kw)
+        # Purge before the worker starts so that we don't interfere with
+        # retry delivery.
+        redis = yield self.persistence_helper.get_redis_manager()
+        yield redis.sub_manager("failures:sphex")._purge_all()  # Just in case
         self.worker = yield self.worker_helper.get_worker(
             FailureWorker, config)
         self.redis = self.worker.redis
-        yield self.redis._purge_all()  # Just in case
-
-    def assert_write_timestamp(self, expected, delta, now):
-        self.assertEqual(expected,
-                         self.worker.get_next_write_timestamp(delta, now=now))
-
-    @inlineCallbacks
-    def assert_zcard(self, expected, key):
-        self.assertEqual(expected, (yield self.redis.zcard(key)))
 
     @inlineCallbacks
     def assert_equal_d(self, expected, value):
         self.assertEqual((yield expected), (yield value))
 
     @inlineCallbacks
-    def assert_not_equal_d(self, expected, value):
-        self.assertNotEqual((yield expected), (yield value))
-
-    @inlineCallbacks
-    def assert_get_retry_key(self, exists=True):
-        retry_key = yield self.worker.get_next_retry_key()
-        if exists:
-            self.assertNotEqual(None, retry_key)
-        else:
-            self.assertEqual(None, retry_key)
-
-    @inlineCallbacks
-    def assert_stored_timestamps(self, *expected):
-        timestamps = yield self.redis.zrange('retry_timestamps', 0, -1)
-        self.assertEqual(list(expected), timestamps)
+    def assert_retry_keys(self, *expected):
+        self.assertEqual(list(expected), (yield self.worker.get_retry_keys()))
 
     def assert_published_retries(self, expected):
         msgs = self.worker_helper.get_dispatched(
@@ -75,12 +55,12 @@ class TestFailureWorker(VumiTestCase):
             message = {'message': 'foo', 'reason': reason}
         return self.worker.store_failure(message, reason)
 
-    @inlineCallbacks
-    def store_retry(self, retry_delay=0, now_delta=0, reason=None,
-                    message_json=None):
-        key = yield self.store_failure(reason, message_json)
-        now = time.time() + now_delta
-        yield self.worker.store_retry(key, retry_delay, now=now)
+    def store_retry(self, retry_delay, reason=None, message=None):
+        if not reason:
+            reason = "bad stuff happened"
+        if not message:
+            message = {'message': 'foo', 'reason': reason}
+        return self.worker.store_failure(message, reason, retry_delay)
 
     @inlineCallbacks
     def test_redis_access(self):
@@ -123,168 +103,50 @@ class TestFailureWorker(VumiTestCase):
                 "reason": "reason",
                 }, self.redis.hgetall(key2))
 
-    def test_write_timestamp(self):
-        """
-        We need granular timestamps.
-        """
-        start = datetime.utcnow().isoformat()
-        timestamp = self.worker.get_next_write_timestamp(0)
-        end = (datetime.utcnow() + timedelta(seconds=6)).isoformat()
-        self.assertTrue(start < timestamp < end)
-
-        self.assert_write_timestamp("1970-01-01T00:00:05", 0, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:05", 0, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 9)
-
-        self.assert_write_timestamp("1970-01-01T00:00:05", 2, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 2, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 2, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:15", 2, 9)
-
-        self.assert_write_timestamp("1970-01-01T00:03:25", 101, 100)
-        self.assert_write_timestamp("1970-01-01T00:03:30", 101, 104)
-        self.assert_write_timestamp("1970-01-01T00:03:30", 101, 105)
-        self.assert_write_timestamp("1970-01-01T00:03:35", 101, 109)
-
-    def test_write_timestamp_granularity(self):
-        """
-        We need granular timestamps with assorted granularity.
-        """
-        self.worker.GRANULARITY = 10
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 9)
-        self.assert_write_timestamp("1970-01-01T00:00:20", 0, 11)
-
-        self.assert_write_timestamp("1970-01-01T00:00:20", 12, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:20", 12, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:20", 12, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:30", 12, 9)
-        self.assert_write_timestamp("1970-01-01T00:00:30", 12, 11)
-
-        self.worker.GRANULARITY = 3
-        self.assert_write_timestamp("1970-01-01T00:00:03", 0, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:06", 0, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:06", 0, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:12", 0, 9)
-        self.assert_write_timestamp("1970-01-01T00:00:12", 0, 11)
-
-        self.assert_write_timestamp("1970-01-01T00:00:15", 12, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:18", 12, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:18", 12, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:24", 12, 9)
-        self.assert_write_timestamp("1970-01-01T00:00:24", 12, 11)
-
-    @inlineCallbacks
-    def test_store_read_timestamp(self):
-        """
-        We need to store granular timestamps.
-        """
-        timestamp1 = "1977-07-28T12:34:56"
-        timestamp2 = "1980-07-30T12:34:56"
-        timestamp3 = "1980-09-02T12:34:56"
-        yield self.assert_stored_timestamps()
-        yield self.worker.store_read_timestamp(timestamp2)
-        yield self.assert_stored_timestamps(timestamp2)
-        yield self.worker.store_read_timestamp(timestamp1)
-        yield self.assert_stored_timestamps(timestamp1, timestamp2)
-        yield self.worker.store_read_timestamp(timestamp3)
-        yield self.assert_stored_timestamps(timestamp1, timestamp2, timestamp3)
-
-    @inlineCallbacks
-    def test_read_timestamp(self):
-        """
-        We need to read the next timestamp.
-        """
-        past = mktimestamp(-10)
-        future = mktimestamp(10)
-        yield self.assert_equal_d(None, self.worker.get_next_read_timestamp())
-        yield self.worker.store_read_timestamp(future)
-        yield self.assert_equal_d(None, self.worker.get_next_read_timestamp())
-        yield self.worker.store_read_timestamp(past)
-        yield self.assert_equal_d(past, self.worker.get_next_read_timestamp())
-
     @inlineCallbacks
     def test_store_retry(self):
         """
         Store a retry in redis and make sure we can get at it again.
         """
-        timestamp = "1970-01-01T00:00:05"
-        retry_key = "retry_keys." + timestamp
         key = yield self.store_failure()
-        yield self.assert_zcard(0, 'retry_timestamps')
-
-        yield self.worker.store_retry(key, 0, now=0)
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_equal_d([timestamp],
-                                  self.redis.zrange('retry_timestamps', 0, 0))
-        yield self.assert_equal_d(set([key]), self.redis.smembers(retry_key))
-
-    def test_get_retry_key_none(self):
-        """
-        If there are no stored retries, get None.
-        """
-        return self.assert_get_retry_key(False)
-
-    @inlineCallbacks
-    def test_get_retry_key_future(self):
-        """
-        If there are no retries due, get None.
-        """
-        yield self.store_retry(10)
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_get_retry_key(False)
-        yield self.assert_zcard(1, 'retry_timestamps')
-
-    @inlineCallbacks
-    def test_get_retry_key_one_due(self):
-        """
-        Get a retry from redis when we have one due.
-        """
-        yield self.store_retry(0, -5)
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_get_retry_key()
-        yield self.assert_zcard(0, 'retry_timestamps')
-        yield self.assert_get_retry_key(False)
-
-    @inlineCallbacks
-    def test_get_retry_key_two_due(self):
-        """
-        Get a retry from redis when we have two due.
-        """
-        yield self.store_retry(0, -5)
-        yield self.store_retry(0, -5)
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_get_retry_key()
-        yield self.assert_zcard(1, 'retry_timestamps')
+        yield self.assert_retry_keys()
+        yield self.worker.store_retry(key, 5, now=0)
+        yield self.assert_retry_keys(key)
+        yield self.assert_equal_d(
+            5.0, self.worker.retry_queue.get_due(key))
 
     @inlineCallbacks
-    def test_get_retry_key_two_due_different_times(self):
+    def test_store_failure_with_retry_delay(self):
         """
-        Get a retry from redis when we have two due at different times.
+        Storing a failure with a retry delay schedules a retry.
         """
-        yield self.store_retry(0, -5)
-        yield self.store_retry(0, -15)
-        yield self.assert_zcard(2, 'retry_timestamps')
-        yield self.assert_get_retry_key()
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_get_retry_key()
-        yield self.assert_zcard(0, 'retry_timestamps')
+        key = yield self.worker.store_failure(
+            {'message': 'foo'}, "reason", retry_delay=10)
+        yield self.assert_retry_keys(key)
+        due = yield self.worker.retry_queue.get_due(key)
+        self.assertTrue(time.time() < due <= time.time() + 10)
 
     @inlineCallbacks
-    def test_get_retry_key_one_due_one_future(self):
-        """
-        Get a retry from redis when we have one due and one in the future.
-        """
-        yield self.store_retry(0, -5)
-        yield self.worker.store_retry(self.store_failure(), 0)
-        yield self.assert_zcard(2, 'retry_timestamps')
-        yield self.assert_get_retry_key()
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_get_retry_key(False)
-        yield self.assert_zcard(1, 'retry_timestamps')
+    def test_migrate_bucketed_retries(self):
+        """
+        Retries stored in per-timestamp buckets by older versions of the
+        worker are moved into the retry queue.
+        """
+        key1 = yield self.store_failure()
+        key2 = yield self.store_failure()
+        yield self.redis.sadd("retry_keys.1970-01-01T00:00:05", key1)
+        yield self.redis.zadd('retry_timestamps', **{
+            "1970-01-01T00:00:05": 5})
+        yield self.redis.sadd("retry_keys.1970-01-01T00:00:10", key2)
+        yield self.redis.zadd('retry_timestamps', **{
+            "1970-01-01T00:00:10": 10})
+        yield self.worker.migrate_bucketed_retries()
+        yield self.assert_retry_keys(key1, key2)
+        yield self.assert_equal_d(
+            10.0, self.worker.retry_queue.get_due(key2))
+        yield self.assert_equal_d(0, self.redis.zcard('retry_timestamps'))
+        yield self.assert_equal_d(
+            False, self.redis.exists("retry_keys.1970-01-01T00:00:05"))
 
     @inlineCallbacks
     def test_deliver_retries_none(self):
@@ -299,36 +161,73 @@ class TestFailureWorker(VumiTestCase):
         """
         Delivering no current retries should do nothing.
         """
-        yield self.worker.store_retry(self.store_failure(), 0)
+        key = yield self.store_retry(10)
         yield self.worker.deliver_retries()
         self.assert_published_retries([])
+        yield self.assert_retry_keys(key)
 
     @inlineCallbacks
     def test_deliver_retries_one_due(self):
         """
         Delivering a current retry should deliver one message.
         """
-        yield self.store_retry(0, -5)
+        key = yield self.store_retry(-5)
         yield self.worker.deliver_retries()
         self.assert_published_retries([{
                     'message': 'foo',
                     'reason': 'bad stuff happened',
                     }])
+        yield self.assert_retry_keys()
+        # The failure is deleted once the retry has been published.
+        yield self.assert_equal_d({}, self.worker.get_failure(key))
 
     @inlineCallbacks
     def test_deliver_retries_many_due(self):
         """
         Delivering current retries should deliver all messages.
         """
-        yield self.store_retry(0, -5)
-        yield self.store_retry(0, -15)
-        yield self.store_retry(0, -5)
+        yield self.store_retry(-5)
+        yield self.store_retry(-15)
+        yield self.store_retry(-5)
         yield self.worker.deliver_retries()
         self.assert_published_retries([{
                     'message': 'foo',
                     'reason': 'bad stuff happened',
                     }] * 3)
 
+    @inlineCallbacks
+    def test_deliver_retries_destination_concurrency(self):
+        """
+        Retries for the same destination are limited by
+        ``retry_destination_concurrency``.
+        """
+        self.worker.DESTINATION_CONCURRENCY = 1
+        in_flight = []
+        max_in_flight = []
+        publisher = self.worker.retry_publisher
+        publish_raw = publisher.publish_raw
+
+        def slow_publish_raw(data):
+            to_addr = json.loads(data)['to_addr']
+            in_flight.append(to_addr)
+            max_in_flight.append(in_flight.count(to_addr))
+
+            def publish():
+                in_flight.remove(to_addr)
+                return publish_raw(data)
+            return deferLater(reactor, 0, publish)
+
+        self.patch(publisher, 'publish_raw', slow_publish_raw)
+        for to_addr in ['+1', '+1', '+2', '+1']:
+            yield self.store_retry(-5, message={'to_addr': to_addr})
+        yield self.worker.deliver_retries()
+        self.assertEqual(max(max_in_flight), 1)
+        self.assertEqual(self.worker._destination_semaphores, {})
+        msgs = self.worker_helper.get_dispatched(
+            'sms.outbound', 'sphex', Message)
+        self.assertEqual(
+            sorted(m['to_addr'] for m in msgs), ['+1', '+1', '+1', '+2'])
+
     def test_update_retry_metadata(self):
         """
         Retry metadata should be updated as appropriate.
@@ -350,9 +249,156 @@ class TestFailureWorker(VumiTestCase):
         """
         The retry publisher should start when configured appropriately.
         """
-        self.assertEqual(None, self.worker.delivery_loop)
+        self.assertFalse(self.worker.retry_queue.is_running)
         yield self.worker.stopWorker()
         yield self.make_worker(1)
-        self.assertEqual(self.worker.deliver_retries,
-                         self.worker.delivery_loop.f)
-        self.assertTrue(self.worker.delivery_loop.running)
+        self.assertTrue(self.worker.retry_queue.is_running)
+
+    @inlineCallbacks
+    def test_metrics(self):
+        """
+        Retry queue metrics are published if a metrics prefix is set.
+        """
+        self.assertEqual(None, self.worker.metrics)
+        yield self.worker.stopWorker()
+        yield self.make_worker(metrics_prefix='vumi.test.failures.')
+        self.assertTrue('retries.depth' in self.worker.metrics)
+        self.assertTrue('retries.lag' in self.worker.metrics)
+
+    @inlineCallbacks
+    def test_metrics_direct(self):
+        """
+        Metrics are published directly if ``direct_metrics`` is set.
+        """
+        yield self.worker.stopWorker()
+        yield self.make_worker(
+            metrics_prefix='vumi.test.failures.',
+            direct_metrics={'host': '127.0.0.1', 'port': 2003})
+        publisher = self.worker.metrics.direct_publisher
+        self.assertNotEqual(publisher, None)
+        yield self.worker.stopWorker()
+        self.assertEqual(publisher._udp_port, None)
+
+    @inlineCallbacks
+    def test_store_failure_dead_letter(self):
+        """
+        Failures that won't be retried are added to the dead letter store
+        with a TTL.
+        """
+        key = yield self.store_failure()
+        yield self.assert_equal_d([key], self.worker.dead_letters.keys())
+        ttl = yield self.redis.ttl(key)
+        self.assertTrue(0 < ttl <= self.worker.DEAD_LETTER_TTL)
+
+    @inlineCallbacks
+    def test_dead_letters_max_size(self):
+        """
+        The oldest dead letters are deleted when there are too many.
+        """
+        self.worker.dead_letters.max_size = 2
+        key1 = yield self.store_failure()
+        key2 = yield self.store_failure()
+        key3 = yield self.store_failure()
+        yield self.assert_equal_d(
+            [key2, key3], self.worker.dead_letters.keys())
+        yield self.assert_equal_d({}, self.worker.get_failure(key1))
+
+    @inlineCallbacks
+    def test_dead_letters_ttl(self):
+        """
+        Dead letters older than the TTL aren't kept and are dropped from the
+        index when new dead letters are added.
+        """
+        self.worker.dead_letters.ttl = 60
+        key1 = yield self.store_failure()
+        yield self.worker.dead_letters.add(key1, time.time() - 61)
+        yield self.assert_equal_d({}, self.worker.get_failure(key1))
+        yield self.redis.zadd('dead_letters', **{'stale': time.time() - 61})
+        key2 = yield self.store_failure()
+        yield self.assert_equal_d([key2], self.worker.dead_letters.keys())
+
+    @inlineCallbacks
+    def test_requeue_dead_letters(self):
+        """
+        Dead letters can be requeued for retrying.
+        """
+        key1 = yield self.store_failure()
+        key2 = yield self.store_failure()
+        key3 = yield self.store_failure()
+        yield self.redis.delete(key2)
+        requeued = yield self.worker.requeue_dead_letters(limit=2)
+        self.assertEqual(requeued, [key1])
+        yield self.assert_retry_keys(key1)
+        yield self.assert_equal_d([key3], self.worker.dead_letters.keys())
+        # The requeued failure no longer expires.
+        self.assertFalse((yield self.redis.ttl(key1)) > 0)
+        yield self.worker.deliver_retries()
+        self.assert_published_retries([{
+                    'message': 'foo',
+                    'reason': 'bad stuff happened',
+                    }])
+
+    @inlineCallbacks
+    def test_do_retry_jitter(self):
+        """
+        Retry delays are reduced by a random fraction of up to the jitter.
+        """
+        self.patch(random, 'random', lambda: 0.5)
+        key = yield self.worker.do_retry(
+            {'retry_metadata': {'retries': 1, 'delay': 10}}, "reason")
+        failure = yield self.worker.get_failure(key)
+        self.assertEqual(failure['retry_delay'], '22.5')
+        yield self.assert_retry_keys(key)
+
+    @inlineCallbacks
+    def test_do_retry_max_retries(self):
+        """
+        Messages that have been retried too often become dead letters.
+        """
+        self.worker.MAX_RETRIES = 2
+        key = yield self.worker.do_retry(
+            {'retry_metadata': {'retries': 1, 'delay': 1}}, "reason")
+        yield self.assert_retry_keys(key)
+        key = yield self.worker.do_retry(
+            {'retry_metadata': {'retries': 2, 'delay': 3}}, "reason")
+        yield self.assert_equal_d([key], self.worker.dead_letters.keys())
+
+    @inlineCallbacks
+    def test_migrate_failure_keys(self):
+        """
+        Failures listed in the old ``failure_keys`` set are moved into the
+        dead letter store unless they were retried.
+        """
+        dead_key = self.worker.failure_key()
+        retried_key = self.worker.failure_key()
+        retrying_key = self.worker.failure_key()
+        yield self.redis.hmset(dead_key, {'retry_delay': '0'})
+        yield self.redis.hmset(retried_key, {'retry_delay': '1'})
+        yield self.redis.hmset(retrying_key, {'retry_delay': '1'})
+        yield self.worker.store_retry(retrying_key, 1)
+        for key in [dead_key, retried_key, retrying_key, 'missing']:
+            yield self.redis.sadd('failure_keys', key)
+        yield self.worker.migrate_failure_keys()
+        yield self.assert_equal_d(
+            [dead_key], self.worker.dead_letters.keys())
+        yield self.assert_equal_d({}, self.worker.get_failure(retried_key))
+        yield self.assert_retry_keys(retrying_key)
+        yield self.assert_equal_d(False, self.redis.exists('failure_keys'))
+
+    @inlineCallbacks
+    def test_process_message_counts_failures(self):
+        """
+        Failures are counted by failure code.
+        """
+        yield self.worker.stopWorker()
+        yield self.make_worker(metrics_prefix='vumi.test.failures.')
+        for failure_code in ['temporary', 'permanent', 'temporary', None]:
+            yield self.worker.process_message(FailureMessage(
+                message={'message': 'foo'}, failure_code=failure_code,
+                reason="reason"))
+        yield self.assert_equal_d({
+            'temporary': 2, 'permanent': 1, 'unspecified': 1,
+        }, self.worker.get_failure_counts())
+        self.assertEqual(
+            [value for _, value
+             in self.worker.metrics['failures.temporary'].poll()], [1, 1])
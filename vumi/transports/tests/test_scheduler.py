@@ -1,28 +1,27 @@
+
 import time
 from datetime import datetime
 
 from twisted.internet.defer import inlineCallbacks
 
-from vumi.persist.fake_redis import FakeRedis
 from vumi.transports.scheduler import Scheduler
 from vumi.message import TransportUserMessage
 from vumi.utils import to_kwargs
-from vumi.tests.helpers import VumiTestCase, MessageHelper
+from vumi.tests.helpers import VumiTestCase, MessageHelper, PersistenceHelper
 
 
 class TestScheduler(VumiTestCase):
 
+    @inlineCallbacks
     def setUp(self):
-        self.r_server = FakeRedis()
-        self.scheduler = Scheduler(self.r_server, self._scheduler_callback)
-        self.add_cleanup(self.stop_scheduler)
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        yield self.redis._purge_all()  # Just in case
+        self.scheduler = Scheduler(self.redis, self._scheduler_callback)
+        self.add_cleanup(self.scheduler.stop)
         self._delivery_history = []
         self.msg_helper = self.add_helper(MessageHelper())
 
-    def stop_scheduler(self):
-        if self.scheduler.is_running:
-            self.scheduler.stop()
-
     def _scheduler_callback(self, scheduled_at, message):
         self._delivery_history.append((scheduled_at, message))
         return (scheduled_at, message)
@@ -37,35 +36,35 @@ class TestScheduler(VumiTestCase):
         self.assertEqual(number, len(self._delivery_history))
 
     def get_pending_messages(self):
-        scheduled_timestamps = self.scheduler.r_key('scheduled_timestamps')
-        return self.r_server.zrange(scheduled_timestamps, 0, -1)
+        return self.scheduler.queue.get_job_ids()
 
+    @inlineCallbacks
     def test_scheduling(self):
         msg = self.msg_helper.make_inbound("inbound")
         now = time.mktime(datetime(2012, 1, 1).timetuple())
         delta = 10  # seconds from now
-        key, bucket_key = self.scheduler.schedule(delta, msg.payload, now)
-        self.assertEqual(bucket_key, '%s#%s.%s' % (
-            self.scheduler.r_prefix,
-            'scheduled_keys',
-            self.scheduler.get_next_write_timestamp(delta, now)
-        ))
-        scheduled_key = self.scheduler.get_scheduled_key(now)
-        self.assertEqual(scheduled_key, None)
-        scheduled_time = now + delta
-        scheduled_key = self.scheduler.get_scheduled_key(scheduled_time)
-        self.assertTrue(scheduled_key)
-        self.assertEqual(set([scheduled_key]),
-                        self.scheduler.get_all_scheduled_keys())
+        key = yield self.scheduler.schedule(delta, msg.payload, now)
+        self.assertEqual(
+            (yield self.scheduler.queue.get_due(key)), now + delta)
+        self.assertEqual(set([key]),
+                         (yield self.scheduler.get_all_scheduled_keys()))
+        scheduled = yield self.scheduler.get_scheduled(key)
+        self.assertEqual(
+            sorted(scheduled.keys()), ['payload', 'scheduled_at'])
+
+    def test_scheduling_unencodable(self):
+        self.assertRaises(
+            TypeError, self.scheduler.schedule, 10, {'foo': object()})
 
     @inlineCallbacks
     def test_delivery_loop(self):
         msg = self.msg_helper.make_inbound("inbound")
         now = time.mktime(datetime(2012, 1, 1).timetuple())
         delta = 16  # seconds from now
-        self.scheduler.schedule(delta, msg.payload, now)
-        scheduled_time = now + delta + self.scheduler.granularity
-        yield self.scheduler.deliver_scheduled(scheduled_time)
+        yield self.scheduler.schedule(delta, msg.payload, now)
+        yield self.scheduler.deliver_scheduled(now + delta - 1)
+        self.assertNumDelivered(0)
+        yield self.scheduler.deliver_scheduled(now + delta)
         self.assertDelivered(msg)
 
     @inlineCallbacks
@@ -75,13 +74,13 @@ class TestScheduler(VumiTestCase):
             msg = self.msg_helper.make_inbound(
                 "inbound", message_id='message_%s' % (i,))
             delta = i * 10
-            key, _ = self.scheduler.schedule(delta, msg.payload, now)
-            scheduled_time = now + delta + self.scheduler.granularity
+            key = yield self.scheduler.schedule(delta, msg.payload, now)
             self.assertEqual(set([key]),
-                self.scheduler.get_all_scheduled_keys())
-            yield self.scheduler.deliver_scheduled(scheduled_time)
+                (yield self.scheduler.get_all_scheduled_keys()))
+            yield self.scheduler.deliver_scheduled(now + delta)
             self.assertNumDelivered(i + 1)
-            self.assertEqual(set(), self.scheduler.get_all_scheduled_keys())
+            self.assertEqual(
+                set(), (yield self.scheduler.get_all_scheduled_keys()))
 
     @inlineCallbacks
     def test_deliver_ancient_messages(self):
@@ -89,30 +88,35 @@ class TestScheduler(VumiTestCase):
         # been running since 1912
         msg = self.msg_helper.make_inbound("inbound")
         way_back = time.mktime(datetime(1912, 1, 1).timetuple())
-        scheduled_key, _ = self.scheduler.schedule(0, msg.payload, way_back)
+        scheduled_key = yield self.scheduler.schedule(
+            0, msg.payload, way_back)
         self.assertTrue(scheduled_key)
-        now = time.mktime(datetime.now().timetuple())
-        yield self.scheduler.deliver_scheduled(now)
-        self.assertEqual(set([scheduled_key]),
-            self.scheduler.get_all_scheduled_keys())
-        self.assertEqual(len(self.get_pending_messages()), 1)
-        yield self.scheduler.deliver_scheduled(
-            way_back + self.scheduler.granularity)
+        self.assertEqual(len((yield self.get_pending_messages())), 1)
+        yield self.scheduler.deliver_scheduled()
         self.assertDelivered(msg)
-        self.assertEqual(self.get_pending_messages(), [])
-        self.assertEqual(set(), self.scheduler.get_all_scheduled_keys())
+        self.assertEqual((yield self.get_pending_messages()), [])
+        self.assertEqual(
+            set(), (yield self.scheduler.get_all_scheduled_keys()))
 
     @inlineCallbacks
     def test_clear_scheduled_messages(self):
         msg = self.msg_helper.make_inbound("inbound")
-        now = time.mktime(datetime.now().timetuple())
-        scheduled_time = now + self.scheduler.granularity
-        key, bucket = self.scheduler.schedule(0, msg.payload, scheduled_time)
-        self.assertEqual(len(self.get_pending_messages()), 1)
+        key = yield self.scheduler.schedule(0, msg.payload)
+        self.assertEqual(len((yield self.get_pending_messages())), 1)
         self.assertEqual(set([key]),
-            self.scheduler.get_all_scheduled_keys())
-        self.scheduler.clear_scheduled(key)
+            (yield self.scheduler.get_all_scheduled_keys()))
+        yield self.scheduler.clear_scheduled(key)
         yield self.scheduler.deliver_scheduled()
-        self.assertEqual(self.r_server.hgetall(key), {})
-        self.assertEqual(self.r_server.smembers(bucket), set())
+        self.assertEqual((yield self.scheduler.get_scheduled(key)), None)
+        self.assertEqual((yield self.get_pending_messages()), [])
         self.assertNumDelivered(0)
+
+    @inlineCallbacks
+    def test_start_and_stop(self):
+        msg = self.msg_helper.make_inbound("inbound")
+        yield self.scheduler.schedule(0, msg.payload)
+        self.scheduler.start()
+        self.assertTrue(self.scheduler.is_running)
+        yield self.scheduler.stop()
+        self.assertFalse(self.scheduler.is_running)
+        self.assertDelivered(msg)
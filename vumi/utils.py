@@ -6,6 +6,7 @@ import sys
 import base64
 import pkg_resources
 import warnings
+from collections import OrderedDict
 from functools import wraps
 
 from zope.interface import implements
@@ -558,3 +559,91 @@ class StatusEdgeDetector(object):
             self._add_type(component, type_)
             return True
         return False
+
+
+class LRUCache(object):
+    """A bounded mapping that discards the least recently used keys.
+
+    Lookups through :meth:`get` are counted as hits or misses.
+
+    :param int max_size:
+        The maximum number of keys to hold. A ``max_size`` of ``0`` disables
+        the cache entirely.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._metrics = None
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+        Return the value for ``key`` and mark it as recently used, or
+        ``default`` if it isn't cached.
+        """
+        if key not in self._data:
+            self._count(miss=True)
+            return default
+        value = self._data.pop(key)
+        self._data[key] = value
+        self._count(miss=False)
+        return value
+
+    def set(self, key, value):
+        """
+        Cache ``value`` for ``key``, discarding the least recently used key
+        if the cache is full.
+        """
+        if self.max_size <= 0:
+            return
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def hit_rate(self):
+        """
+        Return the fraction of lookups that were hits, or ``0.0`` if there
+        have been no lookups.
+        """
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def _count(self, miss):
+        if miss:
+            self.misses += 1
+        else:
+            self.hits += 1
+        if self._metrics is not None:
+            hits, misses = self._metrics
+            (misses if miss else hits).inc()
+
+    def register_metrics(self, manager, name):
+        """Publish cache statistics with a
+        :class:`vumi.blinkenlights.metrics.MetricManager`.
+
+        This registers ``<name>.hits`` and ``<name>.misses`` counters and a
+        ``<name>.hit_rate`` metric holding the hit rate since the previous
+        time metrics were published.
+        """
+        from vumi.blinkenlights.metrics import Count, CacheHitRate
+        self._metrics = (
+            manager.register(Count("%s.hits" % (name,))),
+            manager.register(Count("%s.misses" % (name,))))
+        manager.register(CacheHitRate("%s.hit_rate" % (name,), self))
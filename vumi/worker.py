@@ -15,11 +15,15 @@ from vumi.middleware import setup_middlewares_from_config
 from vumi.connectors import (
     ReceiveInboundConnector, ReceiveOutboundConnector,
     PublishStatusConnector, ReceiveStatusConnector)
-from vumi.config import Config, ConfigInt
+from vumi.config import Config, ConfigDict, ConfigInt, ConfigText
 from vumi.errors import DuplicateConnectorError
-from vumi.utils import generate_worker_id
+from vumi.utils import generate_worker_id, LRUCache
 from vumi.blinkenlights.heartbeat import (HeartBeatPublisher,
                                           HeartBeatMessage)
+from vumi.blinkenlights.metrics_direct import (
+    start_metric_manager, stop_metric_manager)
+from vumi.blinkenlights.profiler import WorkerProfiler, ProfilerResource
+from vumi.blinkenlights.worker_metrics import WorkerMetrics
 
 
 def then_call(d, func, *args, **kw):
@@ -36,6 +40,35 @@ class BaseConfig(Config):
         "The number of messages fetched concurrently from each AMQP queue"
         " by each worker instance.",
         default=20, static=True)
+    worker_metrics_prefix = ConfigText(
+        "If set, reactor lag, consumer backlog, memory use and publish"
+        " latency metrics are published with this prefix and included in"
+        " heartbeats.",
+        static=True)
+    profiler_web_port = ConfigInt(
+        "If set, the worker profiler's HTTP interface is served on this port"
+        " under `/profiler`.",
+        static=True)
+    profiler_control_queue = ConfigText(
+        "If set, profiler commands (`start`, `stop` or `dump`) are consumed"
+        " from this routing key.",
+        static=True)
+    profiler_dump_dir = ConfigText(
+        "The directory the profiler `dump` command writes sampled stacks to."
+        " Dump filenames may not contain path separators. If unset, the"
+        " `dump` command is disabled.",
+        static=True)
+    direct_metrics = ConfigDict(
+        "If set, metrics from the metric managers this worker starts (such as"
+        " the worker and profiler metrics) are aggregated in-process and"
+        " sent straight to a Graphite or statsd server instead of over AMQP."
+        " See `vumi.blinkenlights.metrics_direct.DirectMetricPublisher."
+        "from_config` for the keys.",
+        static=True)
+    profiler_metrics_prefix = ConfigText(
+        "If set, handler timings and reactor lag measured by the profiler"
+        " are published as metrics with this prefix.",
+        static=True)
 
 
 class BaseWorker(Worker):
@@ -48,13 +81,27 @@ class BaseWorker(Worker):
 
     CONFIG_CLASS = BaseConfig
 
+    #: Message fields that per-message config depends on. Config objects
+    #: are cached for each distinct combination of values of these fields.
+    #: Workers whose config depends on messages in other ways should
+    #: override :meth:`get_config_cache_key`.
+    CONFIG_MESSAGE_FIELDS = ()
+
+    #: The maximum number of per-message config objects to cache.
+    CONFIG_CACHE_SIZE = 1000
+
     def __init__(self, options, config=None):
         super(BaseWorker, self).__init__(options, config=config)
         self.connectors = {}
         self.middlewares = []
         self._static_config = self.CONFIG_CLASS(self.config, static=True)
+        self._config_cache = LRUCache(self.CONFIG_CACHE_SIZE)
         self._hb_pub = None
         self._worker_id = None
+        self.worker_metrics = None
+        self.profiler = None
+        self._profiler_resource = None
+        self._profiler_consumer = None
         self.log = WrappingLogger(system=self.config.get('worker_name'))
 
     def startWorker(self):
@@ -63,6 +110,8 @@ class BaseWorker(Worker):
             % (self.__class__.__name__, self.config))
         d = maybeDeferred(self._validate_config)
         then_call(d, self.setup_heartbeat)
+        then_call(d, self.setup_worker_metrics)
+        then_call(d, self.setup_profiler)
         then_call(d, self.setup_middleware)
         then_call(d, self.setup_connectors)
         then_call(d, self.setup_worker)
@@ -74,6 +123,8 @@ class BaseWorker(Worker):
         then_call(d, self.teardown_worker)
         then_call(d, self.teardown_connectors)
         then_call(d, self.teardown_middleware)
+        then_call(d, self.teardown_profiler)
+        then_call(d, self.teardown_worker_metrics)
         then_call(d, self.teardown_heartbeat)
         return d
 
@@ -116,6 +167,8 @@ class BaseWorker(Worker):
             'timestamp': time.time(),
             'pid': os.getpid(),
         }
+        if self.worker_metrics is not None:
+            attrs['stats'] = self.worker_metrics.stats()
         attrs.update(self.custom_heartbeat_attrs())
         return attrs
 
@@ -123,6 +176,70 @@ class BaseWorker(Worker):
         """Worker subclasses can override this to add custom attributes"""
         return {}
 
+    @inlineCallbacks
+    def setup_worker_metrics(self):
+        config = self.get_static_config()
+        if config.worker_metrics_prefix is None:
+            return
+        metrics = yield start_metric_manager(
+            self, config.worker_metrics_prefix,
+            direct_config=config.direct_metrics, preaggregate=True)
+        self.worker_metrics = WorkerMetrics(self, metrics)
+        self.worker_metrics.start()
+
+    @inlineCallbacks
+    def teardown_worker_metrics(self):
+        if self.worker_metrics is not None:
+            worker_metrics, self.worker_metrics = self.worker_metrics, None
+            worker_metrics.stop()
+            yield stop_metric_manager(worker_metrics.metrics)
+
+    @inlineCallbacks
+    def setup_profiler(self):
+        """Create the worker profiler and its control interfaces.
+
+        The profiler only starts collecting data when it's told to, either
+        through the HTTP interface on `profiler_web_port` or a command
+        consumed from `profiler_control_queue`.
+        """
+        config = self.get_static_config()
+        metrics = None
+        if config.profiler_metrics_prefix is not None:
+            metrics = yield start_metric_manager(
+                self, config.profiler_metrics_prefix,
+                direct_config=config.direct_metrics, preaggregate=True)
+        self.profiler = WorkerProfiler(
+            self, metrics, dump_dir=config.profiler_dump_dir)
+        if config.profiler_web_port is not None:
+            self._profiler_resource = yield self.start_web_resources([
+                (ProfilerResource(self.profiler), 'profiler'),
+            ], config.profiler_web_port)
+        if config.profiler_control_queue is not None:
+            self._profiler_consumer = yield self.consume(
+                config.profiler_control_queue, self.consume_profiler_command)
+
+    @inlineCallbacks
+    def teardown_profiler(self):
+        if self._profiler_consumer is not None:
+            yield self._profiler_consumer.stop()
+            self._profiler_consumer = None
+        if self._profiler_resource is not None:
+            yield self._profiler_resource.loseConnection()
+            self._profiler_resource = None
+        if self.profiler is not None:
+            profiler, self.profiler = self.profiler, None
+            profiler.stop()
+            if profiler.metrics is not None:
+                yield stop_metric_manager(profiler.metrics)
+
+    def consume_profiler_command(self, msg):
+        try:
+            status = self.profiler.handle_command(msg.payload)
+        except ValueError as e:
+            self.log.warning("Ignoring profiler command %r: %s" % (msg, e))
+            return
+        self.log.msg("Profiler status: %r" % (status,))
+
     def teardown_connectors(self):
         d = succeed(None)
         for connector_name in self.connectors.keys():
@@ -158,8 +275,55 @@ class BaseWorker(Worker):
         It deliberately returns a deferred even when this isn't strictly
         necessary to ensure that workers will continue to work when per-message
         configuration needs to be fetched from elsewhere.
+
+        Config objects are built by :meth:`build_config` and cached under
+        the key returned by :meth:`get_config_cache_key`.
         """
-        return succeed(self.CONFIG_CLASS(self.config))
+        key = self.get_config_cache_key(msg, ctxt)
+        if key is None:
+            return maybeDeferred(self.build_config, msg, ctxt)
+        config = self._config_cache.get(key)
+        if config is not None:
+            return succeed(config)
+        d = maybeDeferred(self.build_config, msg, ctxt)
+        d.addCallback(self._cache_config, key)
+        return d
+
+    def _cache_config(self, config, key):
+        self._config_cache.set(key, config)
+        return config
+
+    def build_config(self, msg, ctxt=None):
+        """Build a message and context specific config object.
+
+        Subclasses with dynamic config should override this rather than
+        :meth:`get_config` so that the result is cached. This may return a
+        deferred.
+        """
+        return self.CONFIG_CLASS(self.config)
+
+    def get_config_cache_key(self, msg, ctxt=None):
+        """Return a hashable key identifying the config for a message.
+
+        Messages with the same key share a config object. The default key
+        is made up of the values of the :attr:`CONFIG_MESSAGE_FIELDS` in the
+        message. Return ``None`` to skip the cache. Configs built for a
+        ``ctxt`` are never cached.
+        """
+        if ctxt is not None:
+            return None
+        if msg is None:
+            return (None,) * len(self.CONFIG_MESSAGE_FIELDS)
+        return tuple(msg.get(field) for field in self.CONFIG_MESSAGE_FIELDS)
+
+    def invalidate_config(self):
+        """Discard cached config objects.
+
+        This should be called whenever `self.config` (or anything else that
+        :meth:`build_config` uses) changes.
+        """
+        self._static_config = self.CONFIG_CLASS(self.config, static=True)
+        self._config_cache.clear()
 
     def _validate_config(self):
         """Once subclasses call `super().validate_config` properly,
@@ -190,6 +354,10 @@ class BaseWorker(Worker):
                                   prefetch_count=prefetch_count,
                                   middlewares=middlewares)
         self.connectors[connector_name] = connector
+        if self.worker_metrics is not None:
+            self.worker_metrics.instrument_connector(connector)
+        if self.profiler is not None:
+            self.profiler.instrument_connector(connector)
 
         d = connector.setup()
         d.addCallback(lambda r: connector)